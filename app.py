@@ -1,44 +1,182 @@
 # /home/DanDev/terrarium_webapp/app.py
 # --- Imports ---
-from flask import Flask, render_template, jsonify, request, session, redirect, url_for, abort
-import mysql.connector
-from mysql.connector import Error
+from flask import Flask, render_template, jsonify, request, session, redirect, url_for, abort, g
 import os
 from datetime import datetime, date, timedelta, time as time_obj # Added time as time_obj and timedelta
 import math
-from collections import defaultdict
+from collections import defaultdict, Counter
 from decimal import Decimal
 from werkzeug.security import generate_password_hash, check_password_hash
 import secrets
-import logging
 from functools import wraps
+from contextlib import contextmanager
 import json
+import time
+import gzip
+import fcntl
+import sqlite3
+import hashlib
+import base64
+import terrarium_logging
+import terrarium_storage
+import terrarium_metrics
+import terrarium_profiler
+import terrarium_slow_queries
+import terrarium_singleflight
+import reading_stats
+from chart_layout import chart_anchor, chart_payload, CHART_HOLD_LOOKBACK
+import random
+from terrarium_storage import StorageError, DuplicateEntry, StillReferenced, UnknownDevice
+try:
+    import brotli
+except ImportError:
+    brotli = None # Optional: 'br' is only offered to browsers when installed
 
 app = Flask(__name__)
 
 # --- Logging Configuration ---
-logging.basicConfig(level=logging.DEBUG)
+# Queue-based logging: records are formatted and written on a background thread, levels come from
+# TERRARIUM_LOG_LEVEL / TERRARIUM_LOG_LEVELS (e.g. "app=DEBUG,werkzeug=WARNING")
+terrarium_logging.setup_logging()
 
 # --- Secret Key Configuration ---
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', secrets.token_hex(16))
-app.logger.info(f"Flask secret key {'loaded from env' if os.environ.get('FLASK_SECRET_KEY') else 'generated dynamically'}.")
+app.logger.info("Flask secret key %s.", 'loaded from env' if os.environ.get('FLASK_SECRET_KEY') else 'generated dynamically')
 
-# --- Database Configuration ---
+# --- Storage Configuration ---
+# TERRARIUM_STORAGE picks the backend (see terrarium_storage.py): mariadb (default), sqlite (TERRARIUM_SQLITE_PATH)
+# or memory (per process, not persisted; single worker only)
 DB_HOST = 'localhost'; DB_USER = 'terrarium_user'; DB_PASSWORD = 'Life4588'; DB_NAME = 'terrarium_data'
-app.logger.info(f"Database configured for {DB_USER}@{DB_HOST}/{DB_NAME}")
+STORAGE_BACKEND = os.environ.get('TERRARIUM_STORAGE', 'mariadb')
+SQLITE_PATH = os.environ.get('TERRARIUM_SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'terrarium_data.sqlite3'))
+storage = terrarium_storage.open_storage(STORAGE_BACKEND, mariadb={'host': DB_HOST, 'user': DB_USER, 'password': DB_PASSWORD, 'database': DB_NAME}, sqlite_path=SQLITE_PATH)
+app.logger.info("Storage backend: %s", storage.describe())
+
+# --- Metrics ---
+# Prometheus text format at /metrics, summed over all gunicorn workers (see terrarium_metrics.py)
+terrarium_metrics.define('terrarium_http_requests_total', 'counter', "HTTP requests by route, method and status.")
+terrarium_metrics.define('terrarium_http_request_duration_seconds', 'histogram', "HTTP request latency by route and method.")
+terrarium_metrics.define('terrarium_http_requests_in_flight', 'gauge', "HTTP requests being handled right now.")
+terrarium_metrics.define('terrarium_db_connect_seconds', 'histogram', "Time to open a database connection.")
+terrarium_metrics.define('terrarium_db_query_duration_seconds', 'histogram', "Storage operation time by operation (query) name.")
+terrarium_metrics.define('terrarium_db_statement_duration_seconds', 'histogram', "SQL statement time by statement name (see terrarium_slow_queries.py).")
+terrarium_metrics.define('terrarium_db_errors_total', 'counter', "Failed storage operations by operation (query) name.")
+terrarium_metrics.define('terrarium_chart_rows_fetched', 'histogram', "Rows (aggregated intervals) fetched per chart request.", buckets=(10, 50, 100, 250, 500, 1000, 2500, 5000))
+terrarium_metrics.define('terrarium_coalesced_requests_total', 'counter', "Chart/latest computations by outcome: computed, merged_process, merged_worker, wait_timeout.")
+terrarium_metrics.define('terrarium_readings_ingested_total', 'counter', "Readings stored, by device (devices.id; never the unique ID, which devices use as their credential).")
+
+def instrument_storage(storage):
+    """Times every Storage interface call (the operation name is the 'query' label) and each new connection."""
+    backend = (('backend', storage.name),)
+    def timed_operation(name, operation):
+        labels = backend + (('query', name),)
+        @wraps(operation)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try: return operation(*args, **kwargs)
+            except StorageError: terrarium_metrics.inc('terrarium_db_errors_total', labels); raise
+            finally: terrarium_metrics.observe('terrarium_db_query_duration_seconds', time.perf_counter() - started, labels)
+        return wrapper
+    for name, member in vars(terrarium_storage.Storage).items():
+        if callable(member) and not name.startswith('_') and name not in ('describe', 'observe_connect', 'statement_done', 'observe_statement'):
+            setattr(storage, name, timed_operation(name, getattr(storage, name)))
+    storage.connect_observer = lambda seconds: terrarium_metrics.observe('terrarium_db_connect_seconds', seconds, backend)
+    storage.statement_observer = lambda name, seconds: terrarium_metrics.observe('terrarium_db_statement_duration_seconds', seconds, backend + (('statement', name),))
+    return storage
+
+storage = instrument_storage(storage)
+terrarium_singleflight.outcome_observer = lambda name, outcome: terrarium_metrics.inc('terrarium_coalesced_requests_total', (('kind', name), ('outcome', outcome)))
+
+@app.before_request
+def metrics_request_started():
+    g.metrics_started = time.perf_counter(); terrarium_metrics.inc('terrarium_http_requests_in_flight')
+
+@app.after_request
+def metrics_request_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def metrics_request_finished(exc):
+    """Runs for every request, also after an unhandled exception (counted as 500)."""
+    if 'metrics_started' not in g: return
+    terrarium_metrics.inc('terrarium_http_requests_in_flight', amount=-1)
+    labels = (('route', request.url_rule.rule if request.url_rule else 'unmatched'), ('method', request.method)) # Route template, not the path: bounded label values
+    terrarium_metrics.observe('terrarium_http_request_duration_seconds', time.perf_counter() - g.metrics_started, labels)
+    terrarium_metrics.inc('terrarium_http_requests_total', labels + (('status', str(g.get('metrics_status', 500))),))
+
+# --- Admin (operator) access ---
+# Operator-only endpoints (/metrics, /admin/*) and request profiling need header X-Admin-Token: <TERRARIUM_ADMIN_TOKEN>,
+# or Authorization: Bearer <TERRARIUM_ADMIN_TOKEN> (what a Prometheus scrape config sends). Unset = disabled.
+ADMIN_TOKEN = os.environ.get('TERRARIUM_ADMIN_TOKEN', '')
+
+def admin_token_ok(headers):
+    """True if the request headers (Flask or Starlette) carry the admin token."""
+    authorization = headers.get('Authorization', '')
+    token = authorization[7:] if authorization[:7].lower() == 'bearer ' else headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def admin_required(f):
+    """Decorator for operator endpoints (see ADMIN_TOKEN)."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not admin_token_ok(request.headers):
+            app.logger.warning("Rejected admin request to %s from %s.", request.path, request.remote_addr)
+            return jsonify({'success': False, 'message': 'Admin token required.'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
 
-# --- Database Connection ---
-def get_db_connection():
-    conn = None
-    try:
-        conn = mysql.connector.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, database=DB_NAME, connect_timeout=5)
-        if conn.is_connected():
-            app.logger.debug("Database connection successful.")
-            return conn
-    except Error as e:
-        app.logger.error(f"Error connecting to DB for web app: {e}")
-        if conn and conn.is_connected(): conn.close()
-    return None
+@app.route('/metrics')
+@admin_required # Route and device labels are not for everyone on the network
+def metrics():
+    return terrarium_metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# --- Request Profiling ---
+# Opt-in: a request with X-Admin-Token and "X-Profile: 1" (or a random TERRARIUM_PROFILE_SAMPLE_RATE share of all
+# requests) is sampled by terrarium_profiler and saved with its route and query parameters. Browse via /admin/profiles.
+def profile_requested(headers):
+    if headers.get('X-Profile') == '1' and admin_token_ok(headers): return True
+    return terrarium_profiler.PROFILE_SAMPLE_RATE > 0 and random.random() < terrarium_profiler.PROFILE_SAMPLE_RATE
+
+@app.before_request
+def profile_request_started():
+    if profile_requested(request.headers): g.profile_started = time.perf_counter(); g.profiler = terrarium_profiler.SamplingProfiler().start()
+
+@app.teardown_request
+def profile_request_finished(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is None: return
+    profiler.stop()
+    terrarium_profiler.save(profiler, request.url_rule.rule if request.url_rule else request.path, request.method, request.args.to_dict(),
+                            g.get('metrics_status', 500), time.perf_counter() - g.profile_started)
+
+@app.route('/admin/profiles')
+@admin_required
+def list_request_profiles():
+    """Stored profiles, newest first (summary only)."""
+    profiles = []
+    for name in reversed(terrarium_profiler.list_profiles()):
+        profile = terrarium_profiler.load_profile(name)
+        if profile is None: continue # Trimmed by another worker meanwhile
+        profiles.append({'name': name, **{key: profile.get(key) for key in ('time', 'route', 'method', 'params', 'status', 'duration_ms', 'samples')}})
+    return jsonify(profiles)
+
+@app.route('/admin/profiles/<name>')
+@admin_required
+def get_request_profile(name):
+    """Collapsed stacks (flamegraph.pl / speedscope input), or the whole profile with ?format=json."""
+    profile = terrarium_profiler.load_profile(name)
+    if profile is None: return jsonify({'success': False, 'message': 'Profile not found.'}), 404
+    if request.args.get('format') == 'json': return jsonify(profile)
+    return terrarium_profiler.collapsed(profile['stacks']), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+# --- Slow Queries ---
+@app.route('/admin/slow-queries')
+@admin_required
+def list_slow_queries():
+    """Captured slow statements (terrarium_slow_queries.py), newest first. ?name=<statement> filters, ?limit= caps (max 200)."""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    return jsonify(terrarium_slow_queries.recent(limit, request.args.get('name')))
 
 # --- Helper for Authentication ---
 def login_required(f):
@@ -46,11 +184,128 @@ def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'logged_in' not in session or not session.get('user_id'):
-            app.logger.warning(f"Unauthorized access attempt to {request.path} - login required or session invalid.")
+            app.logger.warning("Unauthorized access attempt to %s - login required or session invalid.", request.path)
             return jsonify({'success': False, 'message': 'Authentication required.'}), 401
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Password Hashing ---
+# Hashing is CPU-heavy (tens to hundreds of ms) and runs inside a gunicorn sync worker. A small pool of
+# lock-file slots, shared by all workers, caps how many hashes run at once; auth requests that can't get
+# a slot quickly get a 503 instead of tying up more workers.
+# Hashes use werkzeug's default method (scrypt on werkzeug 3.x) unless PASSWORD_HASH_METHOD opts into another one
+# (werkzeug method string incl. cost parameters, e.g. 'scrypt:32768:8:1'). Stored hashes are rewritten to the current
+# method on the next successful login, so changing it is a deliberate, one-way switch for all users.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or None # None = werkzeug's default
+HASH_MAX_CONCURRENCY = int(os.environ.get('HASH_MAX_CONCURRENCY', '2')) # Hashes running at once across all workers
+HASH_SLOT_WAIT_SEC = float(os.environ.get('HASH_SLOT_WAIT_SEC', '2')) # Max wait for a free slot before answering 503
+HASH_SLOT_DIR = os.environ.get('HASH_SLOT_DIR', '/tmp/terrarium_hash_slots')
+current_hash_prefix = None # Method/cost part of a hash made with the current settings (computed on first use)
+
+class PasswordHashBusy(Exception):
+    """Raised when no hashing slot frees up within HASH_SLOT_WAIT_SEC."""
+
+@contextmanager
+def password_hash_slot():
+    """Holds one of HASH_MAX_CONCURRENCY flock() slots while hashing. Raises PasswordHashBusy on timeout."""
+    os.makedirs(HASH_SLOT_DIR, exist_ok=True)
+    deadline = time.monotonic() + HASH_SLOT_WAIT_SEC
+    while True:
+        for slot in range(HASH_MAX_CONCURRENCY):
+            slot_file = open(os.path.join(HASH_SLOT_DIR, f"slot{slot}.lock"), 'a')
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                slot_file.close(); continue
+            try:
+                yield
+                return
+            finally:
+                fcntl.flock(slot_file, fcntl.LOCK_UN); slot_file.close()
+        if time.monotonic() >= deadline:
+            raise PasswordHashBusy()
+        time.sleep(0.05)
+
+def make_password_hash(plain_value):
+    """generate_password_hash() with PASSWORD_HASH_METHOD if set, else with werkzeug's own default (as before it existed)."""
+    if PASSWORD_HASH_METHOD: return generate_password_hash(plain_value, method=PASSWORD_HASH_METHOD)
+    return generate_password_hash(plain_value)
+
+def hash_secrets(*plain_values):
+    """Hashes one or more secrets (password, security answer) with the current method, in one slot."""
+    with password_hash_slot():
+        return [make_password_hash(value) for value in plain_values]
+
+def hash_needs_upgrade(stored_hash):
+    """True if stored_hash was made with a different method/cost than make_password_hash() uses now."""
+    global current_hash_prefix
+    if current_hash_prefix is None:
+        # werkzeug may add default parameters to the method string, so compare against a real hash
+        current_hash_prefix = make_password_hash('x').split('$', 1)[0]
+    return stored_hash.split('$', 1)[0] != current_hash_prefix
+
+def verify_secret(stored_hash, plain_value):
+    """
+    Checks plain_value against stored_hash. Returns (valid, upgraded_hash); upgraded_hash is a new hash
+    with the current parameters when the stored one is outdated (caller saves it), else None.
+    """
+    with password_hash_slot():
+        if not check_password_hash(stored_hash, plain_value):
+            return False, None
+        if hash_needs_upgrade(stored_hash):
+            return True, make_password_hash(plain_value)
+        return True, None
+
+def hash_busy_response():
+    app.logger.warning("No password hashing slot free within %ss for %s.", HASH_SLOT_WAIT_SEC, request.path)
+    return jsonify({'success': False, 'message': 'Server busy, please try again in a moment.'}), 503, {'Retry-After': '2'}
+
+# --- Auth Attempt Throttling ---
+# Per-IP attempt counter (fixed window) in a small SQLite file so all gunicorn workers share it.
+AUTH_THROTTLE_DB = os.environ.get('AUTH_THROTTLE_DB', '/tmp/terrarium_auth_throttle.sqlite3')
+AUTH_MAX_ATTEMPTS = int(os.environ.get('AUTH_MAX_ATTEMPTS', '10')) # Attempts per IP per window
+AUTH_WINDOW_SEC = int(os.environ.get('AUTH_WINDOW_SEC', '300'))
+auth_throttle_ready = False # Table created in this process
+
+def register_auth_attempt(client_ip):
+    """Counts an auth attempt from client_ip. Returns the seconds to wait if over the limit, else 0."""
+    global auth_throttle_ready
+    now = time.time()
+    try:
+        conn = sqlite3.connect(AUTH_THROTTLE_DB, timeout=1, isolation_level=None)
+        try:
+            if not auth_throttle_ready:
+                conn.execute("CREATE TABLE IF NOT EXISTS auth_attempts (ip TEXT PRIMARY KEY, window_start REAL NOT NULL, attempts INTEGER NOT NULL)")
+                auth_throttle_ready = True
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT window_start, attempts FROM auth_attempts WHERE ip = ?", (client_ip,)).fetchone()
+            if row is None or now - row[0] >= AUTH_WINDOW_SEC:
+                window_start, attempts = now, 1
+                conn.execute("DELETE FROM auth_attempts WHERE window_start < ?", (now - AUTH_WINDOW_SEC,)) # Expire old windows
+            else:
+                window_start, attempts = row[0], row[1] + 1
+            conn.execute("INSERT OR REPLACE INTO auth_attempts (ip, window_start, attempts) VALUES (?, ?, ?)", (client_ip, window_start, attempts))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        app.logger.warning("Auth throttle store unavailable (%s). Allowing attempt.", e)
+        return 0
+    if attempts > AUTH_MAX_ATTEMPTS:
+        return int(window_start + AUTH_WINDOW_SEC - now) + 1
+    return 0
+
+def auth_throttled(f):
+    """Decorator: answers 429 once the client IP exceeds AUTH_MAX_ATTEMPTS within AUTH_WINDOW_SEC."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        retry_after = register_auth_attempt(request.remote_addr or 'unknown')
+        if retry_after:
+            app.logger.warning("Auth attempt limit reached for %s on %s. Retry in %ss.", request.remote_addr, request.path, retry_after)
+            return jsonify({'success': False, 'message': 'Too many attempts. Please try again later.'}), 429, {'Retry-After': str(retry_after)}
+        return f(*args, **kwargs)
+    return decorated_function
+
 # --- Helper: Format Timedelta from DB TIME type ---
 def format_timedelta_as_time_str(td, format='%H:%M:%S'):
     """Converts timedelta (from DB TIME type) to string HH:MM:SS or HH:MM"""
@@ -66,59 +321,187 @@ def format_timedelta_as_time_str(td, format='%H:%M:%S'):
         result_dt = base_dt + timedelta(seconds=total_seconds)
         return result_dt.strftime(format)
     except Exception as e:
-        app.logger.error(f"Error formatting timedelta {td} to string: {e}")
+        app.logger.error("Error formatting timedelta %s to string: %s", td, e)
         return None # Return None on formatting error
 
-# --- Get interval key ---
-def get_interval_key(reading_time, interval_minutes):
-    if not isinstance(reading_time, datetime): app.logger.error(f"Invalid type for reading_time: {type(reading_time)}"); return "InvalidTime"
-    if interval_minutes <= 0: app.logger.warning(f"Invalid interval <= 0: {interval_minutes}. Using 1."); interval_minutes = 1
-    if interval_minutes >= 1440: interval_start_dt = datetime.combine(reading_time.date(), time_obj.min); return interval_start_dt.strftime('%Y-%m-%d %H:%M')
-    elif interval_minutes >= 60: hours = interval_minutes // 60; interval_start_hour = (reading_time.hour // hours) * hours; interval_start_dt = reading_time.replace(hour=interval_start_hour, minute=0, second=0, microsecond=0); return interval_start_dt.strftime('%Y-%m-%d %H:%M')
-    elif interval_minutes >= 1: minutes_past_hour = reading_time.minute; interval_start_minute = (minutes_past_hour // interval_minutes) * interval_minutes; interval_start_dt = reading_time.replace(minute=interval_start_minute, second=0, microsecond=0); return interval_start_dt.strftime('%Y-%m-%d %H:%M')
-    else: app.logger.error(f"Unexpected interval value: {interval_minutes}"); return reading_time.strftime('%Y-%m-%d %H:%M')
-
-
 # --- Fetch and process data ---
-def fetch_and_process_data(conn, device_unique_id, start_dt_query, end_dt_exclusive, interval_minutes):
-    cursor = None; final_labels = []; final_temps = []; final_humids = []; gaps_identified = []
-    app.logger.debug(f"fetch_and_process_data: device={device_unique_id}, start={start_dt_query}, end={end_dt_exclusive}, interval={interval_minutes}")
+# Interval layout and the compact format live in chart_layout.py (pure functions, see test_chart_layout.py)
+READING_MAX_HOLD_SEC = 6 * 3600 # Longest quiet period a report-by-exception reading may cover (readings.hold_seconds)
+
+def fetch_and_process_data(device, start_dt_query, end_dt_exclusive, interval_minutes, compact=False):
+    """Chart data dict for one device (device dict from storage): aggregated per interval by the storage backend, then laid out (chart_payload())."""
+    app.logger.debug("fetch_and_process_data: device=%s, start=%s, end=%s, interval=%s", device['id'], start_dt_query, end_dt_exclusive, interval_minutes)
     try:
-        if not all([device_unique_id, isinstance(start_dt_query, datetime), isinstance(end_dt_exclusive, datetime)]): raise ValueError("Missing params or invalid types.")
+        if not all([device, isinstance(start_dt_query, datetime), isinstance(end_dt_exclusive, datetime)]): raise ValueError("Missing params or invalid types.")
         if interval_minutes <= 0: interval_minutes = 1
-        where_clause = "WHERE device_unique_id = %s AND reading_time >= %s AND reading_time < %s"
-        query_params = (device_unique_id, start_dt_query, end_dt_exclusive)
-        query = f"SELECT reading_time, temperature, humidity FROM readings {where_clause} ORDER BY reading_time ASC"
-        cursor = conn.cursor(dictionary=True); cursor.execute(query, query_params); rows = cursor.fetchall()
-        app.logger.info(f"Fetched {len(rows)} points for device {device_unique_id} [{start_dt_query} - {end_dt_exclusive}].")
-        aggregated_data = defaultdict(lambda: {'sum_temp': 0.0, 'sum_humid': 0.0, 'count': 0})
-        for row in rows:
-            temp_db = row.get('temperature'); humid_db = row.get('humidity'); reading_time = row.get('reading_time')
-            if temp_db is None or humid_db is None or not isinstance(reading_time, datetime): continue
-            try: temp = float(temp_db); humid = float(humid_db)
-            except (ValueError, TypeError) as e: app.logger.warning(f"Data conversion error: {e}. Skipping row."); continue
-            interval_key = get_interval_key(reading_time, interval_minutes)
-            aggregated_data[interval_key]['sum_temp'] += temp; aggregated_data[interval_key]['sum_humid'] += humid; aggregated_data[interval_key]['count'] += 1
-        averaged_data_map = {key: {'temp': round(data['sum_temp'] / data['count'], 2), 'humid': round(data['sum_humid'] / data['count'], 2)} for key, data in aggregated_data.items() if data['count'] > 0}
-        current_dt_label_key_start = get_interval_key(start_dt_query, interval_minutes)
-        current_dt = datetime.strptime(current_dt_label_key_start, '%Y-%m-%d %H:%M')
-        interval = timedelta(minutes=interval_minutes); in_gap = False; gap_start_label = None
-        while current_dt < end_dt_exclusive:
-            current_label_key = get_interval_key(current_dt, interval_minutes); final_labels.append(current_label_key)
-            if current_label_key in averaged_data_map:
-                data_point = averaged_data_map[current_label_key]; final_temps.append(data_point['temp']); final_humids.append(data_point['humid'])
-                if in_gap: last_null_label = get_interval_key(current_dt - interval, interval_minutes); gaps_identified.append({"start": gap_start_label, "end": last_null_label}); in_gap = False; gap_start_label = None
-            else:
-                final_temps.append(None); final_humids.append(None)
-                if not in_gap: in_gap = True; gap_start_label = current_label_key
-            current_dt += interval
-        if in_gap: last_null_label = get_interval_key(current_dt - interval, interval_minutes); gaps_identified.append({"start": gap_start_label, "end": last_null_label})
-    except Error as e: app.logger.error(f"DB error fetch/process device {device_unique_id}: {e}"); raise
-    except ValueError as e: app.logger.error(f"Value error fetch/process device {device_unique_id}: {e}"); raise
-    except Exception as e: app.logger.error(f"Unexpected error fetch/process device {device_unique_id}: {e}", exc_info=True); raise
-    finally:
-        if cursor: cursor.close()
-    return final_labels, final_temps, final_humids, gaps_identified
+        anchor = chart_anchor(start_dt_query)
+        buckets = storage.reading_buckets(device, start_dt_query - CHART_HOLD_LOOKBACK, end_dt_exclusive, anchor, interval_minutes)
+        app.logger.info("Fetched %s intervals for device %s [%s - %s].", len(buckets), device['id'], start_dt_query, end_dt_exclusive)
+        terrarium_metrics.observe('terrarium_chart_rows_fetched', len(buckets), (('backend', storage.name),))
+        return chart_payload(buckets, anchor, start_dt_query, end_dt_exclusive, interval_minutes, compact)
+    except StorageError as e: app.logger.error("DB error fetch/process device %s: %s", device['id'], e); raise
+    except ValueError as e: app.logger.error("Value error fetch/process device %s: %s", device['id'], e); raise
+    except Exception as e: app.logger.error("Unexpected error fetch/process device %s: %s", device['id'], e, exc_info=True); raise
+
+# --- Response compression ---
+COMPRESS_MIN_BYTES = 1024 # Smaller bodies are sent as-is
+
+def negotiate_encoding(accept_encoding):
+    """'br' (if brotli is installed), 'gzip' or None for an Accept-Encoding header value; q=0 refuses a coding."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.partition(';'); params = params.strip(); q = 1.0
+        if params.startswith('q='):
+            try: q = float(params[2:])
+            except ValueError: q = 0.0
+        accepted[coding.strip().lower()] = q
+    for coding in (('br',) if brotli else ()) + ('gzip',):
+        if accepted.get(coding, accepted.get('*', 0)) > 0: return coding
+    return None
+
+def encode_json_body(payload, accept_encoding):
+    """(body bytes, headers) for a JSON response, compressed as the client accepts once it is worth it."""
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    headers = {'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'}
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding == 'br': body = brotli.compress(body, quality=5) # Mid quality: most of the gain, little CPU on a Pi
+    elif encoding == 'gzip': body = gzip.compress(body, compresslevel=6)
+    if encoding: headers['Content-Encoding'] = encoding
+    return body, headers
+
+# --- Chart range ---
+def resolve_chart_range(time_range, start_date_str, end_date_str):
+    """
+    Turns /api/chartdata parameters into (start_dt_query, end_dt_exclusive, interval_minutes, error).
+    error is a message for a 400 response (other values None then). Bad date strings raise ValueError.
+    """
+    start_dt_query = None; end_dt_exclusive = None; interval_minutes = 5; now = datetime.now(); today_start = datetime.combine(date.today(), time_obj.min)
+
+    if start_date_str and end_date_str: # Custom Range
+        start_dt_query = datetime.strptime(start_date_str, '%Y-%m-%d')
+        # Make end date *exclusive* by adding one day
+        end_dt_exclusive = datetime.strptime(end_date_str, '%Y-%m-%d') + timedelta(days=1)
+        delta = end_dt_exclusive - start_dt_query
+        if delta > timedelta(days=366): interval_minutes = 1440
+        elif delta > timedelta(days=93): interval_minutes = 60 * 6
+        elif delta > timedelta(days=31): interval_minutes = 60
+        elif delta > timedelta(days=7): interval_minutes = 30
+        elif delta > timedelta(days=1): interval_minutes = 15
+        else: interval_minutes = 5
+        app.logger.debug("Custom range: %s to %s (exclusive), Interval: %s min", start_dt_query, end_dt_exclusive, interval_minutes)
+
+    elif time_range: # Relative Range
+        end_dt_exclusive = now # Relative ranges go up to 'now'
+        if time_range == 'hour': start_dt_query = now - timedelta(hours=1); interval_minutes = 1
+        elif time_range == '8hour': start_dt_query = now - timedelta(hours=8); interval_minutes = 5
+        elif time_range == 'last24h': start_dt_query = now - timedelta(hours=24); interval_minutes = 10
+        elif time_range == 'past7d': start_dt_query = now - timedelta(days=7); interval_minutes = 30
+        elif time_range == 'past31d': start_dt_query = now - timedelta(days=31); interval_minutes = 60
+        elif time_range == 'past365d': start_dt_query = now - timedelta(days=365); interval_minutes = 1440
+        # --- Fixed time ranges ---
+        elif time_range == 'day': start_dt_query = today_start; end_dt_exclusive = today_start + timedelta(days=1); interval_minutes = 5 # Today 00:00 to tomorrow 00:00
+        elif time_range == 'week': start_dt_query = today_start - timedelta(days=now.weekday()); end_dt_exclusive = start_dt_query + timedelta(days=7); interval_minutes = 30 # Start of week to start of next week
+        elif time_range == 'month': start_dt_query = today_start.replace(day=1); next_month_start = (start_dt_query + timedelta(days=32)).replace(day=1); end_dt_exclusive = next_month_start; interval_minutes = 60 # Start of month to start of next month
+        elif time_range == 'year': start_dt_query = today_start.replace(month=1, day=1); end_dt_exclusive = start_dt_query.replace(year=start_dt_query.year + 1); interval_minutes = 1440 # Start of year to start of next year
+        else: return None, None, None, "Invalid time range specified."
+        app.logger.debug("Relative range '%s': %s to %s (exclusive), Interval: %s min", time_range, start_dt_query, end_dt_exclusive, interval_minutes)
+    else: return None, None, None, "Missing time range or date parameters."
+    return start_dt_query, end_dt_exclusive, interval_minutes, None
+
+# --- Row formatting shared with app_async.py ---
+def format_latest_reading(row, device_unique_id=None):
+    """Makes a readings row JSON-friendly (ISO time, floats). device_unique_id is added to it if given."""
+    latest_reading = {}
+    if row:
+        latest_reading = dict(row)
+        if device_unique_id: latest_reading['device_unique_id'] = device_unique_id
+        if isinstance(latest_reading.get('reading_time'), datetime): latest_reading['reading_time'] = latest_reading['reading_time'].isoformat()
+        if isinstance(latest_reading.get('temperature'), Decimal): latest_reading['temperature'] = float(latest_reading['temperature'])
+        if isinstance(latest_reading.get('humidity'), Decimal): latest_reading['humidity'] = float(latest_reading['humidity'])
+    return latest_reading
+
+def format_device_settings(device_settings):
+    """Builds the settings payload the device script expects from a devices row (plus its settings_version)."""
+    min_temp = device_settings.get('min_temp_threshold')
+    max_temp = device_settings.get('max_temp_threshold')
+    settings_data = {
+        'min_temp_threshold': float(min_temp) if min_temp is not None else None,
+        'max_temp_threshold': float(max_temp) if max_temp is not None else None,
+        # Format for device script (HH:MM:SS) using helper
+        'heating_off_start_time': format_timedelta_as_time_str(device_settings.get('heating_off_start_time'), '%H:%M:%S'),
+        'heating_off_end_time': format_timedelta_as_time_str(device_settings.get('heating_off_end_time'), '%H:%M:%S')
+    }
+    settings_data['settings_version'] = settings_version(settings_data)
+    return settings_data
+
+def settings_version(settings_data):
+    """Short fingerprint of a settings payload; changes whenever any setting changes (no DB column needed)."""
+    canonical = json.dumps([settings_data.get(k) for k in ('min_temp_threshold', 'max_temp_threshold', 'heating_off_start_time', 'heating_off_end_time')])
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+
+def parse_bulk_settings_request(data):
+    """
+    Validates a bulk settings request body {"devices": {"<device_unique_id>": "<known version or null>", ...}}.
+    Returns (known_versions, error) where error is a message for a 400 response.
+    """
+    devices = data.get('devices') if isinstance(data, dict) else None
+    if not isinstance(devices, dict) or not devices: return None, "'devices' must be a non-empty object of device_unique_id -> known settings_version."
+    if len(devices) > BULK_SETTINGS_MAX_DEVICES: return None, f"At most {BULK_SETTINGS_MAX_DEVICES} devices per request."
+    if not all(isinstance(uid, str) and uid and (version is None or isinstance(version, str)) for uid, version in devices.items()):
+        return None, "Device IDs must be strings and versions strings or null."
+    return devices, None
+
+def build_bulk_settings_response(rows, known_versions):
+    """Splits device rows into changed settings, unchanged IDs and unknown IDs for /api/device/settings/bulk."""
+    changed = {}; unchanged = []
+    for row in rows:
+        settings_data = format_device_settings(row)
+        if known_versions.get(row['device_unique_id']) == settings_data['settings_version']: unchanged.append(row['device_unique_id'])
+        else: changed[row['device_unique_id']] = settings_data
+    found = set(changed) | set(unchanged)
+    return {'settings': changed, 'unchanged': unchanged, 'unknown': [uid for uid in known_versions if uid not in found]}
+
+def parse_hold_seconds(value):
+    """
+    Validates the optional 'hold_seconds' of a reading: sent by devices in report-by-exception mode, it says the
+    value stands until the next reading or for this many seconds, whichever comes first. Returns (hold, error).
+    """
+    if value is None: return None, None # Periodic reading
+    if isinstance(value, bool) or not isinstance(value, int) or not (0 < value <= READING_MAX_HOLD_SEC): return None, f"hold_seconds must be an integer between 1 and {READING_MAX_HOLD_SEC}."
+    return value, None
+
+def parse_batch_readings(data, now):
+    """
+    Validates a batch readings body {"readings": [{"device_unique_id", "temperature", "humidity", "age_seconds", "hold_seconds"}, ...]}.
+    age_seconds (optional) is how long ago the reading was taken, so queued readings keep their time.
+    Returns (rows, rejected, error): rows are (index, uid, reading_time, temp, humid, hold), rejected is [{index, error}],
+    error is a message for a 400 response (whole batch refused).
+    """
+    readings = data.get('readings') if isinstance(data, dict) else None
+    if not isinstance(readings, list) or not readings: return None, None, "'readings' must be a non-empty list."
+    if len(readings) > BATCH_READINGS_MAX: return None, None, f"At most {BATCH_READINGS_MAX} readings per request."
+    rows = []; rejected = []
+    for index, item in enumerate(readings):
+        if not isinstance(item, dict): rejected.append({'index': index, 'error': "Reading must be an object."}); continue
+        device_uid = item.get('device_unique_id'); temp = item.get('temperature'); humid = item.get('humidity')
+        if not isinstance(device_uid, str) or not device_uid or temp is None or humid is None: rejected.append({'index': index, 'error': "Missing required fields."}); continue
+        try: temp_float = float(temp); humid_float = float(humid); age = float(item.get('age_seconds') or 0)
+        except (ValueError, TypeError): rejected.append({'index': index, 'error': "Invalid temp/humid/age value."}); continue
+        if not (0 <= age <= BATCH_READING_MAX_AGE_SEC): rejected.append({'index': index, 'error': "age_seconds out of range."}); continue
+        hold_seconds, hold_error = parse_hold_seconds(item.get('hold_seconds'))
+        if hold_error: rejected.append({'index': index, 'error': hold_error}); continue
+        if not (-40 <= temp_float <= 85): app.logger.warning("Implausible temp received %s from %s", temp_float, device_uid)
+        if not (0 <= humid_float <= 100): app.logger.warning("Implausible humidity received %s from %s", humid_float, device_uid)
+        rows.append((index, device_uid, now - timedelta(seconds=age), temp_float, humid_float, hold_seconds))
+    return rows, rejected, None
+
+def registered_batch_rows(rows, device_keys, rejected):
+    """Drops rows of unregistered devices (recorded in 'rejected') and returns storage.add_readings() tuples for the rest."""
+    readings = []
+    for index, device_uid, reading_time, temp_float, humid_float, hold_seconds in rows:
+        if device_uid in device_keys: readings.append((device_keys[device_uid], device_uid, reading_time, temp_float, humid_float, hold_seconds))
+        else: rejected.append({'index': index, 'error': "Device ID not registered."})
+    return readings
 
 # --- Routes ---
 @app.route('/')
@@ -136,168 +519,250 @@ def login_page():
 @app.route('/api/readings/latest')
 @login_required
 def get_latest_readings():
-    conn = None; cursor = None; user_id = session['user_id']; target_device_db_id = request.args.get('device_id', type=int)
+    user_id = session['user_id']; target_device_db_id = request.args.get('device_id', type=int)
     if not target_device_db_id: return jsonify({"error": "Device ID parameter is required."}), 400
     try:
-        conn = get_db_connection();
-        if not conn: return jsonify({"error": "Database connection failed"}), 500
-        cursor = conn.cursor(dictionary=True); cursor.execute("SELECT device_unique_id FROM devices WHERE id = %s AND user_id = %s", (target_device_db_id, user_id)); device = cursor.fetchone()
+        device = storage.get_user_device(user_id, target_device_db_id)
         if not device: return jsonify({"error": "Device not found or access denied."}), 404
-        device_unique_id_to_query = device['device_unique_id']
-        sql = "SELECT reading_time, temperature, humidity, device_unique_id FROM readings WHERE device_unique_id = %s ORDER BY reading_time DESC LIMIT 1"
-        cursor.execute(sql, (device_unique_id_to_query,)); row = cursor.fetchone(); latest_reading = {}
-        if row:
-            latest_reading = dict(row)
-            if isinstance(latest_reading.get('reading_time'), datetime): latest_reading['reading_time'] = latest_reading['reading_time'].isoformat()
-            if isinstance(latest_reading.get('temperature'), Decimal): latest_reading['temperature'] = float(latest_reading['temperature'])
-            if isinstance(latest_reading.get('humidity'), Decimal): latest_reading['humidity'] = float(latest_reading['humidity'])
-    except Error as e: app.logger.error(f"DB Err latest reading user {user_id}, dev {target_device_db_id}: {e}"); return jsonify({"error": "Failed to fetch latest data"}), 500
-    except Exception as e: app.logger.error(f"Unexpected err latest reading: {e}", exc_info=True); return jsonify({"error": "Internal server error"}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        # Identical concurrent requests share one query (terrarium_singleflight.py)
+        latest_reading = terrarium_singleflight.run('latest', ('latest', device['id']), lambda: format_latest_reading(storage.latest_reading(device), device['device_unique_id']))
+    except StorageError as e: app.logger.error("DB Err latest reading user %s, dev %s: %s", user_id, target_device_db_id, e); return jsonify({"error": "Failed to fetch latest data"}), 500
+    except Exception as e: app.logger.error("Unexpected err latest reading: %s", e, exc_info=True); return jsonify({"error": "Internal server error"}), 500
     return jsonify(latest_reading)
 
-# No changes needed in get_chart_data
+# --- Raw readings (keyset pages) ---
+READINGS_PAGE_DEFAULT = int(os.environ.get('READINGS_PAGE_DEFAULT', '500')) # Readings per page unless ?limit= says otherwise
+READINGS_PAGE_MAX = int(os.environ.get('READINGS_PAGE_MAX', '5000'))        # Upper bound for ?limit=
+
+def parse_local_datetime(value):
+    """ISO date/time as stored (naive, Pi local time). Raises ValueError for invalid values and ones with a UTC offset."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None: raise ValueError(f"'{value}' has a UTC offset; times are local without one.")
+    return parsed
+
+def encode_readings_cursor(reading_time, reading_id):
+    """Opaque ?cursor= value for the keyset position after (reading_time, id)."""
+    return base64.urlsafe_b64encode(f"{reading_time.isoformat()}|{reading_id}".encode()).decode().rstrip('=')
+
+def decode_readings_cursor(cursor):
+    """(reading_time, id) from encode_readings_cursor(). Raises ValueError if it isn't one."""
+    reading_time, _, reading_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().partition('|')
+    return parse_local_datetime(reading_time), int(reading_id)
+
+@app.route('/api/readings')
+@login_required
+def get_readings_page():
+    """
+    Raw readings of one device, oldest first: ?device_id= &start= &end= (ISO date/time; default the last 24 hours),
+    &limit= (max READINGS_PAGE_MAX), &fields=reading_time,temperature,... Pass next_cursor back as &cursor= for the next page.
+    """
+    user_id = session['user_id']; device_db_id = request.args.get('device_id', type=int)
+    if not device_db_id: return jsonify({"error": "Device ID parameter is required."}), 400
+    fields = [field.strip() for field in request.args.get('fields', ','.join(terrarium_storage.READING_PAGE_FIELDS)).split(',') if field.strip()]
+    unknown = [field for field in fields if field not in terrarium_storage.READING_PAGE_FIELDS]
+    if unknown or not fields: return jsonify({"error": f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(terrarium_storage.READING_PAGE_FIELDS)}."}), 400
+    limit = min(max(request.args.get('limit', READINGS_PAGE_DEFAULT, type=int), 1), READINGS_PAGE_MAX)
+    try:
+        end_dt = parse_local_datetime(request.args['end']) if request.args.get('end') else datetime.now()
+        start_dt = parse_local_datetime(request.args['start']) if request.args.get('start') else end_dt - timedelta(days=1)
+        since, after_id = decode_readings_cursor(request.args['cursor']) if request.args.get('cursor') else (start_dt, None) # A cursor replaces start
+    except ValueError: return jsonify({"error": "Invalid start, end or cursor (ISO local time, no UTC offset)."}), 400
+    try:
+        device = storage.get_user_device(user_id, device_db_id)
+        if not device: return jsonify({"error": "Device not found or access denied."}), 404
+        rows = storage.reading_page(device, since, after_id, end_dt, limit + 1) # One extra row tells whether another page follows
+    except StorageError as e: app.logger.error("DB error reading page device %s: %s", device_db_id, e); return jsonify({"error": "Database error fetching readings."}), 500
+    except Exception as e: app.logger.error("Unexpected error reading page device %s: %s", device_db_id, e, exc_info=True); return jsonify({"error": "Internal server error."}), 500
+    next_cursor = encode_readings_cursor(rows[limit - 1]['reading_time'], rows[limit - 1]['id']) if len(rows) > limit else None
+    readings = [{field: row[field].isoformat() if field == 'reading_time' else row[field] for field in fields} for row in rows[:limit]]
+    body, headers = encode_json_body({"device_id": device_db_id, "readings": readings, "next_cursor": next_cursor}, request.headers.get('Accept-Encoding'))
+    return app.response_class(body, headers=headers)
+
+def iter_device_readings(device, since, until, page_size=READINGS_PAGE_MAX):
+    """Every reading of a device in [since, until), in time order, fetched one keyset page at a time (bounded memory)."""
+    after_id = None
+    while True:
+        rows = storage.reading_page(device, since, after_id, until, page_size)
+        yield from rows
+        if len(rows) < page_size: return
+        since, after_id = rows[-1]['reading_time'], rows[-1]['id']
+
+# --- Statistics ---
+STATS_MAX_DAYS = 366 # Longest period one /api/statistics request may scan
+
+@app.route('/api/statistics')
+@login_required
+def get_statistics():
+    """
+    Min/max/mean, percentiles and time within the device's temperature thresholds, for the period and per day, from one
+    pass over the raw readings (reading_stats.py). ?device_id= &start= &end= (ISO; default the last 7 days) &percentiles=5,50,95
+    """
+    user_id = session['user_id']; device_db_id = request.args.get('device_id', type=int)
+    if not device_db_id: return jsonify({"error": "Device ID parameter is required."}), 400
+    try:
+        end_dt = parse_local_datetime(request.args['end']) if request.args.get('end') else datetime.now()
+        start_dt = parse_local_datetime(request.args['start']) if request.args.get('start') else end_dt - timedelta(days=7)
+        percentiles = [float(p) for p in request.args['percentiles'].split(',')] if request.args.get('percentiles') else reading_stats.DEFAULT_PERCENTILES
+    except ValueError: return jsonify({"error": "Invalid start, end (ISO local time, no UTC offset) or percentiles."}), 400
+    if not start_dt < end_dt or end_dt - start_dt > timedelta(days=STATS_MAX_DAYS): return jsonify({"error": f"Period must be positive and at most {STATS_MAX_DAYS} days."}), 400
+    if not percentiles or any(not 0 < p <= 100 for p in percentiles) or len(percentiles) > 20: return jsonify({"error": "Percentiles must be 1-20 values in (0, 100]."}), 400
+    try:
+        device = storage.get_user_device(user_id, device_db_id)
+        if not device: return jsonify({"error": "Device not found or access denied."}), 404
+        readings = ((row['reading_time'], row['temperature'], row['humidity'], row['hold_seconds']) for row in iter_device_readings(device, start_dt, end_dt))
+        stats = reading_stats.reading_statistics(readings, device['min_temp_threshold'], device['max_temp_threshold'], percentiles)
+    except StorageError as e: app.logger.error("DB error statistics device %s: %s", device_db_id, e); return jsonify({"error": "Database error computing statistics."}), 500
+    except Exception as e: app.logger.error("Unexpected error statistics device %s: %s", device_db_id, e, exc_info=True); return jsonify({"error": "Internal server error."}), 500
+    stats.update({"device_id": device_db_id, "start": start_dt.isoformat(), "end": end_dt.isoformat(),
+                  "thresholds": {"min_temp": device['min_temp_threshold'], "max_temp": device['max_temp_threshold']}})
+    body, headers = encode_json_body(stats, request.headers.get('Accept-Encoding'))
+    return app.response_class(body, headers=headers)
+
+# --- Hour-of-day heatmap ---
+HEATMAP_DEFAULT_DAYS = 28
+HEATMAP_MAX_DAYS = 366 # Longest period one /api/heatmap request may cover
+
+def heatmap_matrix(rows, day_count):
+    """
+    Day x hour matrices ([day][hour], None where there was no reading) from storage.hourly_averages() rows, plus the
+    per-hour profile over all days (averages weighted by reading count).
+    """
+    temperatures = [[None] * 24 for _ in range(day_count)]; humidities = [[None] * 24 for _ in range(day_count)]; counts = [[0] * 24 for _ in range(day_count)]
+    sums = [[0.0, 0, 0.0, 0] for _ in range(24)] # Per hour: temp sum, temp count, humidity sum, humidity count
+    for row in rows:
+        day, hour = divmod(row['bucket'], 24)
+        if not 0 <= day < day_count or not row['readings']: continue
+        counts[day][hour] = row['readings']
+        if row['temperature'] is not None:
+            temperatures[day][hour] = round(row['temperature'], 2); sums[hour][0] += row['temperature'] * row['readings']; sums[hour][1] += row['readings']
+        if row['humidity'] is not None:
+            humidities[day][hour] = round(row['humidity'], 2); sums[hour][2] += row['humidity'] * row['readings']; sums[hour][3] += row['readings']
+    profile = {'temperatures': [round(t_sum / t_count, 2) if t_count else None for t_sum, t_count, _, _ in sums],
+               'humidities': [round(h_sum / h_count, 2) if h_count else None for _, _, h_sum, h_count in sums]}
+    return {'temperatures': temperatures, 'humidities': humidities, 'readings': counts, 'profile': profile}
+
+@app.route('/api/heatmap')
+@login_required
+def get_heatmap():
+    """
+    Average temperature/humidity per hour of day and day, from one grouped query (storage.hourly_averages()).
+    ?device_id= &start= &end= (YYYY-MM-DD, both inclusive; default the last HEATMAP_DEFAULT_DAYS days up to today)
+    """
+    user_id = session['user_id']; device_db_id = request.args.get('device_id', type=int)
+    if not device_db_id: return jsonify({"error": "Device ID parameter is required."}), 400
+    try:
+        end_day = date.fromisoformat(request.args['end']) if request.args.get('end') else datetime.now().date()
+        start_day = date.fromisoformat(request.args['start']) if request.args.get('start') else end_day - timedelta(days=HEATMAP_DEFAULT_DAYS - 1)
+    except ValueError: return jsonify({"error": "Invalid start or end date (expected YYYY-MM-DD)."}), 400
+    day_count = (end_day - start_day).days + 1
+    if not 0 < day_count <= HEATMAP_MAX_DAYS: return jsonify({"error": f"Period must be 1 to {HEATMAP_MAX_DAYS} days."}), 400
+    since = datetime.combine(start_day, datetime.min.time()) # Midnight, so bucket // 24 is the day and bucket % 24 the hour
+    try:
+        device = storage.get_user_device(user_id, device_db_id)
+        if not device: return jsonify({"error": "Device not found or access denied."}), 404
+        rows = storage.hourly_averages(device, since, since + timedelta(days=day_count))
+    except StorageError as e: app.logger.error("DB error heatmap device %s: %s", device_db_id, e); return jsonify({"error": "Database error computing heatmap."}), 500
+    except Exception as e: app.logger.error("Unexpected error heatmap device %s: %s", device_db_id, e, exc_info=True); return jsonify({"error": "Internal server error."}), 500
+    heatmap = heatmap_matrix(rows, day_count)
+    heatmap.update({"device_id": device_db_id, "start": start_day.isoformat(), "end": end_day.isoformat(),
+                    "days": [(start_day + timedelta(days=offset)).isoformat() for offset in range(day_count)],
+                    "thresholds": {"min_temp": device['min_temp_threshold'], "max_temp": device['max_temp_threshold']},
+                    "heating_off": {"start": format_timedelta_as_time_str(device['heating_off_start_time'], '%H:%M'), "end": format_timedelta_as_time_str(device['heating_off_end_time'], '%H:%M')}})
+    body, headers = encode_json_body(heatmap, request.headers.get('Accept-Encoding'))
+    return app.response_class(body, headers=headers)
+
 @app.route('/api/chartdata')
 @login_required
 def get_chart_data():
     time_range = request.args.get('range'); start_date_str = request.args.get('start_date'); end_date_str = request.args.get('end_date'); device_db_id = request.args.get('device_id', type=int)
     user_id = session['user_id']
     if not device_db_id: return jsonify({"error": "Device ID parameter is required."}), 400
-    app.logger.info(f"Chart data request - User: {user_id}, DeviceDBID: {device_db_id}, Range: {time_range}, Start: {start_date_str}, End: {end_date_str}")
-    conn = None; device_unique_id = None
+    app.logger.info("Chart data request - User: %s, DeviceDBID: %s, Range: %s, Start: %s, End: %s", user_id, device_db_id, time_range, start_date_str, end_date_str)
     try:
-        conn = get_db_connection();
-        if not conn: return jsonify({"error": "Database connection failed"}), 500
-        cursor = conn.cursor(dictionary=True); cursor.execute("SELECT device_unique_id FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id)); device = cursor.fetchone(); cursor.close()
+        device = storage.get_user_device(user_id, device_db_id)
         if not device: return jsonify({"error": "Device not found or access denied."}), 404
-        device_unique_id = device['device_unique_id']
-        start_dt_query = None; end_dt_exclusive = None; interval_minutes = 5; now = datetime.now(); today_start = datetime.combine(date.today(), time_obj.min)
-
-        if start_date_str and end_date_str: # Custom Range
-            start_dt_query = datetime.strptime(start_date_str, '%Y-%m-%d')
-            # Make end date *exclusive* by adding one day
-            end_dt_exclusive = datetime.strptime(end_date_str, '%Y-%m-%d') + timedelta(days=1)
-            delta = end_dt_exclusive - start_dt_query
-            if delta > timedelta(days=366): interval_minutes = 1440
-            elif delta > timedelta(days=93): interval_minutes = 60 * 6
-            elif delta > timedelta(days=31): interval_minutes = 60
-            elif delta > timedelta(days=7): interval_minutes = 30
-            elif delta > timedelta(days=1): interval_minutes = 15
-            else: interval_minutes = 5
-            app.logger.debug(f"Custom range: {start_dt_query} to {end_dt_exclusive} (exclusive), Interval: {interval_minutes} min")
-
-        elif time_range: # Relative Range
-            end_dt_exclusive = now # Relative ranges go up to 'now'
-            if time_range == 'hour': start_dt_query = now - timedelta(hours=1); interval_minutes = 1
-            elif time_range == '8hour': start_dt_query = now - timedelta(hours=8); interval_minutes = 5
-            elif time_range == 'last24h': start_dt_query = now - timedelta(hours=24); interval_minutes = 10
-            elif time_range == 'past7d': start_dt_query = now - timedelta(days=7); interval_minutes = 30
-            elif time_range == 'past31d': start_dt_query = now - timedelta(days=31); interval_minutes = 60
-            elif time_range == 'past365d': start_dt_query = now - timedelta(days=365); interval_minutes = 1440
-            # --- Fixed time ranges ---
-            elif time_range == 'day': start_dt_query = today_start; end_dt_exclusive = today_start + timedelta(days=1); interval_minutes = 5 # Today 00:00 to tomorrow 00:00
-            elif time_range == 'week': start_dt_query = today_start - timedelta(days=now.weekday()); end_dt_exclusive = start_dt_query + timedelta(days=7); interval_minutes = 30 # Start of week to start of next week
-            elif time_range == 'month': start_dt_query = today_start.replace(day=1); next_month_start = (start_dt_query + timedelta(days=32)).replace(day=1); end_dt_exclusive = next_month_start; interval_minutes = 60 # Start of month to start of next month
-            elif time_range == 'year': start_dt_query = today_start.replace(month=1, day=1); end_dt_exclusive = start_dt_query.replace(year=start_dt_query.year + 1); interval_minutes = 1440 # Start of year to start of next year
-            else: return jsonify({"error": "Invalid time range specified."}), 400
-            app.logger.debug(f"Relative range '{time_range}': {start_dt_query} to {end_dt_exclusive} (exclusive), Interval: {interval_minutes} min")
-        else: return jsonify({"error": "Missing time range or date parameters."}), 400
-
+        start_dt_query, end_dt_exclusive, interval_minutes, range_error = resolve_chart_range(time_range, start_date_str, end_date_str)
+        if range_error: return jsonify({"error": range_error}), 400
         if not isinstance(start_dt_query, datetime) or not isinstance(end_dt_exclusive, datetime): return jsonify({"error": "Internal error determining time range."}), 500
-        final_labels, final_temps, final_humids, gaps_identified = fetch_and_process_data(conn, device_unique_id, start_dt_query, end_dt_exclusive, interval_minutes)
-        chart_data = { "labels": final_labels, "temperatures": final_temps, "humidities": final_humids, "gaps": gaps_identified }
-    except ValueError as ve: app.logger.error(f"Date/value error device {device_db_id}: {ve}"); return jsonify({"error": "Invalid date format or value."}), 400
-    except Error as e: app.logger.error(f"DB error chart data device {device_db_id}: {e}"); return jsonify({"error": "Database error processing chart data."}), 500
-    except Exception as e: app.logger.error(f"Unexpected error chart data device {device_db_id}: {e}", exc_info=True); return jsonify({"error": "Internal server error."}), 500
-    finally:
-        if conn and conn.is_connected(): conn.close()
-    return jsonify(chart_data)
+        compact = request.args.get('format') == 'compact'
+        # Keyed by the request parameters (not the resolved times, which differ by the arrival instant) so lined-up refreshes share one computation
+        chart_data = terrarium_singleflight.run('chart', ('chart', device['id'], time_range, start_date_str, end_date_str, compact),
+                                                lambda: fetch_and_process_data(device, start_dt_query, end_dt_exclusive, interval_minutes, compact))
+    except ValueError as ve: app.logger.error("Date/value error device %s: %s", device_db_id, ve); return jsonify({"error": "Invalid date format or value."}), 400
+    except StorageError as e: app.logger.error("DB error chart data device %s: %s", device_db_id, e); return jsonify({"error": "Database error processing chart data."}), 500
+    except Exception as e: app.logger.error("Unexpected error chart data device %s: %s", device_db_id, e, exc_info=True); return jsonify({"error": "Internal server error."}), 500
+    body, headers = encode_json_body(chart_data, request.headers.get('Accept-Encoding'))
+    return app.response_class(body, headers=headers)
 
 
 # --- API Routes for Authentication ---
 @app.route('/api/register', methods=['POST'])
+@auth_throttled
 def api_register():
-    conn = None; cursor = None; name = request.form.get('name'); email = request.form.get('email')
+    name = request.form.get('name'); email = request.form.get('email')
     try:
         password = request.form.get('password'); security_question = request.form.get('security_question'); security_answer = request.form.get('security_answer')
         if not all([name, email, password, security_question, security_answer]): return jsonify({'success': False, 'message': 'Missing required fields.'}), 400
-        conn = get_db_connection();
-        if not conn: return jsonify({'success': False, 'message': 'Database connection failed.'}), 500
-        cursor = conn.cursor(); cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-        if cursor.fetchone(): return jsonify({'success': False, 'message': 'Email already registered!'}), 409
-        hashed_password = generate_password_hash(password); hashed_security_answer = generate_password_hash(security_answer)
-        sql = "INSERT INTO users (name, email, password, security_question, security_answer) VALUES (%s, %s, %s, %s, %s)"
-        cursor.execute(sql, (name, email, hashed_password, security_question, hashed_security_answer)); conn.commit()
-        app.logger.info(f"User registered successfully: {email}"); return jsonify({'success': True, 'message': 'Registration successful!'}), 201
-    except Error as e:
-        app.logger.error(f"Database error during registration for {email}: {e}")
-        if e.errno == 1062: return jsonify({'success': False, 'message': 'Email already registered!'}), 409
-        return jsonify({'success': False, 'message': 'Database error during registration.'}), 500
-    except Exception as e: app.logger.error(f"Unexpected error during registration for {email}: {e}", exc_info=True); return jsonify({'success': False, 'message': 'An internal server error occurred.'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        if storage.get_user_by_email(email): return jsonify({'success': False, 'message': 'Email already registered!'}), 409
+        hashed_password, hashed_security_answer = hash_secrets(password, security_answer)
+        storage.create_user(name, email, hashed_password, security_question, hashed_security_answer)
+        app.logger.info("User registered successfully: %s", email); return jsonify({'success': True, 'message': 'Registration successful!'}), 201
+    except DuplicateEntry: app.logger.warning("Registration raced for %s: email already registered.", email); return jsonify({'success': False, 'message': 'Email already registered!'}), 409
+    except StorageError as e: app.logger.error("Database error during registration for %s: %s", email, e); return jsonify({'success': False, 'message': 'Database error during registration.'}), 500
+    except PasswordHashBusy: return hash_busy_response()
+    except Exception as e: app.logger.error("Unexpected error during registration for %s: %s", email, e, exc_info=True); return jsonify({'success': False, 'message': 'An internal server error occurred.'}), 500
 
 @app.route('/api/login', methods=['POST'])
+@auth_throttled
 def api_login():
     app.logger.debug("--- /api/login endpoint CALLED ---")
-    conn = None; cursor = None; email = request.form.get('email')
-    app.logger.debug(f"Login attempt for email: {email}")
+    email = request.form.get('email')
+    app.logger.debug("Login attempt for email: %s", email)
     try:
         password = request.form.get('password')
         if not email or not password:
             app.logger.warning("Login failed: Missing email or password.")
             return jsonify({'success': False, 'message': 'Email and password are required.'}), 400
 
-        app.logger.debug("Attempting DB connection for login...")
-        conn = get_db_connection();
-        if not conn:
-            app.logger.error("Login failed: DB connection failed.")
-            return jsonify({'success': False, 'message': 'Database connection failed.'}), 500
-        app.logger.debug("DB connection successful.")
-
-        cursor = conn.cursor(dictionary=True)
-        app.logger.debug(f"Executing user lookup for: {email}")
-        cursor.execute("SELECT id, name, email, password FROM users WHERE email = %s", (email,));
-        user = cursor.fetchone()
-        app.logger.debug(f"User lookup result: {'User found' if user else 'User NOT found'}")
-
-        if user and check_password_hash(user['password'], password):
-            app.logger.info(f"Password VALID for {email}. Preparing session.")
+        app.logger.debug("Executing user lookup for: %s", email)
+        user = storage.get_user_by_email(email)
+        app.logger.debug("User lookup result: %s", 'User found' if user else 'User NOT found')
+
+        password_valid, upgraded_hash = verify_secret(user['password'], password) if user else (False, None)
+        if password_valid:
+            app.logger.info("Password VALID for %s. Preparing session.", email)
+            if upgraded_hash:
+                # Stored hash used older parameters; replace it now that we know the password
+                storage.update_user_hashes(user['id'], password=upgraded_hash)
+                app.logger.info("Password hash for user %s upgraded to %s.", user['id'], current_hash_prefix)
             session.clear()
             session['logged_in'] = True
             session['user_id'] = user['id']
             session['user_name'] = user['name']
             session.permanent = True
             app.permanent_session_lifetime = timedelta(days=7)
-            app.logger.debug(f"Session SET before return: {dict(session)}")
-            app.logger.info(f"Login successful for {email} (ID: {user['id']}). Returning JSON 200.")
+            app.logger.debug("Session SET before return: %s", dict(session))
+            app.logger.info("Login successful for %s (ID: %s). Returning JSON 200.", email, user['id'])
             return jsonify({'success': True, 'message': 'Login successful!', 'user': { 'id': user['id'], 'name': user['name'] }}), 200
         else:
-            app.logger.warning(f"Failed login attempt for email: {email} - Incorrect email or password.")
+            app.logger.warning("Failed login attempt for email: %s - Incorrect email or password.", email)
             return jsonify({'success': False, 'message': 'Incorrect email or password.'}), 401
 
-    except Error as e:
-        app.logger.error(f"Database error during login for {email}: {e}")
+    except StorageError as e:
+        app.logger.error("Database error during login for %s: %s", email, e)
         return jsonify({'success': False, 'message': 'Database error during login.'}), 500
+    except PasswordHashBusy:
+        return hash_busy_response()
     except Exception as e:
-        app.logger.error(f"Unexpected error during login for {email}: {e}", exc_info=True)
+        app.logger.error("Unexpected error during login for %s: %s", email, e, exc_info=True)
         return jsonify({'success': False, 'message': 'An internal server error occurred.'}), 500
     finally:
-        if cursor:
-            app.logger.debug("Closing DB cursor.")
-            cursor.close()
-        if conn and conn.is_connected():
-            app.logger.debug("Closing DB connection.")
-            conn.close()
         app.logger.debug("--- /api/login endpoint FINISHED ---")
 
 @app.route('/api/logout')
 def api_logout():
     user_name = session.get('user_name', 'Unknown'); user_id = session.get('user_id')
-    session.clear(); app.logger.info(f"User logged out: {user_name} (ID: {user_id})")
+    session.clear(); app.logger.info("User logged out: %s (ID: %s)", user_name, user_id)
     return redirect(url_for('login_page'))
 
 @app.route('/api/session-check')
@@ -313,138 +778,130 @@ def api_session_check():
             user_details['user_name'] = None
         return jsonify(user_details)
     except Exception as e:
-        app.logger.error(f"Session check error: {str(e)}")
+        app.logger.error("Session check error: %s", str(e))
         return jsonify({'logged_in': False, 'error': 'Session check failed'}), 500
 
 @app.route('/api/forgot-password', methods=['POST'])
+@auth_throttled
 def api_forgot_password():
-    conn = None; cursor = None; action = request.form.get('action'); email = request.form.get('email')
-    app.logger.info(f"Forgot password request. Action: {action}, Email: {email}")
+    action = request.form.get('action'); email = request.form.get('email')
+    app.logger.info("Forgot password request. Action: %s, Email: %s", action, email)
     try:
-        conn = get_db_connection();
-        if not conn: return jsonify({'success': False, 'message': 'DB connection failed.'}), 500
         if action == 'verifyEmail':
             if not email: return jsonify({'success': False, 'message': 'Email required.'}), 400
-            cursor = conn.cursor(dictionary=True); cursor.execute("SELECT security_question FROM users WHERE email = %s", (email,)); user = cursor.fetchone(); cursor.close()
+            user = storage.get_user_by_email(email)
             if user: q_map={'pet':"What was your first pet's name?",'school':"What was the name of your first school?",'city':"What city were you born in?",'maiden':"What was your mother's maiden name?"}; q_text=q_map.get(user['security_question'],"Unknown question."); return jsonify({'success': True, 'security_question': q_text})
             else: return jsonify({'success': False, 'message': 'Email not found.'}), 404
         elif action == 'verifyAnswer':
             security_answer = request.form.get('security_answer');
             if not email or not security_answer: return jsonify({'success': False, 'message': 'Email/answer required.'}), 400
-            cursor = conn.cursor(dictionary=True); cursor.execute("SELECT security_answer FROM users WHERE email = %s", (email,)); user = cursor.fetchone(); cursor.close()
-            if user and check_password_hash(user['security_answer'], security_answer): return jsonify({'success': True, 'message': 'Answer verified.'})
-            else: return jsonify({'success': False, 'message': 'Incorrect answer/email.'}), 401
+            user = storage.get_user_by_email(email)
+            answer_valid, upgraded_hash = verify_secret(user['security_answer'], security_answer) if user else (False, None)
+            if not answer_valid: return jsonify({'success': False, 'message': 'Incorrect answer/email.'}), 401
+            if upgraded_hash: storage.update_user_hashes(user['id'], security_answer=upgraded_hash)
+            return jsonify({'success': True, 'message': 'Answer verified.'})
         elif action == 'resetPassword':
             new_password = request.form.get('new_password');
             if not email or not new_password: return jsonify({'success': False, 'message': 'Email/new password required.'}), 400
             if len(new_password) < 8: return jsonify({'success': False, 'message': 'Password >= 8 chars.'}), 400
-            hashed_password = generate_password_hash(new_password); update_cursor = conn.cursor()
-            update_sql = "UPDATE users SET password = %s WHERE email = %s"; update_cursor.execute(update_sql, (hashed_password, email)); rows = update_cursor.rowcount; conn.commit(); update_cursor.close()
-            if rows > 0: return jsonify({'success': True, 'message': 'Password reset successful.'})
+            hashed_password, = hash_secrets(new_password)
+            if storage.reset_password(email, hashed_password): return jsonify({'success': True, 'message': 'Password reset successful.'})
             else: return jsonify({'success': False, 'message': 'User not found during reset.'}), 404
         else: return jsonify({'success': False, 'message': 'Invalid action.'}), 400
-    except Error as e: app.logger.error(f"DB error forgot pw action '{action}' email {email}: {e}"); return jsonify({'success': False, 'message': 'DB error during recovery.'}), 500
-    except Exception as e: app.logger.error(f"Unexpected error forgot pw action '{action}' email {email}: {e}", exc_info=True); return jsonify({'success': False, 'message': 'Internal server error.'}), 500
-    finally:
-        if conn and conn.is_connected(): conn.close()
+    except StorageError as e: app.logger.error("DB error forgot pw action '%s' email %s: %s", action, email, e); return jsonify({'success': False, 'message': 'DB error during recovery.'}), 500
+    except PasswordHashBusy: return hash_busy_response()
+    except Exception as e: app.logger.error("Unexpected error forgot pw action '%s' email %s: %s", action, email, e, exc_info=True); return jsonify({'success': False, 'message': 'Internal server error.'}), 500
 
 # --- API Routes for Device Management ---
 @app.route('/api/user/devices', methods=['GET'])
 @login_required
 def get_user_devices():
-    conn = None; cursor = None; user_id = session.get('user_id'); app.logger.info(f"Fetching devices for user: {user_id}")
+    user_id = session.get('user_id'); app.logger.info("Fetching devices for user: %s", user_id)
     try:
-        conn = get_db_connection();
-        if not conn: return jsonify({'success': False, 'message': 'DB connection failed.'}), 500
-        cursor = conn.cursor(dictionary=True)
-
-        sql = """
-            SELECT
-                id, device_unique_id, device_name,
-                min_temp_threshold, max_temp_threshold,
-                heating_off_start_time, heating_off_end_time
-            FROM devices
-            WHERE user_id = %s ORDER BY created_at ASC
-        """
-
-        cursor.execute(sql, (user_id,)); devices = cursor.fetchall()
-
+        devices = storage.list_user_devices(user_id)
         for device in devices:
-            # Convert Decimals to float
-            if device.get('min_temp_threshold') is not None: device['min_temp_threshold'] = float(device['min_temp_threshold'])
-            if device.get('max_temp_threshold') is not None: device['max_temp_threshold'] = float(device['max_temp_threshold'])
-            # Format TIME fields for frontend (HH:MM) 
+            # Format TIME fields for frontend (HH:MM)
             device['heating_off_start_time'] = format_timedelta_as_time_str(device.get('heating_off_start_time'), '%H:%M')
             device['heating_off_end_time'] = format_timedelta_as_time_str(device.get('heating_off_end_time'), '%H:%M')
 
         return jsonify({'success': True, 'devices': devices})
-    except Error as e: app.logger.error(f"DB error fetching devices user {user_id}: {e}"); return jsonify({'success': False, 'message': 'DB error fetching devices.'}), 500
-    except Exception as e: app.logger.error(f"Unexpected error fetching devices user {user_id}: {e}", exc_info=True); return jsonify({'success': False, 'message': 'Internal server error.'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+    except StorageError as e: app.logger.error("DB error fetching devices user %s: %s", user_id, e); return jsonify({'success': False, 'message': 'DB error fetching devices.'}), 500
+    except Exception as e: app.logger.error("Unexpected error fetching devices user %s: %s", user_id, e, exc_info=True); return jsonify({'success': False, 'message': 'Internal server error.'}), 500
+
+
+# --- Dashboard Overview (all devices at once) ---
+OVERVIEW_SPARKLINE_HOURS = 24
+OVERVIEW_SPARKLINE_STEP_MINUTES = 30 # 48 points per device
+
+@app.route('/api/user/devices/overview', methods=['GET'])
+@login_required
+def get_devices_overview():
+    """Latest reading plus a 24 h sparkline for every device of the user, from two grouped storage queries."""
+    user_id = session.get('user_id')
+    try:
+        devices = {}
+        for row in storage.overview_latest(user_id):
+            latest = format_latest_reading({k: row[k] for k in ('reading_time', 'temperature', 'humidity')}) if row['reading_time'] else None
+            devices[row['id']] = {
+                'id': row['id'], 'device_unique_id': row['device_unique_id'], 'device_name': row['device_name'],
+                'min_temp_threshold': row['min_temp_threshold'], 'max_temp_threshold': row['max_temp_threshold'],
+                'latest': latest
+            }
+
+        points = OVERVIEW_SPARKLINE_HOURS * 60 // OVERVIEW_SPARKLINE_STEP_MINUTES
+        since = (datetime.now() - timedelta(hours=OVERVIEW_SPARKLINE_HOURS)).replace(second=0, microsecond=0)
+        sparklines = defaultdict(lambda: {'temperatures': [None] * points, 'humidities': [None] * points})
+        for row in storage.overview_buckets(user_id, since, OVERVIEW_SPARKLINE_STEP_MINUTES):
+            bucket = int(row['bucket'])
+            if not 0 <= bucket < points: continue
+            line = sparklines[row['device_db_id']]
+            if row['temperature'] is not None: line['temperatures'][bucket] = round(row['temperature'], 1)
+            if row['humidity'] is not None: line['humidities'][bucket] = round(row['humidity'], 1)
+        for device in devices.values():
+            device['sparkline'] = sparklines[device['id']]
+
+        app.logger.debug("Overview for user %s: %s devices.", user_id, len(devices))
+        return jsonify({'success': True, 'devices': list(devices.values()),
+                        'sparkline': {'start': since.isoformat(), 'step_minutes': OVERVIEW_SPARKLINE_STEP_MINUTES, 'points': points}})
+    except StorageError as e: app.logger.error("DB error fetching overview user %s: %s", user_id, e); return jsonify({'success': False, 'message': 'DB error fetching overview.'}), 500
+    except Exception as e: app.logger.error("Unexpected error fetching overview user %s: %s", user_id, e, exc_info=True); return jsonify({'success': False, 'message': 'Internal server error.'}), 500
 
 
 @app.route('/api/user/devices/link', methods=['POST'])
 @login_required
 def link_device():
-    conn = None; cursor = None; user_id = session.get('user_id'); device_unique_id = request.form.get('device_unique_id'); device_name = request.form.get('device_name')
-    app.logger.info(f"Linking device '{device_unique_id}' (Name: {device_name}) user: {user_id}")
+    user_id = session.get('user_id'); device_unique_id = request.form.get('device_unique_id'); device_name = request.form.get('device_name')
+    app.logger.info("Linking device '%s' (Name: %s) user: %s", device_unique_id, device_name, user_id)
     if not device_unique_id: return jsonify({'success': False, 'message': 'Device ID required.'}), 400
     if len(device_unique_id) > 255 or len(device_unique_id) < 3: return jsonify({'success': False, 'message': 'Invalid Device ID format.'}), 400 # Basic check
     if not device_unique_id.isalnum() and '-' not in device_unique_id and '_' not in device_unique_id: # Allow alphanumeric, hyphen, underscore
         return jsonify({'success': False, 'message': 'Device ID contains invalid characters.'}), 400
 
     try:
-        conn = get_db_connection();
-        if not conn: return jsonify({'success': False, 'message': 'DB connection failed.'}), 500
-        cursor = conn.cursor(dictionary=True); cursor.execute("SELECT id, user_id FROM devices WHERE device_unique_id = %s", (device_unique_id,)); existing_device = cursor.fetchone(); cursor.close()
+        existing_device = storage.find_device(device_unique_id)
         if existing_device:
             if existing_device['user_id'] == user_id: return jsonify({'success': False, 'message': 'Device already linked.'}), 409
             else: return jsonify({'success': False, 'message': 'Device registered to another user.'}), 403
-        # Insert with NULLs for thresholds and times
-        insert_sql = "INSERT INTO devices (user_id, device_unique_id, device_name, min_temp_threshold, max_temp_threshold, heating_off_start_time, heating_off_end_time) VALUES (%s, %s, %s, NULL, NULL, NULL, NULL)"
-        insert_cursor = conn.cursor(); insert_cursor.execute(insert_sql, (user_id, device_unique_id, device_name if device_name else None)); new_device_id = insert_cursor.lastrowid; conn.commit(); insert_cursor.close()
-        app.logger.info(f"Linked device '{device_unique_id}' (DB ID: {new_device_id}) user {user_id}.")
-
-        # Fetch the newly inserted device data to return it, including formatted times
-        fetch_cursor = conn.cursor(dictionary=True)
-        fetch_sql = """
-            SELECT id, device_unique_id, device_name,
-                   min_temp_threshold, max_temp_threshold,
-                   heating_off_start_time, heating_off_end_time
-            FROM devices WHERE id = %s
-        """
-        fetch_cursor.execute(fetch_sql, (new_device_id,)); new_device_data = fetch_cursor.fetchone(); fetch_cursor.close()
-
-        if new_device_data:
-             # Format the fields for the JSON response
-             if new_device_data.get('min_temp_threshold') is not None: new_device_data['min_temp_threshold'] = float(new_device_data['min_temp_threshold'])
-             if new_device_data.get('max_temp_threshold') is not None: new_device_data['max_temp_threshold'] = float(new_device_data['max_temp_threshold'])
-             new_device_data['heating_off_start_time'] = format_timedelta_as_time_str(new_device_data.get('heating_off_start_time'), '%H:%M')
-             new_device_data['heating_off_end_time'] = format_timedelta_as_time_str(new_device_data.get('heating_off_end_time'), '%H:%M')
-             return jsonify({'success': True, 'message': 'Device linked successfully!', 'device': new_device_data}), 201
-        else:
-             app.logger.error(f"Failed to retrieve details for newly linked device ID {new_device_id}")
-             return jsonify({'success': True, 'message': 'Device linked, but failed retrieve details.'}), 201 # Still success, but maybe log error
-
-    except Error as e:
-        app.logger.error(f"DB error linking device '{device_unique_id}' user {user_id}: {e}")
-        if e.errno == 1062: return jsonify({'success': False, 'message': 'Device ID already exists.'}), 409
-        return jsonify({'success': False, 'message': 'DB error during linking.'}), 500
-    except Exception as e: app.logger.error(f"Unexpected error linking device '{device_unique_id}' user {user_id}: {e}", exc_info=True); return jsonify({'success': False, 'message': 'Internal server error.'}), 500
-    finally:
-        if conn and conn.is_connected(): conn.close()
+        # Linked with NULL thresholds and times; returned with formatted times
+        new_device_data = storage.create_device(user_id, device_unique_id, device_name if device_name else None)
+        app.logger.info("Linked device '%s' (DB ID: %s) user %s.", device_unique_id, new_device_data['id'], user_id)
+        new_device_data['heating_off_start_time'] = format_timedelta_as_time_str(new_device_data.get('heating_off_start_time'), '%H:%M')
+        new_device_data['heating_off_end_time'] = format_timedelta_as_time_str(new_device_data.get('heating_off_end_time'), '%H:%M')
+        return jsonify({'success': True, 'message': 'Device linked successfully!', 'device': new_device_data}), 201
+
+    except DuplicateEntry: app.logger.warning("Linking device '%s' user %s: ID already exists.", device_unique_id, user_id); return jsonify({'success': False, 'message': 'Device ID already exists.'}), 409
+    except StorageError as e: app.logger.error("DB error linking device '%s' user %s: %s", device_unique_id, user_id, e); return jsonify({'success': False, 'message': 'DB error during linking.'}), 500
+    except Exception as e: app.logger.error("Unexpected error linking device '%s' user %s: %s", device_unique_id, user_id, e, exc_info=True); return jsonify({'success': False, 'message': 'Internal server error.'}), 500
 
 
 @app.route('/api/user/devices/<int:device_db_id>/settings', methods=['PUT'])
 @login_required
 def update_device_settings(device_db_id):
-    conn = None; cursor = None; user_id = session.get('user_id')
+    user_id = session.get('user_id')
     try:
         data = request.get_json();
         if not data: return jsonify({'success': False, 'message': 'JSON data expected.'}), 400
-        app.logger.info(f"Update settings device {device_db_id} user {user_id}. Data: {data}")
+        app.logger.info("Update settings device %s user %s. Data: %s", device_db_id, user_id, data)
         update_fields = {}; params = []
 
         # --- Handle device name ---
@@ -506,7 +963,7 @@ def update_device_settings(device_db_id):
                     # Validate HH:MM format
                     parsed_time = datetime.strptime(str(val), '%H:%M').time()
                     update_fields['heating_off_start_time'] = '%s'
-                    params.append(str(val)) # Store as 'HH:MM' string, DB handles conversion
+                    params.append(parsed_time)
                     off_start_to_set = parsed_time # Keep parsed time for validation
                 except (ValueError, TypeError):
                     return jsonify({'success': False, 'message': 'Invalid start time format (HH:MM).'}), 400
@@ -522,7 +979,7 @@ def update_device_settings(device_db_id):
                     # Validate HH:MM format
                     parsed_time = datetime.strptime(str(val), '%H:%M').time()
                     update_fields['heating_off_end_time'] = '%s'
-                    params.append(str(val)) # Store as 'HH:MM' string
+                    params.append(parsed_time)
                     off_end_to_set = parsed_time # Keep parsed time for validation
                 except (ValueError, TypeError):
                     return jsonify({'success': False, 'message': 'Invalid end time format (HH:MM).'}), 400
@@ -545,16 +1002,10 @@ def update_device_settings(device_db_id):
 
         if needs_fetch_for_validation:
             # Fetch existing values if needed for validation BEFORE update
-             temp_conn = get_db_connection()
-             if not temp_conn: return jsonify({'success': False, 'message': 'DB connection failed for validation.'}), 500
-             val_cursor = temp_conn.cursor(dictionary=True)
-             val_cursor.execute("SELECT min_temp_threshold, max_temp_threshold FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id))
-             current_vals = val_cursor.fetchone()
-             val_cursor.close()
-             temp_conn.close()
+             current_vals = storage.get_user_device(user_id, device_db_id)
              if not current_vals: return jsonify({'success': False, 'message': 'Device not found for validation.'}), 404
-             check_min = float(current_vals['min_temp_threshold']) if current_vals['min_temp_threshold'] is not None else None
-             check_max = float(current_vals['max_temp_threshold']) if current_vals['max_temp_threshold'] is not None else None
+             check_min = current_vals['min_temp_threshold']
+             check_max = current_vals['max_temp_threshold']
 
         # Override fetched values with values being set
         if 'min_temp_threshold' in update_fields: check_min = params[list(update_fields.keys()).index('min_temp_threshold')]
@@ -572,13 +1023,7 @@ def update_device_settings(device_db_id):
             # Check if the *other* value exists in the database if not provided in payload
             if 'heating_off_start_time' not in update_fields or 'heating_off_end_time' not in update_fields:
                  if not needs_fetch_for_validation: # Avoid redundant fetch
-                     temp_conn = get_db_connection()
-                     if not temp_conn: return jsonify({'success': False, 'message': 'DB connection failed for time validation.'}), 500
-                     val_cursor = temp_conn.cursor(dictionary=True)
-                     val_cursor.execute("SELECT heating_off_start_time, heating_off_end_time FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id))
-                     current_times = val_cursor.fetchone()
-                     val_cursor.close()
-                     temp_conn.close()
+                     current_times = storage.get_user_device(user_id, device_db_id)
                      if not current_times: return jsonify({'success': False, 'message': 'Device not found for time validation.'}), 404
 
                      # Check if the *combined* result would be inconsistent
@@ -598,93 +1043,37 @@ def update_device_settings(device_db_id):
         if not update_fields: return jsonify({'success': False, 'message': 'No valid settings provided to update.'}), 400
 
         # --- Database Update ---
-        conn = get_db_connection();
-        if not conn: return jsonify({'success': False, 'message': 'DB connection failed.'}), 500
-        cursor = conn.cursor()
-        try:
-            set_clause = ", ".join([f"{key} = %s" for key in update_fields.keys()])
-            sql_params = tuple(params + [device_db_id, user_id]) # Ensure order matches SET clause + WHERE clause
-
-            sql = f"UPDATE devices SET {set_clause} WHERE id = %s AND user_id = %s"
-            app.logger.debug(f"Executing update: {sql} with params: {sql_params}")
-            cursor.execute(sql, sql_params); rows_affected = cursor.rowcount
-
-            if rows_affected == 0:
-                 # Check if the device actually exists for this user
-                 check_cursor = conn.cursor()
-                 check_cursor.execute("SELECT id FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id))
-                 exists = check_cursor.fetchone()
-                 check_cursor.close()
-                 if not exists:
-                     app.logger.warning(f"Update settings failed: Device {device_db_id} not found or not owned by user {user_id}.")
-                     return jsonify({'success': False, 'message': 'Device not found or permission denied.'}), 404
-                 else:
-                      # Device exists, but maybe no changes were actually made (e.g., sent same values)
-                      app.logger.info(f"Settings update for device {device_db_id} resulted in 0 rows affected (no change or concurrent update?).")
-                      # Return success even if no rows changed, as the data is effectively 'set'
-                      conn.commit() # Commit anyway in case of concurrent updates resolving
-                      return jsonify({'success': True, 'message': 'Settings already up to date or no changes made.'})
-
-
-            conn.commit()
-            app.logger.info(f"Settings updated successfully for device {device_db_id} user {user_id}.")
-            return jsonify({'success': True, 'message': 'Settings updated successfully!'})
-        except Error as e:
-            conn.rollback() # Rollback on error
-            app.logger.error(f"DB error during update settings device {device_db_id}: {e}")
-            return jsonify({'success': False, 'message': 'DB error updating settings.'}), 500
-        finally:
-             if cursor: cursor.close()
+        changes = dict(zip(update_fields.keys(), params))
+        app.logger.debug("Updating device %s with: %s", device_db_id, changes)
+        if not storage.update_device(user_id, device_db_id, changes):
+            app.logger.warning("Update settings failed: Device %s not found or not owned by user %s.", device_db_id, user_id)
+            return jsonify({'success': False, 'message': 'Device not found or permission denied.'}), 404
+        app.logger.info("Settings updated successfully for device %s user %s.", device_db_id, user_id)
+        return jsonify({'success': True, 'message': 'Settings updated successfully!'})
 
+    except StorageError as e:
+        app.logger.error("DB error during update settings device %s: %s", device_db_id, e)
+        return jsonify({'success': False, 'message': 'DB error updating settings.'}), 500
     except (ValueError, TypeError) as e: # Catch validation errors
-        app.logger.error(f"Value/Type error processing settings update: {e}")
+        app.logger.error("Value/Type error processing settings update: %s", e)
         return jsonify({'success': False, 'message': str(e)}), 400 # Return specific validation message
     except Exception as e:
-        app.logger.error(f"Unexpected error update settings device {device_db_id}: {e}", exc_info=True)
+        app.logger.error("Unexpected error update settings device %s: %s", device_db_id, e, exc_info=True)
         return jsonify({'success': False, 'message': 'Internal server error.'}), 500
-    finally:
-        # Ensure connection is closed if opened
-        if conn and conn.is_connected(): conn.close()
 
 
 @app.route('/api/user/devices/<int:device_db_id>/unlink', methods=['DELETE'])
 @login_required
 def unlink_device(device_db_id):
-    conn = None; cursor = None; user_id = session.get('user_id'); app.logger.info(f"Unlink device {device_db_id} user {user_id}")
+    user_id = session.get('user_id'); app.logger.info("Unlink device %s user %s", device_db_id, user_id)
     try:
-        conn = get_db_connection();
-        if not conn: return jsonify({'success': False, 'message': 'DB connection failed.'}), 500
-        cursor = conn.cursor()
-        # Check for related readings BEFORE deleting device
-        check_cursor = conn.cursor(dictionary=True)
-        check_cursor.execute("SELECT device_unique_id FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id))
-        device = check_cursor.fetchone()
-        if not device:
-            check_cursor.close()
-            return jsonify({'success': False, 'message': 'Device not found or permission denied.'}), 404
-
-        sql = "DELETE FROM devices WHERE id = %s AND user_id = %s"; cursor.execute(sql, (device_db_id, user_id)); rows_affected = cursor.rowcount
-        check_cursor.close() # Close check cursor
-
-        if rows_affected == 0:
-             # Should have been caught by the check above, but handles race conditions
-             return jsonify({'success': False, 'message': 'Device not found or permission denied (concurrent delete?).'}), 404
-
-        conn.commit(); app.logger.info(f"Device {device_db_id} unlinked user {user_id}."); return jsonify({'success': True, 'message': 'Device unlinked successfully.'})
-    except Error as e:
-        conn.rollback() # Rollback on error
-        app.logger.error(f"DB error unlinking device {device_db_id}: {e}")
-        # Check for foreign key violation error (e.g., 1451)
-        if e.errno == 1451:
-             app.logger.warning(f"Attempted to unlink device {device_db_id} with existing readings (FK constraint).")
-             return jsonify({'success': False, 'message': 'Cannot unlink device. Associated readings must be cleared first (contact admin?).'}), 409 # Conflict
-        return jsonify({'success': False, 'message': 'DB error unlinking device.'}), 500
-    except Exception as e:
-        if conn: conn.rollback() # Rollback on unexpected errors too
-        app.logger.error(f"Unexpected error unlinking device {device_db_id}: {e}", exc_info=True); return jsonify({'success': False, 'message': 'Internal server error.'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        if not storage.delete_device(user_id, device_db_id): return jsonify({'success': False, 'message': 'Device not found or permission denied.'}), 404
+        app.logger.info("Device %s unlinked user %s.", device_db_id, user_id); return jsonify({'success': True, 'message': 'Device unlinked successfully.'})
+    except StillReferenced:
+        app.logger.warning("Attempted to unlink device %s with existing readings (FK constraint).", device_db_id)
+        return jsonify({'success': False, 'message': 'Cannot unlink device. Associated readings must be cleared first (contact admin?).'}), 409 # Conflict
+    except StorageError as e: app.logger.error("DB error unlinking device %s: %s", device_db_id, e); return jsonify({'success': False, 'message': 'DB error unlinking device.'}), 500
+    except Exception as e: app.logger.error("Unexpected error unlinking device %s: %s", device_db_id, e, exc_info=True); return jsonify({'success': False, 'message': 'Internal server error.'}), 500
 
 
 # --- API Route for Receiving Device Data ---
@@ -694,32 +1083,51 @@ def receive_device_readings():
     if not data: return jsonify({"error": "JSON data expected."}), 400
     device_uid = data.get('device_unique_id'); temp = data.get('temperature'); humid = data.get('humidity')
     if not device_uid or temp is None or humid is None: return jsonify({"error": "Missing required fields."}), 400
-    conn = None; cursor = None; insert_cursor = None
     try:
-        conn = get_db_connection();
-        if not conn: return jsonify({"error": "DB connection failed."}), 500
-        # Quickly check if device exists 
-        cursor = conn.cursor(); cursor.execute("SELECT 1 FROM devices WHERE device_unique_id = %s LIMIT 1", (device_uid,)); device_exists = cursor.fetchone(); cursor.close()
-        if not device_exists: app.logger.warning(f"Reading from unknown/unregistered device: {device_uid}"); return jsonify({"error": "Device ID not registered."}), 403 # Forbidden or Not Found
+        # Resolve the device's integer key (also the registration check); usually served from the resolver cache
+        device_db_id = storage.resolve_device_keys([device_uid]).get(device_uid)
+        if device_db_id is None: app.logger.warning("Reading from unknown/unregistered device: %s", device_uid); return jsonify({"error": "Device ID not registered."}), 403 # Forbidden or Not Found
 
         try: temp_float = float(temp); humid_float = float(humid)
         except (ValueError,TypeError): return jsonify({"error": "Invalid temp/humid value."}), 400
         # Add range validation for received data?
-        if not (-40 <= temp_float <= 85): app.logger.warning(f"Implausible temp received {temp_float} from {device_uid}"); # Log but maybe still store?
-        if not (0 <= humid_float <= 100): app.logger.warning(f"Implausible humidity received {humid_float} from {device_uid}"); # Log but maybe still store?
-
-        reading_time = datetime.now(); sql = "INSERT INTO readings (device_unique_id, reading_time, temperature, humidity) VALUES (%s, %s, %s, %s)"
-        insert_cursor = conn.cursor(); insert_cursor.execute(sql, (device_uid, reading_time, temp_float, humid_float)); conn.commit()
-        app.logger.debug(f"Stored reading from device {device_uid}"); return jsonify({"success": True, "message": "Reading stored."}), 201
-    except Error as e:
-        if conn: conn.rollback()
-        app.logger.error(f"DB error storing reading device {device_uid}: {e}"); return jsonify({"error": "DB error storing reading."}), 500
-    except Exception as e:
-        if conn: conn.rollback()
-        app.logger.error(f"Unexpected error storing reading device {device_uid}: {e}", exc_info=True); return jsonify({"error": "Internal server error."}), 500
-    finally:
-        if insert_cursor: insert_cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        if not (-40 <= temp_float <= 85): app.logger.warning("Implausible temp received %s from %s", temp_float, device_uid); # Log but maybe still store?
+        if not (0 <= humid_float <= 100): app.logger.warning("Implausible humidity received %s from %s", humid_float, device_uid); # Log but maybe still store?
+
+        hold_seconds, hold_error = parse_hold_seconds(data.get('hold_seconds'))
+        if hold_error: return jsonify({"error": hold_error}), 400
+
+        storage.add_readings([(device_db_id, device_uid, datetime.now(), temp_float, humid_float, hold_seconds)])
+        terrarium_metrics.inc('terrarium_readings_ingested_total', (('device_id', str(device_db_id)),))
+        app.logger.debug("Stored reading from device %s", device_uid); return jsonify({"success": True, "message": "Reading stored."}), 201
+    except UnknownDevice: app.logger.warning("Device %s was unlinked while its reading was stored.", device_uid); return jsonify({"error": "Device ID not registered."}), 403
+    except StorageError as e: app.logger.error("DB error storing reading device %s: %s", device_uid, e); return jsonify({"error": "DB error storing reading."}), 500
+    except Exception as e: app.logger.error("Unexpected error storing reading device %s: %s", device_uid, e, exc_info=True); return jsonify({"error": "Internal server error."}), 500
+
+
+# --- API Route for Batched Device Data (gateway Pis) ---
+BATCH_READINGS_MAX = 500 # Readings accepted per batch request
+BATCH_READING_MAX_AGE_SEC = 24 * 3600 # Oldest queued reading accepted (age_seconds)
+
+@app.route('/api/device/readings/batch', methods=['POST'])
+def receive_device_readings_batch():
+    """
+    Readings for several devices (or several queued readings of one device) in one request and one transaction.
+    Invalid or unregistered entries are skipped and listed in 'rejected'; the rest are stored.
+    """
+    rows, rejected, request_error = parse_batch_readings(request.get_json(silent=True), datetime.now())
+    if request_error: return jsonify({"error": request_error}), 400
+    readings = []
+    try:
+        if rows:
+            readings = registered_batch_rows(rows, storage.resolve_device_keys(sorted({row[1] for row in rows})), rejected)
+            if readings: storage.add_readings(readings)
+            for device_db_id, count in Counter(reading[0] for reading in readings).items(): terrarium_metrics.inc('terrarium_readings_ingested_total', (('device_id', str(device_db_id)),), count)
+        if rejected: app.logger.warning("Batch readings: %s stored, %s rejected: %s", len(readings), len(rejected), rejected[:5])
+        else: app.logger.debug("Batch readings: %s stored.", len(readings))
+        return jsonify({"success": True, "stored": len(readings), "rejected": rejected}), 201
+    except StorageError as e: app.logger.error("DB error storing batch of %s readings: %s", len(rows), e); return jsonify({"error": "DB error storing readings."}), 500
+    except Exception as e: app.logger.error("Unexpected error storing batch readings: %s", e, exc_info=True); return jsonify({"error": "Internal server error."}), 500
 
 
 # --- API Route for Device Settings ---
@@ -733,65 +1141,46 @@ def get_device_settings(device_unique_id):
         app.logger.warning("Attempt to fetch settings with empty device ID.")
         return jsonify({"error": "Device unique ID is required."}), 400
 
-    conn = None
-    cursor = None
-    app.logger.info(f"Device settings request received for ID: {device_unique_id}")
+    app.logger.info("Device settings request received for ID: %s", device_unique_id)
 
     try:
-        conn = get_db_connection()
-        if not conn:
-            app.logger.error(f"Failed to get DB connection for settings request (Device: {device_unique_id})")
-            return jsonify({"error": "Database connection failed"}), 500
-
-        cursor = conn.cursor(dictionary=True)
-        
-        sql = """
-            SELECT
-                min_temp_threshold,
-                max_temp_threshold,
-                heating_off_start_time,
-                heating_off_end_time
-            FROM devices
-            WHERE device_unique_id = %s
-        """
-        
-        cursor.execute(sql, (device_unique_id,))
-        device_settings = cursor.fetchone()
+        device_settings = storage.find_device(device_unique_id)
 
         if device_settings:
-            min_temp = device_settings.get('min_temp_threshold')
-            max_temp = device_settings.get('max_temp_threshold')
-            # Get time values 
-            off_start_time_td = device_settings.get('heating_off_start_time')
-            off_end_time_td = device_settings.get('heating_off_end_time')
-
-            settings_data = {
-                'min_temp_threshold': float(min_temp) if min_temp is not None else None,
-                'max_temp_threshold': float(max_temp) if max_temp is not None else None,
-                # Format for device script (HH:MM:SS) using helper
-                'heating_off_start_time': format_timedelta_as_time_str(off_start_time_td, '%H:%M:%S'),
-                'heating_off_end_time': format_timedelta_as_time_str(off_end_time_td, '%H:%M:%S')
-            }
-            # *** MODIFICATION END ***
-            app.logger.info(f"Found settings for device {device_unique_id}: {settings_data}")
+            settings_data = format_device_settings(device_settings)
+            app.logger.info("Found settings for device %s: %s", device_unique_id, settings_data)
             return jsonify(settings_data), 200
         else:
-            app.logger.warning(f"Settings request failed: Device ID {device_unique_id} not found in database.")
+            app.logger.warning("Settings request failed: Device ID %s not found in database.", device_unique_id)
             # Ensure device exists before returning 404 - might be temporary issue
             return jsonify({"error": "Device not found"}), 404
 
-    except Error as e:
-        app.logger.error(f"Database error fetching settings for device {device_unique_id}: {e}")
+    except StorageError as e:
+        app.logger.error("Database error fetching settings for device %s: %s", device_unique_id, e)
         return jsonify({"error": "Database error fetching settings."}), 500
     except Exception as e:
-        app.logger.error(f"Unexpected error fetching settings for device {device_unique_id}: {e}", exc_info=True)
+        app.logger.error("Unexpected error fetching settings for device %s: %s", device_unique_id, e, exc_info=True)
         return jsonify({"error": "Internal server error."}), 500
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
-            app.logger.debug(f"DB connection closed for settings request device {device_unique_id}.")
+
+
+# --- API Route for Bulk Device Settings ---
+BULK_SETTINGS_MAX_DEVICES = 200 # Device IDs accepted per bulk request
+
+@app.route('/api/device/settings/bulk', methods=['POST'])
+def get_bulk_device_settings():
+    """
+    Settings for many devices in one request/query (gateway Pis, fleet tools).
+    Body: {"devices": {"<device_unique_id>": "<known settings_version or null>", ...}}
+    Returns only settings whose version differs: {"settings": {uid: {...}}, "unchanged": [uid...], "unknown": [uid...]}
+    """
+    known_versions, request_error = parse_bulk_settings_request(request.get_json(silent=True))
+    if request_error: return jsonify({"error": request_error}), 400
+    try:
+        result = build_bulk_settings_response(storage.get_devices_by_uid(list(known_versions)), known_versions)
+        app.logger.debug("Bulk settings: %s requested, %s changed, %s unknown.", len(known_versions), len(result['settings']), len(result['unknown']))
+        return jsonify(result), 200
+    except StorageError as e: app.logger.error("Database error fetching bulk settings (%s devices): %s", len(known_versions), e); return jsonify({"error": "Database error fetching settings."}), 500
+    except Exception as e: app.logger.error("Unexpected error fetching bulk settings: %s", e, exc_info=True); return jsonify({"error": "Internal server error."}), 500
 
 
 # --- Run the App ---
@@ -0,0 +1,305 @@
+# /home/DanDev/terrarium_webapp/app_async.py
+# --- Async (ASGI) serving mode ---
+# Serves the I/O-bound APIs (/api/device/*, /api/readings/latest, /api/chartdata) from an event loop on
+# a shared aiomysql connection pool, so waiting on MariaDB doesn't hold a whole worker per request.
+# Every other route (pages, login, device management) is handed to the Flask app in app.py unchanged.
+#
+# Run (instead of the sync gunicorn command in terrarium-webapp.service):
+#   gunicorn -k uvicorn.workers.UvicornWorker --workers 2 --bind 0.0.0.0:5000 app_async:app
+# Needs: starlette, uvicorn, aiomysql, a2wsgi (pip install into temp_humidity_env).
+# FLASK_SECRET_KEY must be set, otherwise each worker signs session cookies with its own random key.
+# MariaDB only (TERRARIUM_STORAGE=mariadb): queries and the device key resolver are MariaDBStorage's from terrarium_storage.py.
+
+import os
+import asyncio
+import logging
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from functools import wraps
+from datetime import datetime
+import aiomysql
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+import app as flask_module # Shared config, storage and formatting helpers (also sets up logging)
+import terrarium_storage
+import terrarium_metrics
+import terrarium_profiler
+import terrarium_slow_queries
+import terrarium_singleflight
+
+flask_app = flask_module.app
+storage = flask_module.storage
+logger = logging.getLogger('app_async')
+if not isinstance(storage, terrarium_storage.MariaDBStorage):
+    raise RuntimeError(f"Async serving mode needs TERRARIUM_STORAGE=mariadb, not '{storage.name}'.")
+
+# --- Configuration ---
+ASYNC_DB_POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', '20')) # Max MariaDB connections per worker process
+ASYNC_DB_ACQUIRE_TIMEOUT = float(os.environ.get('ASYNC_DB_ACQUIRE_TIMEOUT', '5')) # Seconds to wait for a free pooled connection
+
+if not os.environ.get('FLASK_SECRET_KEY'):
+    logger.warning("FLASK_SECRET_KEY not set: sessions will only be valid on the worker that created them.")
+
+# --- Database Pool ---
+db_pool = None # aiomysql pool, created at startup
+
+class TimedCursor:
+    """aiomysql cursor whose statements are timed and slow ones captured, as terrarium_storage does for the sync backends."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    async def execute(self, sql, params=None):
+        started = time.perf_counter(); result = await self.cursor.execute(sql, params) # Buffered cursor: includes fetching
+        await self.observe(sql, params, started); return result
+
+    async def executemany(self, sql, seq_params):
+        started = time.perf_counter(); result = await self.cursor.executemany(sql, seq_params)
+        await self.observe(sql, seq_params[0] if seq_params else None, started); return result
+
+    async def observe(self, sql, params, started):
+        seconds = time.perf_counter() - started
+        name = storage.statement_done(sql, seconds)
+        if name is None: return
+        plan = None
+        if terrarium_slow_queries.explainable(sql):
+            try:
+                async with self.cursor.connection.cursor(aiomysql.DictCursor) as cursor:
+                    await cursor.execute("EXPLAIN " + sql, params); plan = await cursor.fetchall()
+            except aiomysql.Error as e: plan = {'error': str(e)}
+        await run_in_threadpool(terrarium_slow_queries.record, name, 'mariadb-async', sql, params, seconds, self.cursor.rowcount, plan)
+
+@asynccontextmanager
+async def db_cursor(dictionary=False):
+    """Yields a cursor on a pooled connection (autocommit). Raises asyncio.TimeoutError if the pool stays exhausted."""
+    conn = await asyncio.wait_for(db_pool.acquire(), ASYNC_DB_ACQUIRE_TIMEOUT)
+    try:
+        async with conn.cursor(aiomysql.DictCursor if dictionary else aiomysql.Cursor) as cursor:
+            yield TimedCursor(cursor)
+    finally:
+        db_pool.release(conn)
+
+@asynccontextmanager
+async def lifespan(asgi_app):
+    global db_pool
+    db_pool = await aiomysql.create_pool(host=flask_module.DB_HOST, user=flask_module.DB_USER, password=flask_module.DB_PASSWORD,
+                                         db=flask_module.DB_NAME, minsize=1, maxsize=ASYNC_DB_POOL_SIZE, connect_timeout=5, autocommit=True)
+    logger.info("Async DB pool ready (max %s connections).", ASYNC_DB_POOL_SIZE)
+    yield
+    db_pool.close(); await db_pool.wait_closed()
+    logger.info("Async DB pool closed.")
+
+# --- Session (same cookie as Flask) ---
+def load_flask_session(request):
+    """Decodes the Flask session cookie exactly as Flask's default session interface does. Returns {} if missing/invalid."""
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if not cookie or serializer is None: return {}
+    try: return serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature: return {}
+
+def login_required(handler):
+    """Async counterpart of app.login_required; the decoded session is put on request.state.session."""
+    @wraps(handler)
+    async def decorated_function(request):
+        session = load_flask_session(request)
+        if 'logged_in' not in session or not session.get('user_id'):
+            logger.warning("Unauthorized access attempt to %s - login required or session invalid.", request.url.path)
+            return JSONResponse({'success': False, 'message': 'Authentication required.'}, status_code=401)
+        request.state.session = session
+        return await handler(request)
+    return decorated_function
+
+async def resolve_device_keys(cursor, device_uids):
+    """Async counterpart of MariaDBStorage.resolve_device_keys (same per-process cache)."""
+    resolved, missing = storage.cached_device_keys(device_uids)
+    if missing:
+        await cursor.execute(terrarium_storage.RESOLVE_DEVICE_KEYS_SQL.format(placeholders=", ".join(["%s"] * len(missing))), tuple(missing))
+        resolved.update(storage.remember_device_keys(await cursor.fetchall()))
+    return resolved
+
+def instrumented(route, handler):
+    """
+    Request metrics and profiling as app.py does them for Flask routes; 'route' is the matching Flask rule, so series line up.
+    A profile samples the event loop thread, so requests served concurrently on the same loop show up in it too.
+    """
+    @wraps(handler)
+    async def decorated_function(request):
+        started = time.perf_counter(); status = 500
+        profiler = terrarium_profiler.SamplingProfiler().start() if flask_module.profile_requested(request.headers) else None
+        terrarium_metrics.inc('terrarium_http_requests_in_flight')
+        try:
+            response = await handler(request); status = response.status_code
+            return response
+        finally:
+            if profiler is not None:
+                profiler.stop() # Joins the sampler thread: at most one sampling interval
+                terrarium_profiler.save(profiler, route, request.method, dict(request.query_params), status, time.perf_counter() - started)
+            labels = (('route', route), ('method', request.method))
+            terrarium_metrics.inc('terrarium_http_requests_in_flight', amount=-1)
+            terrarium_metrics.observe('terrarium_http_request_duration_seconds', time.perf_counter() - started, labels)
+            terrarium_metrics.inc('terrarium_http_requests_total', labels + (('status', str(status)),))
+    return decorated_function
+
+def int_arg(request, name):
+    """Like Flask's request.args.get(name, type=int): None if missing or not an integer."""
+    try: return int(request.query_params[name])
+    except (KeyError, ValueError): return None
+
+# --- API Routes for Data ---
+@login_required
+async def get_latest_readings(request):
+    user_id = request.state.session['user_id']; target_device_db_id = int_arg(request, 'device_id')
+    if not target_device_db_id: return JSONResponse({"error": "Device ID parameter is required."}, status_code=400)
+    try:
+        async with db_cursor(dictionary=True) as cursor:
+            await cursor.execute("SELECT id, device_unique_id FROM devices WHERE id = %s AND user_id = %s", (target_device_db_id, user_id)); device = await cursor.fetchone()
+            if not device: return JSONResponse({"error": "Device not found or access denied."}, status_code=404)
+        async def fetch_latest():
+            async with db_cursor(dictionary=True) as cursor:
+                await cursor.execute(terrarium_storage.LATEST_READING_SQL, (storage.readings_key(device),)); return flask_module.format_latest_reading(await cursor.fetchone(), device['device_unique_id'])
+        latest_reading = await terrarium_singleflight.run_async('latest', ('latest', device['id']), fetch_latest) # Identical concurrent requests share one query
+    except asyncio.TimeoutError: logger.error("No pooled DB connection for latest reading user %s.", user_id); return JSONResponse({"error": "Database connection failed"}, status_code=500)
+    except aiomysql.Error as e: logger.error("DB Err latest reading user %s, dev %s: %s", user_id, target_device_db_id, e); return JSONResponse({"error": "Failed to fetch latest data"}, status_code=500)
+    except Exception as e: logger.error("Unexpected err latest reading: %s", e, exc_info=True); return JSONResponse({"error": "Internal server error"}, status_code=500)
+    return JSONResponse(latest_reading)
+
+@login_required
+async def get_chart_data(request):
+    params = request.query_params
+    time_range = params.get('range'); start_date_str = params.get('start_date'); end_date_str = params.get('end_date'); device_db_id = int_arg(request, 'device_id')
+    user_id = request.state.session['user_id']
+    if not device_db_id: return JSONResponse({"error": "Device ID parameter is required."}, status_code=400)
+    logger.info("Chart data request - User: %s, DeviceDBID: %s, Range: %s, Start: %s, End: %s", user_id, device_db_id, time_range, start_date_str, end_date_str)
+    try:
+        async with db_cursor(dictionary=True) as cursor:
+            await cursor.execute("SELECT id, device_unique_id FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id)); device = await cursor.fetchone()
+            if not device: return JSONResponse({"error": "Device not found or access denied."}, status_code=404)
+        start_dt_query, end_dt_exclusive, interval_minutes, range_error = flask_module.resolve_chart_range(time_range, start_date_str, end_date_str)
+        if range_error: return JSONResponse({"error": range_error}, status_code=400)
+        compact = params.get('format') == 'compact'
+        async def fetch_chart():
+            anchor = flask_module.chart_anchor(start_dt_query)
+            async with db_cursor(dictionary=True) as cursor:
+                await cursor.execute(terrarium_storage.CHART_BUCKETS_SQL, (anchor, interval_minutes, storage.readings_key(device), start_dt_query - flask_module.CHART_HOLD_LOOKBACK, end_dt_exclusive))
+                buckets = [terrarium_storage.mariadb_bucket(row) for row in await cursor.fetchall()]
+            terrarium_metrics.observe('terrarium_chart_rows_fetched', len(buckets), (('backend', storage.name),))
+            logger.info("Fetched %s intervals for device %s [%s - %s].", len(buckets), device['device_unique_id'], start_dt_query, end_dt_exclusive)
+            # Laying out a long range is CPU work; keep it off the event loop
+            return await run_in_threadpool(flask_module.chart_payload, buckets, anchor, start_dt_query, end_dt_exclusive, interval_minutes, compact)
+        # Keyed by the request parameters, as in app.py, so lined-up refreshes share one computation
+        chart_data = await terrarium_singleflight.run_async('chart', ('chart', device['id'], time_range, start_date_str, end_date_str, compact), fetch_chart)
+        body, headers = await run_in_threadpool(flask_module.encode_json_body, chart_data, request.headers.get('accept-encoding'))
+    except ValueError as ve: logger.error("Date/value error device %s: %s", device_db_id, ve); return JSONResponse({"error": "Invalid date format or value."}, status_code=400)
+    except asyncio.TimeoutError: logger.error("No pooled DB connection for chart data device %s.", device_db_id); return JSONResponse({"error": "Database connection failed"}, status_code=500)
+    except aiomysql.Error as e: logger.error("DB error chart data device %s: %s", device_db_id, e); return JSONResponse({"error": "Database error processing chart data."}, status_code=500)
+    except Exception as e: logger.error("Unexpected error chart data device %s: %s", device_db_id, e, exc_info=True); return JSONResponse({"error": "Internal server error."}, status_code=500)
+    return Response(body, headers=headers)
+
+# --- API Route for Receiving Device Data ---
+async def receive_device_readings(request):
+    try: data = await request.json()
+    except ValueError: data = None
+    if not data or not isinstance(data, dict): return JSONResponse({"error": "JSON data expected."}, status_code=400)
+    device_uid = data.get('device_unique_id'); temp = data.get('temperature'); humid = data.get('humidity')
+    if not device_uid or temp is None or humid is None: return JSONResponse({"error": "Missing required fields."}, status_code=400)
+    try:
+        async with db_cursor() as cursor:
+            device_db_id = (await resolve_device_keys(cursor, [device_uid])).get(device_uid)
+            if device_db_id is None: logger.warning("Reading from unknown/unregistered device: %s", device_uid); return JSONResponse({"error": "Device ID not registered."}, status_code=403)
+
+            try: temp_float = float(temp); humid_float = float(humid)
+            except (ValueError, TypeError): return JSONResponse({"error": "Invalid temp/humid value."}, status_code=400)
+            if not (-40 <= temp_float <= 85): logger.warning("Implausible temp received %s from %s", temp_float, device_uid)
+            if not (0 <= humid_float <= 100): logger.warning("Implausible humidity received %s from %s", humid_float, device_uid)
+
+            hold_seconds, hold_error = flask_module.parse_hold_seconds(data.get('hold_seconds'))
+            if hold_error: return JSONResponse({"error": hold_error}, status_code=400)
+
+            await cursor.execute(terrarium_storage.INSERT_READING_SQL, storage.reading_insert_params(device_db_id, device_uid, datetime.now(), temp_float, humid_float, hold_seconds))
+        terrarium_metrics.inc('terrarium_readings_ingested_total', (('device_id', str(device_db_id)),))
+        logger.debug("Stored reading from device %s", device_uid); return JSONResponse({"success": True, "message": "Reading stored."}, status_code=201)
+    except asyncio.TimeoutError: logger.error("No pooled DB connection for reading from device %s.", device_uid); return JSONResponse({"error": "DB connection failed."}, status_code=500)
+    except aiomysql.Error as e:
+        if e.args and e.args[0] == 1452: storage.device_key_cache.pop(device_uid, None) # FK: cached key is stale
+        logger.error("DB error storing reading device %s: %s", device_uid, e); return JSONResponse({"error": "DB error storing reading."}, status_code=500)
+    except Exception as e: logger.error("Unexpected error storing reading device %s: %s", device_uid, e, exc_info=True); return JSONResponse({"error": "Internal server error."}, status_code=500)
+
+# --- API Route for Batched Device Data (gateway Pis) ---
+async def receive_device_readings_batch(request):
+    try: data = await request.json()
+    except ValueError: data = None
+    rows, rejected, request_error = flask_module.parse_batch_readings(data, datetime.now())
+    if request_error: return JSONResponse({"error": request_error}, status_code=400)
+    insert_params = []
+    try:
+        if rows:
+            async with db_cursor() as cursor:
+                device_keys = await resolve_device_keys(cursor, sorted({row[1] for row in rows}))
+                readings = flask_module.registered_batch_rows(rows, device_keys, rejected)
+                insert_params = [storage.reading_insert_params(*reading) for reading in readings]
+                if insert_params: await cursor.executemany(terrarium_storage.INSERT_READING_SQL, insert_params) # One multi-row INSERT
+            for device_db_id, count in Counter(reading[0] for reading in readings).items(): terrarium_metrics.inc('terrarium_readings_ingested_total', (('device_id', str(device_db_id)),), count)
+        if rejected: logger.warning("Batch readings: %s stored, %s rejected: %s", len(insert_params), len(rejected), rejected[:5])
+        else: logger.debug("Batch readings: %s stored.", len(insert_params))
+        return JSONResponse({"success": True, "stored": len(insert_params), "rejected": rejected}, status_code=201)
+    except asyncio.TimeoutError: logger.error("No pooled DB connection for batch of %s readings.", len(rows)); return JSONResponse({"error": "DB connection failed."}, status_code=500)
+    except aiomysql.Error as e:
+        if e.args and e.args[0] == 1452: storage.device_key_cache.clear() # FK: a cached key is stale
+        logger.error("DB error storing batch of %s readings: %s", len(rows), e); return JSONResponse({"error": "DB error storing readings."}, status_code=500)
+    except Exception as e: logger.error("Unexpected error storing batch readings: %s", e, exc_info=True); return JSONResponse({"error": "Internal server error."}, status_code=500)
+
+# --- API Route for Device Settings ---
+async def get_device_settings(request):
+    device_unique_id = request.path_params['device_unique_id']
+    logger.info("Device settings request received for ID: %s", device_unique_id)
+    try:
+        async with db_cursor(dictionary=True) as cursor:
+            await cursor.execute("SELECT min_temp_threshold, max_temp_threshold, heating_off_start_time, heating_off_end_time FROM devices WHERE device_unique_id = %s", (device_unique_id,))
+            device_settings = await cursor.fetchone()
+        if not device_settings:
+            logger.warning("Settings request failed: Device ID %s not found in database.", device_unique_id)
+            return JSONResponse({"error": "Device not found"}, status_code=404)
+        settings_data = flask_module.format_device_settings(device_settings)
+        logger.info("Found settings for device %s: %s", device_unique_id, settings_data)
+        return JSONResponse(settings_data)
+    except asyncio.TimeoutError: logger.error("No pooled DB connection for settings request (Device: %s)", device_unique_id); return JSONResponse({"error": "Database connection failed"}, status_code=500)
+    except aiomysql.Error as e: logger.error("Database error fetching settings for device %s: %s", device_unique_id, e); return JSONResponse({"error": "Database error fetching settings."}, status_code=500)
+    except Exception as e: logger.error("Unexpected error fetching settings for device %s: %s", device_unique_id, e, exc_info=True); return JSONResponse({"error": "Internal server error."}, status_code=500)
+
+# --- API Route for Bulk Device Settings ---
+async def get_bulk_device_settings(request):
+    try: data = await request.json()
+    except ValueError: data = None
+    known_versions, request_error = flask_module.parse_bulk_settings_request(data)
+    if request_error: return JSONResponse({"error": request_error}, status_code=400)
+    try:
+        async with db_cursor(dictionary=True) as cursor:
+            await cursor.execute(terrarium_storage.DEVICES_BY_UID_SQL.format(placeholders=", ".join(["%s"] * len(known_versions))), tuple(known_versions))
+            rows = await cursor.fetchall()
+        result = flask_module.build_bulk_settings_response(rows, known_versions)
+        logger.debug("Bulk settings: %s requested, %s changed, %s unknown.", len(known_versions), len(result['settings']), len(result['unknown']))
+        return JSONResponse(result)
+    except asyncio.TimeoutError: logger.error("No pooled DB connection for bulk settings request."); return JSONResponse({"error": "Database connection failed"}, status_code=500)
+    except aiomysql.Error as e: logger.error("Database error fetching bulk settings (%s devices): %s", len(known_versions), e); return JSONResponse({"error": "Database error fetching settings."}, status_code=500)
+    except Exception as e: logger.error("Unexpected error fetching bulk settings: %s", e, exc_info=True); return JSONResponse({"error": "Internal server error."}, status_code=500)
+
+# --- ASGI App ---
+routes = [
+    Route('/api/readings/latest', instrumented('/api/readings/latest', get_latest_readings)),
+    Route('/api/chartdata', instrumented('/api/chartdata', get_chart_data)),
+    Route('/api/device/readings', instrumented('/api/device/readings', receive_device_readings), methods=['POST']),
+    Route('/api/device/readings/batch', instrumented('/api/device/readings/batch', receive_device_readings_batch), methods=['POST']),
+    Route('/api/device/settings/bulk', instrumented('/api/device/settings/bulk', get_bulk_device_settings), methods=['POST']),
+    Route('/api/device/settings/{device_unique_id}', instrumented('/api/device/settings/<string:device_unique_id>', get_device_settings)),
+    Mount('/', app=WSGIMiddleware(flask_app)), # Everything else (and /metrics): the regular Flask routes
+]
+app = Starlette(routes=routes, lifespan=lifespan)
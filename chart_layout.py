@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# --- chart_layout.py ---
+# Lays the per-interval aggregates of a chart query (Storage.reading_buckets() / CHART_BUCKETS_SQL rows) out as
+# /api/chartdata responses, for app.py and app_async.py. Pure functions: no database, no Flask, no clock.
+#   default format -- a '%Y-%m-%d %H:%M' label per interval, values rounded to 2 decimals, gaps as label pairs
+#   compact format -- start/step instead of labels, values as scaled ints, gaps as index pairs (decoded by index.html)
+
+import logging
+from datetime import datetime, timedelta, time as time_obj
+
+logger = logging.getLogger('app')
+
+# --- Get interval key ---
+def get_interval_key(reading_time, interval_minutes):
+    if not isinstance(reading_time, datetime): logger.error("Invalid type for reading_time: %s", type(reading_time)); return "InvalidTime"
+    if interval_minutes <= 0: logger.warning("Invalid interval <= 0: %s. Using 1.", interval_minutes); interval_minutes = 1
+    if interval_minutes >= 1440: interval_start_dt = datetime.combine(reading_time.date(), time_obj.min); return interval_start_dt.strftime('%Y-%m-%d %H:%M')
+    elif interval_minutes >= 60: hours = interval_minutes // 60; interval_start_hour = (reading_time.hour // hours) * hours; interval_start_dt = reading_time.replace(hour=interval_start_hour, minute=0, second=0, microsecond=0); return interval_start_dt.strftime('%Y-%m-%d %H:%M')
+    elif interval_minutes >= 1: minutes_past_hour = reading_time.minute; interval_start_minute = (minutes_past_hour // interval_minutes) * interval_minutes; interval_start_dt = reading_time.replace(minute=interval_start_minute, second=0, microsecond=0); return interval_start_dt.strftime('%Y-%m-%d %H:%M')
+    else: logger.error("Unexpected interval value: %s", interval_minutes); return reading_time.strftime('%Y-%m-%d %H:%M')
+
+# --- Chart layout ---
+CHART_HOLD_LOOKBACK = timedelta(minutes=15) # Also fetched before the range, so a quiet period spanning its start isn't a gap
+
+def chart_anchor(start_dt_query):
+    """Bucket 0 of a chart query: midnight before the lookback. Every chart interval divides a day, so buckets line up with get_interval_key()."""
+    return datetime.combine((start_dt_query - CHART_HOLD_LOOKBACK).date(), time_obj.min)
+
+def chart_series(buckets, anchor, start_dt_query, end_dt_exclusive, interval_minutes):
+    """
+    Lays aggregated intervals (storage reading_buckets(), ordered) out as (first interval start, temps, humids, gaps),
+    gaps as [first, last] index pairs. An interval without readings is a gap, unless a report-by-exception reading
+    (hold_seconds set) still covers it: the device was quiet because nothing changed, so that reading's value is carried forward.
+    """
+    final_temps = []; final_humids = []; gaps_identified = []
+    if interval_minutes <= 0: interval_minutes = 1
+    buckets_by_index = {b['bucket']: b for b in buckets}
+    first_dt = datetime.strptime(get_interval_key(start_dt_query, interval_minutes), '%Y-%m-%d %H:%M')
+    current_dt = first_dt; interval = timedelta(minutes=interval_minutes); gap_start = None
+    held_index = -1 # Latest interval with readings before the current one; its newest reading may still hold
+    while current_dt < end_dt_exclusive:
+        bucket_index = (current_dt - anchor) // interval
+        while held_index + 1 < len(buckets) and buckets[held_index + 1]['bucket'] < bucket_index: held_index += 1
+        bucket = buckets_by_index.get(bucket_index)
+        data_point = {'temp': round(bucket['temperature'], 2), 'humid': round(bucket['humidity'], 2)} if bucket else None
+        if data_point is None and held_index >= 0:
+            held = buckets[held_index]
+            if held['last_hold_seconds'] and held['last_time'] + timedelta(seconds=held['last_hold_seconds']) > current_dt:
+                data_point = {'temp': held['last_temperature'], 'humid': held['last_humidity']} # Quiet period, not an outage
+        if data_point is not None:
+            final_temps.append(data_point['temp']); final_humids.append(data_point['humid'])
+            if gap_start is not None: gaps_identified.append([gap_start, len(final_temps) - 2]); gap_start = None
+        else:
+            final_temps.append(None); final_humids.append(None)
+            if gap_start is None: gap_start = len(final_temps) - 1
+        current_dt += interval
+    if gap_start is not None: gaps_identified.append([gap_start, len(final_temps) - 1])
+    return first_dt, final_temps, final_humids, gaps_identified
+
+def process_chart_buckets(buckets, anchor, start_dt_query, end_dt_exclusive, interval_minutes):
+    """chart_series() in the default layout: a '%Y-%m-%d %H:%M' label per interval, gaps as {'start': label, 'end': label}."""
+    first_dt, final_temps, final_humids, gap_ranges = chart_series(buckets, anchor, start_dt_query, end_dt_exclusive, interval_minutes)
+    interval = timedelta(minutes=max(interval_minutes, 1))
+    final_labels = [get_interval_key(first_dt + i * interval, interval_minutes) for i in range(len(final_temps))]
+    return final_labels, final_temps, final_humids, [{"start": final_labels[first], "end": final_labels[last]} for first, last in gap_ranges]
+
+# --- Compact chart format (/api/chartdata?format=compact) ---
+# No label strings: the client rebuilds them from 'start' (local wall-clock time counted as if it were UTC, so no
+# timezone is involved on either side) and 'step' (seconds). Values are ints (value * scale, null = no data);
+# gaps are [first, last] index pairs. index.html decodes it in decodeChartData().
+CHART_COMPACT_SCALE = 100 # Two decimals, as the default format rounds to
+CHART_WALL_EPOCH = datetime(1970, 1, 1)
+
+def compact_chart_data(first_dt, interval_minutes, final_temps, final_humids, gap_ranges):
+    scale = CHART_COMPACT_SCALE
+    return {"format": "compact", "start": int((first_dt - CHART_WALL_EPOCH).total_seconds()), "step": max(interval_minutes, 1) * 60, "count": len(final_temps), "scale": scale,
+            "temperatures": [None if v is None else round(v * scale) for v in final_temps], "humidities": [None if v is None else round(v * scale) for v in final_humids], "gaps": gap_ranges}
+
+def chart_payload(buckets, anchor, start_dt_query, end_dt_exclusive, interval_minutes, compact=False):
+    """The /api/chartdata response dict in the default or the compact format."""
+    if compact:
+        first_dt, final_temps, final_humids, gap_ranges = chart_series(buckets, anchor, start_dt_query, end_dt_exclusive, interval_minutes)
+        return compact_chart_data(first_dt, interval_minutes, final_temps, final_humids, gap_ranges)
+    final_labels, final_temps, final_humids, gaps_identified = process_chart_buckets(buckets, anchor, start_dt_query, end_dt_exclusive, interval_minutes)
+    return { "labels": final_labels, "temperatures": final_temps, "humidities": final_humids, "gaps": gaps_identified }
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# --- migrate_readings_device_key.py ---
+# Moves readings from the 36-char device_unique_id string to the integer devices.id (readings.device_id),
+# without stopping ingest. Run the steps in order, advancing READINGS_DEVICE_KEY_PHASE in
+# terrarium-webapp.service (and restarting it) where noted:
+#
+#   1. add        adds readings.device_id and the (device_id, reading_time) index (online ALTER)
+#                 -> phase 'dual': the app now writes both keys
+#   2. backfill   fills device_id for older rows in small primary-key ranges (safe to stop and rerun)
+#   3. verify     rows still missing a key, table/index sizes
+#                 -> phase 'id' once verify reports 0 missing: charts/latest now read by device_id
+#   4. finalize   device_id NOT NULL + foreign key to devices(id), device_unique_id made nullable
+#                 -> phase 'id_only': the app stops writing device_unique_id
+#   5. drop-uuid  drops device_unique_id (and its indexes/foreign key) from readings
+#
+# ALTER needs more privileges than the app user has, e.g.:
+#   sudo python3 migrate_readings_device_key.py --user root add
+
+import argparse
+import getpass
+import sys
+import time
+import mysql.connector
+from mysql.connector import Error
+
+# --- Database Configuration ---
+DB_HOST = 'localhost'; DB_USER = 'terrarium_user'; DB_PASSWORD = 'Life4588'; DB_NAME = 'terrarium_data'
+
+DEFAULT_BATCH_ROWS = 5000 # Primary-key range updated per backfill transaction
+DEFAULT_PAUSE_SEC = 0.2   # Sleep between backfill batches, so ingest and the dashboard keep their share of the Pi
+
+
+def column_exists(cursor, table, column):
+    cursor.execute("SELECT COUNT(*) FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s", (table, column))
+    return cursor.fetchone()[0] > 0
+
+
+def indexes_on(cursor, table, column):
+    """Names of the indexes of 'table' that include 'column' (PRIMARY excluded)."""
+    cursor.execute("SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s AND INDEX_NAME <> 'PRIMARY'", (table, column))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def foreign_keys_on(cursor, table, column):
+    cursor.execute("SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s AND REFERENCED_TABLE_NAME IS NOT NULL", (table, column))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def step_add(conn, args):
+    cursor = conn.cursor()
+    if column_exists(cursor, 'readings', 'device_id'):
+        print("readings.device_id already exists.")
+    else:
+        print("Adding readings.device_id ...")
+        cursor.execute("ALTER TABLE readings ADD COLUMN device_id INT NULL") # Added at the end: instant, no table rebuild
+    if 'idx_readings_device_time' not in indexes_on(cursor, 'readings', 'device_id'):
+        print("Adding index (device_id, reading_time) ... (online, may take a while on a large table)")
+        cursor.execute("ALTER TABLE readings ADD INDEX idx_readings_device_time (device_id, reading_time), ALGORITHM=INPLACE, LOCK=NONE")
+    print("Done. Next: set READINGS_DEVICE_KEY_PHASE=dual, restart the web app, then run 'backfill'.")
+    return 0
+
+
+def step_backfill(conn, args):
+    """Fills (or repairs) device_id by primary-key ranges, one short transaction per range."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(id), MAX(id) FROM readings")
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        print("readings is empty.")
+        return 0
+    start_id = args.start_id if args.start_id is not None else min_id
+    total = 0; started = time.monotonic()
+    print(f"Backfilling ids {start_id}..{max_id} in ranges of {args.batch} ...")
+    while start_id <= max_id:
+        end_id = start_id + args.batch
+        cursor.execute("UPDATE readings r JOIN devices d ON d.device_unique_id = r.device_unique_id SET r.device_id = d.id "
+                       "WHERE r.id >= %s AND r.id < %s AND (r.device_id IS NULL OR r.device_id <> d.id)", (start_id, end_id))
+        conn.commit()
+        total += cursor.rowcount
+        print(f"  ids < {end_id}: {total} row(s) updated so far ({time.monotonic() - started:.0f}s)", end='\r')
+        start_id = end_id
+        time.sleep(args.pause)
+    print(f"\nBackfill done: {total} row(s) updated. Rerun with --start-id {start_id} to continue after rows added since. Next: 'verify'.")
+    return 0
+
+
+def step_verify(conn, args):
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM readings WHERE device_id IS NULL")
+    missing = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM readings r LEFT JOIN devices d ON d.id = r.device_id WHERE r.device_id IS NOT NULL AND d.id IS NULL")
+    dangling = cursor.fetchone()[0]
+    orphans = 0
+    if column_exists(cursor, 'readings', 'device_unique_id'):
+        cursor.execute("SELECT COUNT(*) FROM readings r LEFT JOIN devices d ON d.device_unique_id = r.device_unique_id WHERE r.device_id IS NULL AND d.id IS NULL")
+        orphans = cursor.fetchone()[0]
+    cursor.execute("SELECT TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'readings'")
+    rows, data_bytes, index_bytes = cursor.fetchone()
+    print(f"readings: ~{rows} rows, data {data_bytes / 1048576:.1f} MiB, indexes {index_bytes / 1048576:.1f} MiB")
+    print(f"  rows without device_id: {missing} ({orphans} of them belong to no device)")
+    print(f"  rows whose device_id matches no device: {dangling}")
+    if missing or dangling:
+        print("Not ready: run 'backfill' again (orphans need deleting or a matching device first).")
+        return 1
+    print("Ready: set READINGS_DEVICE_KEY_PHASE=id, restart the web app, then run 'finalize'.")
+    return 0
+
+
+def step_finalize(conn, args):
+    if step_verify(conn, args) != 0:
+        return 1
+    cursor = conn.cursor()
+    print("Making device_id NOT NULL, adding foreign key, making device_unique_id nullable ...")
+    changes = ["MODIFY device_id INT NOT NULL"]
+    if not foreign_keys_on(cursor, 'readings', 'device_id'):
+        changes.append("ADD CONSTRAINT fk_readings_device FOREIGN KEY (device_id) REFERENCES devices (id)")
+    if column_exists(cursor, 'readings', 'device_unique_id'):
+        cursor.execute("SELECT COLUMN_TYPE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'readings' AND COLUMN_NAME = 'device_unique_id'")
+        changes.append(f"MODIFY device_unique_id {cursor.fetchone()[0]} NULL")
+    cursor.execute("ALTER TABLE readings " + ", ".join(changes))
+    print("Done. Next: set READINGS_DEVICE_KEY_PHASE=id_only, restart the web app, then run 'drop-uuid'.")
+    return 0
+
+
+def step_drop_uuid(conn, args):
+    cursor = conn.cursor()
+    if not column_exists(cursor, 'readings', 'device_unique_id'):
+        print("readings.device_unique_id already dropped.")
+        return 0
+    cursor.execute("SELECT COUNT(*) FROM readings WHERE device_id IS NULL")
+    if cursor.fetchone()[0]:
+        print("Rows without device_id exist. Run 'finalize' first.")
+        return 1
+    changes = [f"DROP FOREIGN KEY {name}" for name in foreign_keys_on(cursor, 'readings', 'device_unique_id')]
+    if changes:
+        cursor.execute("ALTER TABLE readings " + ", ".join(changes)) # Must go before the indexes it uses
+    changes = [f"DROP INDEX {name}" for name in indexes_on(cursor, 'readings', 'device_unique_id')] + ["DROP COLUMN device_unique_id"]
+    print(f"ALTER TABLE readings {', '.join(changes)} ... (rebuilds the table)")
+    cursor.execute("ALTER TABLE readings " + ", ".join(changes))
+    cursor.execute("ANALYZE TABLE readings"); cursor.fetchall()
+    print("Done.")
+    return step_verify(conn, args)
+
+
+STEPS = {'add': step_add, 'backfill': step_backfill, 'verify': step_verify, 'finalize': step_finalize, 'drop-uuid': step_drop_uuid}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate readings to the integer device key (readings.device_id).")
+    parser.add_argument('step', choices=list(STEPS), help="Migration step (run in the order listed at the top of this file)")
+    parser.add_argument('--user', default=DB_USER, help="MariaDB user (ALTER steps need e.g. root)")
+    parser.add_argument('--password', help="MariaDB password (prompted if --user is not the app user)")
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH_ROWS, help="backfill: primary-key range per transaction")
+    parser.add_argument('--pause', type=float, default=DEFAULT_PAUSE_SEC, help="backfill: seconds to sleep between batches")
+    parser.add_argument('--start-id', type=int, help="backfill: resume from this readings.id")
+    args = parser.parse_args()
+
+    password = args.password
+    if password is None:
+        password = DB_PASSWORD if args.user == DB_USER else getpass.getpass(f"MariaDB password for {args.user}: ")
+    try:
+        conn = mysql.connector.connect(host=DB_HOST, user=args.user, password=password, database=DB_NAME, connect_timeout=5)
+    except Error as e:
+        print(f"Error connecting to database: {e}")
+        return 1
+    try:
+        return STEPS[args.step](conn, args)
+    except Error as e:
+        print(f"\nDatabase error during '{args.step}': {e}")
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
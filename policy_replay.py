@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# --- policy_replay.py ---
+# Replays stored readings through the heater policy (thermostat_policy.py) to predict how a
+# settings change would have behaved: relay cycles, duty cycle and time outside the min/max band.
+#
+# Open-loop: the historical temperatures are used as-is, the heater's effect on them is not modelled.
+# Between readings the policy runs at the device's control cadence on the latest temperature, so a
+# report-by-exception reading (hold_seconds) keeps deciding -- and the max-on limit keeps counting -- while it holds.
+# Readings for all selected devices are streamed in one ordered query and replayed in a single pass,
+# so memory stays flat regardless of how many months are replayed.
+#
+# Usage examples:
+#   python3 policy_replay.py --days 90
+#   python3 policy_replay.py --device <uuid> --min 24 --max 28 --off-start 22:00 --off-end 06:00
+
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+import mysql.connector
+from mysql.connector import Error
+import thermostat_policy
+
+# --- Database Configuration ---
+DB_HOST = 'localhost'; DB_USER = 'terrarium_user'; DB_PASSWORD = 'Life4588'; DB_NAME = 'terrarium_data'
+
+FETCH_BATCH_SIZE = 5000 # Rows per fetchmany() while streaming readings
+# Same phase as the web app (see READINGS_DEVICE_KEY_PHASE in terrarium_storage.py): from 'id' on, readings are keyed by devices.id
+READINGS_READ_BY_ID = os.environ.get('READINGS_DEVICE_KEY_PHASE', 'uuid') in ('id', 'id_only')
+DEFAULT_MAX_GAP_MINUTES = 5 # Longer intervals between readings are outages and not counted, unless the reading's hold_seconds covers them
+CONTROL_STEP_SECONDS = 60 # The device decides this often on its latest reading (SENSOR_READ_INTERVAL in terrarium_control.py)
+
+
+def new_replay_stats():
+    """Returns the per-device accumulator used by replay_step()."""
+    return {
+        'state': thermostat_policy.new_heater_state(),
+        'last_time': None, 'last_temp': None, 'last_hold': None,
+        'readings': 0, 'cycles': 0, 'limit_trips': 0,
+        'covered_seconds': 0.0, 'on_seconds': 0.0,
+        'below_band_seconds': 0.0, 'above_band_seconds': 0.0, 'gap_seconds': 0.0,
+        'reasons': {}
+    }
+
+
+def control_step(stats, step_time, temp_c, settings):
+    """Runs the heater policy once at step_time and counts the decision."""
+    decision = thermostat_policy.decide_heater(
+        stats['state'], temp_c, step_time.time(), step_time.timestamp(),
+        settings['min_temp'], settings['max_temp'], settings['off_start'], settings['off_end'])
+    if decision['relay_on'] and not stats['state']['relay_on']:
+        stats['cycles'] += 1
+    if decision['reason'] == 'limit':
+        stats['limit_trips'] += 1
+    stats['reasons'][decision['reason']] = stats['reasons'].get(decision['reason'], 0) + 1
+    stats['state'] = decision
+
+
+def replay_step(stats, reading_time, temp_c, hold_seconds, settings, max_gap_seconds, step_seconds=CONTROL_STEP_SECONDS):
+    """
+    Advances one device by one reading. The interval since the previous reading is attributed to
+    the previous temperature and, every step_seconds, decided again on it (as on the device, which keeps
+    controlling on its latest reading). The interval counts as covered if it is within max_gap_seconds
+    or the previous reading's hold_seconds (report-by-exception: the device was quiet because nothing changed).
+    """
+    if stats['last_time'] is not None:
+        interval = (reading_time - stats['last_time']).total_seconds()
+        if 0 < interval <= max(max_gap_seconds, stats['last_hold'] or 0):
+            stats['covered_seconds'] += interval
+            last_temp = stats['last_temp']
+            if last_temp is not None:
+                if settings['min_temp'] is not None and last_temp < settings['min_temp']:
+                    stats['below_band_seconds'] += interval
+                elif settings['max_temp'] is not None and last_temp > settings['max_temp']:
+                    stats['above_band_seconds'] += interval
+            step_time = stats['last_time']; step = timedelta(seconds=step_seconds)
+            while True:
+                next_time = min(step_time + step, reading_time)
+                if stats['state']['relay_on']:
+                    stats['on_seconds'] += (next_time - step_time).total_seconds()
+                if next_time >= reading_time:
+                    break
+                control_step(stats, next_time, last_temp, settings)
+                step_time = next_time
+        elif interval > 0:
+            stats['gap_seconds'] += interval
+
+    control_step(stats, reading_time, temp_c, settings)
+    stats['last_time'] = reading_time
+    stats['last_temp'] = temp_c
+    stats['last_hold'] = hold_seconds
+    stats['readings'] += 1
+
+
+def replay_readings(rows, settings_by_device, max_gap_minutes=DEFAULT_MAX_GAP_MINUTES):
+    """
+    Replays (device_unique_id, reading_time, temperature, hold_seconds) rows, ordered by device then time.
+    settings_by_device maps device id -> {'min_temp', 'max_temp', 'off_start', 'off_end'}.
+    Returns {device_id: summary dict}.
+    """
+    max_gap_seconds = max_gap_minutes * 60
+    results = {}
+    for device_id, reading_time, temp, hold_seconds in rows:
+        stats = results.get(device_id)
+        if stats is None:
+            stats = results[device_id] = new_replay_stats()
+        temp_c = float(temp) if temp is not None else None
+        replay_step(stats, reading_time, temp_c, hold_seconds, settings_by_device[device_id], max_gap_seconds)
+    return {device_id: summarize(stats) for device_id, stats in results.items()}
+
+
+def summarize(stats):
+    """Turns a replay accumulator into the reported figures."""
+    covered = stats['covered_seconds']
+    covered_days = covered / 86400 if covered else 0
+    return {
+        'readings': stats['readings'],
+        'covered_hours': round(covered / 3600, 1),
+        'gap_hours': round(stats['gap_seconds'] / 3600, 1),
+        'relay_cycles': stats['cycles'],
+        'cycles_per_day': round(stats['cycles'] / covered_days, 1) if covered_days else None,
+        'duty_cycle_pct': round(100 * stats['on_seconds'] / covered, 1) if covered else None,
+        'below_band_hours': round(stats['below_band_seconds'] / 3600, 1),
+        'above_band_hours': round(stats['above_band_seconds'] / 3600, 1),
+        'out_of_band_pct': round(100 * (stats['below_band_seconds'] + stats['above_band_seconds']) / covered, 1) if covered else None,
+        'limit_trips': stats['limit_trips'],
+        'decisions': stats['reasons']
+    }
+
+
+def stream_readings(conn, device_ids, start_dt, end_dt):
+    """Yields (device_unique_id, reading_time, temperature, hold_seconds) for all devices in one ordered query."""
+    placeholders = ", ".join(["%s"] * len(device_ids))
+    if READINGS_READ_BY_ID:
+        # Integer key: ordered by device_id (uses the (device_id, reading_time) index), UUID taken from devices
+        sql = (f"SELECT d.device_unique_id, r.reading_time, r.temperature, r.hold_seconds FROM readings r JOIN devices d ON d.id = r.device_id "
+               f"WHERE d.device_unique_id IN ({placeholders}) AND r.reading_time >= %s AND r.reading_time < %s "
+               f"ORDER BY r.device_id, r.reading_time")
+    else:
+        sql = (f"SELECT device_unique_id, reading_time, temperature, hold_seconds FROM readings "
+               f"WHERE device_unique_id IN ({placeholders}) AND reading_time >= %s AND reading_time < %s "
+               f"ORDER BY device_unique_id, reading_time")
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, tuple(device_ids) + (start_dt, end_dt))
+        while True:
+            batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not batch:
+                break
+            yield from batch
+    finally:
+        cursor.close()
+
+
+def load_device_settings(conn, device_ids=None):
+    """Returns {device_unique_id: settings} as stored in the devices table."""
+    cursor = conn.cursor(dictionary=True)
+    sql = "SELECT device_unique_id, min_temp_threshold, max_temp_threshold, heating_off_start_time, heating_off_end_time FROM devices"
+    params = ()
+    if device_ids:
+        sql += f" WHERE device_unique_id IN ({', '.join(['%s'] * len(device_ids))})"
+        params = tuple(device_ids)
+    cursor.execute(sql, params)
+    settings = {}
+    for row in cursor.fetchall():
+        settings[row['device_unique_id']] = {
+            'min_temp': float(row['min_temp_threshold']) if row['min_temp_threshold'] is not None else None,
+            'max_temp': float(row['max_temp_threshold']) if row['max_temp_threshold'] is not None else None,
+            # TIME columns come back as timedelta
+            'off_start': (datetime.min + row['heating_off_start_time']).time() if row['heating_off_start_time'] is not None else None,
+            'off_end': (datetime.min + row['heating_off_end_time']).time() if row['heating_off_end_time'] is not None else None,
+        }
+    cursor.close()
+    return settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay stored readings through the heater policy.")
+    parser.add_argument('--device', action='append', help="device_unique_id to replay (repeatable, default: all devices)")
+    parser.add_argument('--days', type=int, default=30, help="Days of history to replay (default 30)")
+    parser.add_argument('--min', type=float, dest='min_temp', help="Override min_temp_threshold")
+    parser.add_argument('--max', type=float, dest='max_temp', help="Override max_temp_threshold")
+    parser.add_argument('--off-start', help="Override heating_off_start_time (HH:MM, '' to clear)")
+    parser.add_argument('--off-end', help="Override heating_off_end_time (HH:MM, '' to clear)")
+    parser.add_argument('--max-gap', type=int, default=DEFAULT_MAX_GAP_MINUTES, help="Minutes between readings counted as an outage (unless the reading's hold_seconds covers them)")
+    args = parser.parse_args()
+
+    end_dt = datetime.now()
+    start_dt = end_dt - timedelta(days=args.days)
+
+    try:
+        conn = mysql.connector.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, database=DB_NAME, connect_timeout=5)
+    except Error as e:
+        print(f"Error connecting to database: {e}")
+        return 1
+
+    try:
+        settings_by_device = load_device_settings(conn, args.device)
+        if not settings_by_device:
+            print("No matching devices found.")
+            return 1
+        for settings in settings_by_device.values():
+            if args.min_temp is not None: settings['min_temp'] = args.min_temp
+            if args.max_temp is not None: settings['max_temp'] = args.max_temp
+            if args.off_start is not None: settings['off_start'] = thermostat_policy.parse_off_time(args.off_start)
+            if args.off_end is not None: settings['off_end'] = thermostat_policy.parse_off_time(args.off_end)
+
+        results = replay_readings(stream_readings(conn, list(settings_by_device), start_dt, end_dt), settings_by_device, args.max_gap)
+    except Error as e:
+        print(f"Database error during replay: {e}")
+        return 1
+    finally:
+        conn.close()
+
+    print(f"Replay {start_dt:%Y-%m-%d %H:%M} -> {end_dt:%Y-%m-%d %H:%M}")
+    for device_id, summary in results.items():
+        settings = settings_by_device[device_id]
+        print(f"\nDevice {device_id}  (Min={settings['min_temp']}, Max={settings['max_temp']}, Off={settings['off_start']}-{settings['off_end']})")
+        for key, value in summary.items():
+            print(f"  {key:>18}: {value}")
+    missing = set(settings_by_device) - set(results)
+    for device_id in missing:
+        print(f"\nDevice {device_id}: no readings in range.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# --- reading_stats.py ---
+# One-pass statistics over a device's raw readings, used by app.py's /api/statistics.
+# Pure functions and accumulators only: no database, no clock. Readings must arrive ordered by time.
+#
+# Per metric (temperature, humidity): count, min, max and mean are exact; percentiles come from a
+# ValueSketch, a histogram of fixed-width bins (the sensor's 0.1 resolution by default), so a percentile
+# is off by at most half a bin and memory depends on the spread of values, not on how many there are.
+# Sketches merge by adding bin counts, which is how the period total is built from the daily results.
+# Time in range is time-weighted against the device's min/max temperature thresholds: the interval
+# up to the next reading counts for the previous one, unless it is longer than the allowed gap
+# (max_gap_seconds, or the reading's hold_seconds for report-by-exception readings) -- then it is an outage.
+
+import math
+
+DEFAULT_RESOLUTION = 0.1 # DHT22 reports one decimal
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+DEFAULT_MAX_GAP_SECONDS = 5 * 60 # Longer silence without hold_seconds is an outage, as in policy_replay.py
+
+
+class ValueSketch:
+    """Mergeable fixed-resolution histogram: quantile(q) is within resolution / 2 of the exact value."""
+    __slots__ = ('resolution', 'bins', 'count')
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION):
+        self.resolution = resolution; self.bins = {}; self.count = 0
+
+    def add(self, value):
+        index = math.floor(value / self.resolution + 0.5)
+        self.bins[index] = self.bins.get(index, 0) + 1; self.count += 1
+
+    def merge(self, other):
+        for index, count in other.bins.items(): self.bins[index] = self.bins.get(index, 0) + count
+        self.count += other.count
+
+    def quantiles(self, qs):
+        """Values at the given quantiles (0..1), in the order given; None when empty. One pass over the sorted bins."""
+        if not self.count: return [None] * len(qs)
+        order = sorted(range(len(qs)), key=lambda i: qs[i]); results = [None] * len(qs)
+        seen = 0; position = 0; bins = sorted(self.bins.items())
+        for index, count in bins:
+            seen += count
+            while position < len(order) and seen >= max(1, math.ceil(qs[order[position]] * self.count)):
+                results[order[position]] = round(index * self.resolution, 6); position += 1
+        return results
+
+
+class MetricStats:
+    """Exact count/min/max/sum plus a ValueSketch for one metric."""
+    __slots__ = ('count', 'min', 'max', 'total', 'sketch')
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION):
+        self.count = 0; self.min = None; self.max = None; self.total = 0.0; self.sketch = ValueSketch(resolution)
+
+    def add(self, value):
+        if value is None: return
+        self.count += 1; self.total += value; self.sketch.add(value)
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    def merge(self, other):
+        if not other.count: return
+        self.count += other.count; self.total += other.total; self.sketch.merge(other.sketch)
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def summary(self, percentiles):
+        result = {'count': self.count, 'min': self.min, 'max': self.max, 'mean': round(self.total / self.count, 2) if self.count else None}
+        result.update(zip((f"p{p:g}" for p in percentiles), self.sketch.quantiles([p / 100 for p in percentiles])))
+        return result
+
+
+class PeriodStats:
+    """Temperature/humidity MetricStats plus time-in-range seconds for one period (a day, or the whole range)."""
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION):
+        self.temperature = MetricStats(resolution); self.humidity = MetricStats(resolution)
+        self.below_seconds = 0.0; self.within_seconds = 0.0; self.above_seconds = 0.0; self.gap_seconds = 0.0
+
+    def merge(self, other):
+        self.temperature.merge(other.temperature); self.humidity.merge(other.humidity)
+        self.below_seconds += other.below_seconds; self.within_seconds += other.within_seconds
+        self.above_seconds += other.above_seconds; self.gap_seconds += other.gap_seconds
+
+    def summary(self, percentiles):
+        covered = self.below_seconds + self.within_seconds + self.above_seconds
+        def share(seconds): return round(100 * seconds / covered, 1) if covered else None
+        return {'temperature': self.temperature.summary(percentiles), 'humidity': self.humidity.summary(percentiles),
+                'time_in_range': {'within_pct': share(self.within_seconds), 'below_pct': share(self.below_seconds), 'above_pct': share(self.above_seconds),
+                                  'covered_hours': round(covered / 3600, 2), 'gap_hours': round(self.gap_seconds / 3600, 2)}}
+
+
+def band_position(temperature, min_temp, max_temp):
+    """'below', 'above' or 'within' the thresholds (an unset threshold doesn't limit)."""
+    if min_temp is not None and temperature < min_temp: return 'below'
+    if max_temp is not None and temperature > max_temp: return 'above'
+    return 'within'
+
+
+def reading_statistics(readings, min_temp, max_temp, percentiles=DEFAULT_PERCENTILES, max_gap_seconds=DEFAULT_MAX_GAP_SECONDS, resolution=DEFAULT_RESOLUTION):
+    """
+    Statistics for (reading_time, temperature, humidity, hold_seconds) tuples in time order.
+    Returns {'period': summary, 'days': [summary with 'date', ...]}; only one day is accumulated at a time.
+    """
+    total = PeriodStats(resolution); days = []
+    day = None; day_stats = None; previous = None # previous: (reading_time, temperature, hold_seconds)
+    for reading_time, temperature, humidity, hold_seconds in readings:
+        if reading_time.date() != day:
+            if day_stats is not None: total.merge(day_stats); days.append({'date': day.isoformat(), **day_stats.summary(percentiles)})
+            day = reading_time.date(); day_stats = PeriodStats(resolution)
+        if previous is not None and previous[1] is not None:
+            interval = (reading_time - previous[0]).total_seconds() # Counted for the day the interval ends in
+            if 0 < interval <= max(max_gap_seconds, previous[2] or 0):
+                position = band_position(previous[1], min_temp, max_temp)
+                if position == 'below': day_stats.below_seconds += interval
+                elif position == 'above': day_stats.above_seconds += interval
+                else: day_stats.within_seconds += interval
+            elif interval > 0:
+                day_stats.gap_seconds += interval
+        day_stats.temperature.add(temperature); day_stats.humidity.add(humidity)
+        previous = (reading_time, temperature, hold_seconds)
+    if day_stats is not None: total.merge(day_stats); days.append({'date': day.isoformat(), **day_stats.summary(percentiles)})
+    return {'period': total.summary(percentiles), 'days': days}
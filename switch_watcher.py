@@ -3,14 +3,40 @@
 #                     and turns a specific background program (service) on or off based
 #                     on the switch's position. Also logs events to database.
 
+import os           # Reads optional overrides from environment variables
 import time         # Lets the script pause or wait
 import board        # Helps use the computer's pins (like on a Raspberry Pi) by name
 import digitalio    # Used to read the state (on/off) of the pins
 import subprocess   # Lets this script run other commands on the computer, like starting/stopping services
 import sys          # Allows the script to exit cleanly
 import signal       # Helps the script shut down gracefully if asked to stop (e.g., by Ctrl+C)
+import threading    # Runs the D-Bus listener and the event writer in the background
+import queue        # Hands events from the switch loop to the background DB writer
+import json         # Format of the on-disk event spool
+import logging      # Log messages (set up by terrarium_logging, level via TERRARIUM_LOG_LEVEL)
+from datetime import datetime, timedelta # Event timestamps are captured when the switch flips
 import mysql.connector # Added for Database access
 from mysql.connector import Error # Added for DB specific error handling
+import terrarium_logging # Shared queue-based logging setup
+
+# libgpiod v2 bindings give us kernel edge events (no polling). Optional: without them we poll.
+try:
+    import gpiod
+    from gpiod.line import Direction, Edge, Bias, Value
+except ImportError:
+    gpiod = None
+
+# jeepney (pure-Python D-Bus) lets us talk to systemd directly instead of forking systemctl.
+# Optional: without it we fall back to running /bin/systemctl.
+try:
+    import jeepney
+    from jeepney import DBusAddress, new_method_call, MatchRule, Properties, message_bus
+    from jeepney.wrappers import unwrap_msg
+    from jeepney.io.blocking import open_dbus_connection
+except ImportError:
+    jeepney = None
+
+logger = logging.getLogger('switch_watcher')
 
 # --- Configuration ---
 
@@ -18,6 +44,12 @@ from mysql.connector import Error # Added for DB specific error handling
 # 'board.D21' means digital pin 21.
 SWITCH_PIN = board.D21
 
+# The same pin as seen by the kernel GPIO character device (used for edge events).
+# On the Pi 5 the 40-pin header is gpiochip0 on current kernels (gpiochip4 on older ones).
+# Both can be overridden, e.g. to point the watcher at a gpio-sim / gpio-mockup chip for testing.
+SWITCH_GPIO_CHIP = os.environ.get('SWITCH_GPIO_CHIP', '/dev/gpiochip0')
+SWITCH_LINE_OFFSET = int(os.environ.get('SWITCH_LINE_OFFSET', '21'))
+
 # The name of the background program being controlled.
 SERVICE_NAME = "terrarium-control.service"
 
@@ -29,25 +61,45 @@ SERVICE_NAME = "terrarium-control.service"
 #   The pin will be ON by default.
 PULL_DIRECTION = digitalio.Pull.UP # Set according to current wiring
 
-# How long (in seconds) to wait after the switch is flipped before reacting.
-# Physical switches can be 'bouncy' and send multiple quick signals. This pause
-# helps make sure we only react once to a single flip. 0.3 seconds is usually enough.
+# How long (in seconds) the switch must stay quiet after a flip before we react.
+# Physical switches can be 'bouncy' and send multiple quick signals. Each new edge
+# restarts this window, so we only react once to a single flip. 0.3 seconds is usually enough.
 DEBOUNCE_TIME_SEC = 0.3
 
 # How often (in seconds) the script checks the switch's state.
-# Checking too often uses more compute power, too slowly makes it feel unresponsive.
+# Only used by the polling fallback when kernel edge events are unavailable.
 POLL_INTERVAL_SEC = 0.2
 
+# How the service is started/stopped: 'auto' (D-Bus, falling back to systemctl)
+# or 'subprocess' (always systemctl). The D-Bus backend connects to the system bus; set
+# DBUS_SYSTEM_BUS_ADDRESS to point it at a local dbus-daemon stand-in for testing.
+SERVICE_CONTROL_BACKEND = os.environ.get('SERVICE_CONTROL_BACKEND', 'auto')
+
+# How long (in seconds) to wait for systemd to answer a call, or for the service
+# to reach its new state after a start/stop request.
+DBUS_CALL_TIMEOUT_SEC = 5
+
 # --- Database Configuration ---
 DB_HOST = 'localhost'
 DB_USER = 'root' # Using root DB user as script runs as system root
 DB_PASSWORD = 'Life4588'
 DB_NAME = 'terrarium_data'
 
+# --- Event Logging Configuration ---
+# Events are queued in memory and written by a background thread. If the database is
+# unreachable they are appended to this spool file and replayed after reconnecting.
+EVENT_SPOOL_FILE = '/home/DanDev/switch_watcher_event_spool.jsonl'
+EVENT_QUEUE_SIZE = 1000      # Events held in memory before new ones go straight to the spool
+EVENT_BATCH_SIZE = 50        # Max events written per INSERT/commit
+EVENT_RETRY_INTERVAL_SEC = 30 # How often the writer retries the database while events are spooled
+EVENT_FLUSH_TIMEOUT_SEC = 3  # How long shutdown waits for the writer to flush
+
 # --- Internal Tracking Variables ---
 
-# This will hold the object representing the switch pin after setup. Starts as empty.
+# This will hold the object representing the switch pin after setup (polling fallback). Starts as empty.
 switch = None
+# Holds the kernel line request when edge events are used instead of polling.
+switch_request = None
 # Remembers what the switch state was the last time we checked. Starts as unknown.
 previous_switch_state = None
 # Holds the database connection object
@@ -56,6 +108,22 @@ db_connection = None
 db_cursor = None
 # Flagged to track if the script is currently trying to shut down.
 shutting_down = False
+# D-Bus connection used for calls to systemd (None = use systemctl fallback).
+dbus_call_conn = None
+# systemd object path of SERVICE_NAME, e.g. /org/freedesktop/systemd1/unit/terrarium_2dcontrol_2eservice
+dbus_unit_path = None
+# Latest ActiveState of the service ('active', 'inactive', ...) as reported by systemd signals.
+service_active_state = None
+# Notified whenever service_active_state changes (used to wait for start/stop to finish).
+service_state_changed = threading.Condition()
+# Background thread listening for PropertiesChanged signals on the unit.
+dbus_monitor_thread = None
+# Events waiting for the background writer: (event_time, event_type, details), None = stop.
+event_queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+# Background thread that owns the DB connection and writes events in batches.
+event_writer_thread = None
+# Serializes access to the spool file (writer thread vs. queue overflow on the switch thread).
+event_spool_lock = threading.Lock()
 
 # --- Helper Functions ---
 
@@ -63,13 +131,20 @@ def run_systemctl(action):
     """
     Tells the systemctl to do something
     (like 'start' or 'stop') the program specified in SERVICE_NAME.
+    Uses systemd's D-Bus API when available, otherwise runs /bin/systemctl.
     Returns True if the command seemed to work, False otherwise.
     """
     # Only allow specific safe actions
     if action not in ["start", "stop", "is-active"]:
-        print(f"Error: Tried to run an invalid action '{action}' on the service.")
+        logger.error("Tried to run an invalid action '%s' on the service.", action)
         return None # Indicate an invalid action was requested
 
+    if action in ["start", "stop"] and dbus_call_conn:
+        result = dbus_control_unit(action)
+        if result is not None:
+            return result
+        logger.warning("D-Bus '%s' failed, falling back to systemctl.", action)
+
     # Put together the command to run, e.g., "/bin/systemctl start terrarium_monitor.service"
     command = ["/bin/systemctl", action, SERVICE_NAME]
     try:
@@ -78,20 +153,20 @@ def run_systemctl(action):
         # Set a timeout so it doesn't hang forever if systemctl gets stuck.
         result = subprocess.run(command, check=False, capture_output=True, text=True, timeout=5)
         # Show what happened (useful for debugging)
-        print(f"Ran command: '{' '.join(command)}' | Result code: {result.returncode} | Output: {result.stdout.strip()} {result.stderr.strip()}")
+        logger.info("Ran command: '%s' | Result code: %s | Output: %s %s", ' '.join(command), result.returncode, result.stdout.strip(), result.stderr.strip())
         # A result code of 0 usually means success.
         return result.returncode == 0
     except FileNotFoundError:
         # This means the 'systemctl' command itself wasn't found.
-        print(f"Error: Could not find the 'systemctl' command.")
+        logger.error("Could not find the 'systemctl' command.")
         return False
     except subprocess.TimeoutExpired:
         # The command took too long to finish.
-        print(f"Error: The command '{' '.join(command)}' timed out.")
+        logger.error("The command '%s' timed out.", ' '.join(command))
         return False
     except Exception as e:
         # Catch any other unexpected problems running the command.
-        print(f"Error trying to run '{action}' on the service: {e}")
+        logger.error("Error trying to run '%s' on the service: %s", action, e)
         return False
 
 def is_service_active():
@@ -99,6 +174,9 @@ def is_service_active():
     Checks if the background program (SERVICE_NAME) is currently running.
     Returns True if it's running, False if it's stopped.
     """
+    # With the D-Bus listener running, systemd has already told us the state: no process needed.
+    if dbus_monitor_thread and dbus_monitor_thread.is_alive() and service_active_state is not None:
+        return service_active_state in ("active", "reloading")
     # Prepare the command to check the service status quietly (we only care if it's active or not).
     command = ["/bin/systemctl", "is-active", "--quiet", SERVICE_NAME]
     try:
@@ -108,9 +186,133 @@ def is_service_active():
         return result.returncode == 0
     except Exception as e:
         # If anything goes wrong trying to check, assume it's not running for safety.
-        print(f"Error checking if service is active: {e}")
+        logger.error("Error checking if service is active: %s", e)
         return False # Assume inactive if we hit an error
 
+# --- systemd D-Bus Backend ---
+SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+SYSTEMD_MANAGER = None if jeepney is None else DBusAddress(
+    '/org/freedesktop/systemd1', bus_name=SYSTEMD_BUS_NAME, interface='org.freedesktop.systemd1.Manager')
+
+def set_service_state(state):
+    """Stores the latest ActiveState and wakes anyone waiting for a change."""
+    global service_active_state
+    with service_state_changed:
+        if state != service_active_state:
+            logger.info("Service '%s' state: %s", SERVICE_NAME, state)
+        service_active_state = state
+        service_state_changed.notify_all()
+
+def get_unit_active_state(conn):
+    """Reads the unit's ActiveState property over the given connection."""
+    unit = DBusAddress(dbus_unit_path, bus_name=SYSTEMD_BUS_NAME, interface='org.freedesktop.systemd1.Unit')
+    reply = unwrap_msg(conn.send_and_get_reply(Properties(unit).get('ActiveState'), timeout=DBUS_CALL_TIMEOUT_SEC))
+    return reply[0][1] # Variant: ('s', 'active')
+
+def initialize_dbus_backend():
+    """
+    Connects to systemd over the system bus, resolves the unit and starts the state listener.
+    Returns True if the D-Bus backend is in use, False if we fall back to systemctl.
+    """
+    global dbus_call_conn, dbus_unit_path, dbus_monitor_thread
+    if SERVICE_CONTROL_BACKEND == 'subprocess':
+        logger.info("Service control backend: systemctl (configured).")
+        return False
+    if jeepney is None:
+        logger.warning("jeepney library not available. Service control backend: systemctl.")
+        return False
+    try:
+        dbus_call_conn = open_dbus_connection(bus='SYSTEM')
+        reply = unwrap_msg(dbus_call_conn.send_and_get_reply(
+            new_method_call(SYSTEMD_MANAGER, 'LoadUnit', 's', (SERVICE_NAME,)), timeout=DBUS_CALL_TIMEOUT_SEC))
+        dbus_unit_path = reply[0]
+        set_service_state(get_unit_active_state(dbus_call_conn))
+        dbus_monitor_thread = threading.Thread(target=dbus_monitor_loop, name="systemd-dbus-monitor", daemon=True)
+        dbus_monitor_thread.start()
+        logger.info("Service control backend: systemd D-Bus (unit %s).", dbus_unit_path)
+        return True
+    except Exception as e:
+        logger.warning("Could not use systemd D-Bus API (%s). Service control backend: systemctl.", e)
+        if dbus_call_conn:
+            try: dbus_call_conn.close()
+            except Exception: pass
+        dbus_call_conn = None
+        return False
+
+def dbus_monitor_loop():
+    """
+    Background thread: subscribes to systemd signals and keeps service_active_state current
+    from PropertiesChanged on the unit. Reconnects if the bus connection drops.
+    """
+    rule = MatchRule(type='signal', interface='org.freedesktop.DBus.Properties',
+                     member='PropertiesChanged', path=dbus_unit_path)
+    while not shutting_down:
+        conn = None
+        try:
+            conn = open_dbus_connection(bus='SYSTEM')
+            unwrap_msg(conn.send_and_get_reply(message_bus.AddMatch(rule), timeout=DBUS_CALL_TIMEOUT_SEC))
+            with conn.filter(rule, bufsize=16) as signals:
+                # systemd only emits unit signals to subscribed clients
+                unwrap_msg(conn.send_and_get_reply(new_method_call(SYSTEMD_MANAGER, 'Subscribe'), timeout=DBUS_CALL_TIMEOUT_SEC))
+                # Re-read once subscribed so a change between the two can't be missed
+                set_service_state(get_unit_active_state(conn))
+                while not shutting_down:
+                    try:
+                        msg = conn.recv_until_filtered(signals, timeout=60)
+                    except TimeoutError:
+                        continue
+                    interface, changed, invalidated = msg.body
+                    if 'ActiveState' in changed:
+                        set_service_state(changed['ActiveState'][1])
+                    elif 'ActiveState' in invalidated:
+                        set_service_state(get_unit_active_state(conn))
+        except Exception as e:
+            if shutting_down:
+                break
+            logger.warning("systemd D-Bus listener error: %s. Reconnecting in 5 seconds...", e)
+            set_service_state(None) # Unknown until reconnected: is_service_active() falls back to systemctl
+            time.sleep(5)
+        finally:
+            if conn:
+                try: conn.close()
+                except Exception: pass
+
+def dbus_control_unit(action):
+    """
+    Starts or stops SERVICE_NAME via StartUnit/StopUnit and waits for systemd to report the
+    resulting ActiveState. Returns True/False, or None if the outcome is unknown over D-Bus
+    (call failed, or the listener is reconnecting and the state can't be read either).
+    """
+    method = 'StartUnit' if action == 'start' else 'StopUnit'
+    target_states = ("active",) if action == 'start' else ("inactive", "failed")
+    try:
+        reply = unwrap_msg(dbus_call_conn.send_and_get_reply(
+            new_method_call(SYSTEMD_MANAGER, method, 'ss', (SERVICE_NAME, 'replace')), timeout=DBUS_CALL_TIMEOUT_SEC))
+        logger.info("systemd %s('%s') queued job %s", method, SERVICE_NAME, reply[0])
+    except Exception as e:
+        logger.error("Error calling systemd %s over D-Bus: %s", method, e)
+        return None
+
+    if not (dbus_monitor_thread and dbus_monitor_thread.is_alive()):
+        return True # Job accepted; no listener to confirm the outcome
+    # Wait for the state change signal instead of polling
+    with service_state_changed:
+        reached = service_state_changed.wait_for(lambda: service_active_state in target_states, timeout=DBUS_CALL_TIMEOUT_SEC)
+    if reached:
+        return True
+    state = service_active_state
+    if state is None:
+        # Listener is reconnecting, so no signal could arrive: ask systemd directly
+        try:
+            state = get_unit_active_state(dbus_call_conn)
+        except Exception as e:
+            logger.warning("Cannot read the service state over D-Bus (%s) while the listener reconnects.", e)
+            return None
+        if state in target_states:
+            return True
+    logger.warning("Service did not reach %s within %ss (state: %s).", '/'.join(target_states), DBUS_CALL_TIMEOUT_SEC, state)
+    return False
+
 # --- Database Connection Function (uses root credentials) ---
 def connect_database():
     """Establishes connection to the MySQL/MariaDB database as root."""
@@ -118,7 +320,7 @@ def connect_database():
     if db_connection and db_connection.is_connected():
         return True # Already connected
     try:
-        print("Watcher connecting to database (as root)...") # Differentiate logs
+        logger.info("Watcher connecting to database (as root)...") # Differentiate logs
         db_connection = mysql.connector.connect(
             host=DB_HOST,
             user=DB_USER,
@@ -128,41 +330,178 @@ def connect_database():
         )
         if db_connection.is_connected():
             db_cursor = db_connection.cursor()
-            print("Watcher database connection successful.")
+            logger.info("Watcher database connection successful.")
             return True
         else:
-             print("Watcher database connection failed (is_connected False).")
+             logger.error("Watcher database connection failed (is_connected False).")
              db_connection = None; db_cursor = None
              return False
     except Error as e:
-        print(f"Error connecting watcher to MySQL database: {e}")
+        logger.error("Error connecting watcher to MySQL database: %s", e)
         db_connection = None
         db_cursor = None
         return False
 
 # --- DB System Event Logging Function ---
-def log_system_event(event_type, details=None):
-    """Logs an event (like startup, shutdown) to the system_events table."""
-    # Attempt to connect if necessary
-    if not (db_connection and db_connection.is_connected()):
-        print("DB connection needed for event log, trying to connect...")
-        if not connect_database():
-             print(f"Failed to connect to DB. Cannot log event: {event_type}")
-             return # Exit function if connection fails
+def log_system_event(event_type, details=None, event_time=None):
+    """
+    Queues an event (like startup, shutdown) for the system_events table and returns immediately.
+    'event_time' is when it happened (defaults to now); it is stored instead of the DB default.
+    """
+    if event_time is None:
+        event_time = datetime.now()
+    try:
+        event_queue.put_nowait((event_time, event_type, details))
+    except queue.Full:
+        logger.warning("Event queue full. Spooling event '%s' to disk.", event_type)
+        spool_events([(event_time, event_type, details)])
+
+def insert_events(events):
+    """Writes a batch of (event_time, event_type, details) in one INSERT + commit. Raises Error on failure."""
+    sql = "INSERT INTO system_events (event_time, event_type, details) VALUES (%s, %s, %s)"
+    db_cursor.executemany(sql, events)
+    db_connection.commit()
+
+def spool_line(event_time, event_type, details):
+    """One spool file line (JSON object) for an event."""
+    return json.dumps({'event_time': event_time.isoformat(), 'event_type': event_type, 'details': details}) + "\n"
+
+def spool_events(events):
+    """Appends events to the on-disk spool (one JSON object per line)."""
+    try:
+        with event_spool_lock, open(EVENT_SPOOL_FILE, 'a') as f:
+            for event_time, event_type, details in events:
+                f.write(spool_line(event_time, event_type, details))
+            f.flush()
+            os.fsync(f.fileno())
+        logger.info("Spooled %s event(s) to '%s'.", len(events), EVENT_SPOOL_FILE)
+    except (IOError, OSError) as e:
+        logger.error("Failed to spool %s event(s), they are lost: %s", len(events), e)
+
+def rewrite_spool(events):
+    """Atomically replaces the spool with the given events (temp file, fsync, rename). Call with event_spool_lock held."""
+    tmp_path = EVENT_SPOOL_FILE + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for event_time, event_type, details in events:
+            f.write(spool_line(event_time, event_type, details))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, EVENT_SPOOL_FILE)
+    try: # Make the rename itself durable
+        dir_fd = os.open(os.path.dirname(os.path.abspath(EVENT_SPOOL_FILE)), os.O_RDONLY)
+        try: os.fsync(dir_fd)
+        finally: os.close(dir_fd)
+    except OSError as e:
+        logger.warning("Could not sync the spool directory: %s", e)
+
+def replay_spool():
+    """
+    Inserts spooled events (oldest first) and removes the spool once committed.
+    Returns True if the spool is empty afterwards. Call only while connected.
+    """
+    with event_spool_lock:
+        if not os.path.exists(EVENT_SPOOL_FILE):
+            return True
+        events = []
+        with open(EVENT_SPOOL_FILE, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    events.append((datetime.fromisoformat(record['event_time']), record['event_type'], record.get('details')))
+                except (ValueError, KeyError) as e:
+                    logger.warning("Skipping unreadable spool line: %s", e)
+        for start in range(0, len(events), EVENT_BATCH_SIZE):
+            try:
+                insert_events(events[start:start + EVENT_BATCH_SIZE])
+            except Error:
+                # Keep only what was not committed, so a later replay doesn't duplicate events. Written to a
+                # temp file that replaces the spool, so a crash or power cut here leaves the old or the new spool.
+                if start:
+                    try: rewrite_spool(events[start:])
+                    except OSError as e: logger.error("Could not rewrite the spool (%s). Its first %s event(s) will be inserted again.", e, start)
+                raise
+        os.remove(EVENT_SPOOL_FILE)
+    logger.info("Replayed %s spooled event(s) to the database.", len(events))
+    return True
+
+def reset_database_connection():
+    """Drops the (probably broken) connection so the next write reconnects."""
+    global db_connection, db_cursor
+    try:
+        if db_cursor: db_cursor.close()
+        if db_connection: db_connection.close()
+    except Exception:
+        pass
+    db_connection = None
+    db_cursor = None
 
-    # Proceed if connected
-    if db_cursor:
+def event_writer_loop():
+    """
+    Background thread: drains the event queue in batches and writes them to the database.
+    Events that can't be written go to the spool, which is replayed after reconnecting.
+    """
+    spool_pending = os.path.exists(EVENT_SPOOL_FILE)
+    stopping = False
+    while not stopping:
+        batch = []
         try:
-            sql = "INSERT INTO system_events (event_type, details) VALUES (%s, %s)"
-            val = (event_type, details)
-            db_cursor.execute(sql, val)
-            db_connection.commit()
-            print(f"Event logged: {event_type}")
+            # Block until an event arrives; while events are spooled, wake periodically to retry the DB
+            item = event_queue.get(timeout=EVENT_RETRY_INTERVAL_SEC if spool_pending else None)
+            while True:
+                if item is None:
+                    stopping = True # Sentinel from stop_event_writer(): flush everything and exit
+                else:
+                    batch.append(item)
+                if len(batch) >= EVENT_BATCH_SIZE and not stopping:
+                    break
+                item = event_queue.get_nowait()
+        except queue.Empty:
+            pass # Queue drained (or the retry timer fired)
+
+        if not batch and not spool_pending:
+            continue
+        if not connect_database():
+            if batch: spool_events(batch)
+            spool_pending = True
+            continue
+        try:
+            if spool_pending:
+                spool_pending = not replay_spool() # Keep order: older spooled events first
+            if batch:
+                insert_events(batch)
+                logger.info("Event(s) logged: %s", ', '.join(event_type for _, event_type, _ in batch))
         except Error as e:
-            print(f"Failed to log system event '{event_type}': {e}")
-            # If connection lost mid-log, can try reconnecting here too
-    else:
-         print(f"Cannot log event '{event_type}', DB cursor unavailable.")
+            logger.error("Failed to write system events: %s", e)
+            reset_database_connection()
+            if batch: spool_events(batch)
+            spool_pending = True
+
+    reset_database_connection()
+    logger.info("Event writer stopped.")
+
+def start_event_writer():
+    """Starts the background event writer thread."""
+    global event_writer_thread
+    event_writer_thread = threading.Thread(target=event_writer_loop, name="event-writer", daemon=True)
+    event_writer_thread.start()
+
+def stop_event_writer():
+    """Asks the writer to flush and stop. Events it can't flush in time are spooled."""
+    if not (event_writer_thread and event_writer_thread.is_alive()):
+        return
+    try:
+        event_queue.put(None, timeout=1)
+    except queue.Full:
+        pass
+    event_writer_thread.join(EVENT_FLUSH_TIMEOUT_SEC)
+    if event_writer_thread.is_alive():
+        leftovers = []
+        while not event_queue.empty():
+            item = event_queue.get_nowait()
+            if item is not None: leftovers.append(item)
+        if leftovers:
+            logger.warning("Event writer did not finish in time. Spooling remaining events.")
+            spool_events(leftovers)
 
 
 def cleanup(signum=None, frame=None):
@@ -170,45 +509,97 @@ def cleanup(signum=None, frame=None):
     This function is called when the script is asked to stop.
     It cleans up neatly, releasing the pin connection and DB connection.
     """
-    global shutting_down, db_connection, db_cursor, switch # Add DB/switch variables
+    global shutting_down, db_connection, db_cursor, switch, switch_request # Add DB/switch variables
     # Make sure we only run the cleanup steps once.
     if shutting_down:
         return
     shutting_down = True # Set flag so the main loop stops
     signal_name = signal.Signals(signum).name if signum else "Normal Exit"
-    print(f"\nShutting down the switch watcher (Signal: {signal_name})...")
+    logger.info("Shutting down the switch watcher (Signal: %s)...", signal_name)
 
-    # --- Close Database Connection ---
-    print("Watcher closing database connection...")
-    if db_cursor:
-        try: db_cursor.close(); print("Watcher DB cursor closed.")
-        except Error as e: print(f"Error closing watcher DB cursor: {e}")
-    if db_connection and db_connection.is_connected():
-        try: db_connection.close(); print("Watcher DB connection closed.")
-        except Error as e: print(f"Error closing watcher DB connection: {e}")
-    db_connection = None # Clear globals
-    db_cursor = None
+    # --- Flush Events and Close Database Connection ---
+    # The writer thread owns the DB connection and closes it when it stops.
+    logger.info("Watcher flushing queued events and closing database connection...")
+    stop_event_writer()
+
+    # --- Close D-Bus Connection ---
+    if dbus_call_conn:
+        try: dbus_call_conn.close(); logger.info("Watcher D-Bus connection closed.")
+        except Exception as e: logger.error("Error closing watcher D-Bus connection: %s", e)
+
+    # Release the kernel line request if edge events were used
+    if switch_request:
+        try:
+            switch_request.release()
+            logger.info("Switch GPIO line released.")
+        except Exception as e:
+            logger.error("Error trying to release the switch GPIO line: %s", e)
 
     # If switch pin is setup correctly
     if switch:
         try:
             # Release the pin so other programs can use it.
             switch.deinit()
-            print("Switch pin connection released.")
+            logger.info("Switch pin connection released.")
         except Exception as e:
             # Just report errors during cleanup, but try to exit anyway.
-            print(f"Error trying to release the switch pin: {e}")
+            logger.error("Error trying to release the switch pin: %s", e)
 
-    print("Switch watcher stopped.")
+    logger.info("Switch watcher stopped.")
     # Exit the script cleanly.
     sys.exit(0)
 
+def describe_switch_state(raw_state):
+    """Returns 'ON'/'OFF' for a raw pin value, taking the wiring (pull direction) into account."""
+    if PULL_DIRECTION == digitalio.Pull.UP:
+        return "OFF" if raw_state else "ON" # PullUP: LOW=ON
+    return "ON" if raw_state else "OFF" # PullDOWN: HIGH=ON
+
+def initialize_switch_events():
+    """
+    Requests the switch line from the kernel with edge detection on both edges.
+    Returns True if edge events are available, False if we need to fall back to polling.
+    """
+    global switch_request, previous_switch_state
+    if gpiod is None:
+        logger.warning("gpiod library not available. Falling back to polling the switch.")
+        return False
+    try:
+        bias = Bias.PULL_UP if PULL_DIRECTION == digitalio.Pull.UP else Bias.PULL_DOWN
+        switch_request = gpiod.request_lines(
+            SWITCH_GPIO_CHIP,
+            consumer="switch-watcher",
+            config={SWITCH_LINE_OFFSET: gpiod.LineSettings(direction=Direction.INPUT, edge_detection=Edge.BOTH, bias=bias)}
+        )
+        # Give the pin a tiny moment to stabilize after setting the bias.
+        time.sleep(0.1)
+        previous_switch_state = read_switch_value()
+        logger.info("Switch line %s:%s ready with edge events. Initial state is: %s", SWITCH_GPIO_CHIP, SWITCH_LINE_OFFSET, describe_switch_state(previous_switch_state))
+        return True
+    except Exception as e:
+        # e.g. chip missing, line busy, or kernel without edge support
+        logger.warning("Edge events unavailable on %s:%s (%s). Falling back to polling the switch.", SWITCH_GPIO_CHIP, SWITCH_LINE_OFFSET, e)
+        if switch_request:
+            try: switch_request.release()
+            except Exception: pass
+        switch_request = None
+        return False
+
+def read_switch_value():
+    """Reads the raw switch pin value (True = HIGH) from whichever backend is active."""
+    if switch_request:
+        return switch_request.get_value(SWITCH_LINE_OFFSET) == Value.ACTIVE
+    return switch.value
+
 def initialize_switch():
     """
     Sets up the computer pin to read the switch's state.
     Returns True if setup was successful, False otherwise.
     """
     global switch, previous_switch_state # Modified the global variables
+    # Prefer kernel edge events, poll only if they are unavailable
+    if initialize_switch_events():
+        return True
     try:
         # Object to represent the physical pin connection.
         switch = digitalio.DigitalInOut(SWITCH_PIN)
@@ -224,137 +615,181 @@ def initialize_switch():
         # and store it as the initial state.
         previous_switch_state = switch.value
         # Show a message about the initial state.
-        # Adjusted logic to correctly display ON/OFF based on pull direction
-        if PULL_DIRECTION == digitalio.Pull.UP:
-             state_str = "OFF (HIGH)" if previous_switch_state else "ON (LOW)" # PullUP: LOW=ON
-        else: # PULL_DOWN
-             state_str = "ON (HIGH)" if previous_switch_state else "OFF (LOW)" # PullDOWN: HIGH=ON
+        state_str = f"{describe_switch_state(previous_switch_state)} ({'HIGH' if previous_switch_state else 'LOW'})"
         pull_str = "Pull Up (expects Ground when ON)" if PULL_DIRECTION == digitalio.Pull.UP else "Pull Down (expects 3.3V when ON)"
-        print(f"Switch pin {SWITCH_PIN} is ready. Wiring mode: {pull_str}. Initial state is: {state_str}")
+        logger.info("Switch pin %s is ready. Wiring mode: %s. Initial state is: %s", SWITCH_PIN, pull_str, state_str)
         return True # Signal success
     except ValueError as e:
         # Common error if the pin doesn't exist or is already in use.
-        print(f"FATAL ERROR: Failed to set up the switch pin {SWITCH_PIN}. Is the pin number correct? Is it already used by another program? Details: {e}")
+        logger.critical("Failed to set up the switch pin %s. Is the pin number correct? Is it already used by another program? Details: %s", SWITCH_PIN, e)
         return False # Signal failure
     except RuntimeError as e:
         # Might happen if the hardware libraries aren't installed or can't access the hardware.
-        print(f"FATAL ERROR: Failed to set up the switch pin {SWITCH_PIN}. Do you need to run as root, or are hardware libraries missing? Details: {e}")
+        logger.critical("Failed to set up the switch pin %s. Do you need to run as root, or are hardware libraries missing? Details: %s", SWITCH_PIN, e)
         return False # Signal failure
     except Exception as e:
         # Catch any other unexpected problems during setup.
-        print(f"FATAL ERROR: Failed to set up the switch: {e}")
+        logger.critical("Failed to set up the switch: %s", e)
         return False # Signal failure
 
+# --- Switch Change Handling ---
+def handle_switch_change(stable_state, flip_time=None):
+    """
+    Acts on a debounced switch change: starts/stops the service and logs the event.
+    'stable_state' is the raw pin value (True = HIGH), 'flip_time' when the switch moved.
+    """
+    state_str = describe_switch_state(stable_state)
+
+    # --- Decide What To Do ---
+    # Check if the background service is running right now.
+    service_is_currently_active = is_service_active()
+    # Determine if the service *should* be running based on stable state and pull direction
+    should_be_running = (stable_state is False if PULL_DIRECTION == digitalio.Pull.UP else stable_state is True)
+    desired_state_str = "RUNNING" if should_be_running else "STOPPED"
+    logger.info("Switch is now stable in %s state. Service should be %s.", state_str, desired_state_str)
+    logger.info("(Service is currently %s)", 'running' if service_is_currently_active else 'stopped')
+
+    # --- Perform Action and Log Event ---
+    action_taken = False
+    event_to_log = None
+    event_details = 'Triggered by switch'
+
+    # If the service should be running...
+    if should_be_running:
+        # ...and it's NOT running...
+        if not service_is_currently_active:
+            logger.info("Switch wants service ON, starting '%s'...", SERVICE_NAME)
+            if run_systemctl("start"):
+                event_to_log = 'MONITOR_START'
+                action_taken = True
+        else:
+            # ...but if it's already running, do nothing.
+            logger.info("Switch wants service ON, but '%s' is already running. No action needed.", SERVICE_NAME)
+    # If the service should be stopped...
+    else: # should_be_running is False
+        # ...and it IS running...
+        if service_is_currently_active:
+            logger.info("Switch wants service OFF, stopping '%s'...", SERVICE_NAME)
+            if run_systemctl("stop"):
+                 event_to_log = 'MONITOR_STOP'
+                 action_taken = True
+        else:
+            # ...but if it's already stopped, do nothing.
+            logger.info("Switch wants service OFF, but '%s' is already stopped. No action needed.", SERVICE_NAME)
+
+    # Log the event AFTER the systemctl command seems successful
+    if event_to_log:
+        log_system_event(event_to_log, event_details, flip_time)
+        logger.info("Queued event: %s", event_to_log)
+
+    if action_taken:
+        logger.info("Systemctl action sequence completed.")
+
 # --- Main Part of the Script ---
-def watch_switch():
+def watch_switch_events():
     """
-    The main loop that continuously checks the switch and acts on changes.
+    Event-driven loop: sleeps in the kernel until the switch line changes.
+    Debouncing uses the kernel event timestamps: we act once the line has been
+    quiet for DEBOUNCE_TIME_SEC after the last edge, then read the settled value.
     """
-    print("DEBUG: Entered watch_switch() function.") # Debugging
-    loop_counter = 0 # Initialize loop counter
-    global previous_switch_state # We need to update the remembered state
+    global previous_switch_state
+    debounce_ns = int(DEBOUNCE_TIME_SEC * 1_000_000_000)
+    last_edge_ns = None # Timestamp of the most recent edge not yet acted on
+    first_edge_ns = None # Timestamp of the first edge of the current flip
+    logger.info("Entering watch_switch event loop (kernel edge events).")
+    while not shutting_down:
+        try:
+            if last_edge_ns is None:
+                timeout = None # Nothing pending: block until the next edge
+            else:
+                timeout = max(0, debounce_ns - (time.monotonic_ns() - last_edge_ns)) / 1_000_000_000
+
+            if switch_request.wait_edge_events(timeout):
+                # Edge event timestamps use CLOCK_MONOTONIC, same as time.monotonic_ns()
+                for event in switch_request.read_edge_events():
+                    if first_edge_ns is None: first_edge_ns = event.timestamp_ns
+                    last_edge_ns = event.timestamp_ns
+                continue
+
+            if last_edge_ns is None:
+                continue
+            # Quiet for the whole debounce window: the switch has settled
+            # Convert the kernel timestamp of the first edge to wall-clock time
+            flip_time = datetime.now() - timedelta(microseconds=(time.monotonic_ns() - first_edge_ns) // 1000)
+            last_edge_ns = None
+            first_edge_ns = None
+            stable_state = read_switch_value()
+            if stable_state == previous_switch_state:
+                logger.warning("Detected switch bounce (state changed back quickly). Ignoring the flip.")
+                continue
+            previous_switch_state = stable_state
+            logger.info("Switch flipped! New state: %s", describe_switch_state(stable_state))
+            handle_switch_change(stable_state, flip_time)
+
+        except (OSError, IOError) as e:
+            logger.warning("Problem reading the switch line: %s. Check the wiring/connection.", e)
+            time.sleep(5)
+        except Exception as e:
+            logger.error("An unexpected error occurred: %s", e)
+            time.sleep(1)
+
+def watch_switch_polling():
+    """
+    Fallback loop when edge events are unavailable: polls the pin every POLL_INTERVAL_SEC.
+    Debouncing is timestamp based: a new value must hold for DEBOUNCE_TIME_SEC before we act.
+    """
+    global previous_switch_state
+    candidate_state = None # Value seen that differs from the stable state
+    candidate_since = None # When candidate_state was first seen
+    candidate_time = None
+    logger.info("Entering watch_switch polling loop.")
     # Keep running until the 'shutting_down' flag becomes True.
-    print("Entering watch_switch main loop. shutting_down =", shutting_down) # Debugging
     while not shutting_down:
-        loop_counter += 1 # Loop counter
-        print(f"DEBUG: Top of watch_switch loop #{loop_counter}") # Debugging
         try:
             # Read the current state of the switch (True or False).
-            print(f"DEBUG: Reading switch value...") # Debugging
             current_switch_state = switch.value
-            print(f"DEBUG: Switch value read: {current_switch_state}") # Debugging
-
-            # Check if the state has changed since the last time we looked.
-            if current_switch_state != previous_switch_state:
-                # Determine ON/OFF string based on pull direction
-                if PULL_DIRECTION == digitalio.Pull.UP:
-                    state_str = "OFF" if current_switch_state else "ON"
-                else:
-                    state_str = "ON" if current_switch_state else "OFF"
-                print(f"Switch flipped! New state: {state_str}")
-
-                # --- Handle Switch Bounce ---
-                # Wait for the debounce time to ignore electrical noise.
-                time.sleep(DEBOUNCE_TIME_SEC)
-                # Read the switch state AGAIN after the pause.
-                stable_state = switch.value
-                # If the state flipped back during the pause, it was probably noise.
-                if stable_state != current_switch_state:
-                    print("Detected switch bounce (state changed back quickly). Ignoring the flip.")
-                    # Update the 'previous' state to the actual stable state we just read.
-                    previous_switch_state = stable_state
-                    # Skip the rest of the actions and check again next loop.
-                    continue
-
-                # --- End of Bounce Handling ---
-
-                # If we get here, the switch state seems stable after the debounce delay.
-                # Update the 'previous' state to this new, stable state.
-                previous_switch_state = current_switch_state # Note: using current_switch_state here is correct
-
-                # --- Decide What To Do ---
-                # Check if the background service is running right now.
-                service_is_currently_active = is_service_active()
-                # Determine if the service *should* be running based on stable state and pull direction
-                should_be_running = (stable_state is False if PULL_DIRECTION == digitalio.Pull.UP else stable_state is True)
-                desired_state_str = "RUNNING" if should_be_running else "STOPPED"
-                print(f"Switch is now stable in {state_str} state. Service should be {desired_state_str}.")
-                print(f"(Service is currently {'running' if service_is_currently_active else 'stopped'})")
-
-                # --- Perform Action and Log Event ---
-                action_taken = False
-                event_to_log = None
-                event_details = 'Triggered by switch'
-
-                # If the service should be running...
-                if should_be_running:
-                    # ...and it's NOT running...
-                    if not service_is_currently_active:
-                        print(f"Switch wants service ON, starting '{SERVICE_NAME}'...")
-                        if run_systemctl("start"):
-                            event_to_log = 'MONITOR_START'
-                            action_taken = True
-                    else:
-                        # ...but if it's already running, do nothing.
-                        print(f"Switch wants service ON, but '{SERVICE_NAME}' is already running. No action needed.")
-                # If the service should be stopped...
-                else: # should_be_running is False
-                    # ...and it IS running...
-                    if service_is_currently_active:
-                        print(f"Switch wants service OFF, stopping '{SERVICE_NAME}'...")
-                        if run_systemctl("stop"):
-                             event_to_log = 'MONITOR_STOP'
-                             action_taken = True
-                    else:
-                        # ...but if it's already stopped, do nothing.
-                        print(f"Switch wants service OFF, but '{SERVICE_NAME}' is already stopped. No action needed.")
-
-                # Log the event AFTER the systemctl command seems successful
-                if event_to_log:
-                    log_system_event(event_to_log, event_details)
-                    print(f"Logged event: {event_to_log}")
-
-                if action_taken:
-                    print("Systemctl action sequence completed.")
-
+            now = time.monotonic()
+
+            if current_switch_state == previous_switch_state:
+                if candidate_state is not None:
+                    logger.warning("Detected switch bounce (state changed back quickly). Ignoring the flip.")
+                candidate_state = None
+            elif current_switch_state != candidate_state:
+                # New value: start the debounce window
+                candidate_state = current_switch_state
+                candidate_since = now
+                candidate_time = datetime.now() # Wall-clock time of the flip, for the event log
+            elif now - candidate_since >= DEBOUNCE_TIME_SEC:
+                # Held long enough: accept it
+                candidate_state = None
+                previous_switch_state = current_switch_state
+                logger.info("Switch flipped! New state: %s", describe_switch_state(current_switch_state))
+                handle_switch_change(current_switch_state, candidate_time)
 
             # Wait a short time before checking the switch again.
-            # This prevents the script from using too much computer power.
             time.sleep(POLL_INTERVAL_SEC)
 
         # --- Handle Specific Errors Gracefully ---
         except (OSError, IOError) as e:
             # These errors often mean a problem reading the physical pin.
-            print(f"Problem reading the switch pin: {e}. Check the wiring/connection.")
+            logger.warning("Problem reading the switch pin: %s. Check the wiring/connection.", e)
             # Wait a bit longer before trying again, in case it's a temporary issue.
             time.sleep(5)
         except Exception as e:
             # Catch any other unexpected problems during the main loop.
-            print(f"An unexpected error occurred: {e}")
+            logger.error("An unexpected error occurred: %s", e)
             # Wait a short moment before trying again.
             time.sleep(1)
 
-    print("DEBUG: Exited watch_switch loop.") # Debugging
+def watch_switch():
+    """
+    The main loop that waits for switch changes and acts on them.
+    """
+    if switch_request:
+        watch_switch_events()
+    else:
+        watch_switch_polling()
+    logger.info("Exited watch_switch loop.")
 
 # --- Script Starts Running Here ---
 if __name__ == "__main__":
@@ -363,27 +798,31 @@ if __name__ == "__main__":
     signal.signal(signal.SIGTERM, cleanup) # Standard terminate signal
     signal.signal(signal.SIGINT, cleanup)  # Ctrl+C signal
 
-    print("--- Starting Switch Watcher ---")
+    # Log to the console/journal through the shared queue-based logger
+    terrarium_logging.setup_logging()
+    logger.info("--- Starting Switch Watcher ---")
     # Try to set up the switch pin. If it fails, stop the script.
     if not initialize_switch():
         sys.exit(1) # Exit with an error code
 
-    # Connect to database after switch init
-    if not connect_database():
-        print("Warning: Watcher failed initial DB connection. Event logging disabled until reconnect.")
-        # Script will continue to control service, but won't log events initially
+    # Connect to systemd over D-Bus (falls back to running systemctl)
+    initialize_dbus_backend()
+
+    # Start the background event writer (connects to the database on its own thread;
+    # events are spooled to disk until the database is reachable)
+    start_event_writer()
 
-    print("DEBUG: Initialization complete. Calling watch_switch().") # Debugging
+    logger.debug("Initialization complete. Calling watch_switch().") # Debugging
     try:
         # Start the main loop to watch the switch.
         watch_switch()
     except SystemExit:
         # This is expected if the 'cleanup' function was called successfully. Do nothing.
-        print("DEBUG: Caught SystemExit.") # Debugging
+        logger.debug("Caught SystemExit.") # Debugging
         pass
     except Exception as e:
         # If a major unexpected error happens that wasn't caught inside the loop...
-        print(f"\nDEBUG: Caught unexpected error in main block: {e}") # Debugging
+        logger.error("Caught unexpected error in main block: %s", e, exc_info=True)
         # Clean up before exiting.
         cleanup()
-    print("DEBUG: Script execution finished.") # Debugging
+    logger.debug("Script execution finished.") # Debugging
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# systemd_dbus_standin.py - A stand-in for systemd on a private dbus-daemon, so switch_watcher.py's
+#                           D-Bus service-control backend can be tried without touching the real system bus.
+#
+# Starts its own dbus-daemon and answers the systemd calls the watcher makes there:
+#   Manager: LoadUnit, StartUnit, StopUnit, Subscribe    Unit: Properties.Get('ActiveState')
+# StartUnit/StopUnit move the unit through activating/deactivating to active/inactive and send
+# PropertiesChanged signals for each step, like systemd does for subscribed clients. Nothing is really started.
+#
+# On its own (prints the bus address, runs until Ctrl+C):
+#   python3 systemd_dbus_standin.py
+#   DBUS_SYSTEM_BUS_ADDRESS=<printed address> sudo -E python3 switch_watcher.py
+# From a test: see test_switch_watcher_dbus.py. Needs jeepney and dbus-daemon.
+
+import subprocess   # Runs the private dbus-daemon
+import threading    # Serves calls and sends delayed state changes in the background
+import time
+from jeepney import DBusAddress, MessageType, new_method_return, new_error, new_signal
+from jeepney.bus_messages import message_bus
+from jeepney.io.blocking import open_dbus_connection
+
+SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+UNIT_PATH_PREFIX = '/org/freedesktop/systemd1/unit/'
+
+
+def unit_object_path(unit_name):
+    """systemd's object path for a unit name (bus path escaping: every byte outside [A-Za-z0-9] becomes _xx)."""
+    return UNIT_PATH_PREFIX + ''.join(c if c.isascii() and c.isalnum() else f"_{ord(c):02x}" for c in unit_name)
+
+
+class SystemdStandin:
+    """
+    One fake unit on a private bus. 'state' is its ActiveState; 'calls' lists the method names received.
+    Set send_signals = False to stop PropertiesChanged signals (as if the watcher's listener missed them).
+    """
+
+    def __init__(self, unit_name='terrarium-control.service', initial_state='inactive', transition_sec=0.1):
+        self.unit_name = unit_name
+        self.unit_path = unit_object_path(unit_name)
+        self.state = initial_state
+        self.transition_sec = transition_sec # Time spent in activating/deactivating
+        self.send_signals = True
+        self.calls = []
+        self.address = None
+        self._daemon = None
+        self._conn = None
+        self._send_lock = threading.Lock() # Replies (serving thread) and signals (timers) share the connection
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Starts dbus-daemon, takes the systemd bus name and begins serving. Returns self."""
+        self._daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                                        stdout=subprocess.PIPE, text=True)
+        self.address = self._daemon.stdout.readline().strip()
+        self._conn = open_dbus_connection(self.address)
+        self._conn.send_and_get_reply(message_bus.RequestName(SYSTEMD_BUS_NAME), timeout=5)
+        self._thread = threading.Thread(target=self._serve, name='systemd-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping = True
+        if self._thread: self._thread.join(2)
+        if self._conn: self._conn.close()
+        if self._daemon:
+            self._daemon.terminate(); self._daemon.wait(5); self._daemon.stdout.close()
+
+    def set_state(self, state):
+        """Changes the unit's ActiveState and (if enabled) signals it."""
+        self.state = state
+        if not self.send_signals or self._stopping: return
+        unit = DBusAddress(self.unit_path, interface='org.freedesktop.DBus.Properties')
+        signal = new_signal(unit, 'PropertiesChanged', 'sa{sv}as', ('org.freedesktop.systemd1.Unit', {'ActiveState': ('s', state)}, []))
+        with self._send_lock: self._conn.send(signal)
+
+    def _transition(self, intermediate, final):
+        self.set_state(intermediate)
+        threading.Timer(self.transition_sec, self.set_state, (final,)).start()
+
+    def _reply(self, msg):
+        member = msg.header.fields.get(3) # Header field 3: member (method name)
+        self.calls.append(member)
+        if member == 'LoadUnit':
+            if msg.body[0] != self.unit_name: return new_error(msg, 'org.freedesktop.systemd1.NoSuchUnit', 's', (f"Unit {msg.body[0]} not found.",))
+            return new_method_return(msg, 'o', (self.unit_path,))
+        if member == 'Subscribe':
+            return new_method_return(msg)
+        if member == 'Get' and msg.body[1] == 'ActiveState':
+            return new_method_return(msg, 'v', (('s', self.state),))
+        if member in ('StartUnit', 'StopUnit'):
+            if member == 'StartUnit' and self.state != 'active': self._transition('activating', 'active')
+            if member == 'StopUnit' and self.state not in ('inactive', 'failed'): self._transition('deactivating', 'inactive')
+            return new_method_return(msg, 'o', ('/org/freedesktop/systemd1/job/1',))
+        return new_error(msg, 'org.freedesktop.DBus.Error.UnknownMethod', 's', (f"Stand-in does not implement {member}.",))
+
+    def _serve(self):
+        while not self._stopping:
+            try:
+                msg = self._conn.receive(timeout=0.2)
+            except TimeoutError:
+                continue
+            except (OSError, EOFError):
+                break # Connection closed by stop()
+            if msg.header.message_type != MessageType.method_call: continue
+            reply = self._reply(msg)
+            with self._send_lock: self._conn.send(reply)
+
+
+if __name__ == "__main__":
+    standin = SystemdStandin().start()
+    print(f"systemd stand-in for '{standin.unit_name}' on: {standin.address}")
+    print(f"Run the watcher with: DBUS_SYSTEM_BUS_ADDRESS='{standin.address}'")
+    try:
+        last_state = None
+        while True:
+            if standin.state != last_state: print(f"ActiveState: {standin.state}"); last_state = standin.state
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        print("\nStopping stand-in.")
+    finally:
+        standin.stop()
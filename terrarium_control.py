@@ -4,7 +4,7 @@
 import uuid
 import os
 import time
-from datetime import datetime, time as time_obj # Use alias to avoid name clash with time module
+from datetime import datetime
 import logging
 import requests                 # For sending data to web API AND fetching settings
 import json                     # For formatting data as JSON
@@ -12,23 +12,52 @@ import board                    # For GPIO pin definitions (DHT Sensor)
 import adafruit_dht             # For DHT sensor
 import signal                   # For graceful shutdown
 import sys                      # For sys.exit
+import threading                # For the background sensor sampler
+import statistics               # For median filtering of sensor samples
+from collections import deque   # Ring buffer of sensor samples
 from RPLCD.i2c import CharLCD   # Import LCD library
 from gpiozero import OutputDevice # For Relay control
 from gpiozero.pins.native import NativeFactory # For non-default pin factory
+import thermostat_policy        # Pure heater decision logic (shared with policy_replay.py)
+import terrarium_logging        # Shared queue-based logging setup
 
 # --- Configuration ---
 # Path for storing the Unique Device ID
 DEVICE_ID_FILE = '/home/DanDev/terrarium_device_id.txt'
+# Path for the last-known settings (loaded at boot so heating works before the server answers)
+SETTINGS_CACHE_FILE = '/home/DanDev/terrarium_settings_cache.json'
+SETTINGS_CACHE_VERSION = 1 # Bump when the cache file format changes
 WEBAPP_URL = 'http://192.168.1.42:5000'
 READING_API_ENDPOINT = f'{WEBAPP_URL}/api/device/readings'
 SETTINGS_API_ENDPOINT = f'{WEBAPP_URL}/api/device/settings'
-SENSOR_READ_INTERVAL = 60 # Seconds between readings/updates
+SENSOR_READ_INTERVAL = 60 # Seconds between control decisions on the latest reading
+UPLOAD_INTERVAL = 60 # Seconds between readings sent to the server (report-by-exception: between checks)
+# Report-by-exception: a reading is only uploaded when it moved beyond the deadband since the last upload, or
+# REPORT_MAX_SILENCE passed. Each upload carries hold_seconds, so the server can tell a quiet period from an outage.
+REPORT_BY_EXCEPTION = True # False: upload every reading (every UPLOAD_INTERVAL)
+REPORT_DEADBAND_TEMP = 0.2 # °C change from the last uploaded value that triggers an upload
+REPORT_DEADBAND_HUMID = 1.0 # %RH change from the last uploaded value that triggers an upload
+REPORT_MAX_SILENCE = 600 # Seconds; upload at least this often even if nothing changed
+REPORT_HOLD_SECONDS = REPORT_MAX_SILENCE + UPLOAD_INTERVAL # Promised to the server: next upload comes within this (plus one check of slack)
 SETTINGS_FETCH_INTERVAL = 300 # Seconds (5 minutes)
-MAX_HEATER_ON_DURATION = 15 * 60 # Seconds (15 minutes)
-MIN_HEATER_OFF_COOLDOWN = 10 * 60  # Seconds (10 minutes)
+SETTINGS_RETRY_INTERVAL = 60 # Seconds between settings job checks (and retries of a failed fetch)
+LCD_UPDATE_INTERVAL = 5 # Seconds between LCD refreshes (only changed cells are written)
+HEARTBEAT_INTERVAL = 600 # Seconds between heartbeat/scheduler stats log lines
+CONTROL_ERROR_RETRY_DELAY = 15 # Seconds before the next control cycle after an unexpected error
+MAX_HEATER_ON_DURATION = thermostat_policy.MAX_HEATER_ON_DURATION # Seconds (15 minutes)
+MIN_HEATER_OFF_COOLDOWN = thermostat_policy.MIN_HEATER_OFF_COOLDOWN  # Seconds (10 minutes)
 
 # --- Sensor Config ---
 DHT_SENSOR_PIN = board.D16 # GPIO Pin for DHT22
+SENSOR_SAMPLE_INTERVAL = 2.5 # Seconds between background samples (DHT22 needs >= 2s between reads)
+SENSOR_BUFFER_SIZE = 24 # Accepted samples kept in the ring buffer (~1 minute)
+SENSOR_MEDIAN_WINDOW = 5 # Samples used for the median filter
+SENSOR_EMA_ALPHA = 0.3 # Smoothing factor applied to the median (1.0 = no smoothing)
+SENSOR_OUTLIER_TEMP_DELTA = 2.0 # Max °C a sample may differ from the median before it is rejected
+SENSOR_OUTLIER_HUMID_DELTA = 10.0 # Max %RH a sample may differ from the median before it is rejected
+SENSOR_MAX_CONSECUTIVE_REJECTS = 4 # After this many rejects in a row, treat it as a real step change
+SENSOR_MAX_READING_AGE = 30 # Seconds; a filtered value older than this is treated as unavailable
+SENSOR_FIRST_SAMPLE_TIMEOUT = 10 # Seconds to wait at startup for the first sample
 
 # --- Relay Config ---
 RELAY_PIN = 18 # GPIO Pin for the relay IN1
@@ -41,17 +70,26 @@ LCD_I2C_EXPANDER = 'PCF8574' # Common expander chip
 LCD_COLS = 16
 LCD_ROWS = 2
 SHUTDOWN_MSG_DELAY = 2.0 # How long to show shutdown message
+LCD_MIN_REDRAW_INTERVAL = 1.0 # Seconds between LCD redraws (rate limit, extra frames are held as pending)
+LCD_RUN_MERGE_GAP = 1 # Unchanged cells between two changed runs rewritten instead of moving the cursor
+
+# --- Gateway Config ---
+# If this file exists, one process runs every channel (sensor + relay + device ID) listed in it instead of
+# the single DHT_SENSOR_PIN / RELAY_PIN / DEVICE_ID_FILE setup above. Example:
+#   {"channels": [{"name": "Tank1", "sensor_pin": "D16", "relay_pin": 18, "device_id_file": "/home/DanDev/terrarium_device_id.txt"},
+#                 {"name": "Tank2", "sensor_pin": "D20", "relay_pin": 23, "relay_active_high": false}]}
+GATEWAY_CONFIG_FILE = os.environ.get('TERRARIUM_GATEWAY_CONFIG', '/home/DanDev/terrarium_gateway.json')
+GATEWAY_SETTINGS_CACHE_FILE = '/home/DanDev/terrarium_gateway_settings_cache.json' # Last-known settings of all channels
+BATCH_READING_API_ENDPOINT = f'{READING_API_ENDPOINT}/batch' # All channels' readings in one POST
+BULK_SETTINGS_API_ENDPOINT = f'{SETTINGS_API_ENDPOINT}/bulk' # All channels' settings in one POST
+GATEWAY_PENDING_MAX = 500 # Readings kept for resending while the server is unreachable (oldest dropped first)
+GATEWAY_BATCH_BACKOFF_MAX = 15 * 60 # Longest wait between batch retries; the wait doubles from UPLOAD_INTERVAL per failure
 
 # --- Logging Setup ---
+# Console/journal plus a size-rotated, gzip-compressed file on the SD card. Formatting and file writes
+# happen on the logging thread. Levels: TERRARIUM_LOG_LEVEL / TERRARIUM_LOG_LEVELS (see terrarium_logging.py)
 log_file = '/home/DanDev/terrarium_control.log' # Log file location
-logging.basicConfig(
-    level=logging.DEBUG, # Set to DEBUG for detailed logs, INFO for less verbosity
-    format='%(asctime)s - %(levelname)s - %(module)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler() # Also output to console/journal
-    ]
-)
+terrarium_logging.setup_logging(log_file=log_file)
 logging.info("Terrarium Control Script Starting Up")
 
 # --- Global Variables ---
@@ -63,9 +101,29 @@ current_min_temp = None # Store fetched min temp
 current_max_temp = None # Store fetched max temp
 current_heating_off_start = None # Will store time_obj or None
 current_heating_off_end = None   # Will store time_obj or None
-last_settings_fetch_time = 0 # Track when settings were last fetched
+last_settings_fetch_time = 0    # Monotonic time of the last successful settings fetch
+settings_lock = threading.Lock() # Guards the current_* settings globals
+settings_fetch_thread = None     # Background settings fetch in progress
+control_state = {'temp': None, 'humid': None, 'relay_status': "Relay: ---", 'error_msg': None} # Last control cycle result
+scheduled_jobs = []              # Periodic jobs run by run_scheduler()
+shutdown_event = threading.Event() # Set by cleanup() to wake the scheduler
 relay_on_start_time = None       # Track time when relay was turned ON
 force_heater_off_until = None    # Track time until forced OFF period ends
+sensor_lock = threading.Lock()   # Guards sensor_filter (samples / filtered value)
+sensor_stop_event = threading.Event() # Set to stop the sampler thread
+sensor_first_sample_event = threading.Event() # Set once the first sample is accepted
+sensor_thread = None             # Background sampler thread
+lcd_frame_buffer = None          # Shadow of what is on the LCD (list of LCD_ROWS strings), None = unknown
+lcd_pending_frame = None         # Latest frame held back by the redraw rate limit
+lcd_last_redraw_time = 0         # Monotonic time of the last redraw
+lcd_stats = {'redraws': 0, 'skipped': 0, 'cursor_moves': 0, 'chars_written': 0, 'clears': 0} # LCD bus write counters
+last_report = None               # Last uploaded reading: {'temp', 'humid', 'time'} (monotonic), None = nothing sent yet
+report_stats = {'sent': 0, 'suppressed': 0} # Upload checks that sent / skipped a reading (report-by-exception)
+gateway_channels = []            # Channel dicts (gateway mode only), see new_channel()
+gateway_pending = deque(maxlen=GATEWAY_PENDING_MAX) # Readings waiting for upload: dicts with a monotonic 'taken_at'
+gateway_batch_retry = {'failures': 0, 'next_attempt': 0} # Batch upload backoff: consecutive failures, monotonic time of the next try
+gateway_lcd_page = 0             # Channel shown on the LCD next
+http_session = None              # requests.Session shared by all channels (gateway mode), keeps the connection open
 
 # --- Force Native Pin Factory ---
 try:
@@ -75,122 +133,126 @@ try:
 except ImportError:
      logging.info("NativeFactory not found, using default pin factory.")
 except Exception as factory_ex:
-    logging.warning(f"Could not set NativeFactory, using gpiozero default: {factory_ex}")
+    logging.warning("Could not set NativeFactory, using gpiozero default: %s", factory_ex)
 
 # --- Initialize Relay ---
-def initialize_relay():
-    """Initializes the relay GPIO pin."""
-    global relay
+def open_relay(pin, active_high):
+    """Opens a relay output in the OFF state and verifies it. Returns the OutputDevice, or None on failure."""
     try:
         # Correct logic for initial_value based on active_high:
         # active_high=True: initial_value=False means LOW (OFF)
         # active_high=False: initial_value=True means HIGH (OFF)
-        initial_pin_state_for_off = not RELAY_IS_ACTIVE_HIGH
+        initial_pin_state_for_off = not active_high
 
-        relay = OutputDevice(RELAY_PIN, active_high=RELAY_IS_ACTIVE_HIGH, initial_value=initial_pin_state_for_off)
-        logging.info(f"Relay control initialized on GPIO {RELAY_PIN}. Active-High: {RELAY_IS_ACTIVE_HIGH}. Initial state requested: OFF (Pin state should be {'LOW' if RELAY_IS_ACTIVE_HIGH else 'HIGH'})")
+        relay_device = OutputDevice(pin, active_high=active_high, initial_value=initial_pin_state_for_off)
+        logging.info("Relay control initialized on GPIO %s. Active-High: %s. Initial state requested: OFF (Pin state should be %s)", pin, active_high, 'LOW' if active_high else 'HIGH')
 
         # Verification check
         time.sleep(0.2) # Short pause for state to settle
         try:
             # relay.value returns 1 if the pin is HIGH, 0 if LOW.
-            actual_pin_value = relay.value # Read the pin state (0=LOW, 1=HIGH)
-            expected_pin_value_for_off = 0 if RELAY_IS_ACTIVE_HIGH else 1 # Pin state expected for OFF
+            actual_pin_value = relay_device.value # Read the pin state (0=LOW, 1=HIGH)
+            expected_pin_value_for_off = 0 if active_high else 1 # Pin state expected for OFF
 
-            logging.info(f"Pin {RELAY_PIN} state after init: {'HIGH (1)' if actual_pin_value == 1 else 'LOW (0)'}. Expected pin state for OFF: {'HIGH (1)' if expected_pin_value_for_off == 1 else 'LOW (0)'}.")
+            logging.info("Pin %s state after init: %s. Expected pin state for OFF: %s.", pin, 'HIGH (1)' if actual_pin_value == 1 else 'LOW (0)', 'HIGH (1)' if expected_pin_value_for_off == 1 else 'LOW (0)')
 
             # Check if actual pin state matches the expected state for OFF
             if actual_pin_value != expected_pin_value_for_off:
-                 logging.warning(f"Relay pin state ({'HIGH' if actual_pin_value == 1 else 'LOW'}) does NOT match expected state for OFF ({'HIGH' if expected_pin_value_for_off == 1 else 'LOW'}) immediately after initialization!")
+                 logging.warning("Relay pin state (%s) does NOT match expected state for OFF (%s) immediately after initialization!", 'HIGH' if actual_pin_value == 1 else 'LOW', 'HIGH' if expected_pin_value_for_off == 1 else 'LOW')
             # Check if the relay *thinks* it's off
-            if relay.is_active:
-                 logging.warning(f"Relay object reports is_active=True immediately after initialization requesting OFF state! Active-High={RELAY_IS_ACTIVE_HIGH}, Initial Value Sent={initial_pin_state_for_off}")
+            if relay_device.is_active:
+                 logging.warning("Relay object reports is_active=True immediately after initialization requesting OFF state! Active-High=%s, Initial Value Sent=%s", active_high, initial_pin_state_for_off)
 
         except Exception as read_err:
-             logging.warning(f"Could not read relay pin value after init: {read_err}")
+             logging.warning("Could not read relay pin value after init: %s", read_err)
 
-        return True
+        return relay_device
     except Exception as e:
-        logging.critical(f"CRITICAL: Failed to initialize relay on GPIO {RELAY_PIN}: {e}")
+        logging.critical("CRITICAL: Failed to initialize relay on GPIO %s: %s", pin, e)
         logging.critical("Check GPIO pin number, permissions (run with sudo?), RPi.GPIO installed?, and potential conflicts.")
-        relay = None
-        return False
+        return None
+
+def initialize_relay():
+    """Initializes the relay GPIO pin."""
+    global relay
+    relay = open_relay(RELAY_PIN, RELAY_IS_ACTIVE_HIGH)
+    return relay is not None
 
 # --- Device ID Management (Get or Generate) ---
-def get_or_generate_persistent_device_id():
+def get_or_generate_persistent_device_id(id_file=DEVICE_ID_FILE):
     """
     Gets the device's unique ID. Generates/stores UUIDv4 on first run.
     Returns ID string or None on critical error.
     """
     device_id = None
     try:
-        if os.path.exists(DEVICE_ID_FILE):
-            logging.debug(f"Device ID file found at {DEVICE_ID_FILE}")
-            with open(DEVICE_ID_FILE, 'r') as f:
+        if os.path.exists(id_file):
+            logging.debug("Device ID file found at %s", id_file)
+            with open(id_file, 'r') as f:
                 device_id = f.read().strip()
             if device_id and len(device_id) >= 36:
                  try:
                      uuid.UUID(device_id, version=4)
-                     logging.info(f"Read/validated existing ID: {device_id}")
+                     logging.info("Read/validated existing ID: %s", device_id)
                      return device_id
                  except ValueError:
-                     logging.critical(f"CRITICAL: Invalid UUID in file '{DEVICE_ID_FILE}'. Manual fix needed.")
+                     logging.critical("CRITICAL: Invalid UUID in file '%s'. Manual fix needed.", id_file)
                      return None
             else:
-                logging.critical(f"CRITICAL: Invalid content in ID file '{DEVICE_ID_FILE}'. Manual fix needed.")
+                logging.critical("CRITICAL: Invalid content in ID file '%s'. Manual fix needed.", id_file)
                 return None
         else:
-            logging.info(f"Device ID file not found. Generating new ID...")
+            logging.info("Device ID file not found. Generating new ID...")
             new_device_id = str(uuid.uuid4())
-            logging.info(f"Generated new ID: {new_device_id}")
+            logging.info("Generated new ID: %s", new_device_id)
             try:
-                with open(DEVICE_ID_FILE, 'w') as f:
+                with open(id_file, 'w') as f:
                     f.write(new_device_id)
-                logging.info(f"Saved new ID to '{DEVICE_ID_FILE}'")
+                logging.info("Saved new ID to '%s'", id_file)
                 return new_device_id
             except IOError as e:
-                logging.error(f"ERROR saving new ID file '{DEVICE_ID_FILE}': {e}. Using unsaved ID for session.")
+                logging.error("ERROR saving new ID file '%s': %s. Using unsaved ID for session.", id_file, e)
                 return new_device_id
             except Exception as e:
-                logging.error(f"ERROR saving new ID: {e}. Using unsaved ID for session.")
+                logging.error("ERROR saving new ID: %s. Using unsaved ID for session.", e)
                 return new_device_id
     except Exception as e:
-        logging.critical(f"CRITICAL ERROR during ID retrieval: {e}")
+        logging.critical("CRITICAL ERROR during ID retrieval: %s", e)
         return None
 
 
 # --- Sensor Initialization ---
-def initialize_sensor():
-    """Initializes the DHT sensor object."""
-    global dht_device
+def open_sensor(pin):
+    """Creates a DHT22 sensor object on 'pin'. Returns it, or None on failure."""
     try:
-        dht_device = adafruit_dht.DHT22(DHT_SENSOR_PIN, use_pulseio=True)
-        logging.info(f"DHT22 sensor successfully initialized on pin: {DHT_SENSOR_PIN}")
+        sensor = adafruit_dht.DHT22(pin, use_pulseio=True)
+        logging.info("DHT22 sensor successfully initialized on pin: %s", pin)
         # Attempt initial read check
         try:
-            _ = dht_device.temperature # Read temperature
-            _ = dht_device.humidity    # Read humidity
+            _ = sensor.temperature # Read temperature
+            _ = sensor.humidity    # Read humidity
             logging.info("Initial sensor read check successful.")
         except RuntimeError as init_read_err:
             # DHT sensors need warm-up time, initial failure is common
-            logging.warning(f"Initial sensor read failed: {init_read_err}. Will retry in main loop.")
+            logging.warning("Initial sensor read failed: %s. Will retry in main loop.", init_read_err)
         except Exception as init_read_generic_err:
-             logging.warning(f"Initial sensor read failed (generic): {init_read_generic_err}. Will retry.")
-        return True
+             logging.warning("Initial sensor read failed (generic): %s. Will retry.", init_read_generic_err)
+        return sensor
     except RuntimeError as init_err:
-        logging.critical(f"CRITICAL: Failed to initialize DHT22 sensor (RuntimeError): {init_err}")
-        logging.critical(f"Check wiring on pin {DHT_SENSOR_PIN}, power, and sensor functionality.")
-        dht_device = None # Ensure it's None
-        return False
+        logging.critical("CRITICAL: Failed to initialize DHT22 sensor (RuntimeError): %s", init_err)
+        logging.critical("Check wiring on pin %s, power, and sensor functionality.", pin)
     except NotImplementedError:
         logging.critical("CRITICAL: Failed to initialize DHT22 sensor. 'pulseio' not supported on this platform/kernel?")
         logging.critical("Try running without 'use_pulseio=True' or check kernel/library compatibility.")
-        dht_device = None
-        return False
     except Exception as e:
-        logging.critical(f"CRITICAL: Unexpected error initializing DHT22 sensor: {e}", exc_info=True)
-        dht_device = None # Ensure it's None
-        return False
+        logging.critical("CRITICAL: Unexpected error initializing DHT22 sensor: %s", e, exc_info=True)
+    return None
+
+def initialize_sensor():
+    """Initializes the DHT sensor object."""
+    global dht_device
+    dht_device = open_sensor(DHT_SENSOR_PIN)
+    return dht_device is not None
 
 
 # --- LCD Initialization ---
@@ -200,75 +262,187 @@ def initialize_lcd():
     try:
         lcd = CharLCD(i2c_expander=LCD_I2C_EXPANDER, address=LCD_I2C_ADDRESS, port=1,
                       cols=LCD_COLS, rows=LCD_ROWS, auto_linebreaks=False)
-        lcd.clear()
-        lcd.write_string("Initializing...")
-        logging.info(f"LCD initialized at address {hex(LCD_I2C_ADDRESS)}")
+        clear_lcd()
+        render_lcd_frame(compose_lcd_frame(status_msg="Initializing..."), force=True)
+        logging.info("LCD initialized at address %s", hex(LCD_I2C_ADDRESS))
         time.sleep(1)
-        lcd.clear()
         return True
     except Exception as e:
-        logging.error(f"ERROR: Failed to initialize LCD: {e}. Script will continue without LCD.")
+        logging.error("ERROR: Failed to initialize LCD: %s. Script will continue without LCD.", e)
         lcd = None
         return False
 
 # --- Sensor Reading Function ---
-def read_sensor():
-    """Reads Temp & Humidity from the sensor. Returns (temp_c, humidity) or (None, None)."""
-    global dht_device
-    if dht_device is None:
+def read_sensor_once(sensor=None):
+    """Performs a single DHT22 read (default: dht_device). Returns (temp_c, humidity) or (None, None). Never sleeps."""
+    sensor = sensor if sensor is not None else dht_device
+    if sensor is None:
         logging.error("DHT sensor object not available for reading.")
         return None, None
 
-    temperature_c = None
-    humidity = None
-    max_retries = 3
-    retry_delay = 2.0 # Seconds between retries
-
-    for attempt in range(max_retries):
-        try:
-            temperature_c = dht_device.temperature
-            humidity = dht_device.humidity
-
-            # Basic validation (DHT22 specific ranges)
-            if humidity is not None and not (0 <= humidity <= 100):
-                logging.warning(f"Discarding improbable humidity reading: {humidity:.1f}% (Attempt {attempt+1})")
-                humidity = None # Invalidate humidity but keep temp if valid
-            if temperature_c is not None and not (-40 <= temperature_c <= 85): # DHT22 range up to 85C
-                logging.warning(f"Discarding improbable temperature reading: {temperature_c:.1f}°C (Attempt {attempt+1})")
-                temperature_c = None # Invalidate temp
-
-            # If BOTH are valid after checks, return them
-            if temperature_c is not None and humidity is not None:
-                logging.info(f"Successful Sensor Read: Temp={temperature_c:.1f}°C, Humidity={humidity:.1f}%")
-                return temperature_c, humidity
-            else:
-                 # If one is None but the other is valid, loop might continue if retries remain
-                 logging.debug(f"Sensor read attempt {attempt+1} resulted in partial/invalid data (T:{temperature_c}, H:{humidity}). Retrying if possible.")
+    try:
+        temperature_c = sensor.temperature
+        humidity = sensor.humidity
 
-        except RuntimeError as error:
-            # These are common and typically temporary, log as warning
-            logging.warning(f"DHT22 Runtime error reading sensor (Attempt {attempt+1}/{max_retries}): {error.args[0]}")
-            # Keep temperature_c and humidity as None if error occurred
-            temperature_c = None
+        # Basic validation (DHT22 specific ranges)
+        if humidity is not None and not (0 <= humidity <= 100):
+            logging.warning("Discarding improbable humidity reading: %.1f%%", humidity)
             humidity = None
-        except Exception as e:
-            # Log other errors more severely
-            logging.error(f"Unexpected error reading DHT22 sensor (Attempt {attempt+1}): {e}", exc_info=True)
+        if temperature_c is not None and not (-40 <= temperature_c <= 85): # DHT22 range up to 85C
+            logging.warning("Discarding improbable temperature reading: %.1f°C", temperature_c)
             temperature_c = None
-            humidity = None
 
-        # Wait before retrying only if not the last attempt
-        if attempt < max_retries - 1:
-             time.sleep(retry_delay)
-
-    # If loop finishes without success
-    logging.error(f"Failed to get valid sensor reading after {max_retries} attempts.")
+        if temperature_c is not None and humidity is not None:
+            return temperature_c, humidity
+        logging.debug("Sensor read resulted in partial/invalid data (T:%s, H:%s).", temperature_c, humidity)
+    except RuntimeError as error:
+        # These are common and typically temporary (checksum, timing), next sample will retry
+        logging.debug("DHT22 Runtime error reading sensor: %s", error.args[0])
+    except Exception as e:
+        logging.error("Unexpected error reading DHT22 sensor: %s", e, exc_info=True)
     return None, None
 
+def new_sensor_filter():
+    """Returns an empty sensor filter state: accepted raw samples, latest filtered value and counters."""
+    return {
+        'samples': deque(maxlen=SENSOR_BUFFER_SIZE), # Accepted raw samples: (monotonic_time, temp_c, humidity)
+        'filtered': {'temp': None, 'humid': None, 'time': None}, # Latest filtered value and when it was produced
+        'stats': {'reads': 0, 'failures': 0, 'rejected': 0}, # Sampler counters
+        'consecutive_rejects': 0 # Outliers rejected in a row
+    }
+
+sensor_filter = new_sensor_filter() # Single-channel sensor state (guarded by sensor_lock)
+sensor_filtered = sensor_filter['filtered']; sensor_stats = sensor_filter['stats']
+
+def filter_sensor_sample(sensor_filter, temp_c, humidity, sample_time, label="Sensor"):
+    """
+    Runs a raw sample through outlier rejection, the median filter and the EMA and stores the
+    filtered value in 'sensor_filter'. Caller holds the lock guarding it. Returns True if accepted.
+    """
+    samples = sensor_filter['samples']; filtered = sensor_filter['filtered']
+    recent = list(samples)[-SENSOR_MEDIAN_WINDOW:]
+    # Outlier rejection against the median of recent accepted samples
+    if len(recent) >= 3:
+        median_temp = statistics.median(s[1] for s in recent)
+        median_humid = statistics.median(s[2] for s in recent)
+        is_outlier = (abs(temp_c - median_temp) > SENSOR_OUTLIER_TEMP_DELTA or
+                      abs(humidity - median_humid) > SENSOR_OUTLIER_HUMID_DELTA)
+        if is_outlier:
+            sensor_filter['consecutive_rejects'] += 1
+            sensor_filter['stats']['rejected'] += 1
+            if sensor_filter['consecutive_rejects'] < SENSOR_MAX_CONSECUTIVE_REJECTS:
+                logging.debug("%s: rejected outlier sample T=%.1f H=%.1f (median T=%.1f H=%.1f)", label, temp_c, humidity, median_temp, median_humid)
+                return False
+            # Persistent deviation: a real step change (e.g. lid opened), restart the filter from here
+            logging.info("%s values moved to T=%.1f H=%.1f and stayed there. Resetting filter.", label, temp_c, humidity)
+            samples.clear()
+            filtered['temp'] = None
+            filtered['humid'] = None
+    sensor_filter['consecutive_rejects'] = 0
+
+    samples.append((sample_time, temp_c, humidity))
+    recent = list(samples)[-SENSOR_MEDIAN_WINDOW:]
+    median_temp = statistics.median(s[1] for s in recent)
+    median_humid = statistics.median(s[2] for s in recent)
+
+    # EMA over the median output
+    if filtered['temp'] is None:
+        filtered['temp'] = median_temp
+        filtered['humid'] = median_humid
+    else:
+        filtered['temp'] += SENSOR_EMA_ALPHA * (median_temp - filtered['temp'])
+        filtered['humid'] += SENSOR_EMA_ALPHA * (median_humid - filtered['humid'])
+    filtered['time'] = sample_time
+    return True
+
+def add_sensor_sample(temp_c, humidity, sample_time):
+    """Filters a raw sample from the single-channel sensor and publishes it. Returns True if the sample was accepted."""
+    with sensor_lock:
+        accepted = filter_sensor_sample(sensor_filter, temp_c, humidity, sample_time)
+    if accepted:
+        sensor_first_sample_event.set()
+    return accepted
+
+def sensor_sampler_loop():
+    """Background thread: polls the DHT22 every SENSOR_SAMPLE_INTERVAL seconds until stopped."""
+    logging.info("Sensor sampler started (interval %ss).", SENSOR_SAMPLE_INTERVAL)
+    next_sample_time = time.monotonic()
+    while not sensor_stop_event.is_set():
+        temp_c, humidity = read_sensor_once()
+        sensor_stats['reads'] += 1
+        if temp_c is not None and humidity is not None:
+            add_sensor_sample(temp_c, humidity, time.monotonic())
+        else:
+            sensor_stats['failures'] += 1
+        # Fixed cadence, never closer together than the sensor allows
+        next_sample_time = max(next_sample_time + SENSOR_SAMPLE_INTERVAL, time.monotonic() + 2.0)
+        sensor_stop_event.wait(max(0, next_sample_time - time.monotonic()))
+    logging.info("Sensor sampler stopped. Stats: %s", sensor_stats)
+
+def start_sensor_sampler(target=sensor_sampler_loop):
+    """Starts the background sampler thread (gateway mode passes its own loop)."""
+    global sensor_thread
+    if sensor_thread and sensor_thread.is_alive(): return
+    sensor_stop_event.clear()
+    sensor_thread = threading.Thread(target=target, name="dht-sampler", daemon=True)
+    sensor_thread.start()
+
+def stop_sensor_sampler(timeout=5.0):
+    """Stops the background sampler thread and waits for it to finish its current read."""
+    sensor_stop_event.set()
+    if sensor_thread and sensor_thread.is_alive():
+        sensor_thread.join(timeout)
+
+def get_latest_reading():
+    """
+    Non-blocking. Returns (temp_c, humidity, age_seconds) of the latest filtered value,
+    or (None, None, None) if no sample has been accepted yet.
+    """
+    with sensor_lock:
+        temp_c = sensor_filtered['temp']; humidity = sensor_filtered['humid']; sample_time = sensor_filtered['time']
+    if sample_time is None:
+        return None, None, None
+    return round(temp_c, 2), round(humidity, 2), time.monotonic() - sample_time
+
+def read_sensor():
+    """
+    Returns the latest filtered (temp_c, humidity) from the background sampler without waiting,
+    or (None, None) if there is no value younger than SENSOR_MAX_READING_AGE.
+    """
+    temp_c, humidity, age = get_latest_reading()
+    if age is None:
+        logging.warning("No sensor sample available yet.")
+        return None, None
+    if age > SENSOR_MAX_READING_AGE:
+        logging.error("Latest sensor value is stale (%.0fs old). Stats: %s", age, sensor_stats)
+        return None, None
+    logging.info("Sensor Reading: Temp=%.1f°C, Humidity=%.1f%% (age %.1fs)", temp_c, humidity, age)
+    return temp_c, humidity
+
+
+# --- Report-by-Exception ---
+def report_due(previous, temp_c, humidity, now):
+    """
+    Decides whether a reading is uploaded. 'previous' is the last uploaded {'temp', 'humid', 'time'} or None.
+    Returns (due, reason): reason is periodic, first, temp, humid or silence (for logging).
+    """
+    if not REPORT_BY_EXCEPTION: return True, 'periodic'
+    if previous is None: return True, 'first'
+    if round(abs(temp_c - previous['temp']), 2) >= REPORT_DEADBAND_TEMP: return True, 'temp' # Rounded: readings have 2 decimals
+    if round(abs(humidity - previous['humid']), 2) >= REPORT_DEADBAND_HUMID: return True, 'humid'
+    if now - previous['time'] >= REPORT_MAX_SILENCE - UPLOAD_INTERVAL / 2: return True, 'silence' # Half a check early, never late
+    return False, None
 
 # --- Data Sending Function ---
-def send_data_to_server(device_id, temperature, humidity):
-    """Sends sensor data via HTTP POST to the web application API."""
+def describe_http_error(e):
+    """Status code plus the server's 'error' message (or raw body) of a requests HTTPError."""
+    error_detail = f"Status code: {e.response.status_code}"
+    try: error_json = e.response.json(); error_detail += f" - {error_json.get('error', e.response.text)}"
+    except json.JSONDecodeError: error_detail += f" - {e.response.text}"
+    return error_detail
+
+def send_data_to_server(device_id, temperature, humidity, hold_seconds=None):
+    """Sends sensor data via HTTP POST to the web application API. hold_seconds marks a report-by-exception reading."""
     if not device_id:
         logging.error("Cannot send data: Device ID is missing.")
         return False
@@ -278,179 +452,327 @@ def send_data_to_server(device_id, temperature, humidity):
         'temperature': temperature,
         'humidity': humidity
     }
+    if hold_seconds is not None:
+        payload['hold_seconds'] = hold_seconds
     headers = {'Content-Type': 'application/json'}
 
     try:
-        logging.debug(f"Sending data to {READING_API_ENDPOINT}: {json.dumps(payload)}")
+        logging.debug("Sending data to %s: %s", READING_API_ENDPOINT, payload)
         response = requests.post(READING_API_ENDPOINT, headers=headers, data=json.dumps(payload), timeout=15)
         response.raise_for_status()
-        logging.info(f"Data sent successfully. Server response status: {response.status_code}")
+        logging.info("Data sent successfully. Server response status: %s", response.status_code)
         return True
 
     except requests.exceptions.ConnectionError as e:
-        logging.error(f"Connection Error sending data to {WEBAPP_URL}: {e}")
+        logging.error("Connection Error sending data to %s: %s", WEBAPP_URL, e)
     except requests.exceptions.Timeout as e:
-        logging.error(f"Timeout sending data to {WEBAPP_URL}: {e}")
+        logging.error("Timeout sending data to %s: %s", WEBAPP_URL, e)
     except requests.exceptions.HTTPError as e:
-        error_detail = f"Status code: {e.response.status_code}"
-        try: error_json = e.response.json(); error_detail += f" - {error_json.get('error', e.response.text)}"
-        except json.JSONDecodeError: error_detail += f" - {e.response.text}"
-        logging.error(f"HTTP Error sending data: {error_detail}")
+        logging.error("HTTP Error sending data: %s", describe_http_error(e))
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error during data sending request: {e}")
+        logging.error("Error during data sending request: %s", e)
     except Exception as e:
-        logging.error(f"Unexpected error sending data: {e}", exc_info=True)
+        logging.error("Unexpected error sending data: %s", e, exc_info=True)
 
     return False
 
 
+# --- Settings Validation ---
+def parse_settings(settings, current, source="server"):
+    """
+    Validates a settings dict (as served by /api/device/settings) against the current
+    (min, max, off_start, off_end) tuple. Invalid parts keep their current values.
+    Returns the new (min, max, off_start, off_end) tuple, with the off times as time objects.
+    """
+    current_min, current_max, current_off_start, current_off_end = current
+
+    # --- Temperature Threshold Handling ---
+    new_min = settings.get('min_temp_threshold')
+    new_max = settings.get('max_temp_threshold')
+    # Basic validation: if both are set, min should be less than max
+    if new_min is not None and new_max is not None:
+         try:
+             if float(new_min) >= float(new_max):
+                 logging.warning("Settings from %s are invalid (min >= max): Min=%s, Max=%s. Ignoring threshold update.", source, new_min, new_max)
+                 # Time settings might still be valid
+                 new_min = current_min # Revert to current
+                 new_max = current_max
+         except (ValueError, TypeError) as conv_err:
+              logging.warning("Temp settings from %s have non-numeric values: Min='%s', Max='%s'. Error: %s. Ignoring threshold update.", source, new_min, new_max, conv_err)
+              new_min = current_min # Revert
+              new_max = current_max
+
+    # Off Period Time Handling
+    new_off_start_str = settings.get('heating_off_start_time') # Expects HH:MM:SS or None
+    new_off_end_str = settings.get('heating_off_end_time')     # Expects HH:MM:SS or None
+    new_off_start_time = None
+    new_off_end_time = None
+
+    try:
+        if new_off_start_str:
+            # Parse HH:MM:SS string into a time object
+            new_off_start_time = datetime.strptime(new_off_start_str, '%H:%M:%S').time()
+        if new_off_end_str:
+            # Parse HH:MM:SS string into a time object
+            new_off_end_time = datetime.strptime(new_off_end_str, '%H:%M:%S').time()
+
+        # Add consistency check: If one is set, the other should be too
+        if (new_off_start_time is not None and new_off_end_time is None) or \
+           (new_off_start_time is None and new_off_end_time is not None):
+             logging.warning("Inconsistent time settings from %s: Start='%s', End='%s'. Both should be set or neither. Ignoring time update.", source, new_off_start_str, new_off_end_str)
+             # Revert to current stored times
+             new_off_start_time = current_off_start
+             new_off_end_time = current_off_end
+
+    except ValueError as time_parse_error:
+         logging.warning("Settings from %s contain invalid time format: Start='%s', End='%s'. Error: %s. Ignoring time update.", source, new_off_start_str, new_off_end_str, time_parse_error)
+         # Revert to current stored times
+         new_off_start_time = current_off_start
+         new_off_end_time = current_off_end
+
+    return new_min, new_max, new_off_start_time, new_off_end_time
+
+def format_settings(settings_tuple):
+    """Turns a (min, max, off_start, off_end) tuple back into the settings API shape."""
+    min_temp, max_temp, off_start, off_end = settings_tuple
+    return {
+        'min_temp_threshold': min_temp,
+        'max_temp_threshold': max_temp,
+        'heating_off_start_time': off_start.strftime('%H:%M:%S') if off_start else None,
+        'heating_off_end_time': off_end.strftime('%H:%M:%S') if off_end else None
+    }
+
+def apply_settings(settings, source="server"):
+    """
+    Validates a settings dict (as served by /api/device/settings) and stores it in the globals.
+    Invalid parts are ignored and keep their current values. Returns True if anything changed.
+    """
+    global current_min_temp, current_max_temp, current_heating_off_start, current_heating_off_end
+    current = (current_min_temp, current_max_temp, current_heating_off_start, current_heating_off_end)
+    new_settings = parse_settings(settings, current, source)
+
+    # --- Check if any settings changed ---
+    settings_changed = new_settings != current # Compares time objects too
+
+    if settings_changed:
+         log_settings = format_settings(new_settings)
+         logging.info("Updating stored settings from %s: Min=%s, Max=%s, OffStart=%s, OffEnd=%s", source, new_settings[0], new_settings[1], log_settings['heating_off_start_time'], log_settings['heating_off_end_time'])
+         with settings_lock: # Control cycle must never see a half-applied update
+             current_min_temp, current_max_temp, current_heating_off_start, current_heating_off_end = new_settings
+    else:
+         logging.debug("Settings from %s are the same as current. No update needed.", source)
+
+    return settings_changed
+
+def current_settings_dict():
+    """Returns the stored settings in the same shape as the settings API response."""
+    with settings_lock:
+        return format_settings((current_min_temp, current_max_temp, current_heating_off_start, current_heating_off_end))
+
+# --- Persistent Settings Cache ---
+def write_json_atomic(path, data):
+    """Atomically writes 'data' as JSON to 'path' (temp file + fsync + rename). Returns True on success."""
+    tmp_file = f"{path}.tmp"
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path) # Atomic on POSIX: readers see old or new file, never partial
+        logging.info("Saved settings cache to '%s'", path)
+        return True
+    except (IOError, OSError) as e:
+        logging.error("ERROR saving settings cache '%s': %s", path, e)
+        try: os.remove(tmp_file)
+        except OSError: pass
+        return False
+
+def save_settings_cache():
+    """Atomically writes the current settings to SETTINGS_CACHE_FILE."""
+    return write_json_atomic(SETTINGS_CACHE_FILE, {
+        'version': SETTINGS_CACHE_VERSION,
+        'device_id': DEVICE_UNIQUE_ID,
+        'fetched_at': time.time(),
+        'settings': current_settings_dict()
+    })
+
+def load_settings_cache():
+    """Loads last-known settings from SETTINGS_CACHE_FILE at startup. Returns True if settings were applied."""
+    if not os.path.exists(SETTINGS_CACHE_FILE):
+        logging.info("No settings cache at '%s'. Waiting for first fetch.", SETTINGS_CACHE_FILE)
+        return False
+    try:
+        with open(SETTINGS_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+        if cache.get('version') != SETTINGS_CACHE_VERSION:
+            logging.warning("Settings cache version %s not supported (expected %s). Ignoring cache.", cache.get('version'), SETTINGS_CACHE_VERSION)
+            return False
+        if cache.get('device_id') != DEVICE_UNIQUE_ID:
+            logging.warning("Settings cache belongs to a different device ID. Ignoring cache.")
+            return False
+        settings = cache.get('settings')
+        if not isinstance(settings, dict):
+            logging.warning("Settings cache has no settings. Ignoring cache.")
+            return False
+        apply_settings(settings, source="cache")
+        age_hours = (time.time() - float(cache.get('fetched_at', 0))) / 3600
+        logging.info("Loaded cached settings (fetched %.1fh ago). Revalidating with server in background.", age_hours)
+        return True
+    except (IOError, OSError, ValueError, TypeError) as e:
+        logging.error("ERROR reading settings cache '%s': %s. Ignoring cache.", SETTINGS_CACHE_FILE, e)
+        return False
+
 # --- Settings Fetch Function ---
 def fetch_device_settings(device_id):
     """Fetches settings (temp thresholds, off period) from the web server."""
-    # Add new globals to modify
-    global current_min_temp, current_max_temp, current_heating_off_start, current_heating_off_end
-
     if not device_id:
         logging.error("Cannot fetch settings: Device ID is missing.")
         return False
 
     url = f"{SETTINGS_API_ENDPOINT}/{device_id}"
-    logging.debug(f"Attempting to fetch settings from: {url}")
+    logging.debug("Attempting to fetch settings from: %s", url)
 
     try:
         response = requests.get(url, timeout=10)
         response.raise_for_status()
         settings = response.json()
-        logging.info(f"Successfully fetched settings: {settings}")
+        logging.info("Successfully fetched settings: %s", settings)
 
-        # --- Temperature Threshold Handling ---
-        new_min = settings.get('min_temp_threshold')
-        new_max = settings.get('max_temp_threshold')
-        # Basic validation: if both are set, min should be less than max
-        if new_min is not None and new_max is not None:
-             try:
-                 if float(new_min) >= float(new_max):
-                     logging.warning(f"Fetched settings are invalid (min >= max): Min={new_min}, Max={new_max}. Ignoring threshold update.")
-                     # Don't return False yet, time settings might be valid
-                     new_min = current_min_temp # Revert to current
-                     new_max = current_max_temp
-             except (ValueError, TypeError) as conv_err:
-                  logging.warning(f"Fetched temp settings have non-numeric values: Min='{new_min}', Max='{new_max}'. Error: {conv_err}. Ignoring threshold update.")
-                  new_min = current_min_temp # Revert
-                  new_max = current_max_temp
-
-        # Off Period Time Handling
-        new_off_start_str = settings.get('heating_off_start_time') # Expects HH:MM:SS or None
-        new_off_end_str = settings.get('heating_off_end_time')     # Expects HH:MM:SS or None
-        new_off_start_time = None
-        new_off_end_time = None
-
-        try:
-            if new_off_start_str:
-                # Parse HH:MM:SS string into a time object
-                new_off_start_time = datetime.strptime(new_off_start_str, '%H:%M:%S').time()
-            if new_off_end_str:
-                # Parse HH:MM:SS string into a time object
-                new_off_end_time = datetime.strptime(new_off_end_str, '%H:%M:%S').time()
-
-            # Add consistency check: If one is set, the other should be too
-            if (new_off_start_time is not None and new_off_end_time is None) or \
-               (new_off_start_time is None and new_off_end_time is not None):
-                 logging.warning(f"Fetched inconsistent time settings: Start='{new_off_start_str}', End='{new_off_end_str}'. Both should be set or neither. Ignoring time update.")
-                 # Revert to current stored times
-                 new_off_start_time = current_heating_off_start
-                 new_off_end_time = current_heating_off_end
-
-        except ValueError as time_parse_error:
-             logging.warning(f"Fetched settings contain invalid time format: Start='{new_off_start_str}', End='{new_off_end_str}'. Error: {time_parse_error}. Ignoring time update.")
-             # Revert to current stored times
-             new_off_start_time = current_heating_off_start
-             new_off_end_time = current_heating_off_end
-
-        # --- Check if any settings changed ---
-        settings_changed = (
-            new_min != current_min_temp or
-            new_max != current_max_temp or
-            new_off_start_time != current_heating_off_start or # Compare time objects
-            new_off_end_time != current_heating_off_end       # Compare time objects
-        )
-
-        if settings_changed:
-             # Update logging and assignment
-             log_start_str = new_off_start_time.strftime('%H:%M:%S') if new_off_start_time else "None"
-             log_end_str = new_off_end_time.strftime('%H:%M:%S') if new_off_end_time else "None"
-             logging.info(f"Updating stored settings: Min={new_min}, Max={new_max}, OffStart={log_start_str}, OffEnd={log_end_str}")
-             current_min_temp = new_min
-             current_max_temp = new_max
-             current_heating_off_start = new_off_start_time # Store time object
-             current_heating_off_end = new_off_end_time     # Store time object
-        else:
-             logging.debug("Fetched settings are the same as current. No update needed.")
+        # Validate/store, then persist so the next boot starts with these values
+        if apply_settings(settings, source="server") or not os.path.exists(SETTINGS_CACHE_FILE):
+            save_settings_cache()
 
         return True # Indicate success
 
     except requests.exceptions.ConnectionError as e:
-        logging.error(f"Connection Error fetching settings from {url}: {e}")
+        logging.error("Connection Error fetching settings from %s: %s", url, e)
     except requests.exceptions.Timeout as e:
-        logging.error(f"Timeout fetching settings from {url}: {e}")
+        logging.error("Timeout fetching settings from %s: %s", url, e)
     except requests.exceptions.HTTPError as e:
-        error_detail = f"Status code: {e.response.status_code}"
-        try: error_json = e.response.json(); error_detail += f" - {error_json.get('error', e.response.text)}"
-        except json.JSONDecodeError: error_detail += f" - {e.response.text}"
-        logging.error(f"HTTP Error fetching settings ({url}): {error_detail}")
+        logging.error("HTTP Error fetching settings (%s): %s", url, describe_http_error(e))
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error during settings fetching request ({url}): {e}")
+        logging.error("Error during settings fetching request (%s): %s", url, e)
     except json.JSONDecodeError as e:
-        logging.error(f"Error decoding settings JSON response from {url}: {e}")
-        logging.error(f"Received content: {response.text[:500]}") # Log raw response on decode error
+        logging.error("Error decoding settings JSON response from %s: %s", url, e)
+        logging.error("Received content: %s", response.text[:500]) # Log raw response on decode error
     except Exception as e:
-        logging.error(f"Unexpected error fetching settings ({url}): {e}", exc_info=True)
+        logging.error("Unexpected error fetching settings (%s): %s", url, e, exc_info=True)
 
     # If any exception occurred, return False
     return False
 
-# --- LCD Update Function ---
-def update_lcd(temp_c, humid, relay_state_str=None, status_msg=None):
-    """Updates the LCD display with sensor data, relay status, or a status message."""
-    global lcd
-    if not lcd: return
+# --- LCD Frame Buffer / Differential Renderer ---
+def compose_lcd_frame(temp_c=None, humid=None, relay_state_str=None, status_msg=None):
+    """Builds the LCD_ROWS x LCD_COLS frame (list of padded strings) for the given display state."""
+    if status_msg:
+        # Priority status message, wrapped onto line 2 if too long
+        line1 = status_msg[:LCD_COLS]
+        line2 = status_msg[LCD_COLS:(LCD_COLS*2)]
+    elif temp_c is not None and humid is not None:
+        # Normal display: Temp/Humid on Line 1, Relay Status on Line 2
+        try:
+            line1 = f"T:{temp_c:>4.1f}C   H:{humid:>3.0f}%"
+        except Exception: # Catch potential float format errors
+            line1 = "T: Err H: Err"
+        line2 = relay_state_str if relay_state_str else "Relay: ---"
+    else:
+        # Fallback if no error but data is None
+        line1 = "Reading..."
+        line2 = ""
+    frame = [line1[:LCD_COLS].ljust(LCD_COLS), line2[:LCD_COLS].ljust(LCD_COLS)]
+    return frame[:LCD_ROWS]
+
+def diff_lcd_frame(old_frame, new_frame):
+    """
+    Compares two frames and returns the writes needed as a list of (row, col, text).
+    Changed cells separated by <= LCD_RUN_MERGE_GAP unchanged cells are merged into one run,
+    since rewriting a cell costs no more than a cursor move. old_frame=None means a full redraw.
+    """
+    writes = []
+    for row, new_line in enumerate(new_frame):
+        if old_frame is None:
+            writes.append((row, 0, new_line))
+            continue
+        old_line = old_frame[row]
+        run_start = None
+        run_end = None
+        for col in range(LCD_COLS):
+            if new_line[col] == old_line[col]:
+                continue
+            if run_start is not None and col - run_end - 1 <= LCD_RUN_MERGE_GAP:
+                run_end = col # Extend current run
+            else:
+                if run_start is not None:
+                    writes.append((row, run_start, new_line[run_start:run_end + 1]))
+                run_start = col
+                run_end = col
+        if run_start is not None:
+            writes.append((row, run_start, new_line[run_start:run_end + 1]))
+    return writes
+
+def render_lcd_frame(frame, force=False):
+    """
+    Writes only the changed cells of 'frame' to the LCD using cursor positioning.
+    Redraws are rate limited to LCD_MIN_REDRAW_INTERVAL; a limited frame is kept as pending
+    and written by flush_lcd(). force=True bypasses the rate limit.
+    Returns True if the frame was written (or was already on screen), False otherwise.
+    """
+    global lcd_frame_buffer, lcd_pending_frame, lcd_last_redraw_time
+    if not lcd: return False
 
-    try:
-        lcd.clear()
+    now = time.monotonic()
+    if not force and lcd_frame_buffer is not None and now - lcd_last_redraw_time < LCD_MIN_REDRAW_INTERVAL:
+        lcd_pending_frame = frame
+        lcd_stats['skipped'] += 1
+        return False
+    lcd_pending_frame = None
 
-        if status_msg:
-            # Priority status message
-            lcd.cursor_pos = (0, 0)
-            lcd.write_string(status_msg[:LCD_COLS])
-            if len(status_msg) > LCD_COLS :
-                 lcd.cursor_pos = (1,0)
-                 lcd.write_string(status_msg[LCD_COLS:(LCD_COLS*2)])
+    writes = diff_lcd_frame(lcd_frame_buffer, frame)
+    if not writes:
+        return True # Nothing changed, no bus traffic
 
-        elif temp_c is not None and humid is not None:
-            # Normal display: Temp/Humid on Line 1
-            try:
-                temp_f = temp_c * (9 / 5) + 32
-                line1 = f"T:{temp_c:>4.1f}C   H:{humid:>3.0f}%"[:LCD_COLS]
-                # Alternative with F: line1 = f"{temp_c:>4.1f}C {temp_f:>4.1f}F"[:LCD_COLS]
-            except Exception: # Catch potential float format errors
-                line1 = "T: Err H: Err"[:LCD_COLS]
-            lcd.cursor_pos = (0, 0)
-            lcd.write_string(line1.ljust(LCD_COLS))
-
-            # Relay Status on Line 2
-            line2 = (relay_state_str if relay_state_str else "Relay: ---")[:LCD_COLS]
-            lcd.cursor_pos = (1, 0)
-            lcd.write_string(line2.ljust(LCD_COLS))
+    try:
+        cursor_at = None # (row, col) where the LCD cursor is after the previous write
+        for row, col, text in writes:
+            if cursor_at != (row, col):
+                lcd.cursor_pos = (row, col)
+                lcd_stats['cursor_moves'] += 1
+            lcd.write_string(text)
+            lcd_stats['chars_written'] += len(text)
+            cursor_at = (row, col + len(text))
+        lcd_frame_buffer = list(frame)
+        lcd_last_redraw_time = now
+        lcd_stats['redraws'] += 1
+        logging.debug("LCD redraw: %s run(s). Totals: %s", len(writes), lcd_stats)
+        return True
+    except Exception as e:
+        lcd_frame_buffer = None # Display contents unknown, next render rewrites everything
+        logging.error("Failed to update LCD: %s", e, exc_info=True)
+        return False
 
-        else:
-            # Fallback if no error but data is None
-            lcd.cursor_pos = (0,0)
-            lcd.write_string("Reading...".ljust(LCD_COLS))
-            lcd.cursor_pos = (1,0)
-            lcd.write_string(" ".ljust(LCD_COLS)) # Clear second line
+def flush_lcd():
+    """Writes a frame held back by the rate limit, once the redraw interval has passed."""
+    if lcd_pending_frame is not None:
+        render_lcd_frame(lcd_pending_frame)
 
+def clear_lcd():
+    """Clears the LCD and resets the shadow buffer to blank."""
+    global lcd_frame_buffer, lcd_pending_frame
+    if not lcd: return
+    try:
+        lcd.clear()
+        lcd_stats['clears'] += 1
+        lcd_frame_buffer = [" " * LCD_COLS for _ in range(LCD_ROWS)]
     except Exception as e:
-        logging.error(f"Failed to update LCD: {e}", exc_info=True)
+        lcd_frame_buffer = None
+        logging.error("Failed to clear LCD: %s", e)
+    lcd_pending_frame = None
+
+# --- LCD Update Function ---
+def update_lcd(temp_c, humid, relay_state_str=None, status_msg=None, force=False):
+    """Updates the LCD display with sensor data, relay status, or a status message."""
+    if not lcd: return
+    render_lcd_frame(compose_lcd_frame(temp_c, humid, relay_state_str, status_msg), force=force)
 
 
 # --- Cleanup Function ---
@@ -459,6 +781,7 @@ def cleanup(signum=None, frame=None):
     global lcd, shutting_down, dht_device, relay
     if shutting_down: return
     shutting_down = True
+    shutdown_event.set() # Wake the scheduler out of its sleep
 
     signal_name = signal.Signals(signum).name if signum else "Script Exit"
     print(f"\nReceived {signal_name}. Initiating graceful shutdown...")
@@ -466,13 +789,13 @@ def cleanup(signum=None, frame=None):
     if lcd:
         try:
             print("Attempting to display shutdown message on LCD...")
-            lcd.clear()
-            lcd.cursor_pos = (0, 0)
-            lcd.write_string("Shutting down...".ljust(LCD_COLS))
+            update_lcd(None, None, status_msg="Shutting down...", force=True)
             time.sleep(SHUTDOWN_MSG_DELAY)
         except Exception as lcd_shutdown_msg_error:
             print(f"Warning: Could not display shutdown message on LCD: {lcd_shutdown_msg_error}")
 
+    release_gateway_channels() # Gateway mode: all channel relays OFF, sensors released
+
     if relay:
         try:
             print("Turning relay OFF and closing GPIO...")
@@ -483,6 +806,8 @@ def cleanup(signum=None, frame=None):
         except Exception as e:
             print(f"Warning: Error during relay cleanup: {e}")
 
+    stop_sensor_sampler() # Sampler must not be mid-read when the sensor is released
+
     if dht_device:
         try:
             if hasattr(dht_device, 'exit') and callable(dht_device.exit):
@@ -511,12 +836,602 @@ def cleanup(signum=None, frame=None):
     logging.info("--- Terrarium Control Script Stopped ---")
     sys.exit(0)
 
+# --- Control Cycle ---
+def run_control_cycle():
+    """Evaluates the latest filtered reading and drives the relay. Updates control_state for the LCD/upload jobs."""
+    global relay_on_start_time, force_heater_off_until
+    error_message_for_lcd = None
+    relay_status_str = "Relay: ---" # Default
+
+    # --- Read Sensor (latest filtered value from background sampler, never blocks) ---
+    temp, humid = read_sensor()
+    if temp is None or humid is None:
+        logging.warning("Sensor read failed or returned invalid data this cycle.")
+        error_message_for_lcd = "Sensor Error" # Set error message for LCD
+
+    # --- Heating Control Logic (Check Relay First) ---
+    if relay is None:
+        logging.error("Cannot perform heating control: Relay not initialized.")
+        relay_status_str = "Relay: ERROR"
+        error_message_for_lcd = "Relay Error" # Prioritize relay error
+    else:
+        relay_is_currently_on = relay.is_active
+        state = {'relay_on': relay_is_currently_on, 'on_since': relay_on_start_time, 'cooldown_until': force_heater_off_until}
+        with settings_lock:
+            settings = (current_min_temp, current_max_temp, current_heating_off_start, current_heating_off_end)
+        decision = thermostat_policy.decide_heater(
+            state, temp, datetime.now().time(), time.monotonic(), *settings,
+            MAX_HEATER_ON_DURATION, MIN_HEATER_OFF_COOLDOWN)
+        logging.debug("Heater decision: Temp=%s, Min=%s, Max=%s, Relay ON=%s -> %s", temp, current_min_temp, current_max_temp, relay_is_currently_on, decision['reason'])
+
+        if decision['cooldown_until'] != force_heater_off_until:
+            if decision['cooldown_until'] is None:
+                logging.info("Forced heater cooldown period finished.")
+            else:
+                logging.warning("Heater exceeded MAX ON limit of %ss. Forcing OFF, cooldown until monotonic time %.1f.", MAX_HEATER_ON_DURATION, decision['cooldown_until'])
+        force_heater_off_until = decision['cooldown_until']
+
+        # Apply the change if needed
+        if decision['relay_on'] != relay_is_currently_on:
+            logging.info("Turning relay %s (reason: %s, Temp=%s, Min=%s, Max=%s).", 'ON' if decision['relay_on'] else 'OFF', decision['reason'], temp, current_min_temp, current_max_temp)
+            try:
+                if decision['relay_on']: relay.on()
+                else: relay.off()
+                relay_on_start_time = decision['on_since']
+            except Exception as e: logging.error("Failed to switch relay %s: %s", 'ON' if decision['relay_on'] else 'OFF', e)
+
+        relay_status_str = decision['status']
+        if decision['error_msg'] and not error_message_for_lcd: error_message_for_lcd = decision['error_msg']
+
+    control_state['temp'] = temp
+    control_state['humid'] = humid
+    control_state['relay_status'] = relay_status_str
+    control_state['error_msg'] = error_message_for_lcd
+
+    # --- Update LCD ---
+    update_lcd(temp, humid, relay_status_str, error_message_for_lcd)
+
+
+# --- Scheduled Jobs ---
+def control_job():
+    """Scheduler job: heating control on the latest reading."""
+    try:
+        run_control_cycle()
+    except Exception as e:
+        logging.error("An unexpected error occurred in the control cycle: %s", e, exc_info=True)
+        handle_control_error()
+        return CONTROL_ERROR_RETRY_DELAY # Retry sooner than usual, but not in a tight loop
+
+def upload_job():
+    """Scheduler job: sends the latest filtered reading to the server (report-by-exception: only if due)."""
+    global last_report
+    temp, humid = read_sensor()
+    if temp is None or humid is None:
+        logging.warning("No valid sensor reading to upload this cycle.")
+        return
+    now = time.monotonic()
+    due, reason = report_due(last_report, temp, humid, now)
+    if not due:
+        report_stats['suppressed'] += 1
+        logging.debug("Reading T=%.1f H=%.1f within deadband of last upload. Not sent.", temp, humid)
+        return
+    logging.debug("Uploading reading (reason: %s).", reason)
+    if send_data_to_server(DEVICE_UNIQUE_ID, temp, humid, REPORT_HOLD_SECONDS if REPORT_BY_EXCEPTION else None):
+        last_report = {'temp': temp, 'humid': humid, 'time': now} # A failed upload is retried on the next check
+        report_stats['sent'] += 1
+
+def settings_job():
+    """Scheduler job: starts a background settings fetch when one is due. Never blocks on the network."""
+    global settings_fetch_thread
+    if settings_fetch_thread and settings_fetch_thread.is_alive():
+        return # Previous fetch still waiting on the server
+    if last_settings_fetch_time and time.monotonic() - last_settings_fetch_time < SETTINGS_FETCH_INTERVAL:
+        return
+    settings_fetch_thread = threading.Thread(target=settings_fetch_worker, name="settings-fetch", daemon=True)
+    settings_fetch_thread.start()
+
+def settings_fetch_worker():
+    """Background thread body for settings_job. A failed fetch is retried on the next job run."""
+    global last_settings_fetch_time
+    logging.info("Time to fetch device settings...")
+    if fetch_device_settings(DEVICE_UNIQUE_ID):
+        last_settings_fetch_time = time.monotonic()
+    else:
+        logging.warning("Failed to fetch/update settings. Using previous values (if any).")
+
+def lcd_job():
+    """Scheduler job: refreshes the LCD from the last control state (only changed cells are written)."""
+    flush_lcd()
+    update_lcd(control_state['temp'], control_state['humid'], control_state['relay_status'], control_state['error_msg'])
+
+def scheduler_summary():
+    """One-line per-job run/lateness summary for the heartbeat log."""
+    return ", ".join(
+        f"{job['name']}: runs={job['runs']} missed={job['missed']} late_avg={(job['total_lateness'] / job['runs'] if job['runs'] else 0):.3f}s late_max={job['max_lateness']:.3f}s"
+        for job in scheduled_jobs)
+
+def heartbeat_job():
+    """Scheduler job: logs liveness plus per-job lateness, sensor and LCD counters."""
+    logging.info("Heartbeat. Jobs [%s]. Sensor %s. Uploads %s. LCD %s.", scheduler_summary(), sensor_stats, report_stats, lcd_stats)
+
+def handle_control_error():
+    """Turns the relay off and shows an error after an unexpected control failure."""
+    global relay_on_start_time
+    # Turn off relay on unexpected errors for safety
+    if relay and relay.is_active:
+        try:
+            logging.warning("Turning relay OFF due to unexpected error in control cycle.")
+            relay.off()
+            relay_on_start_time = None # Reset timer on error too
+            relay_status_str = "Relay: OFF (ERR)"
+        except Exception as relay_err:
+            logging.error("Failed to turn off relay during error handling: %s", relay_err)
+            relay_status_str = "Relay: ERR!"
+    else:
+        # If relay wasn't active or doesn't exist, still indicate error
+        relay_status_str = "Relay: ERR!" if relay else "Relay: ERROR" # Adjust if relay is None
+    control_state['relay_status'] = relay_status_str
+    control_state['error_msg'] = "System Error"
+
+    # Display error on LCD
+    update_lcd(None, None, relay_status_str, "System Error", force=True)
+
+
+# --- Deadline Scheduler ---
+def add_job(name, func, interval, first_delay=0):
+    """
+    Registers a periodic job. Deadlines advance by whole intervals from the previous deadline,
+    so jobs do not drift with their own run time. A job may return a number of seconds to
+    override its next deadline (e.g. retry after a failure).
+    """
+    scheduled_jobs.append({
+        'name': name, 'func': func, 'interval': interval,
+        'next_run': time.monotonic() + first_delay,
+        'runs': 0, 'missed': 0, 'total_lateness': 0.0, 'max_lateness': 0.0
+    })
+
+def run_scheduler():
+    """Sleeps until the earliest deadline (or shutdown) and runs due jobs. Returns on shutdown."""
+    while not shutting_down:
+        job = min(scheduled_jobs, key=lambda j: j['next_run']) # Ties go to the job registered first
+        delay = job['next_run'] - time.monotonic()
+        if delay > 0:
+            # Single sleep until the next deadline; cleanup() sets the event to wake us early
+            if shutdown_event.wait(delay):
+                break
+            continue
+
+        started = time.monotonic()
+        lateness = started - job['next_run']
+        job['runs'] += 1
+        job['total_lateness'] += lateness
+        job['max_lateness'] = max(job['max_lateness'], lateness)
+
+        result = None
+        try:
+            result = job['func']()
+        except Exception as e:
+            logging.error("Scheduled job '%s' failed: %s", job['name'], e, exc_info=True)
+
+        finished = time.monotonic()
+        logging.debug("Job '%s' ran %.3fs late, took %.2fs.", job['name'], lateness, finished - started)
+
+        if isinstance(result, (int, float)) and not isinstance(result, bool):
+            job['next_run'] = finished + result
+        else:
+            next_run = job['next_run'] + job['interval']
+            if next_run <= finished:
+                # Overran one or more deadlines: skip them rather than running back to back
+                skipped = int((finished - next_run) // job['interval']) + 1
+                job['missed'] += skipped
+                next_run += skipped * job['interval']
+            job['next_run'] = next_run
+
+
+# --- Gateway Mode (several channels in one process) ---
+def new_channel(index, config):
+    """Builds the state dict of one gateway channel from its config file entry."""
+    return {
+        'number': index + 1, # 1-based, shown on the LCD
+        'name': str(config.get('name') or f"Ch{index + 1}"),
+        'sensor_pin': config.get('sensor_pin'),
+        'relay_pin': config.get('relay_pin'),
+        'relay_active_high': bool(config.get('relay_active_high', RELAY_IS_ACTIVE_HIGH)),
+        'device_id_file': config.get('device_id_file') or f"/home/DanDev/terrarium_device_id_{index + 1}.txt",
+        'device_id': None, 'sensor': None, 'relay': None,
+        'lock': threading.Lock(), # Guards 'filter' and 'settings'
+        'filter': new_sensor_filter(),
+        'settings': (None, None, None, None), # (min, max, off_start, off_end) as in the current_* globals
+        'settings_version': None, # Version string from the server, sent back so unchanged settings aren't resent
+        'heater': thermostat_policy.new_heater_state(),
+        'last_report': None, # Last queued reading for report-by-exception, as the last_report global
+        'control': {'temp': None, 'humid': None, 'relay_status': "Relay: ---", 'error_msg': None}
+    }
+
+def load_gateway_config(path=GATEWAY_CONFIG_FILE):
+    """Reads the gateway config file. Returns a list of channel dicts; raises ValueError if the file is unusable."""
+    try:
+        with open(path, 'r') as f:
+            config = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise ValueError(f"Cannot read gateway config '{path}': {e}")
+    entries = config.get('channels') if isinstance(config, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"Gateway config '{path}' has no 'channels' list.")
+    channels = [new_channel(i, entry) for i, entry in enumerate(entries) if isinstance(entry, dict)]
+    if len(channels) != len(entries):
+        raise ValueError("Every gateway channel must be an object.")
+    for field in ('sensor_pin', 'relay_pin', 'device_id_file'):
+        values = [ch[field] for ch in channels]
+        if None in values: raise ValueError(f"Every gateway channel needs a '{field}'.")
+        if len(set(values)) != len(values): raise ValueError(f"Gateway channels share a '{field}'.")
+    return channels
+
+def initialize_gateway_channels(channels):
+    """
+    Opens the device ID, sensor and relay of every channel. A channel that fails is left out (and its relay
+    released) so one bad sensor doesn't stop the other enclosures. Returns (usable channels, error summary).
+    """
+    usable = []; errors = []
+    for ch in channels:
+        label = f"Channel {ch['number']} ({ch['name']})"
+        ch['device_id'] = get_or_generate_persistent_device_id(ch['device_id_file'])
+        sensor_pin = getattr(board, str(ch['sensor_pin']), None) # e.g. "D16" -> board.D16
+        ch['sensor'] = open_sensor(sensor_pin) if sensor_pin is not None else None
+        ch['relay'] = open_relay(ch['relay_pin'], ch['relay_active_high'])
+        failed = [part for part, ok in (("ID", ch['device_id']), ("Sensor", ch['sensor']), ("Relay", ch['relay'])) if not ok]
+        if failed:
+            logging.critical("%s disabled, failed to initialize: %s (sensor pin %s, relay pin %s).", label, ", ".join(failed), ch['sensor_pin'], ch['relay_pin'])
+            errors.append(f"{ch['number']}:{'/'.join(failed)}")
+            release_channel(ch)
+            continue
+        logging.info("%s ready: Device ID %s, sensor pin %s, relay pin %s.", label, ch['device_id'], ch['sensor_pin'], ch['relay_pin'])
+        usable.append(ch)
+    return usable, " ".join(errors)
+
+def release_channel(ch):
+    """Turns a channel's relay OFF and releases its GPIO/sensor. Safe to call more than once."""
+    if ch['relay']:
+        try: ch['relay'].off(); ch['relay'].close()
+        except Exception as e: logging.warning("Error releasing relay of channel %s: %s", ch['number'], e)
+        ch['relay'] = None
+    if ch['sensor'] and hasattr(ch['sensor'], 'exit') and callable(ch['sensor'].exit):
+        try: ch['sensor'].exit()
+        except Exception as e: logging.warning("Error releasing sensor of channel %s: %s", ch['number'], e)
+    ch['sensor'] = None
+
+def release_gateway_channels():
+    """Shutdown: all channel relays OFF first, then the sensors once the sampler has stopped."""
+    for ch in gateway_channels:
+        if ch['relay']:
+            try: ch['relay'].off()
+            except Exception as e: print(f"Warning: Could not turn off relay of channel {ch['number']}: {e}")
+    if gateway_channels:
+        stop_sensor_sampler()
+        for ch in gateway_channels: release_channel(ch)
+        print(f"{len(gateway_channels)} gateway channel(s) turned OFF and released.")
+
+def gateway_sampler_loop():
+    """Background thread: reads every channel's DHT22 in turn, once per SENSOR_SAMPLE_INTERVAL."""
+    logging.info("Gateway sensor sampler started (%s channels, interval %ss).", len(gateway_channels), SENSOR_SAMPLE_INTERVAL)
+    next_sample_time = time.monotonic()
+    while not sensor_stop_event.is_set():
+        for ch in gateway_channels:
+            temp_c, humidity = read_sensor_once(ch['sensor'])
+            with ch['lock']:
+                ch['filter']['stats']['reads'] += 1
+                if temp_c is not None and humidity is not None:
+                    filter_sensor_sample(ch['filter'], temp_c, humidity, time.monotonic(), label=f"Channel {ch['number']}")
+                else:
+                    ch['filter']['stats']['failures'] += 1
+        if all(ch['filter']['filtered']['time'] is not None for ch in gateway_channels):
+            sensor_first_sample_event.set()
+        # Each sensor is read once per round, so a round of >= 2s respects the DHT22 minimum
+        next_sample_time = max(next_sample_time + SENSOR_SAMPLE_INTERVAL, time.monotonic() + 2.0)
+        sensor_stop_event.wait(max(0, next_sample_time - time.monotonic()))
+    logging.info("Gateway sensor sampler stopped.")
+
+def read_channel(ch):
+    """Latest filtered (temp_c, humidity) of a channel, or (None, None) if missing or older than SENSOR_MAX_READING_AGE."""
+    with ch['lock']:
+        filtered = dict(ch['filter']['filtered'])
+    if filtered['time'] is None:
+        logging.warning("Channel %s: no sensor sample available yet.", ch['number'])
+        return None, None
+    age = time.monotonic() - filtered['time']
+    if age > SENSOR_MAX_READING_AGE:
+        logging.error("Channel %s: latest sensor value is stale (%.0fs old). Stats: %s", ch['number'], age, ch['filter']['stats'])
+        return None, None
+    return round(filtered['temp'], 2), round(filtered['humid'], 2)
+
+def run_channel_control(ch):
+    """Control cycle of one channel: heater decision on its latest reading and settings, relay switched if needed."""
+    temp, humid = read_channel(ch)
+    error_message_for_lcd = "Sensor Error" if temp is None or humid is None else None
+    relay_is_currently_on = ch['relay'].is_active
+    heater = ch['heater']
+    state = {'relay_on': relay_is_currently_on, 'on_since': heater['on_since'], 'cooldown_until': heater['cooldown_until']}
+    with ch['lock']:
+        settings = ch['settings']
+    decision = thermostat_policy.decide_heater(
+        state, temp, datetime.now().time(), time.monotonic(), *settings,
+        MAX_HEATER_ON_DURATION, MIN_HEATER_OFF_COOLDOWN)
+    logging.debug("Channel %s heater decision: Temp=%s, Min=%s, Max=%s, Relay ON=%s -> %s", ch['number'], temp, settings[0], settings[1], relay_is_currently_on, decision['reason'])
+
+    if decision['cooldown_until'] != heater['cooldown_until']:
+        if decision['cooldown_until'] is None:
+            logging.info("Channel %s: forced heater cooldown period finished.", ch['number'])
+        else:
+            logging.warning("Channel %s: heater exceeded MAX ON limit of %ss. Forcing OFF, cooldown until monotonic time %.1f.", ch['number'], MAX_HEATER_ON_DURATION, decision['cooldown_until'])
+
+    on_since = heater['on_since']
+    if decision['relay_on'] != relay_is_currently_on:
+        logging.info("Channel %s: turning relay %s (reason: %s, Temp=%s, Min=%s, Max=%s).", ch['number'], 'ON' if decision['relay_on'] else 'OFF', decision['reason'], temp, settings[0], settings[1])
+        try:
+            if decision['relay_on']: ch['relay'].on()
+            else: ch['relay'].off()
+            on_since = decision['on_since']
+        except Exception as e: logging.error("Channel %s: failed to switch relay %s: %s", ch['number'], 'ON' if decision['relay_on'] else 'OFF', e)
+    ch['heater'] = {'relay_on': ch['relay'].is_active, 'on_since': on_since, 'cooldown_until': decision['cooldown_until']}
+
+    if decision['error_msg'] and not error_message_for_lcd: error_message_for_lcd = decision['error_msg']
+    ch['control'] = {'temp': temp, 'humid': humid, 'relay_status': decision['status'], 'error_msg': error_message_for_lcd}
+
+def gateway_control_job():
+    """Scheduler job: control cycle of every channel. A failing channel is switched OFF without affecting the others."""
+    for ch in gateway_channels:
+        try:
+            run_channel_control(ch)
+        except Exception as e:
+            logging.error("Unexpected error in control cycle of channel %s: %s", ch['number'], e, exc_info=True)
+            try:
+                ch['relay'].off()
+                ch['heater'] = thermostat_policy.new_heater_state()
+                relay_status_str = "Relay: OFF (ERR)"
+            except Exception as relay_err:
+                logging.error("Failed to turn off relay of channel %s during error handling: %s", ch['number'], relay_err)
+                relay_status_str = "Relay: ERR!"
+            ch['control'] = {'temp': None, 'humid': None, 'relay_status': relay_status_str, 'error_msg': "System Error"}
+
+def gateway_upload_job():
+    """Scheduler job: queues every channel's latest reading (report-by-exception: if due) and sends the queue in one batch request."""
+    now = time.monotonic()
+    for ch in gateway_channels:
+        temp, humid = read_channel(ch)
+        if temp is None or humid is None:
+            logging.warning("Channel %s: no valid sensor reading to upload this cycle.", ch['number'])
+            continue
+        due, reason = report_due(ch['last_report'], temp, humid, now)
+        if not due:
+            report_stats['suppressed'] += 1
+            continue
+        # Queued readings are resent until delivered, so the channel counts as reported from here
+        ch['last_report'] = {'temp': temp, 'humid': humid, 'time': now}
+        report_stats['sent'] += 1
+        gateway_pending.append({'device_unique_id': ch['device_id'], 'temperature': temp, 'humidity': humid, 'taken_at': now,
+                                'hold_seconds': REPORT_HOLD_SECONDS if REPORT_BY_EXCEPTION else None})
+    if gateway_pending and now >= gateway_batch_retry['next_attempt'] - UPLOAD_INTERVAL / 2: # Half a check early, never a cycle late
+        send_gateway_batch()
+
+def schedule_batch_retry(retry_after=None):
+    """Backs off after a failed batch upload: UPLOAD_INTERVAL doubled per consecutive failure (or the server's Retry-After), capped. Returns the delay."""
+    gateway_batch_retry['failures'] += 1
+    delay = min(GATEWAY_BATCH_BACKOFF_MAX, UPLOAD_INTERVAL * 2 ** (gateway_batch_retry['failures'] - 1))
+    if retry_after: delay = min(GATEWAY_BATCH_BACKOFF_MAX, max(delay, retry_after))
+    gateway_batch_retry['next_attempt'] = time.monotonic() + delay
+    return delay
+
+def send_gateway_batch():
+    """
+    POSTs all pending readings to BATCH_READING_API_ENDPOINT. Each carries its age so the server stores the
+    time it was taken. Readings stay queued (up to GATEWAY_PENDING_MAX) and are retried with backoff unless the
+    server refuses the request itself (400), since resending it would fail the same way.
+    """
+    batch = list(gateway_pending)
+    now = time.monotonic()
+    payload = {'readings': [
+        {'device_unique_id': r['device_unique_id'], 'temperature': r['temperature'], 'humidity': r['humidity'],
+         'age_seconds': round(now - r['taken_at'], 1), 'hold_seconds': r['hold_seconds']} for r in batch]}
+    try:
+        logging.debug("Sending %s reading(s) to %s", len(batch), BATCH_READING_API_ENDPOINT)
+        response = http_session.post(BATCH_READING_API_ENDPOINT, json=payload, timeout=15)
+        response.raise_for_status()
+        result = response.json()
+        for _ in batch: gateway_pending.popleft()
+        gateway_batch_retry['failures'] = 0; gateway_batch_retry['next_attempt'] = 0
+        if result.get('rejected'):
+            logging.warning("Server stored %s of %s reading(s). Rejected: %s", result.get('stored'), len(batch), result['rejected'])
+        else:
+            logging.info("Batch of %s reading(s) sent successfully.", len(batch))
+        return True
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 400: # The endpoint's whole-batch validation error: resending would fail the same way
+            logging.error("Server refused batch of %s reading(s), dropping it: %s", len(batch), describe_http_error(e))
+            for _ in batch: gateway_pending.popleft()
+            gateway_batch_retry['failures'] = 0; gateway_batch_retry['next_attempt'] = 0 # The server is there: next batch as usual
+            return False
+        # Anything else (413/429 from a proxy or throttle, 404/405 from an older server, 5xx) may pass later: keep the readings
+        retry_after = e.response.headers.get('Retry-After', '')
+        delay = schedule_batch_retry(int(retry_after) if retry_after.isdigit() else None)
+        logging.error("HTTP Error sending batch of %s reading(s): %s. Retrying in %ss.", len(batch), describe_http_error(e), delay)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        delay = schedule_batch_retry()
+        logging.error("Error sending batch of %s reading(s) to %s: %s. Retrying in %ss.", len(batch), WEBAPP_URL, e, delay)
+    except Exception as e:
+        logging.error("Unexpected error sending batch: %s", e, exc_info=True)
+    return False
+
+def apply_channel_settings(ch, settings, source="server"):
+    """Validates and stores a settings dict for one channel. Returns True if anything changed."""
+    with ch['lock']:
+        current = ch['settings']
+    new_settings = parse_settings(settings, current, f"{source}, channel {ch['number']}")
+    with ch['lock']:
+        ch['settings'] = new_settings
+        ch['settings_version'] = settings.get('settings_version')
+    if new_settings != current:
+        log_settings = format_settings(new_settings)
+        logging.info("Channel %s: updated settings from %s: Min=%s, Max=%s, OffStart=%s, OffEnd=%s", ch['number'], source, new_settings[0], new_settings[1], log_settings['heating_off_start_time'], log_settings['heating_off_end_time'])
+        return True
+    return False
+
+def save_gateway_settings_cache():
+    """Atomically writes the settings of all channels to GATEWAY_SETTINGS_CACHE_FILE."""
+    channels = {}
+    for ch in gateway_channels:
+        with ch['lock']:
+            channels[ch['device_id']] = {'settings_version': ch['settings_version'], 'settings': format_settings(ch['settings'])}
+    return write_json_atomic(GATEWAY_SETTINGS_CACHE_FILE, {'version': SETTINGS_CACHE_VERSION, 'fetched_at': time.time(), 'channels': channels})
+
+def load_gateway_settings_cache():
+    """Loads last-known settings for every channel found in GATEWAY_SETTINGS_CACHE_FILE. Returns the number loaded."""
+    if not os.path.exists(GATEWAY_SETTINGS_CACHE_FILE):
+        logging.info("No gateway settings cache at '%s'. Waiting for first fetch.", GATEWAY_SETTINGS_CACHE_FILE)
+        return 0
+    try:
+        with open(GATEWAY_SETTINGS_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+        if cache.get('version') != SETTINGS_CACHE_VERSION:
+            logging.warning("Gateway settings cache version %s not supported (expected %s). Ignoring cache.", cache.get('version'), SETTINGS_CACHE_VERSION)
+            return 0
+        cached_channels = cache.get('channels') or {}
+        loaded = 0
+        for ch in gateway_channels:
+            entry = cached_channels.get(ch['device_id'])
+            if isinstance(entry, dict) and isinstance(entry.get('settings'), dict):
+                apply_channel_settings(ch, dict(entry['settings'], settings_version=entry.get('settings_version')), source="cache")
+                loaded += 1
+        age_hours = (time.time() - float(cache.get('fetched_at', 0))) / 3600
+        logging.info("Loaded cached settings for %s of %s channel(s) (fetched %.1fh ago).", loaded, len(gateway_channels), age_hours)
+        return loaded
+    except (IOError, OSError, ValueError, TypeError, AttributeError) as e:
+        logging.error("ERROR reading gateway settings cache '%s': %s. Ignoring cache.", GATEWAY_SETTINGS_CACHE_FILE, e)
+        return 0
+
+def fetch_gateway_settings():
+    """Fetches the settings of all channels in one request; only changed settings come back."""
+    with_versions = {}
+    for ch in gateway_channels:
+        with ch['lock']:
+            with_versions[ch['device_id']] = ch['settings_version']
+    try:
+        response = http_session.post(BULK_SETTINGS_API_ENDPOINT, json={'devices': with_versions}, timeout=10)
+        response.raise_for_status()
+        result = response.json()
+    except requests.exceptions.HTTPError as e:
+        logging.error("HTTP Error fetching bulk settings: %s", describe_http_error(e))
+        return False
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error("Error fetching bulk settings from %s: %s", BULK_SETTINGS_API_ENDPOINT, e)
+        return False
+
+    changed = False
+    by_device_id = {ch['device_id']: ch for ch in gateway_channels}
+    for device_id, settings in (result.get('settings') or {}).items():
+        if device_id in by_device_id and isinstance(settings, dict):
+            changed = apply_channel_settings(by_device_id[device_id], settings) or changed
+    for device_id in result.get('unknown') or []:
+        if device_id in by_device_id:
+            logging.warning("Channel %s: device ID %s is not linked in the web app yet.", by_device_id[device_id]['number'], device_id)
+    logging.info("Bulk settings fetched: %s changed, %s unchanged, %s unknown.", len(result.get('settings') or {}), len(result.get('unchanged') or []), len(result.get('unknown') or []))
+    if changed or not os.path.exists(GATEWAY_SETTINGS_CACHE_FILE):
+        save_gateway_settings_cache()
+    return True
+
+def gateway_settings_worker():
+    """Background thread body for the gateway settings job. A failed fetch is retried on the next job run."""
+    global last_settings_fetch_time
+    if fetch_gateway_settings():
+        last_settings_fetch_time = time.monotonic()
+    else:
+        logging.warning("Failed to fetch/update gateway settings. Using previous values (if any).")
+
+def gateway_settings_job():
+    """Scheduler job: starts a background bulk settings fetch when one is due. Never blocks on the network."""
+    global settings_fetch_thread
+    if settings_fetch_thread and settings_fetch_thread.is_alive():
+        return # Previous fetch still waiting on the server
+    if last_settings_fetch_time and time.monotonic() - last_settings_fetch_time < SETTINGS_FETCH_INTERVAL:
+        return
+    settings_fetch_thread = threading.Thread(target=gateway_settings_worker, name="settings-fetch", daemon=True)
+    settings_fetch_thread.start()
+
+def gateway_lcd_job():
+    """Scheduler job: shows the next channel on the LCD, the relay line prefixed with its channel number."""
+    global gateway_lcd_page
+    flush_lcd()
+    if not gateway_channels: return
+    ch = gateway_channels[gateway_lcd_page % len(gateway_channels)]
+    gateway_lcd_page += 1
+    state = ch['control']
+    relay_str = f"{ch['number']}:{state['relay_status'][len('Relay:'):]}" if state['relay_status'].startswith('Relay:') else state['relay_status']
+    error_msg = f"{ch['number']}: {state['error_msg']}" if state['error_msg'] else None
+    update_lcd(state['temp'], state['humid'], relay_str, error_msg)
+
+def gateway_heartbeat_job():
+    """Scheduler job: logs liveness, per-job lateness, per-channel sensor counters and the upload queue."""
+    channel_summary = "; ".join(f"{ch['number']} {ch['filter']['stats']}" for ch in gateway_channels)
+    logging.info("Heartbeat. Jobs [%s]. Channels [%s]. Uploads %s, pending %s. LCD %s.", scheduler_summary(), channel_summary, report_stats, len(gateway_pending), lcd_stats)
+
+def run_gateway():
+    """Gateway mode main: every channel in GATEWAY_CONFIG_FILE runs in this process, sharing the scheduler, LCD and uplink."""
+    global gateway_channels, http_session
+    logging.info("--- Initializing Gateway (config '%s') ---", GATEWAY_CONFIG_FILE)
+    lcd_ok = initialize_lcd()
+    try:
+        channels = load_gateway_config()
+    except ValueError as e:
+        logging.critical("CRITICAL FAILURE: %s Exiting.", e)
+        if lcd_ok: update_lcd(None, None, status_msg="Init Error: Config!", force=True); time.sleep(5)
+        sys.exit(1)
+
+    gateway_channels, init_errors = initialize_gateway_channels(channels)
+    if not gateway_channels:
+        logging.critical("CRITICAL FAILURE: no usable gateway channel (%s). Exiting.", init_errors)
+        if lcd_ok: update_lcd(None, None, status_msg=f"Init Error: {init_errors}", force=True); time.sleep(5)
+        sys.exit(1)
+    if init_errors and lcd_ok:
+        update_lcd(None, None, status_msg=f"Disabled: {init_errors}", force=True); time.sleep(5)
+
+    print("\n" + "="*50); print("      TERRARIUM GATEWAY DEVICE IDS"); print("="*50)
+    for ch in gateway_channels: print(f" Channel {ch['number']} ({ch['name']}): {ch['device_id']}")
+    print("\n -> Link each ID in the web app settings."); print("="*50 + "\n")
+    logging.info("Gateway running %s channel(s). Batch endpoint: %s, bulk settings endpoint: %s", len(gateway_channels), BATCH_READING_API_ENDPOINT, BULK_SETTINGS_API_ENDPOINT)
+
+    http_session = requests.Session() # One keep-alive connection to the server for every channel
+    load_gateway_settings_cache()
+
+    start_sensor_sampler(target=gateway_sampler_loop)
+    if not sensor_first_sample_event.wait(SENSOR_FIRST_SAMPLE_TIMEOUT):
+        logging.warning("Not every channel had a valid sensor sample within %ss of startup. Continuing; sampler keeps trying.", SENSOR_FIRST_SAMPLE_TIMEOUT)
+
+    # Same job layout as single-channel mode; each job covers all channels
+    add_job('settings', gateway_settings_job, SETTINGS_RETRY_INTERVAL)
+    add_job('control', gateway_control_job, SENSOR_READ_INTERVAL)
+    add_job('upload', gateway_upload_job, UPLOAD_INTERVAL)
+    add_job('lcd', gateway_lcd_job, LCD_UPDATE_INTERVAL, first_delay=LCD_UPDATE_INTERVAL)
+    add_job('heartbeat', gateway_heartbeat_job, HEARTBEAT_INTERVAL, first_delay=HEARTBEAT_INTERVAL)
+
+    logging.info("Starting gateway control loop...")
+    try:
+        run_scheduler()
+    except KeyboardInterrupt:
+        logging.info("KeyboardInterrupt detected in main loop. Exiting loop.")
+        if not shutting_down: cleanup(signal.SIGINT)
+    if not shutting_down:
+        logging.warning("Loop exited without shutdown signal. Calling cleanup.")
+        cleanup()
+
+
 # --- Main Application Logic ---
 if __name__ == "__main__":
     # Register signal handlers
     signal.signal(signal.SIGTERM, cleanup)
     signal.signal(signal.SIGINT, cleanup)
 
+    if os.path.exists(GATEWAY_CONFIG_FILE):
+        run_gateway() # Several channels from the config file; exits via cleanup()
+
     logging.info("--- Initializing Device ---")
     DEVICE_UNIQUE_ID = get_or_generate_persistent_device_id()
     sensor_ok = initialize_sensor()
@@ -528,318 +1443,52 @@ if __name__ == "__main__":
         if not DEVICE_UNIQUE_ID: critical_msg += " No ID!"
         if not sensor_ok: critical_msg += " Sensor!"
         if not relay_ok: critical_msg += " Relay!"
-        logging.critical(f"CRITICAL FAILURE: {critical_msg}. Exiting.")
+        logging.critical("CRITICAL FAILURE: %s. Exiting.", critical_msg)
         if lcd:
              try:
-                 lcd.clear(); lcd.cursor_pos = (0, 0)
-                 lcd.write_string(critical_msg[:LCD_COLS])
-                 if len(critical_msg) > LCD_COLS: lcd.cursor_pos = (1, 0); lcd.write_string(critical_msg[LCD_COLS:(LCD_COLS*2)])
+                 update_lcd(None, None, status_msg=critical_msg, force=True)
                  time.sleep(5)
-             except Exception as lcd_init_err: logging.error(f"Failed to display init error on LCD: {lcd_init_err}")
+             except Exception as lcd_init_err: logging.error("Failed to display init error on LCD: %s", lcd_init_err)
         exit(1)
 
     print("\n" + "="*50); print("      TERRARIUM DEVICE ID INFORMATION"); print("="*50)
     print(f" This device's Unique ID is: {DEVICE_UNIQUE_ID}")
     print("\n -> Link this ID in the web app settings."); print("="*50 + "\n")
-    logging.info(f"Using Device ID: {DEVICE_UNIQUE_ID}")
-
-    logging.info(f"Web App URL: {WEBAPP_URL}")
-    logging.info(f"Reading API endpoint: {READING_API_ENDPOINT}")
-    logging.info(f"Settings API endpoint: {SETTINGS_API_ENDPOINT}/<ID>")
-    logging.info(f"Sensor read interval: {SENSOR_READ_INTERVAL} seconds")
-    logging.info(f"Settings fetch interval: {SETTINGS_FETCH_INTERVAL} seconds")
-    logging.info(f"Relay Pin: {RELAY_PIN}, Active-High: {RELAY_IS_ACTIVE_HIGH}")
-
+    logging.info("Using Device ID: %s", DEVICE_UNIQUE_ID)
+
+    logging.info("Web App URL: %s", WEBAPP_URL)
+    logging.info("Reading API endpoint: %s", READING_API_ENDPOINT)
+    logging.info("Settings API endpoint: %s/<ID>", SETTINGS_API_ENDPOINT)
+    logging.info("Sensor read interval: %s seconds", SENSOR_READ_INTERVAL)
+    logging.info("Settings fetch interval: %s seconds", SETTINGS_FETCH_INTERVAL)
+    logging.info("Upload interval: %s seconds, LCD refresh interval: %s seconds", UPLOAD_INTERVAL, LCD_UPDATE_INTERVAL)
+    if REPORT_BY_EXCEPTION:
+        logging.info("Report-by-exception: deadband %s°C / %s%%RH, max silence %s seconds.", REPORT_DEADBAND_TEMP, REPORT_DEADBAND_HUMID, REPORT_MAX_SILENCE)
+    logging.info("Relay Pin: %s, Active-High: %s", RELAY_PIN, RELAY_IS_ACTIVE_HIGH)
+
+    # --- Last-Known Settings (server is revalidated in the background by the settings job) ---
+    load_settings_cache()
+
+    # --- Start Background Sensor Sampling ---
+    start_sensor_sampler()
+    if not sensor_first_sample_event.wait(SENSOR_FIRST_SAMPLE_TIMEOUT):
+        logging.warning("No valid sensor sample within %ss of startup. Continuing; sampler keeps trying.", SENSOR_FIRST_SAMPLE_TIMEOUT)
+
+    # --- Scheduled Jobs ---
+    # Registration order matters for jobs due at the same time: the settings fetch is started before the first control cycle.
+    add_job('settings', settings_job, SETTINGS_RETRY_INTERVAL)
+    add_job('control', control_job, SENSOR_READ_INTERVAL)
+    add_job('upload', upload_job, UPLOAD_INTERVAL)
+    add_job('lcd', lcd_job, LCD_UPDATE_INTERVAL, first_delay=LCD_UPDATE_INTERVAL)
+    add_job('heartbeat', heartbeat_job, HEARTBEAT_INTERVAL, first_delay=HEARTBEAT_INTERVAL)
 
     # --- Main Loop ---
     logging.info("Starting main control loop...")
-    while not shutting_down:
-        loop_start_time = time.monotonic()
-        error_message_for_lcd = None
-        relay_status_str = "Relay: ---" # Default
-
-        try: # *** START OF MAIN TRY BLOCK ***
-            # --- Fetch Settings Periodically ---
-            current_time = time.monotonic()
-            if last_settings_fetch_time == 0 or (current_time - last_settings_fetch_time >= SETTINGS_FETCH_INTERVAL):
-                logging.info("Time to fetch device settings...")
-                if fetch_device_settings(DEVICE_UNIQUE_ID):
-                    last_settings_fetch_time = current_time
-                else:
-                    logging.warning("Failed to fetch/update settings. Using previous values (if any).")
-                    # If fetch fails, we keep using the existing global settings values.
-
-            # --- Read Sensor ---
-            temp, humid = read_sensor()
-
-            # --- Send Data to Server ---
-            if temp is not None and humid is not None:
-                send_data_to_server(DEVICE_UNIQUE_ID, temp, humid)
-            else:
-                logging.warning("Sensor read failed or returned invalid data this cycle.")
-                error_message_for_lcd = "Sensor Error" # Set error message for LCD
-
-            # --- Heating Control Logic (Check Relay & Sensor First) ---
-            if relay is None:
-                logging.error("Cannot perform heating control: Relay not initialized.")
-                relay_status_str = "Relay: ERROR"
-                error_message_for_lcd = "Relay Error" # Prioritize relay error
-            elif temp is None:
-                logging.warning("Cannot perform heating control: Invalid temperature reading.")
-                # Turn OFF for safety if sensor fails WHILE relay is ON
-                if relay.is_active:
-                    logging.warning("Turning relay OFF due to invalid temperature reading.")
-                    try: relay.off()
-                    except Exception as e: logging.error(f"Failed to turn OFF relay during sensor error: {e}")
-                relay_status_str = "Relay: OFF (Safe)"
-                if not error_message_for_lcd: error_message_for_lcd = "Sensor Error" # Show sensor error if no other error
-            else:
-                 # Relay OK, Sensor OK -> Proceed with Time and Temp Logic
-                 temp_float = float(temp) # Temp is not None here
-                 now_time = datetime.now().time() # Get current time as a time object
-
-                 # Check for Scheduled Off Period
-                 is_in_off_period = False
-                 # Check only if both start and end times are valid time objects
-                 if isinstance(current_heating_off_start, time_obj) and isinstance(current_heating_off_end, time_obj):
-                     start_off = current_heating_off_start
-                     end_off = current_heating_off_end
-
-                     logging.debug(f"Checking time {now_time.strftime('%H:%M:%S')} against OFF period: {start_off.strftime('%H:%M:%S')} - {end_off.strftime('%H:%M:%S')}")
-
-                     # Handle overnight period (e.g., start 22:00, end 06:00)
-                     if start_off > end_off:
-                         if now_time >= start_off or now_time < end_off:
-                             is_in_off_period = True
-                             logging.info(f"Current time is WITHIN overnight OFF period.")
-                     # Handle same-day period (e.g., start 10:00, end 17:00)
-                     else: # start_off <= end_off
-                         if start_off <= now_time < end_off:
-                             is_in_off_period = True
-                             logging.info(f"Current time is WITHIN same-day OFF period.")
-
-                 if is_in_off_period:
-                     # --- Time is within the scheduled OFF period ---
-                     if relay.is_active:
-                         logging.info("Turning relay OFF due to scheduled off period.")
-                         try: relay.off()
-                         except Exception as e: logging.error(f"Failed to turn OFF relay during scheduled period: {e}")
-                     else:
-                          logging.debug("Relay already OFF during scheduled off period.")
-                     relay_status_str = "Relay: OFF (Sched)"
-                     # Skip the temperature logic below
-
-                 else:
-                     # --- Time is outside scheduled OFF period (or period not set) ---
-                     if isinstance(current_heating_off_start, time_obj): # Log only if period is defined
-                          logging.debug(f"Current time is OUTSIDE OFF period. Applying temperature logic.")
-
-            # --- Heating Control Logic (Check Relay & Sensor First) ---
-            if relay is None:
-                logging.error("Cannot perform heating control: Relay not initialized.")
-                relay_status_str = "Relay: ERROR"
-                error_message_for_lcd = "Relay Error" # Prioritize relay error
-            elif temp is None:
-                logging.warning("Cannot perform heating control: Invalid temperature reading.")
-                # Turn OFF for safety if sensor fails WHILE relay is ON
-                if relay.is_active:
-                    logging.warning("Turning relay OFF due to invalid temperature reading.")
-                    try:
-                        relay.off()
-                        relay_on_start_time = None # Reset timer if forced off by sensor error
-                    except Exception as e: logging.error(f"Failed to turn OFF relay during sensor error: {e}")
-                relay_status_str = "Relay: OFF (Safe)"
-                if not error_message_for_lcd: error_message_for_lcd = "Sensor Error" # Show sensor error if no other error
-            else:
-                 # Relay OK, Sensor OK -> Proceed with Time and Temp Logic
-                 temp_float = float(temp) # Temp is not None here
-                 now_time = datetime.now().time() # Get current time for scheduled off check
-                 current_monotonic_time = time.monotonic() # Get current time for duration checks
-
-                 # --- Check for forced OFF cooldown period ---
-                 is_in_forced_cooldown = False
-                 if force_heater_off_until is not None:
-                     if current_monotonic_time < force_heater_off_until:
-                         logging.info(f"Heater is in forced cooldown period (until {force_heater_off_until:.1f}). Keeping relay OFF.")
-                         if relay.is_active:
-                             try:
-                                 relay.off()
-                                 relay_on_start_time = None # Ensure timer is reset
-                             except Exception as e: logging.error(f"Failed to turn OFF relay during forced cooldown: {e}")
-                         relay_status_str = "Relay: OFF (Cool)"
-                         is_in_forced_cooldown = True
-                     else:
-                         # Cooldown finished
-                         logging.info(f"Forced heater cooldown period finished at {current_monotonic_time:.1f}.")
-                         force_heater_off_until = None # Clear the cooldown flag
-
-                 # --- Check for Scheduled Off Period (only if not in cooldown) ---
-                 is_in_scheduled_off = False
-                 if not is_in_forced_cooldown:
-                     if isinstance(current_heating_off_start, time_obj) and isinstance(current_heating_off_end, time_obj):
-                         start_off = current_heating_off_start
-                         end_off = current_heating_off_end
-                         logging.debug(f"Checking time {now_time.strftime('%H:%M:%S')} against OFF period: {start_off.strftime('%H:%M:%S')} - {end_off.strftime('%H:%M:%S')}")
-                         # Handle overnight period
-                         if start_off > end_off:
-                             if now_time >= start_off or now_time < end_off: is_in_scheduled_off = True
-                         # Handle same-day period
-                         else:
-                             if start_off <= now_time < end_off: is_in_scheduled_off = True
-
-                         if is_in_scheduled_off:
-                             logging.info(f"Current time is WITHIN scheduled OFF period.")
-                             if relay.is_active:
-                                 logging.info("Turning relay OFF due to scheduled off period.")
-                                 try:
-                                     relay.off()
-                                     relay_on_start_time = None # Reset ON timer
-                                 except Exception as e: logging.error(f"Failed to turn OFF relay during scheduled period: {e}")
-                             else:
-                                 logging.debug("Relay already OFF during scheduled off period.")
-                             relay_status_str = "Relay: OFF (Sched)"
-                             # Skip remaining logic for this cycle
-
-                 # --- Apply Temperature & Max ON Time Logic (only if NOT in cooldown AND NOT in scheduled off) ---
-                 if not is_in_forced_cooldown and not is_in_scheduled_off:
-                     if isinstance(current_heating_off_start, time_obj): # Log only if scheduled period exists
-                         logging.debug(f"Current time is OUTSIDE OFF period. Applying temperature/limit logic.")
-                     else: # Log if no schedule exists
-                         logging.debug(f"No scheduled OFF period set. Applying temperature/limit logic.")
-
-                     # --- Check Max ON Time Limit (only if relay is currently ON) ---
-                     max_on_time_exceeded = False
-                     if relay.is_active and relay_on_start_time is not None:
-                         time_on = current_monotonic_time - relay_on_start_time
-                         logging.debug(f"Heater ON check: Currently ON for {time_on:.1f}s (Limit: {MAX_HEATER_ON_DURATION}s).")
-                         if time_on > MAX_HEATER_ON_DURATION:
-                             logging.warning(f"Heater has been ON for {time_on:.1f}s, exceeding MAX limit of {MAX_HEATER_ON_DURATION}s. Forcing OFF and starting cooldown.")
-                             max_on_time_exceeded = True
-                             force_heater_off_until = current_monotonic_time + MIN_HEATER_OFF_COOLDOWN # Schedule cooldown
-                             logging.info(f"Forced cooldown active until monotonic time: {force_heater_off_until:.1f}")
-                             try:
-                                 relay.off()
-                                 relay_on_start_time = None # Reset timer
-                             except Exception as e: logging.error(f"Failed to turn OFF relay after max ON time: {e}")
-                             relay_status_str = "Relay: OFF (Limit)" # Set status for this cycle
-                             # Skip temperature logic below if limit exceeded
-
-                     # --- Apply Temperature Logic (only if max ON time NOT exceeded) ---
-                     if not max_on_time_exceeded:
-                         min_temp_float = None
-                         max_temp_float = None
-                         threshold_error = False
-                         try:
-                             if current_min_temp is not None: min_temp_float = float(current_min_temp)
-                             if current_max_temp is not None: max_temp_float = float(current_max_temp)
-                         except (ValueError, TypeError) as conv_err:
-                             logging.error(f"Invalid threshold values stored: Min='{current_min_temp}', Max='{current_max_temp}'. Error: {conv_err}. Cannot control heating.")
-                             if relay.is_active:
-                                 logging.warning("Turning relay OFF due to invalid stored thresholds.")
-                                 try:
-                                     relay.off()
-                                     relay_on_start_time = None # Reset timer
-                                 except Exception as e: logging.error(f"Failed to turn OFF relay during threshold error: {e}")
-                             relay_status_str = "Relay: OFF (Cfg Err)"
-                             error_message_for_lcd = "Settings Error"
-                             threshold_error = True
-
-                         # Proceed only if thresholds are valid
-                         if not threshold_error:
-                             relay_is_currently_on = relay.is_active # Re-check state as it might have changed due to errors above
-                             logging.debug(f"Temp Control Check: Temp={temp_float:.1f}, Min={min_temp_float}, Max={max_temp_float}, Relay ON={relay_is_currently_on}")
-                             action_taken = False
-
-                             # Determine desired state based on temp and thresholds
-                             desired_state_on = False
-                             if relay_is_currently_on:
-                                 # If ON, it should turn OFF if temp >= max (and max is set)
-                                 if max_temp_float is not None and temp_float >= max_temp_float:
-                                     desired_state_on = False
-                                 else:
-                                     desired_state_on = True # Stay ON if below max or max not set
-                             else:
-                                 # If OFF, it should turn ON if temp < min (and min is set)
-                                 if min_temp_float is not None and temp_float < min_temp_float:
-                                     desired_state_on = True
-                                 else:
-                                     desired_state_on = False # Stay OFF if above min or min not set
-
-                             # Apply the change if needed
-                             if desired_state_on and not relay_is_currently_on:
-                                 logging.info(f"Temp ({temp_float:.1f}°C) < Min ({min_temp_float:.1f}°C). Turning relay ON.")
-                                 try:
-                                     relay.on()
-                                     relay_on_start_time = current_monotonic_time # START TIMER 
-                                     action_taken = True
-                                 except Exception as e: logging.error(f"Failed to turn ON relay: {e}")
-                             elif not desired_state_on and relay_is_currently_on:
-                                 logging.info(f"Temp ({temp_float:.1f}°C) >= Max ({max_temp_float:.1f}°C) or Min not met. Turning relay OFF.")
-                                 try:
-                                     relay.off()
-                                     relay_on_start_time = None # STOP TIMER 
-                                     action_taken = True
-                                 except Exception as e: logging.error(f"Failed to turn OFF relay: {e}")
-
-                             # Set Status String based on the ACTUAL relay state after attempting changes
-                             # Only set default OFF/ON if no specific status was set earlier
-                             final_relay_state = relay.is_active
-                             if relay_status_str == "Relay: ---": # Check if status is still default
-                                 if final_relay_state:
-                                     relay_status_str = "Relay: ON (Heat)"
-                                 else:
-                                     relay_status_str = "Relay: OFF"
-
-                             if not action_taken and relay_status_str == "Relay: ---": # Log only if no action AND no specific status
-                                  logging.debug(f"No temp state change needed. Relay maintained: {'ON' if final_relay_state else 'OFF'}")
-                                  # Update status if still default
-                                  relay_status_str = "Relay: ON (Heat)" if final_relay_state else "Relay: OFF"
-
-
-            # --- Update LCD ---
-            update_lcd(temp, humid, relay_status_str, error_message_for_lcd)
-
-            # --- Calculate Sleep Time ---
-            loop_end_time = time.monotonic()
-            time_elapsed = loop_end_time - loop_start_time
-            sleep_time = max(0, SENSOR_READ_INTERVAL - time_elapsed) # Ensure non-negative sleep
-
-            logging.debug(f"Loop took {time_elapsed:.2f}s. Sleeping for {sleep_time:.2f} seconds...")
-
-            # Use short sleeps to remain responsive to shutdown signals
-            sleep_end_time = time.monotonic() + sleep_time
-            while time.monotonic() < sleep_end_time and not shutting_down:
-                time.sleep(0.1) # Check for shutdown signal every 100ms
-
-        # --- except blocks ---
-        except KeyboardInterrupt:
-             logging.info("KeyboardInterrupt detected in main loop. Exiting loop.")
-             if not shutting_down: cleanup(signal.SIGINT)
-             break
-
-        except Exception as e:
-             logging.error(f"An unexpected error occurred in the main loop: {e}", exc_info=True)
-             # Turn off relay on unexpected errors for safety
-             if relay and relay.is_active:
-                 try:
-                     logging.warning("Turning relay OFF due to unexpected error in main loop.")
-                     relay.off()
-                     relay_on_start_time = None # Reset timer on error too
-                     relay_status_str = "Relay: OFF (ERR)"
-                 except Exception as relay_err:
-                     logging.error(f"Failed to turn off relay during error handling: {relay_err}")
-                     relay_status_str = "Relay: ERR!"
-             else:
-                  # If relay wasn't active or doesn't exist, still indicate error
-                  relay_status_str = "Relay: ERR!" if relay else "Relay: ERROR" # Adjust if relay is None
-
-             # Display error on LCD
-             update_lcd(None, None, relay_status_str, "System Error")
-
-             # Prevent rapid looping on persistent errors
-             logging.info("Sleeping for 15 seconds due to error...")
-             time.sleep(15)
-
+    try:
+        run_scheduler()
+    except KeyboardInterrupt:
+        logging.info("KeyboardInterrupt detected in main loop. Exiting loop.")
+        if not shutting_down: cleanup(signal.SIGINT)
 
     logging.info("Main control loop finished.")
     # Cleanup is normally called by the signal handler, but call just in case loop exited non-standardly
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# --- terrarium_logging.py ---
+# Shared logging setup for app.py, terrarium_control.py and switch_watcher.py.
+#
+# Callers log with lazy %-style arguments (logging.info("Temp=%.1f", t)); nothing is formatted
+# on the calling thread. Records go through a QueueHandler to a QueueListener thread, which does
+# the formatting and the console/file I/O. A small in-RAM ring buffer keeps recent records below
+# the output level and writes them out when an ERROR is logged, so the context of a failure is
+# available without logging at DEBUG all the time.
+#
+# Environment variables (all optional):
+#   TERRARIUM_LOG_LEVEL       default output level (DEBUG, INFO, WARNING, ...). Default: INFO
+#   TERRARIUM_LOG_LEVELS      per-logger levels, e.g. "werkzeug=WARNING,terrarium_control=DEBUG"
+#   TERRARIUM_LOG_RING_LEVEL  lowest level kept in the ring buffer, or OFF. Default: DEBUG
+#   TERRARIUM_LOG_RING_SIZE   records kept in the ring buffer. Default: 200
+#   TERRARIUM_LOG_MAX_BYTES   log file size before rotation. Default: 1 MiB
+#   TERRARIUM_LOG_BACKUPS     rotated (gzip-compressed) files to keep. Default: 5
+
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+from collections import deque
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(module)s - %(message)s'
+
+_listener = None # Active QueueListener (one per process)
+
+
+def _parse_level(value, default):
+    """Turns 'DEBUG'/'info'/'10' into a logging level number. Returns None for OFF."""
+    if value is None or str(value).strip() == '':
+        return default
+    value = str(value).strip().upper()
+    if value == 'OFF':
+        return None
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value)
+    return level if isinstance(level, int) else default
+
+
+def _parse_module_levels(spec):
+    """Parses 'name=LEVEL,name2=LEVEL' into {name: level}. Malformed entries are skipped."""
+    levels = {}
+    for item in (spec or '').split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        parsed = _parse_level(level, None)
+        if name.strip() and parsed is not None:
+            levels[name.strip()] = parsed
+    return levels
+
+
+class ModuleLevelFilter(logging.Filter):
+    """Passes a record if it meets the level configured for its logger (or nearest parent), else the default level."""
+
+    def __init__(self, default_level, module_levels):
+        super().__init__()
+        self.default_level = default_level
+        self.module_levels = module_levels
+        self._cache = {}
+
+    def level_for(self, name):
+        level = self._cache.get(name)
+        if level is None:
+            level = self.default_level
+            lookup = name
+            while lookup:
+                if lookup in self.module_levels:
+                    level = self.module_levels[lookup]
+                    break
+                lookup = lookup.rpartition('.')[0]
+            self._cache[name] = level
+        return level
+
+    def filter(self, record):
+        # Scripts that log through the root logger (logging.info(...)) are matched by module name
+        name = record.module if record.name == 'root' else record.name
+        return record.levelno >= self.level_for(name)
+
+
+# Arguments of these types can safely be formatted later on the listener thread
+_DEFERRABLE_ARG_TYPES = (str, int, float, bool, type(None), bytes, Decimal, datetime, date, time, timedelta, BaseException)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that hands the record over without formatting it; the listener thread does that.
+    Records whose arguments may change (dicts, lists) or only work on this thread (Flask's
+    session/request proxies) are formatted here instead.
+    """
+
+    def prepare(self, record):
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(a, _DEFERRABLE_ARG_TYPES) for a in args)):
+            try:
+                record.msg = record.getMessage()
+                record.args = None
+            except Exception:
+                pass # Left as-is; the output handler reports the formatting error
+        return record
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last 'capacity' records in memory. When a record at 'dump_level' or above arrives,
+    the buffered records that the outputs filtered out are written to the outputs, oldest first.
+    """
+
+    def __init__(self, capacity, targets, output_filter, dump_level=logging.ERROR, level=logging.DEBUG):
+        super().__init__(level)
+        self.buffer = deque(maxlen=capacity)
+        self.targets = targets
+        self.output_filter = output_filter
+        self.dump_level = dump_level
+
+    def emit(self, record):
+        if record.levelno >= self.dump_level:
+            self.dump(f"{record.levelname} in {record.module}")
+        else:
+            self.buffer.append(record)
+
+    def dump(self, reason):
+        # Only records the outputs didn't already write
+        suppressed = [r for r in self.buffer if not self.output_filter.filter(r)]
+        self.buffer.clear()
+        if not suppressed:
+            return
+        header = logging.LogRecord('terrarium_logging', logging.INFO, __file__, 0,
+                                   "--- %d buffered record(s) before %s ---", (len(suppressed), reason), None)
+        for target in self.targets:
+            target.acquire()
+            try:
+                for r in [header] + suppressed:
+                    target.emit(r) # Bypasses the target's level on purpose
+            finally:
+                target.release()
+
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+
+def _gzip_rotator(source, dest):
+    """Compresses the rotated file (runs on the listener thread, not the caller's)."""
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_logging(log_file=None, console=True):
+    """
+    Configures the root logger for this process: queue handler on the root, listener thread with
+    console and/or size-rotated gzip file output, per-logger levels and the error ring buffer.
+    Safe to call more than once (later calls are ignored).
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    default_level = _parse_level(os.environ.get('TERRARIUM_LOG_LEVEL'), logging.INFO)
+    module_levels = _parse_module_levels(os.environ.get('TERRARIUM_LOG_LEVELS'))
+    ring_level = _parse_level(os.environ.get('TERRARIUM_LOG_RING_LEVEL'), logging.DEBUG)
+    ring_size = int(os.environ.get('TERRARIUM_LOG_RING_SIZE', '200'))
+    max_bytes = int(os.environ.get('TERRARIUM_LOG_MAX_BYTES', str(1024 * 1024)))
+    backups = int(os.environ.get('TERRARIUM_LOG_BACKUPS', '5'))
+
+    output_filter = ModuleLevelFilter(default_level, module_levels)
+    formatter = logging.Formatter(LOG_FORMAT)
+    outputs = []
+    if console:
+        outputs.append(logging.StreamHandler())
+    if log_file:
+        try:
+            file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups)
+            file_handler.namer = _gzip_namer
+            file_handler.rotator = _gzip_rotator
+            outputs.append(file_handler)
+        except OSError as e:
+            logging.getLogger(__name__).warning("Cannot open log file %s: %s. Logging to console only.", log_file, e)
+    for handler in outputs:
+        handler.setFormatter(formatter)
+        handler.addFilter(output_filter)
+
+    handlers = list(outputs)
+    if ring_level is not None and ring_size > 0:
+        handlers.insert(0, RingBufferHandler(ring_size, outputs, output_filter, level=ring_level))
+
+    # Loggers only create records that some handler can use
+    lowest_output = min([default_level] + list(module_levels.values()))
+    root = logging.getLogger()
+    root.setLevel(min(lowest_output, ring_level) if ring_level is not None else lowest_output)
+    for name, level in module_levels.items():
+        logging.getLogger(name).setLevel(min(level, ring_level) if ring_level is not None else level)
+
+    log_queue = queue.SimpleQueue()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LazyQueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return _listener
+
+
+def shutdown_logging():
+    """Flushes queued records and stops the listener thread. Called automatically at exit."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# --- terrarium_metrics.py ---
+# Counters, gauges and histograms for the web app, summed over all gunicorn workers and rendered in the
+# Prometheus text exposition format (served by app.py at /metrics).
+#
+# Each worker keeps its values in memory; a background thread writes them to <dir>/<master pid>-<pid>.json
+# (atomic rename) at most once per TERRARIUM_METRICS_FLUSH_SEC while they change. A scrape merges the files
+# of all workers of the same gunicorn master with the answering worker's live values:
+#   counters, histograms -- summed over all workers, including ones that exited (so totals never go back)
+#   gauges               -- summed over live workers only (e.g. requests in flight)
+# Files left by an earlier run (a master that no longer exists) are deleted at scrape time.
+#
+# Environment variables (all optional):
+#   TERRARIUM_METRICS_DIR        directory for the per-worker files. Default: /tmp/terrarium_metrics
+#   TERRARIUM_METRICS_FLUSH_SEC  how often a worker writes its file while values change. Default: 1
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('terrarium_metrics')
+
+METRICS_DIR = os.environ.get('TERRARIUM_METRICS_DIR', '/tmp/terrarium_metrics')
+FLUSH_INTERVAL_SEC = float(os.environ.get('TERRARIUM_METRICS_FLUSH_SEC', '1'))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Seconds
+
+_definitions = {} # name -> (type, help, buckets)
+_lock = threading.Lock()
+_values = {'counter': {}, 'gauge': {}, 'histogram': {}} # type -> {(name, labels): value or [bucket counts..., sum, count]}
+_dirty = False
+_owner_pid = None # Process the values and flusher thread belong to (reset after fork)
+
+
+def define(name, metric_type, help_text, buckets=LATENCY_BUCKETS):
+    """Declares a metric ('counter', 'gauge' or 'histogram'). Labels are given per observation as ((key, value), ...)."""
+    _definitions[name] = (metric_type, help_text, tuple(buckets) if metric_type == 'histogram' else None)
+
+
+def _process_values():
+    """This process's value store; starts over (and starts the flusher) in a newly forked worker."""
+    global _owner_pid, _dirty
+    pid = os.getpid()
+    if _owner_pid != pid:
+        _owner_pid = pid; _dirty = False
+        for store in _values.values(): store.clear()
+        threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+    return _values
+
+
+def inc(name, labels=(), amount=1):
+    """Adds to a counter (or a gauge, with a negative amount to decrement)."""
+    global _dirty
+    with _lock:
+        store = _process_values()[_definitions[name][0]]
+        key = (name, tuple(labels))
+        store[key] = store.get(key, 0) + amount; _dirty = True
+
+
+def observe(name, value, labels=()):
+    """Records one histogram observation."""
+    global _dirty
+    buckets = _definitions[name][2]
+    with _lock:
+        store = _process_values()['histogram']
+        key = (name, tuple(labels))
+        entry = store.get(key)
+        if entry is None: entry = store[key] = [0] * (len(buckets) + 2) # Per-bucket counts (not cumulative), sum, count
+        for index, bound in enumerate(buckets):
+            if value <= bound: entry[index] += 1; break
+        entry[-2] += value; entry[-1] += 1; _dirty = True
+
+
+@contextmanager
+def timed(name, labels=()):
+    """Observes the duration of the with-block (also when it raises) into histogram 'name'."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, labels)
+
+
+# --- Per-worker files ---
+def _snapshot():
+    with _lock:
+        values = _process_values()
+        return {metric_type: [[name, [list(pair) for pair in labels], value] for (name, labels), value in store.items()] for metric_type, store in values.items()}
+
+
+def _file_path(pid):
+    return os.path.join(METRICS_DIR, f"{os.getppid()}-{pid}.json")
+
+
+def _flush():
+    global _dirty
+    with _lock:
+        if not _dirty: return
+        _dirty = False
+    data = _snapshot()
+    path = _file_path(os.getpid()); tmp_path = path + '.tmp'
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(tmp_path, 'w') as f: json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Cannot write metrics file %s: %s", path, e)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL_SEC)
+        _flush()
+
+
+def _pid_alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass
+    return True
+
+
+def _sibling_snapshots():
+    """(snapshot, alive) for the other workers of this master. Deletes files of earlier runs."""
+    master = os.getppid(); own = os.getpid(); snapshots = []
+    try: names = os.listdir(METRICS_DIR)
+    except FileNotFoundError: return snapshots
+    for file_name in names:
+        if not file_name.endswith('.json'): continue
+        try: file_master, file_pid = (int(part) for part in file_name[:-5].split('-'))
+        except ValueError: continue
+        path = os.path.join(METRICS_DIR, file_name)
+        if file_master != master:
+            if not _pid_alive(file_master):
+                try: os.remove(path)
+                except OSError: pass
+            continue
+        if file_pid == own: continue # Live values are used instead
+        try:
+            with open(path) as f: snapshots.append((json.load(f), _pid_alive(file_pid)))
+        except (OSError, ValueError) as e:
+            logger.debug("Skipping metrics file %s: %s", path, e)
+    return snapshots
+
+
+# --- Exposition ---
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render():
+    """All metrics of all workers in the Prometheus text format (version 0.0.4)."""
+    merged = {'counter': {}, 'gauge': {}, 'histogram': {}}
+    for snapshot, alive in [(_snapshot(), True)] + _sibling_snapshots():
+        for metric_type, entries in snapshot.items():
+            if metric_type == 'gauge' and not alive: continue
+            store = merged[metric_type]
+            for name, labels, value in entries:
+                if name not in _definitions: continue # Defined by a newer/older version of the app
+                key = (name, tuple(tuple(pair) for pair in labels))
+                if metric_type == 'histogram':
+                    total = store.setdefault(key, [0] * len(value))
+                    if len(total) == len(value): store[key] = [a + b for a, b in zip(total, value)]
+                else:
+                    store[key] = store.get(key, 0) + value
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in sorted(_definitions.items()):
+        lines.append(f"# HELP {name} {help_text}"); lines.append(f"# TYPE {name} {metric_type}")
+        series = sorted((labels, value) for (series_name, labels), value in merged[metric_type].items() if series_name == name)
+        for labels, value in series:
+            if metric_type != 'histogram':
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}"); continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', format(bound, 'g'))])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-2])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
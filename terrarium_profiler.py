@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# --- terrarium_profiler.py ---
+# Opt-in sampling profiler for live web requests (used by app.py and app_async.py).
+#
+# While a profiled request runs, a background thread looks at the request thread's stack every
+# TERRARIUM_PROFILE_INTERVAL_MS and counts each distinct stack. Nothing is traced or hooked, so the
+# request itself runs at full speed; only the sampler thread costs a little CPU.
+# Each profile is saved as <dir>/<time>-<pid>-<route>.json: route, method, query parameters, status,
+# duration and the stacks in collapsed form ("file:function;file:function count"), which flamegraph.pl,
+# speedscope and similar tools read directly. Only the newest TERRARIUM_PROFILE_MAX_FILES are kept.
+#
+# Environment variables (all optional):
+#   TERRARIUM_PROFILE_DIR          where profiles are kept. Default: /tmp/terrarium_profiles
+#   TERRARIUM_PROFILE_INTERVAL_MS  sampling interval. Default: 5
+#   TERRARIUM_PROFILE_MAX_FILES    profiles kept on disk (oldest are deleted). Default: 200
+#   TERRARIUM_PROFILE_SAMPLE_RATE  fraction of all requests profiled without being asked (0..1). Default: 0
+
+import json
+import logging
+import os
+import re
+import sys
+import threading
+from datetime import datetime
+
+logger = logging.getLogger('terrarium_profiler')
+
+PROFILE_DIR = os.environ.get('TERRARIUM_PROFILE_DIR', '/tmp/terrarium_profiles')
+PROFILE_INTERVAL_SEC = float(os.environ.get('TERRARIUM_PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_MAX_FILES = int(os.environ.get('TERRARIUM_PROFILE_MAX_FILES', '200'))
+PROFILE_SAMPLE_RATE = float(os.environ.get('TERRARIUM_PROFILE_SAMPLE_RATE', '0'))
+
+_PROFILE_NAME = re.compile(r'^[0-9T-]+-\d+-[\w.-]+\.json$') # What save() writes; anything else is never served
+
+
+class SamplingProfiler:
+    """Samples one thread's stack from a daemon thread between start() and stop()."""
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL_SEC):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.stacks = {} # Collapsed stack -> samples
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: break # Thread has ended
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1; self.samples += 1
+
+
+def collapsed(stacks):
+    """Collapsed-stack text (one 'frame;frame;frame count' line per stack), heaviest first."""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+
+def save(profiler, route, method, params, status, duration):
+    """Writes one profile and trims the history to PROFILE_MAX_FILES. Returns the file name (None on failure)."""
+    now = datetime.now()
+    slug = re.sub(r'[^\w.-]+', '_', route).strip('_') or 'root'
+    name = f"{now:%Y%m%dT%H%M%S%f}-{os.getpid()}-{slug}.json"
+    data = {'route': route, 'method': method, 'params': params, 'status': status, 'time': now.isoformat(timespec='seconds'),
+            'duration_ms': round(duration * 1000, 1), 'interval_ms': profiler.interval * 1000, 'samples': profiler.samples,
+            'stacks': profiler.stacks}
+    path = os.path.join(PROFILE_DIR, name); tmp_path = path + '.tmp'
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(tmp_path, 'w') as f: json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Cannot write profile %s: %s", path, e)
+        return None
+    _trim()
+    logger.info("Profiled %s %s: %.0f ms, %s samples -> %s", method, route, duration * 1000, profiler.samples, name)
+    return name
+
+
+def _trim():
+    names = sorted(list_profiles(), reverse=True)
+    for name in names[PROFILE_MAX_FILES:]:
+        try: os.remove(os.path.join(PROFILE_DIR, name))
+        except OSError: pass # Another worker got there first
+
+
+def list_profiles():
+    """File names of the stored profiles (oldest first, since names start with the time)."""
+    try: return sorted(name for name in os.listdir(PROFILE_DIR) if _PROFILE_NAME.match(name))
+    except FileNotFoundError: return []
+
+
+def load_profile(name):
+    """The stored profile dict, or None if there is no such profile."""
+    if not _PROFILE_NAME.match(name): return None
+    try:
+        with open(os.path.join(PROFILE_DIR, name)) as f: return json.load(f)
+    except (OSError, ValueError):
+        return None
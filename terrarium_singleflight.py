@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# --- terrarium_singleflight.py ---
+# Request coalescing ("single flight") for the dashboard's read APIs (app.py, app_async.py).
+#
+# Browser tabs refreshing the same device and range tend to line up, and each would run the same queries.
+# run(name, key, compute) lets identical calls that overlap share one computation:
+#   - in this process, later callers wait for the one already running and get its result;
+#   - across gunicorn workers, the computing worker holds an flock on <dir>/<key hash>.lock and writes its
+#     (JSON) result to <key hash>.json. A worker that had to wait for the lock takes that result if it was
+#     finished after the worker arrived, i.e. the computation was already in flight; otherwise it computes.
+# Only overlapping calls are merged; nothing is cached beyond that. Errors are not shared across workers
+# (the next waiter simply computes itself). Results must be JSON-serializable.
+#
+# Environment variables (all optional):
+#   TERRARIUM_SINGLEFLIGHT_DIR       lock/result files. Default: /tmp/terrarium_singleflight
+#   TERRARIUM_SINGLEFLIGHT_WAIT_SEC  longest wait for another worker before computing anyway. Default: 10
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('terrarium_singleflight')
+
+SINGLEFLIGHT_DIR = os.environ.get('TERRARIUM_SINGLEFLIGHT_DIR', '/tmp/terrarium_singleflight')
+SINGLEFLIGHT_WAIT_SEC = float(os.environ.get('TERRARIUM_SINGLEFLIGHT_WAIT_SEC', '10'))
+POLL_SEC = 0.01 # Lock retry interval while another worker computes
+SWEEP_EVERY = 200 # Result writes between removals of stale files (per process)
+STALE_SEC = 300 # Result files older than this are removed by the sweep
+
+# Optional callable(name, outcome), told how each call was served:
+#   'computed' -- ran compute(); 'merged_process' / 'merged_worker' -- shared a result; 'wait_timeout' -- gave up waiting, computed
+outcome_observer = None
+
+_flights = {} # key -> _Flight running in this process
+_async_flights = {} # key -> asyncio.Future (event loop callers)
+_lock = threading.Lock()
+_writes = 0
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event(); self.result = None; self.error = None
+
+
+def _observe(name, outcome):
+    if outcome_observer: outcome_observer(name, outcome)
+
+
+def _paths(key):
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    return os.path.join(SINGLEFLIGHT_DIR, digest + '.lock'), os.path.join(SINGLEFLIGHT_DIR, digest + '.json')
+
+
+def _open_lock(lock_path):
+    """File descriptor of the key's lock file, or None if the directory isn't usable (then nothing is shared)."""
+    try:
+        os.makedirs(SINGLEFLIGHT_DIR, mode=0o700, exist_ok=True)
+        return os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+        logger.warning("Single-flight directory %s unusable (%s). Not coalescing across workers.", SINGLEFLIGHT_DIR, e)
+        return None
+
+
+def _try_lock(fd):
+    try: fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB); return True
+    except BlockingIOError: return False
+
+
+def _shared_result(result_path, arrived):
+    """(True, result) if another worker finished this computation after 'arrived', else (False, None)."""
+    try:
+        with open(result_path) as f: entry = json.load(f)
+    except (OSError, ValueError):
+        return False, None
+    return (True, entry['result']) if entry.get('finished', 0) >= arrived else (False, None)
+
+
+def _publish(result_path, result):
+    global _writes
+    tmp_path = f"{result_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f: json.dump({'finished': time.time(), 'result': result}, f)
+        os.replace(tmp_path, result_path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning("Cannot publish single-flight result %s: %s", result_path, e)
+    _writes += 1
+    if _writes % SWEEP_EVERY == 0: _sweep()
+
+
+def _sweep():
+    cutoff = time.time() - STALE_SEC
+    try:
+        for file_name in os.listdir(SINGLEFLIGHT_DIR):
+            if not file_name.endswith('.json'): continue # Lock files stay: another worker may hold one
+            path = os.path.join(SINGLEFLIGHT_DIR, file_name)
+            try:
+                if os.path.getmtime(path) < cutoff: os.remove(path)
+            except OSError: pass # Removed by another worker meanwhile
+    except OSError as e:
+        logger.debug("Single-flight sweep failed: %s", e)
+
+
+def _run_across_workers(key, compute):
+    """(result, outcome) for the calling worker: computed under the key's lock, or taken from the worker that held it."""
+    arrived = time.time(); lock_path, result_path = _paths(key)
+    fd = _open_lock(lock_path)
+    if fd is None: return compute(), 'computed'
+    try:
+        waited = False
+        while not _try_lock(fd):
+            if time.time() - arrived >= SINGLEFLIGHT_WAIT_SEC:
+                logger.warning("Waited %ss for another worker on %s. Computing without it.", SINGLEFLIGHT_WAIT_SEC, key)
+                return compute(), 'wait_timeout'
+            waited = True; time.sleep(POLL_SEC)
+        if waited:
+            found, result = _shared_result(result_path, arrived)
+            if found: return result, 'merged_worker'
+        result = compute()
+        _publish(result_path, result)
+        return result, 'computed'
+    finally:
+        os.close(fd) # Also releases the lock
+
+
+def run(name, key, compute):
+    """
+    compute(), or the result of an identical call (same key) already running in this process or another worker.
+    'name' labels the outcome for outcome_observer (e.g. 'chart'). key must have a stable repr (tuple of str/int/None).
+    """
+    with _lock:
+        flight = _flights.get(key); leader = flight is None
+        if leader: flight = _flights[key] = _Flight()
+    if not leader:
+        flight.done.wait(); _observe(name, 'merged_process')
+        if flight.error is not None: raise flight.error
+        return flight.result
+    try:
+        flight.result, outcome = _run_across_workers(key, compute)
+        _observe(name, outcome)
+        return flight.result
+    except Exception as e:
+        flight.error = e; raise
+    finally:
+        with _lock: del _flights[key]
+        flight.done.set()
+
+
+async def run_async(name, key, compute):
+    """run() for the event loop: compute is a coroutine function; waiting for another worker doesn't block the loop."""
+    future = _async_flights.get(key)
+    if future is not None:
+        result = await asyncio.shield(future); _observe(name, 'merged_process')
+        return result
+    future = _async_flights[key] = asyncio.get_running_loop().create_future()
+    try:
+        arrived = time.time(); lock_path, result_path = _paths(key); outcome = 'computed'
+        fd = _open_lock(lock_path)
+        try:
+            waited = False; result = None; found = False
+            while fd is not None and not _try_lock(fd):
+                if time.time() - arrived >= SINGLEFLIGHT_WAIT_SEC:
+                    logger.warning("Waited %ss for another worker on %s. Computing without it.", SINGLEFLIGHT_WAIT_SEC, key)
+                    outcome = 'wait_timeout'; break
+                waited = True; await asyncio.sleep(POLL_SEC)
+            if waited and outcome != 'wait_timeout':
+                found, result = _shared_result(result_path, arrived)
+                if found: outcome = 'merged_worker'
+            if not found:
+                result = await compute()
+                if fd is not None and outcome == 'computed': _publish(result_path, result)
+        finally:
+            if fd is not None: os.close(fd)
+        future.set_result(result); _observe(name, outcome)
+        return result
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError): future.cancel()
+        else: future.set_exception(e); future.exception() # Marks it retrieved, so an unawaited future doesn't warn
+        raise
+    finally:
+        del _async_flights[key]
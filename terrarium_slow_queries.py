@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# --- terrarium_slow_queries.py ---
+# Slow-query sentinel for the web app's SQL (terrarium_storage.py backends and app_async.py).
+#
+# Every statement is timed under a stable name: the name of the terrarium_storage *_SQL constant it
+# came from (e.g. chart_buckets), or "<verb>_<table>_<hash>" for inline SQL. A statement slower than
+# TERRARIUM_SLOW_QUERY_MS is captured with its query plan (EXPLAIN), row count and redacted parameters:
+# strings (emails, hashes, device IDs) are replaced by their length, numbers/times/NULL are kept.
+# At most one capture per statement name per TERRARIUM_SLOW_QUERY_CAPTURE_SEC and worker, so a plan
+# that flips under load costs one EXPLAIN a minute, not one per request.
+# Captures go to a small SQLite file shared by all gunicorn workers; only the newest are kept.
+#
+# Environment variables (all optional):
+#   TERRARIUM_SLOW_QUERY_MS           capture threshold in ms, 0 = off. Default: 250
+#   TERRARIUM_SLOW_QUERY_CAPTURE_SEC  min seconds between captures of the same statement (per worker). Default: 60
+#   TERRARIUM_SLOW_QUERY_KEEP         captures kept. Default: 200
+#   TERRARIUM_SLOW_QUERY_DB           capture store. Default: /tmp/terrarium_slow_queries.sqlite3
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger('terrarium_slow_queries')
+
+SLOW_QUERY_SEC = float(os.environ.get('TERRARIUM_SLOW_QUERY_MS', '250')) / 1000
+CAPTURE_INTERVAL_SEC = float(os.environ.get('TERRARIUM_SLOW_QUERY_CAPTURE_SEC', '60'))
+SLOW_QUERY_KEEP = int(os.environ.get('TERRARIUM_SLOW_QUERY_KEEP', '200'))
+SLOW_QUERY_DB = os.environ.get('TERRARIUM_SLOW_QUERY_DB', '/tmp/terrarium_slow_queries.sqlite3')
+
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)") # IN (%s, %s, ...) of any length
+_STATEMENT_TABLE = re.compile(r"^\s*(select|insert|update|delete|with)\b.*?\b(?:from|into|update)\s+(\w+)", re.I | re.S)
+
+_names = {} # Normalized SQL -> registered name
+_last_capture = {} # Statement name -> monotonic time of the last capture (this process)
+_capture_lock = threading.Lock()
+_store_ready = False
+
+
+def normalize(sql):
+    """Whitespace collapsed and placeholder lists shortened, so IN-lists of any length are one statement."""
+    return " ".join(_PLACEHOLDER_LIST.sub("(...)", sql).split())
+
+
+def register(names_to_sql):
+    """Names statements, e.g. register({'chart_buckets': CHART_BUCKETS_SQL}). Templates with {placeholders} are accepted."""
+    for name, sql in names_to_sql.items():
+        _names[normalize(sql.replace('{placeholders}', '%s'))] = name
+
+
+def statement_name(sql):
+    """The registered name of a statement, else '<verb>_<table>_<hash of the normalized SQL>' (stable across workers)."""
+    normalized = normalize(sql)
+    name = _names.get(normalized)
+    if name is None:
+        match = _STATEMENT_TABLE.match(normalized)
+        prefix = f"{match.group(1)}_{match.group(2)}".lower() if match else (re.findall(r"\w+", normalized) or ["sql"])[0].lower()
+        name = _names[normalized] = f"{prefix}_{hashlib.sha1(normalized.encode()).hexdigest()[:8]}"
+    return name
+
+
+def redact(params):
+    """Parameters safe to store: strings become '<str:N>', everything else is kept as text."""
+    if params is None: return None
+    if isinstance(params, dict): return {key: redact([value])[0] for key, value in params.items()}
+    return [f"<str:{len(value)}>" if isinstance(value, (str, bytes)) else (value if value is None or isinstance(value, (int, float)) else str(value)) for value in params]
+
+
+def explainable(sql):
+    """EXPLAIN only makes sense for statements that read rows."""
+    return normalize(sql).split(" ", 1)[0].lower() in ('select', 'with', 'update', 'delete')
+
+
+def should_capture(name, seconds):
+    """True if a statement this slow should be captured now (threshold and per-name rate limit)."""
+    if not SLOW_QUERY_SEC or seconds < SLOW_QUERY_SEC: return False
+    now = time.monotonic()
+    with _capture_lock:
+        if now - _last_capture.get(name, -CAPTURE_INTERVAL_SEC) < CAPTURE_INTERVAL_SEC: return False
+        _last_capture[name] = now
+    return True
+
+
+def record(name, backend, sql, params, seconds, rows, plan):
+    """Stores one capture. plan is a list of EXPLAIN rows (dicts or tuples) or None. Never raises."""
+    global _store_ready
+    logger.warning("Slow query %s (%s): %.0f ms, %s rows", name, backend, seconds * 1000, rows)
+    try:
+        conn = sqlite3.connect(SLOW_QUERY_DB, timeout=1, isolation_level=None)
+        try:
+            if not _store_ready:
+                conn.execute("CREATE TABLE IF NOT EXISTS slow_queries (id INTEGER PRIMARY KEY, captured_at TEXT NOT NULL, pid INTEGER NOT NULL, "
+                             "name TEXT NOT NULL, backend TEXT, duration_ms REAL NOT NULL, rows INTEGER, params TEXT, plan TEXT, statement TEXT NOT NULL)")
+                _store_ready = True
+            conn.execute("INSERT INTO slow_queries (captured_at, pid, name, backend, duration_ms, rows, params, plan, statement) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (datetime.now().isoformat(timespec='seconds'), os.getpid(), name, backend, round(seconds * 1000, 1), rows,
+                          json.dumps(redact(params)), json.dumps(plan, default=str), normalize(sql)))
+            conn.execute("DELETE FROM slow_queries WHERE id <= (SELECT MAX(id) FROM slow_queries) - ?", (SLOW_QUERY_KEEP,))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning("Slow query store unavailable (%s). Capture of %s dropped.", e, name)
+
+
+def recent(limit=50, name=None):
+    """Newest captures first, as dicts (params/plan decoded)."""
+    try:
+        conn = sqlite3.connect(SLOW_QUERY_DB, timeout=1)
+        conn.row_factory = sqlite3.Row
+        try:
+            sql = "SELECT * FROM slow_queries" + (" WHERE name = ?" if name else "") + " ORDER BY id DESC LIMIT ?"
+            rows = conn.execute(sql, ((name,) if name else ()) + (limit,)).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.OperationalError: # No capture yet (no table)
+        return []
+    captures = []
+    for row in rows:
+        capture = dict(row); capture['params'] = json.loads(capture['params']); capture['plan'] = json.loads(capture['plan'])
+        captures.append(capture)
+    return captures
@@ -0,0 +1,857 @@
+#!/usr/bin/env python3
+# --- terrarium_storage.py ---
+# Storage layer for the web app: users, devices, device settings and readings behind one interface
+# (class Storage), so the routes in app.py never see SQL or a database driver. Backends:
+#   mariadb  -- the production database (MariaDBStorage)
+#   sqlite   -- one file in WAL mode, for a small Pi without MariaDB (SQLiteStorage)
+#   memory   -- plain Python structures, per process; for tests, benchmarks and the dev server (MemoryStorage)
+#
+# Chart ranges are aggregated by each backend in its own way: GROUP BY in MariaDB and SQLite (only one
+# row per interval leaves the database), bisect over a time-sorted list in memory.
+#
+# Values at the interface: thresholds and reading values are float or None, off times are timedelta
+# since midnight (as MariaDB returns TIME columns) or None, times are naive local datetimes.
+# Driver errors are raised as StorageError (or one of its subclasses below).
+# Each SQL statement is timed by name and slow ones are captured with their plan (terrarium_slow_queries.py).
+
+import bisect
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, time as time_obj
+import terrarium_slow_queries
+
+try:
+    import mysql.connector
+    from mysql.connector import Error as MariaDBError
+except ImportError:
+    mysql = None # Only needed for the mariadb backend
+
+logger = logging.getLogger('terrarium_storage')
+
+BACKENDS = ('mariadb', 'sqlite', 'memory')
+DEVICE_FIELDS = ('id', 'device_unique_id', 'device_name', 'min_temp_threshold', 'max_temp_threshold', 'heating_off_start_time', 'heating_off_end_time')
+READING_PAGE_FIELDS = ('id', 'reading_time', 'temperature', 'humidity', 'hold_seconds') # reading_page() row keys
+DEVICE_SETTING_FIELDS = ('device_name', 'min_temp_threshold', 'max_temp_threshold', 'heating_off_start_time', 'heating_off_end_time') # update_device() keys
+
+
+# --- Errors ---
+class StorageError(Exception):
+    """A storage operation failed (connection, query, driver). Routes answer 500 unless a subclass says otherwise."""
+
+class StorageUnavailable(StorageError):
+    """The database could not be reached."""
+
+class DuplicateEntry(StorageError):
+    """A unique value (user email, device_unique_id) already exists."""
+
+class StillReferenced(StorageError):
+    """The row is still referenced by others (a device that has readings)."""
+
+class UnknownDevice(StorageError):
+    """A reading refers to a device that no longer exists."""
+
+
+# --- Shared helpers ---
+def to_float(value):
+    return float(value) if value is not None else None
+
+def to_timedelta(value):
+    """TIME value (timedelta, datetime.time or 'HH:MM[:SS]' string) -> timedelta since midnight, None stays None."""
+    if value is None or isinstance(value, timedelta): return value
+    if isinstance(value, str): value = time_obj.fromisoformat(value)
+    return timedelta(hours=value.hour, minutes=value.minute, seconds=value.second)
+
+def device_row(row, extra=()):
+    """Normalizes a devices row to the interface types (DEVICE_FIELDS plus 'extra' keys)."""
+    device = {key: row[key] for key in DEVICE_FIELDS + tuple(extra)}
+    device['min_temp_threshold'] = to_float(device['min_temp_threshold']); device['max_temp_threshold'] = to_float(device['max_temp_threshold'])
+    device['heating_off_start_time'] = to_timedelta(device['heating_off_start_time']); device['heating_off_end_time'] = to_timedelta(device['heating_off_end_time'])
+    return device
+
+def reading_row(row, keys=('temperature', 'humidity')):
+    """Converts the given DECIMAL values of a row (dict) to float, in place. Returns the row (None stays None)."""
+    if row:
+        for key in keys: row[key] = to_float(row[key])
+    return row
+
+def reading_bucket(bucket, temperature, humidity, last_time, last_temperature, last_humidity, last_hold_seconds):
+    """One aggregated chart interval: averages plus the newest reading in it (for carrying held values forward)."""
+    return {'bucket': int(bucket), 'temperature': to_float(temperature), 'humidity': to_float(humidity), 'last_time': last_time,
+            'last_temperature': to_float(last_temperature), 'last_humidity': to_float(last_humidity), 'last_hold_seconds': int(last_hold_seconds) if last_hold_seconds else None}
+
+
+# --- Interface ---
+class Storage:
+    """
+    What the web app needs from a database. Device dicts have DEVICE_FIELDS (find_device() adds 'user_id').
+    Bucket numbers count whole intervals since 'anchor': reading_time - anchor = bucket * interval + remainder.
+    """
+    name = None
+    connect_observer = None # Optional callable(seconds), told how long each new database connection took
+    statement_observer = None # Optional callable(statement name, seconds), told how long each SQL statement took
+
+    def describe(self):
+        return self.name
+
+    def observe_connect(self, started):
+        if self.connect_observer: self.connect_observer(time.perf_counter() - started)
+
+    def statement_done(self, sql, seconds):
+        """Reports a statement's time. Returns its name if it is to be captured as a slow query, else None."""
+        name = terrarium_slow_queries.statement_name(sql)
+        if self.statement_observer: self.statement_observer(name, seconds)
+        return name if terrarium_slow_queries.should_capture(name, seconds) else None
+
+    def observe_statement(self, sql, params, started, rows, explain):
+        """statement_done() for a finished statement; a slow one is captured with explain(sql, params) as its plan."""
+        seconds = time.perf_counter() - started
+        name = self.statement_done(sql, seconds)
+        if name is None: return
+        plan = explain(sql, params) if terrarium_slow_queries.explainable(sql) else None
+        terrarium_slow_queries.record(name, self.name, sql, params, seconds, rows, plan)
+
+    # Users
+    def get_user_by_email(self, email):
+        """User dict (id, name, email, password, security_question, security_answer) or None."""
+        raise NotImplementedError
+
+    def create_user(self, name, email, password_hash, security_question, security_answer_hash):
+        """Returns the new user id. Raises DuplicateEntry if the email is taken."""
+        raise NotImplementedError
+
+    def update_user_hashes(self, user_id, password=None, security_answer=None):
+        """Replaces the given hashes of a user (rehash with current parameters)."""
+        raise NotImplementedError
+
+    def reset_password(self, email, password_hash):
+        """Sets a new password hash by email. Returns False if there is no such user."""
+        raise NotImplementedError
+
+    # Devices
+    def list_user_devices(self, user_id):
+        """The user's devices, oldest link first."""
+        raise NotImplementedError
+
+    def get_user_device(self, user_id, device_db_id):
+        """Device dict if the device exists and belongs to the user, else None."""
+        raise NotImplementedError
+
+    def find_device(self, device_unique_id):
+        """Device dict plus 'user_id' for a device_unique_id, or None."""
+        raise NotImplementedError
+
+    def get_devices_by_uid(self, device_uids):
+        """Device dicts for the registered ones among device_uids (any order)."""
+        raise NotImplementedError
+
+    def create_device(self, user_id, device_unique_id, device_name):
+        """Links a new device without settings and returns its device dict. Raises DuplicateEntry."""
+        raise NotImplementedError
+
+    def update_device(self, user_id, device_db_id, changes):
+        """Sets DEVICE_SETTING_FIELDS values (times as datetime.time). Returns False if the user has no such device."""
+        raise NotImplementedError
+
+    def delete_device(self, user_id, device_db_id):
+        """Deletes the user's device. Returns False if not found; raises StillReferenced if readings keep it."""
+        raise NotImplementedError
+
+    # Readings
+    def resolve_device_keys(self, device_uids):
+        """{device_unique_id: devices.id} for the registered ones among device_uids (the ingest path's registration check)."""
+        raise NotImplementedError
+
+    def add_readings(self, readings):
+        """Stores (device_db_id, device_unique_id, reading_time, temperature, humidity, hold_seconds) tuples in one transaction."""
+        raise NotImplementedError
+
+    def latest_reading(self, device):
+        """Newest reading of a device as {reading_time, temperature, humidity}, or None."""
+        raise NotImplementedError
+
+    def reading_buckets(self, device, since, until, anchor, interval_minutes):
+        """Readings with values in [since, until) aggregated per interval (reading_bucket() dicts), ordered by bucket."""
+        raise NotImplementedError
+
+    def reading_page(self, device, since, after_id, until, limit):
+        """
+        Up to 'limit' raw readings (READING_PAGE_FIELDS dicts) before 'until', ordered by (reading_time, id): from 'since'
+        on if after_id is None, else those after the keyset position (since, after_id). Walks the (device, time) index.
+        """
+        raise NotImplementedError
+
+    def hourly_averages(self, device, since, until):
+        """
+        Average temperature/humidity and reading count per whole hour since 'since' (bucket 0 = the hour starting at 'since'),
+        for readings in [since, until), as {bucket, temperature, humidity, readings} dicts ordered by bucket. One grouped pass.
+        """
+        raise NotImplementedError
+
+    def overview_latest(self, user_id):
+        """The user's devices (oldest first), each with reading_time/temperature/humidity of its newest reading (None if none)."""
+        raise NotImplementedError
+
+    def overview_buckets(self, user_id, since, step_minutes):
+        """Average temperature/humidity per device and interval since 'since', for all of the user's devices at once."""
+        raise NotImplementedError
+
+
+# --- MariaDB ---
+# readings is moving from the 36-char device_unique_id string to the integer devices.id (readings.device_id).
+# The phase is advanced step by step together with migrate_readings_device_key.py (default 'uuid': deploying the code
+# alone changes nothing, each later phase is switched on by the operator once its migration step has run):
+#   uuid    -- write and read device_unique_id only (before 'add')
+#   dual    -- write both keys, read by device_unique_id (while 'backfill' runs)
+#   id      -- write both keys, read by device_id (after 'verify' shows no missing keys)
+#   id_only -- write device_id only (after 'finalize'; then 'drop-uuid' removes the old column)
+READINGS_KEY_PHASES = ('uuid', 'dual', 'id', 'id_only')
+READINGS_KEY_PHASE = os.environ.get('READINGS_DEVICE_KEY_PHASE', 'uuid')
+if READINGS_KEY_PHASE not in READINGS_KEY_PHASES:
+    logger.warning("Unknown READINGS_DEVICE_KEY_PHASE '%s', using 'uuid'.", READINGS_KEY_PHASE); READINGS_KEY_PHASE = 'uuid'
+READINGS_READ_BY_ID = READINGS_KEY_PHASE in ('id', 'id_only')
+READINGS_KEY_COLUMN = 'device_id' if READINGS_READ_BY_ID else 'device_unique_id' # readings column queries filter/join on
+DEVICES_KEY_COLUMN = 'id' if READINGS_READ_BY_ID else 'device_unique_id'         # matching devices column
+DEVICE_KEY_CACHE_TTL = 60 # Seconds a device_unique_id -> devices.id lookup is reused on the ingest path
+
+DEVICE_COLUMNS = ", ".join(DEVICE_FIELDS)
+RESOLVE_DEVICE_KEYS_SQL = "SELECT device_unique_id, id FROM devices WHERE device_unique_id IN ({placeholders})"
+DEVICES_BY_UID_SQL = f"SELECT {DEVICE_COLUMNS} FROM devices WHERE device_unique_id IN ({{placeholders}})"
+INSERT_READING_SQL = "INSERT INTO readings ({key_columns}, reading_time, temperature, humidity, hold_seconds) VALUES ({key_values}, %s, %s, %s, %s)".format(
+    key_columns={'uuid': 'device_unique_id', 'id_only': 'device_id'}.get(READINGS_KEY_PHASE, 'device_unique_id, device_id'),
+    key_values='%s' if READINGS_KEY_PHASE in ('uuid', 'id_only') else '%s, %s')
+LATEST_READING_SQL = f"SELECT reading_time, temperature, humidity FROM readings WHERE {READINGS_KEY_COLUMN} = %s ORDER BY reading_time DESC, id DESC LIMIT 1"
+# Keyset pages: the (device key, reading_time) index is in (reading_time, id) order, so every page is one index range
+READING_PAGE_SQL = f"""
+    SELECT id, reading_time, temperature, humidity, hold_seconds FROM readings
+    WHERE {READINGS_KEY_COLUMN} = %s AND reading_time >= %s AND reading_time < %s ORDER BY reading_time, id LIMIT %s
+"""
+READING_PAGE_AFTER_SQL = f"""
+    SELECT id, reading_time, temperature, humidity, hold_seconds FROM readings
+    WHERE {READINGS_KEY_COLUMN} = %s AND reading_time >= %s AND (reading_time > %s OR id > %s) AND reading_time < %s ORDER BY reading_time, id LIMIT %s
+"""
+# One row per interval; the newest reading of each comes along via GROUP_CONCAT ... LIMIT 1 (MariaDB 10.3+)
+CHART_BUCKETS_SQL = f"""
+    SELECT TIMESTAMPDIFF(MINUTE, %s, reading_time) DIV %s AS bucket,
+           AVG(temperature) AS temperature, AVG(humidity) AS humidity, MAX(reading_time) AS last_time,
+           GROUP_CONCAT(CONCAT_WS(',', temperature, humidity, IFNULL(hold_seconds, 0)) ORDER BY reading_time DESC, id DESC LIMIT 1) AS last_reading
+    FROM readings
+    WHERE {READINGS_KEY_COLUMN} = %s AND reading_time >= %s AND reading_time < %s AND temperature IS NOT NULL AND humidity IS NOT NULL
+    GROUP BY bucket ORDER BY bucket
+"""
+# Heatmap hours: plain aggregates only (no per-hour newest reading as for the chart), so a year is one index range scan
+HOURLY_AVERAGES_SQL = f"""
+    SELECT TIMESTAMPDIFF(HOUR, %s, reading_time) AS bucket, AVG(temperature) AS temperature, AVG(humidity) AS humidity, COUNT(temperature) AS readings
+    FROM readings
+    WHERE {READINGS_KEY_COLUMN} = %s AND reading_time >= %s AND reading_time < %s
+    GROUP BY bucket ORDER BY bucket
+"""
+# Devices with their newest reading: one grouped subquery for all of the user's devices; of readings sharing the
+# newest timestamp the last stored (highest id), as latest_reading() returns
+OVERVIEW_LATEST_SQL = f"""
+    SELECT d.id, d.device_unique_id, d.device_name, d.min_temp_threshold, d.max_temp_threshold,
+           r.reading_time, r.temperature, r.humidity
+    FROM devices d
+    LEFT JOIN (SELECT rd.{READINGS_KEY_COLUMN} AS device_key, MAX(rd.reading_time) AS latest_time
+               FROM readings rd JOIN devices dd ON dd.{DEVICES_KEY_COLUMN} = rd.{READINGS_KEY_COLUMN}
+               WHERE dd.user_id = %s GROUP BY rd.{READINGS_KEY_COLUMN}) lt ON lt.device_key = d.{DEVICES_KEY_COLUMN}
+    LEFT JOIN readings r ON r.id = (SELECT MAX(rt.id) FROM readings rt WHERE rt.{READINGS_KEY_COLUMN} = lt.device_key AND rt.reading_time = lt.latest_time)
+    WHERE d.user_id = %s ORDER BY d.created_at ASC, d.id ASC
+"""
+# Sparkline buckets for all of the user's devices in one pass
+OVERVIEW_BUCKETS_SQL = f"""
+    SELECT d.id AS device_db_id, TIMESTAMPDIFF(MINUTE, %s, r.reading_time) DIV %s AS bucket,
+           AVG(r.temperature) AS temperature, AVG(r.humidity) AS humidity
+    FROM readings r JOIN devices d ON d.{DEVICES_KEY_COLUMN} = r.{READINGS_KEY_COLUMN}
+    WHERE d.user_id = %s AND r.reading_time >= %s
+    GROUP BY d.id, bucket
+"""
+MARIADB_ERRORS = {1062: DuplicateEntry, 1451: StillReferenced, 1452: UnknownDevice} # errno -> StorageError subclass
+
+class MariaDBTimedCursor:
+    """Buffered mysql.connector cursor whose execute()/executemany() are timed (Storage.observe_statement)."""
+
+    def __init__(self, storage, conn, cursor):
+        self.storage = storage; self.conn = conn; self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter(); self.cursor.execute(sql, params) # Buffered: the time includes fetching the rows
+        self.storage.observe_statement(sql, params, started, self.cursor.rowcount, self.explain)
+
+    def executemany(self, sql, seq_params):
+        started = time.perf_counter(); self.cursor.executemany(sql, seq_params)
+        self.storage.observe_statement(sql, seq_params[0] if seq_params else None, started, self.cursor.rowcount, self.explain)
+
+    def explain(self, sql, params):
+        try:
+            cursor = self.conn.cursor(dictionary=True, buffered=True)
+            try: cursor.execute("EXPLAIN " + sql, params); return cursor.fetchall()
+            finally: cursor.close()
+        except MariaDBError as e: return {'error': str(e)}
+
+def mariadb_bucket(row):
+    """CHART_BUCKETS_SQL row (dict) -> reading_bucket()."""
+    last_reading = row['last_reading']
+    if isinstance(last_reading, (bytes, bytearray)): last_reading = last_reading.decode()
+    last_temp, last_humid, last_hold = last_reading.split(',')
+    return reading_bucket(row['bucket'], row['temperature'], row['humidity'], row['last_time'], last_temp, last_humid, int(last_hold))
+
+class MariaDBStorage(Storage):
+    """The production backend: a new mysql.connector connection per operation, as the routes always did."""
+    name = 'mariadb'
+
+    def __init__(self, host, user, password, database):
+        if mysql is None: raise StorageError("mysql-connector-python is not installed (needed for the mariadb backend).")
+        self.config = {'host': host, 'user': user, 'password': password, 'database': database, 'connect_timeout': 5}
+        self.device_key_cache = {} # device_unique_id -> (devices.id, monotonic expiry), per worker process
+
+    def describe(self):
+        return f"mariadb {self.config['user']}@{self.config['host']}/{self.config['database']} (readings key phase {READINGS_KEY_PHASE})"
+
+    @contextmanager
+    def cursor(self, dictionary=True):
+        """Cursor on a fresh connection; commits on success, rolls back and raises StorageError on failure."""
+        started = time.perf_counter()
+        try: conn = mysql.connector.connect(**self.config)
+        except MariaDBError as e: logger.error("Error connecting to DB: %s", e); raise StorageUnavailable(str(e)) from e
+        self.observe_connect(started)
+        cursor = None
+        try:
+            cursor = conn.cursor(dictionary=dictionary, buffered=True)
+            yield MariaDBTimedCursor(self, conn, cursor)
+            conn.commit()
+        except MariaDBError as e:
+            conn.rollback()
+            raise MARIADB_ERRORS.get(e.errno, StorageError)(str(e)) from e
+        finally:
+            if cursor: cursor.close()
+            conn.close()
+
+    # Device key resolver (also used by app_async.py)
+    def readings_key(self, device):
+        """Value readings are filtered on for a device dict (devices.id or device_unique_id, depending on phase)."""
+        return device['id'] if READINGS_READ_BY_ID else device['device_unique_id']
+
+    def cached_device_keys(self, device_uids):
+        """Resolver cache lookup. Returns ({uid: devices.id} found, [uids to look up])."""
+        now = time.monotonic(); found = {}; missing = []
+        for uid in device_uids:
+            entry = self.device_key_cache.get(uid)
+            if entry and entry[1] > now: found[uid] = entry[0]
+            else: missing.append(uid)
+        return found, missing
+
+    def remember_device_keys(self, rows):
+        """Caches (device_unique_id, id) rows from a devices lookup; returns them as {uid: id}. Unknown IDs are not cached."""
+        expires = time.monotonic() + DEVICE_KEY_CACHE_TTL; resolved = {}
+        for uid, device_db_id in rows:
+            self.device_key_cache[uid] = (device_db_id, expires); resolved[uid] = device_db_id
+        return resolved
+
+    def reading_insert_params(self, device_db_id, device_uid, reading_time, temp, humid, hold_seconds):
+        """INSERT_READING_SQL parameters for the current phase."""
+        if READINGS_KEY_PHASE == 'uuid': return (device_uid, reading_time, temp, humid, hold_seconds)
+        if READINGS_KEY_PHASE == 'id_only': return (device_db_id, reading_time, temp, humid, hold_seconds)
+        return (device_uid, device_db_id, reading_time, temp, humid, hold_seconds)
+
+    # Users
+    def get_user_by_email(self, email):
+        with self.cursor() as cursor:
+            cursor.execute("SELECT id, name, email, password, security_question, security_answer FROM users WHERE email = %s", (email,)); return cursor.fetchone()
+
+    def create_user(self, name, email, password_hash, security_question, security_answer_hash):
+        with self.cursor() as cursor:
+            cursor.execute("INSERT INTO users (name, email, password, security_question, security_answer) VALUES (%s, %s, %s, %s, %s)", (name, email, password_hash, security_question, security_answer_hash))
+            return cursor.lastrowid
+
+    def update_user_hashes(self, user_id, password=None, security_answer=None):
+        changes = {key: value for key, value in (('password', password), ('security_answer', security_answer)) if value is not None}
+        if not changes: return
+        with self.cursor() as cursor:
+            cursor.execute(f"UPDATE users SET {', '.join(f'{key} = %s' for key in changes)} WHERE id = %s", tuple(changes.values()) + (user_id,))
+
+    def reset_password(self, email, password_hash):
+        with self.cursor() as cursor:
+            cursor.execute("UPDATE users SET password = %s WHERE email = %s", (password_hash, email)); return cursor.rowcount > 0
+
+    # Devices
+    def list_user_devices(self, user_id):
+        with self.cursor() as cursor:
+            cursor.execute(f"SELECT {DEVICE_COLUMNS} FROM devices WHERE user_id = %s ORDER BY created_at ASC", (user_id,)); return [device_row(row) for row in cursor.fetchall()]
+
+    def get_user_device(self, user_id, device_db_id):
+        with self.cursor() as cursor:
+            cursor.execute(f"SELECT {DEVICE_COLUMNS} FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id)); row = cursor.fetchone()
+        return device_row(row) if row else None
+
+    def find_device(self, device_unique_id):
+        with self.cursor() as cursor:
+            cursor.execute(f"SELECT {DEVICE_COLUMNS}, user_id FROM devices WHERE device_unique_id = %s", (device_unique_id,)); row = cursor.fetchone()
+        return device_row(row, ('user_id',)) if row else None
+
+    def get_devices_by_uid(self, device_uids):
+        with self.cursor() as cursor:
+            cursor.execute(DEVICES_BY_UID_SQL.format(placeholders=", ".join(["%s"] * len(device_uids))), tuple(device_uids)); return [device_row(row) for row in cursor.fetchall()]
+
+    def create_device(self, user_id, device_unique_id, device_name):
+        with self.cursor() as cursor:
+            cursor.execute("INSERT INTO devices (user_id, device_unique_id, device_name, min_temp_threshold, max_temp_threshold, heating_off_start_time, heating_off_end_time) VALUES (%s, %s, %s, NULL, NULL, NULL, NULL)", (user_id, device_unique_id, device_name))
+            cursor.execute(f"SELECT {DEVICE_COLUMNS} FROM devices WHERE id = %s", (cursor.lastrowid,)); return device_row(cursor.fetchone())
+
+    def update_device(self, user_id, device_db_id, changes):
+        with self.cursor() as cursor:
+            cursor.execute(f"UPDATE devices SET {', '.join(f'{key} = %s' for key in changes)} WHERE id = %s AND user_id = %s", tuple(changes.values()) + (device_db_id, user_id))
+            if cursor.rowcount: return True
+            # 0 rows: either no such device, or the values were already set
+            cursor.execute("SELECT id FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id)); return cursor.fetchone() is not None
+
+    def delete_device(self, user_id, device_db_id):
+        with self.cursor() as cursor:
+            cursor.execute("SELECT device_unique_id FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id)); device = cursor.fetchone()
+            if not device: return False
+            cursor.execute("DELETE FROM devices WHERE id = %s AND user_id = %s", (device_db_id, user_id)); deleted = cursor.rowcount > 0
+        self.device_key_cache.pop(device['device_unique_id'], None) # Other workers drop it within DEVICE_KEY_CACHE_TTL
+        return deleted
+
+    # Readings
+    def resolve_device_keys(self, device_uids):
+        """One query for cache misses; usually served from the resolver cache."""
+        resolved, missing = self.cached_device_keys(device_uids)
+        if missing:
+            with self.cursor(dictionary=False) as cursor:
+                cursor.execute(RESOLVE_DEVICE_KEYS_SQL.format(placeholders=", ".join(["%s"] * len(missing))), tuple(missing)); resolved.update(self.remember_device_keys(cursor.fetchall()))
+        return resolved
+
+    def add_readings(self, readings):
+        try:
+            with self.cursor(dictionary=False) as cursor:
+                cursor.executemany(INSERT_READING_SQL, [self.reading_insert_params(*reading) for reading in readings]) # One multi-row INSERT
+        except UnknownDevice:
+            self.device_key_cache.clear(); raise # FK: a cached key is stale (device unlinked/relinked)
+
+    def latest_reading(self, device):
+        with self.cursor() as cursor:
+            cursor.execute(LATEST_READING_SQL, (self.readings_key(device),)); return reading_row(cursor.fetchone())
+
+    def reading_buckets(self, device, since, until, anchor, interval_minutes):
+        with self.cursor() as cursor:
+            cursor.execute(CHART_BUCKETS_SQL, (anchor, interval_minutes, self.readings_key(device), since, until)); return [mariadb_bucket(row) for row in cursor.fetchall()]
+
+    def reading_page(self, device, since, after_id, until, limit):
+        with self.cursor() as cursor:
+            key = self.readings_key(device)
+            if after_id is None: cursor.execute(READING_PAGE_SQL, (key, since, until, limit))
+            else: cursor.execute(READING_PAGE_AFTER_SQL, (key, since, since, after_id, until, limit))
+            return [reading_row(row) for row in cursor.fetchall()]
+
+    def hourly_averages(self, device, since, until):
+        with self.cursor() as cursor:
+            cursor.execute(HOURLY_AVERAGES_SQL, (since, self.readings_key(device), since, until)); return [reading_row(row) for row in cursor.fetchall()]
+
+    def overview_latest(self, user_id):
+        with self.cursor() as cursor:
+            cursor.execute(OVERVIEW_LATEST_SQL, (user_id, user_id))
+            return [reading_row(row, ('min_temp_threshold', 'max_temp_threshold', 'temperature', 'humidity')) for row in cursor.fetchall()]
+
+    def overview_buckets(self, user_id, since, step_minutes):
+        with self.cursor() as cursor:
+            cursor.execute(OVERVIEW_BUCKETS_SQL, (since, step_minutes, user_id, since)); return [reading_row(row) for row in cursor.fetchall()]
+
+
+# --- SQLite ---
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY, name TEXT NOT NULL, email TEXT NOT NULL UNIQUE, password TEXT NOT NULL,
+        security_question TEXT, security_answer TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP);
+    CREATE TABLE IF NOT EXISTS devices (
+        id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), device_unique_id TEXT NOT NULL UNIQUE, device_name TEXT,
+        min_temp_threshold REAL, max_temp_threshold REAL, heating_off_start_time TEXT, heating_off_end_time TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP);
+    CREATE INDEX IF NOT EXISTS idx_devices_user ON devices (user_id);
+    CREATE TABLE IF NOT EXISTS readings (
+        id INTEGER PRIMARY KEY, device_id INTEGER NOT NULL REFERENCES devices (id), reading_time TEXT NOT NULL,
+        temperature REAL, humidity REAL, hold_seconds INTEGER);
+    CREATE INDEX IF NOT EXISTS idx_readings_device_time ON readings (device_id, reading_time);
+"""
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",    # Readers don't block the writer (ingest) and vice versa
+    "PRAGMA synchronous = NORMAL",  # fsync at checkpoints only; safe with WAL, far fewer SD card writes
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",   # Wait for another worker's write instead of failing at once
+    "PRAGMA cache_size = -8000",    # 8 MiB page cache per connection
+    "PRAGMA temp_store = MEMORY",   # GROUP BY temp b-trees in RAM
+    "PRAGMA mmap_size = 67108864",  # Read through a 64 MiB memory map
+)
+SQLITE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S' # Stored as TEXT; sorts and compares like the datetimes (whole seconds, as MariaDB's TIMESTAMP)
+SQLITE_DEVICE_COLUMNS = ", ".join(DEVICE_FIELDS)
+SQLITE_BUCKET = "(strftime('%s', reading_time) - strftime('%s', ?)) / ?" # Whole intervals since the anchor (integer division)
+# The newest reading of each interval (ties on reading_time: highest id, as MariaDB's GROUP_CONCAT) is picked by ROW_NUMBER() (SQLite 3.25+)
+SQLITE_CHART_BUCKETS_SQL = f"""
+    SELECT bucket, AVG(temperature) AS temperature, AVG(humidity) AS humidity, MAX(reading_time) AS last_time,
+           MAX(CASE WHEN newest = 1 THEN temperature END) AS last_temperature, MAX(CASE WHEN newest = 1 THEN humidity END) AS last_humidity,
+           MAX(CASE WHEN newest = 1 THEN hold_seconds END) AS last_hold_seconds
+    FROM (SELECT bucket, reading_time, temperature, humidity, hold_seconds,
+                 ROW_NUMBER() OVER (PARTITION BY bucket ORDER BY reading_time DESC, id DESC) AS newest
+          FROM (SELECT {SQLITE_BUCKET} AS bucket, id, reading_time, temperature, humidity, hold_seconds
+                FROM readings
+                WHERE device_id = ? AND reading_time >= ? AND reading_time < ? AND temperature IS NOT NULL AND humidity IS NOT NULL))
+    GROUP BY bucket ORDER BY bucket
+"""
+SQLITE_READING_PAGE_SQL = """
+    SELECT id, reading_time, temperature, humidity, hold_seconds FROM readings
+    WHERE device_id = ? AND reading_time >= ? AND reading_time < ? ORDER BY reading_time, id LIMIT ?
+"""
+SQLITE_READING_PAGE_AFTER_SQL = """
+    SELECT id, reading_time, temperature, humidity, hold_seconds FROM readings
+    WHERE device_id = ? AND reading_time >= ? AND (reading_time > ? OR id > ?) AND reading_time < ? ORDER BY reading_time, id LIMIT ?
+"""
+SQLITE_HOURLY_AVERAGES_SQL = f"""
+    SELECT {SQLITE_BUCKET} AS bucket, AVG(temperature) AS temperature, AVG(humidity) AS humidity, COUNT(temperature) AS readings
+    FROM readings
+    WHERE device_id = ? AND reading_time >= ? AND reading_time < ?
+    GROUP BY bucket ORDER BY bucket
+"""
+SQLITE_OVERVIEW_LATEST_SQL = """
+    SELECT d.id, d.device_unique_id, d.device_name, d.min_temp_threshold, d.max_temp_threshold, r.reading_time, r.temperature, r.humidity
+    FROM devices d
+    LEFT JOIN readings r ON r.id = (SELECT id FROM readings WHERE device_id = d.id ORDER BY reading_time DESC, id DESC LIMIT 1)
+    WHERE d.user_id = ? ORDER BY d.created_at ASC, d.id ASC
+"""
+SQLITE_OVERVIEW_BUCKETS_SQL = f"""
+    SELECT r.device_id AS device_db_id, {SQLITE_BUCKET.replace('reading_time', 'r.reading_time')} AS bucket,
+           AVG(r.temperature) AS temperature, AVG(r.humidity) AS humidity
+    FROM readings r JOIN devices d ON d.id = r.device_id
+    WHERE d.user_id = ? AND r.reading_time >= ?
+    GROUP BY r.device_id, bucket
+"""
+
+class SQLiteTimedConnection(sqlite3.Connection):
+    """sqlite3 connection whose execute()/executemany() are timed (Storage.observe_statement). Set .storage after connecting."""
+    storage = None
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter(); cursor = super().execute(sql, params) # Runs to the first row: nearly all of an aggregate query
+        if self.storage: self.storage.observe_statement(sql, params, started, cursor.rowcount if cursor.rowcount >= 0 else None, self.explain)
+        return cursor
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params); started = time.perf_counter(); cursor = super().executemany(sql, seq_params)
+        if self.storage: self.storage.observe_statement(sql, seq_params[0] if seq_params else None, started, cursor.rowcount, self.explain)
+        return cursor
+
+    def explain(self, sql, params):
+        try: return [dict(row) for row in super().execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        except sqlite3.Error as e: return {'error': str(e)}
+
+def sqlite_time(value):
+    """datetime -> stored TEXT (microseconds dropped); datetime.time -> 'HH:MM:SS'; None stays None."""
+    if value is None: return None
+    if isinstance(value, datetime): return value.strftime(SQLITE_TIME_FORMAT)
+    return value.strftime('%H:%M:%S')
+
+def parse_sqlite_time(value):
+    return datetime.strptime(value, SQLITE_TIME_FORMAT) if value is not None else None
+
+class SQLiteStorage(Storage):
+    """Single-file backend in WAL mode. One connection per thread, opened on first use (so after gunicorn forks)."""
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as conn: conn.executescript(SQLITE_SCHEMA)
+
+    def describe(self):
+        return f"sqlite {self.path}"
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            started = time.perf_counter()
+            conn = sqlite3.connect(self.path, timeout=5, factory=SQLiteTimedConnection)
+            conn.row_factory = sqlite3.Row; conn.storage = self
+            for pragma in SQLITE_PRAGMAS: conn.execute(pragma)
+            self.local.conn = conn
+            self.observe_connect(started)
+        return conn
+
+    @contextmanager
+    def connection(self, integrity_error=StorageError):
+        """This thread's connection inside a transaction; sqlite3 errors become StorageError (IntegrityError -> integrity_error)."""
+        try:
+            conn = self.connect()
+            with conn: # Commits, or rolls back on an exception
+                yield conn
+        except sqlite3.IntegrityError as e: raise integrity_error(str(e)) from e
+        except sqlite3.OperationalError as e: raise (StorageUnavailable if 'unable to open' in str(e) else StorageError)(str(e)) from e
+        except sqlite3.Error as e: raise StorageError(str(e)) from e
+
+    def query(self, sql, params=()):
+        with self.connection() as conn: return conn.execute(sql, params).fetchall()
+
+    # Users
+    def get_user_by_email(self, email):
+        rows = self.query("SELECT id, name, email, password, security_question, security_answer FROM users WHERE email = ?", (email,))
+        return dict(rows[0]) if rows else None
+
+    def create_user(self, name, email, password_hash, security_question, security_answer_hash):
+        with self.connection(integrity_error=DuplicateEntry) as conn:
+            return conn.execute("INSERT INTO users (name, email, password, security_question, security_answer) VALUES (?, ?, ?, ?, ?)", (name, email, password_hash, security_question, security_answer_hash)).lastrowid
+
+    def update_user_hashes(self, user_id, password=None, security_answer=None):
+        with self.connection() as conn:
+            conn.execute("UPDATE users SET password = COALESCE(?, password), security_answer = COALESCE(?, security_answer) WHERE id = ?", (password, security_answer, user_id))
+
+    def reset_password(self, email, password_hash):
+        with self.connection() as conn:
+            return conn.execute("UPDATE users SET password = ? WHERE email = ?", (password_hash, email)).rowcount > 0
+
+    # Devices
+    def list_user_devices(self, user_id):
+        return [device_row(row) for row in self.query(f"SELECT {SQLITE_DEVICE_COLUMNS} FROM devices WHERE user_id = ? ORDER BY created_at ASC, id ASC", (user_id,))]
+
+    def get_user_device(self, user_id, device_db_id):
+        rows = self.query(f"SELECT {SQLITE_DEVICE_COLUMNS} FROM devices WHERE id = ? AND user_id = ?", (device_db_id, user_id))
+        return device_row(rows[0]) if rows else None
+
+    def find_device(self, device_unique_id):
+        rows = self.query(f"SELECT {SQLITE_DEVICE_COLUMNS}, user_id FROM devices WHERE device_unique_id = ?", (device_unique_id,))
+        return device_row(rows[0], ('user_id',)) if rows else None
+
+    def get_devices_by_uid(self, device_uids):
+        return [device_row(row) for row in self.query(f"SELECT {SQLITE_DEVICE_COLUMNS} FROM devices WHERE device_unique_id IN ({', '.join(['?'] * len(device_uids))})", tuple(device_uids))]
+
+    def create_device(self, user_id, device_unique_id, device_name):
+        with self.connection(integrity_error=DuplicateEntry) as conn:
+            device_db_id = conn.execute("INSERT INTO devices (user_id, device_unique_id, device_name) VALUES (?, ?, ?)", (user_id, device_unique_id, device_name)).lastrowid
+            return device_row(conn.execute(f"SELECT {SQLITE_DEVICE_COLUMNS} FROM devices WHERE id = ?", (device_db_id,)).fetchone())
+
+    def update_device(self, user_id, device_db_id, changes):
+        values = [sqlite_time(value) if key.endswith('_time') else value for key, value in changes.items()]
+        with self.connection() as conn:
+            # SQLite counts matched rows, so 0 means no such device
+            return conn.execute(f"UPDATE devices SET {', '.join(f'{key} = ?' for key in changes)} WHERE id = ? AND user_id = ?", values + [device_db_id, user_id]).rowcount > 0
+
+    def delete_device(self, user_id, device_db_id):
+        with self.connection(integrity_error=StillReferenced) as conn:
+            return conn.execute("DELETE FROM devices WHERE id = ? AND user_id = ?", (device_db_id, user_id)).rowcount > 0
+
+    # Readings
+    def resolve_device_keys(self, device_uids):
+        rows = self.query(f"SELECT device_unique_id, id FROM devices WHERE device_unique_id IN ({', '.join(['?'] * len(device_uids))})", tuple(device_uids))
+        return {row[0]: row[1] for row in rows}
+
+    def add_readings(self, readings):
+        with self.connection(integrity_error=UnknownDevice) as conn:
+            conn.executemany("INSERT INTO readings (device_id, reading_time, temperature, humidity, hold_seconds) VALUES (?, ?, ?, ?, ?)",
+                             [(device_db_id, sqlite_time(reading_time), round(temp, 1), round(humid, 1), hold_seconds) for device_db_id, _, reading_time, temp, humid, hold_seconds in readings])
+
+    def latest_reading(self, device):
+        rows = self.query("SELECT reading_time, temperature, humidity FROM readings WHERE device_id = ? ORDER BY reading_time DESC, id DESC LIMIT 1", (device['id'],))
+        return {'reading_time': parse_sqlite_time(rows[0][0]), 'temperature': rows[0][1], 'humidity': rows[0][2]} if rows else None
+
+    def reading_buckets(self, device, since, until, anchor, interval_minutes):
+        rows = self.query(SQLITE_CHART_BUCKETS_SQL, (sqlite_time(anchor), interval_minutes * 60, device['id'], sqlite_time(since), sqlite_time(until)))
+        return [reading_bucket(row['bucket'], row['temperature'], row['humidity'], parse_sqlite_time(row['last_time']), row['last_temperature'], row['last_humidity'], row['last_hold_seconds']) for row in rows]
+
+    def reading_page(self, device, since, after_id, until, limit):
+        if after_id is None: rows = self.query(SQLITE_READING_PAGE_SQL, (device['id'], sqlite_time(since), sqlite_time(until), limit))
+        else: rows = self.query(SQLITE_READING_PAGE_AFTER_SQL, (device['id'], sqlite_time(since), sqlite_time(since), after_id, sqlite_time(until), limit))
+        rows = [dict(row) for row in rows]
+        for row in rows: row['reading_time'] = parse_sqlite_time(row['reading_time'])
+        return rows
+
+    def hourly_averages(self, device, since, until):
+        return [dict(row) for row in self.query(SQLITE_HOURLY_AVERAGES_SQL, (sqlite_time(since), 3600, device['id'], sqlite_time(since), sqlite_time(until)))]
+
+    def overview_latest(self, user_id):
+        rows = [dict(row) for row in self.query(SQLITE_OVERVIEW_LATEST_SQL, (user_id,))]
+        for row in rows: row['reading_time'] = parse_sqlite_time(row['reading_time'])
+        return rows
+
+    def overview_buckets(self, user_id, since, step_minutes):
+        return [dict(row) for row in self.query(SQLITE_OVERVIEW_BUCKETS_SQL, (sqlite_time(since), step_minutes * 60, user_id, sqlite_time(since)))]
+
+
+# --- In-memory ---
+class MemoryStorage(Storage):
+    """
+    Everything in dicts, guarded by one lock; readings per device in a list sorted by time, so ranges are
+    bisected instead of scanned. Each process has its own copy: run a single worker (or the dev server).
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}                   # id -> user dict
+        self.devices = {}                 # id -> device dict (DEVICE_FIELDS + user_id), in link order
+        self.readings = defaultdict(list) # devices.id -> [(reading_time, seq, temperature, humidity, hold_seconds)], sorted
+        self.ids = itertools.count(1)     # Shared id sequence for users and devices
+        self.seq = itertools.count()      # Keeps readings with the same time in arrival order
+
+    def describe(self):
+        return "memory (per process, not persisted)"
+
+    # Users
+    def get_user_by_email(self, email):
+        with self.lock:
+            return next((dict(user) for user in self.users.values() if user['email'] == email), None)
+
+    def create_user(self, name, email, password_hash, security_question, security_answer_hash):
+        with self.lock:
+            if any(user['email'] == email for user in self.users.values()): raise DuplicateEntry(f"Duplicate email {email}")
+            user_id = next(self.ids)
+            self.users[user_id] = {'id': user_id, 'name': name, 'email': email, 'password': password_hash, 'security_question': security_question, 'security_answer': security_answer_hash}
+            return user_id
+
+    def update_user_hashes(self, user_id, password=None, security_answer=None):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user and password is not None: user['password'] = password
+            if user and security_answer is not None: user['security_answer'] = security_answer
+
+    def reset_password(self, email, password_hash):
+        with self.lock:
+            user = next((user for user in self.users.values() if user['email'] == email), None)
+            if user: user['password'] = password_hash
+            return user is not None
+
+    # Devices
+    def list_user_devices(self, user_id):
+        with self.lock:
+            return [device_row(device) for device in self.devices.values() if device['user_id'] == user_id]
+
+    def get_user_device(self, user_id, device_db_id):
+        with self.lock:
+            device = self.devices.get(device_db_id)
+            return device_row(device) if device and device['user_id'] == user_id else None
+
+    def find_device(self, device_unique_id):
+        with self.lock:
+            return next((device_row(device, ('user_id',)) for device in self.devices.values() if device['device_unique_id'] == device_unique_id), None)
+
+    def get_devices_by_uid(self, device_uids):
+        wanted = set(device_uids)
+        with self.lock:
+            return [device_row(device) for device in self.devices.values() if device['device_unique_id'] in wanted]
+
+    def create_device(self, user_id, device_unique_id, device_name):
+        with self.lock:
+            if self.find_device(device_unique_id): raise DuplicateEntry(f"Duplicate device_unique_id {device_unique_id}")
+            device_db_id = next(self.ids)
+            self.devices[device_db_id] = dict({key: None for key in DEVICE_FIELDS}, id=device_db_id, user_id=user_id, device_unique_id=device_unique_id, device_name=device_name)
+            return device_row(self.devices[device_db_id])
+
+    def update_device(self, user_id, device_db_id, changes):
+        with self.lock:
+            device = self.devices.get(device_db_id)
+            if not device or device['user_id'] != user_id: return False
+            device.update(changes)
+            return True
+
+    def delete_device(self, user_id, device_db_id):
+        with self.lock:
+            device = self.devices.get(device_db_id)
+            if not device or device['user_id'] != user_id: return False
+            if self.readings.get(device_db_id): raise StillReferenced(f"Device {device_db_id} has readings")
+            del self.devices[device_db_id]
+            return True
+
+    # Readings
+    def resolve_device_keys(self, device_uids):
+        wanted = set(device_uids)
+        with self.lock:
+            return {device['device_unique_id']: device_db_id for device_db_id, device in self.devices.items() if device['device_unique_id'] in wanted}
+
+    def add_readings(self, readings):
+        with self.lock:
+            if any(reading[0] not in self.devices for reading in readings): raise UnknownDevice("Reading for a device that no longer exists")
+            for device_db_id, _, reading_time, temp, humid, hold_seconds in readings:
+                series = self.readings[device_db_id]
+                entry = (reading_time.replace(microsecond=0), next(self.seq), round(temp, 1), round(humid, 1), hold_seconds)
+                if not series or entry > series[-1]: series.append(entry) # Usual case: newest reading
+                else: bisect.insort(series, entry)
+
+    def latest_reading(self, device):
+        with self.lock:
+            series = self.readings.get(device['id'])
+            if not series: return None
+            reading_time, _, temp, humid, _ = series[-1]
+        return {'reading_time': reading_time, 'temperature': temp, 'humidity': humid}
+
+    def series_range(self, device_db_id, since, until=None):
+        """Readings of one device with since <= reading_time < until (copied under the lock)."""
+        with self.lock:
+            series = self.readings.get(device_db_id, [])
+            start = bisect.bisect_left(series, (since,))
+            end = bisect.bisect_left(series, (until,)) if until is not None else len(series)
+            return series[start:end]
+
+    def reading_buckets(self, device, since, until, anchor, interval_minutes):
+        buckets = [] # [bucket, sum_temp, sum_humid, count, last_time, last_temp, last_humid, last_hold]
+        for reading_time, _, temp, humid, hold_seconds in self.series_range(device['id'], since, until):
+            if temp is None or humid is None: continue
+            bucket = int((reading_time - anchor).total_seconds() // 60) // interval_minutes
+            if buckets and buckets[-1][0] == bucket:
+                entry = buckets[-1]; entry[1] += temp; entry[2] += humid; entry[3] += 1; entry[4:] = [reading_time, temp, humid, hold_seconds]
+            else:
+                buckets.append([bucket, temp, humid, 1, reading_time, temp, humid, hold_seconds])
+        return [reading_bucket(bucket, sum_temp / count, sum_humid / count, *last) for bucket, sum_temp, sum_humid, count, *last in buckets]
+
+    def reading_page(self, device, since, after_id, until, limit):
+        """The arrival sequence number stands in for readings.id."""
+        with self.lock:
+            series = self.readings.get(device['id'], [])
+            start = bisect.bisect_left(series, (since,) if after_id is None else (since, after_id + 1))
+            end = min(bisect.bisect_left(series, (until,)), start + limit)
+            page = series[start:end] if end > start else []
+        return [dict(zip(('reading_time', 'id', 'temperature', 'humidity', 'hold_seconds'), entry)) for entry in page]
+
+    def hourly_averages(self, device, since, until):
+        hours = {} # bucket -> [sum_temp, count_temp, sum_humid, count_humid]; the series is in time order, so buckets come in order
+        for reading_time, _, temp, humid, _ in self.series_range(device['id'], since, until):
+            entry = hours.setdefault(int((reading_time - since).total_seconds() // 3600), [0.0, 0, 0.0, 0])
+            if temp is not None: entry[0] += temp; entry[1] += 1
+            if humid is not None: entry[2] += humid; entry[3] += 1
+        return [{'bucket': bucket, 'temperature': t_sum / t_count if t_count else None, 'humidity': h_sum / h_count if h_count else None, 'readings': t_count}
+                for bucket, (t_sum, t_count, h_sum, h_count) in hours.items()]
+
+    def overview_latest(self, user_id):
+        rows = []
+        for device in self.list_user_devices(user_id):
+            row = {key: device[key] for key in ('id', 'device_unique_id', 'device_name', 'min_temp_threshold', 'max_temp_threshold')}
+            row.update(self.latest_reading(device) or {'reading_time': None, 'temperature': None, 'humidity': None})
+            rows.append(row)
+        return rows
+
+    def overview_buckets(self, user_id, since, step_minutes):
+        rows = []
+        for device in self.list_user_devices(user_id):
+            sums = {}
+            for reading_time, _, temp, humid, _ in self.series_range(device['id'], since):
+                entry = sums.setdefault(int((reading_time - since).total_seconds() // 60) // step_minutes, [0.0, 0, 0.0, 0])
+                if temp is not None: entry[0] += temp; entry[1] += 1
+                if humid is not None: entry[2] += humid; entry[3] += 1
+            rows.extend({'device_db_id': device['id'], 'bucket': bucket, 'temperature': t_sum / t_count if t_count else None, 'humidity': h_sum / h_count if h_count else None}
+                        for bucket, (t_sum, t_count, h_sum, h_count) in sums.items())
+        return rows
+
+
+# --- Backend selection ---
+# Statement names for timing and slow-query captures: the constants' names (chart_buckets, sqlite_chart_buckets, ...)
+terrarium_slow_queries.register({name[:-4].lower(): sql for name, sql in list(globals().items()) if name.endswith('_SQL') and isinstance(sql, str)})
+
+def open_storage(backend, mariadb=None, sqlite_path=None):
+    """Creates the configured backend: 'mariadb' (mariadb = connection settings dict), 'sqlite' (sqlite_path) or 'memory'."""
+    if backend == 'mariadb': return MariaDBStorage(**mariadb)
+    if backend == 'sqlite': return SQLiteStorage(sqlite_path)
+    if backend == 'memory': return MemoryStorage()
+    raise ValueError(f"Unknown storage backend '{backend}' (expected one of {', '.join(BACKENDS)}).")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# test_chart_layout.py - chart_layout.py: gaps and held values in the chart series, and the compact
+#                        /api/chartdata format decoding to the same chart as the default one.
+#   python3 -m pytest -q test_chart_layout.py
+
+from datetime import datetime, timedelta
+import pytest
+from chart_layout import chart_anchor, chart_series, chart_payload, CHART_WALL_EPOCH
+
+START = datetime(2026, 3, 1)
+END = START + timedelta(hours=3)
+ANCHOR = chart_anchor(START) # Midnight the day before: the lookback crosses into it
+
+
+def bucket(minutes, temperature, humidity, hold_seconds=None, last_minutes=None, interval_minutes=10):
+    """A reading_buckets() row for the interval 'minutes' after START; its newest reading is at 'last_minutes'."""
+    last_time = START + timedelta(minutes=minutes if last_minutes is None else last_minutes)
+    return {'bucket': (START + timedelta(minutes=minutes) - ANCHOR) // timedelta(minutes=interval_minutes),
+            'temperature': temperature, 'humidity': humidity, 'readings': 1, 'last_time': last_time,
+            'last_temperature': round(temperature, 1), 'last_humidity': round(humidity, 1), 'last_hold_seconds': hold_seconds}
+
+
+def sample_buckets():
+    return [bucket(0, 24.123, 60.0),
+            # 00:10-00:29 missing: outage
+            bucket(30, 25.0, 61.0, hold_seconds=1500, last_minutes=35), # Holds until 01:00 (exclusive)
+            # 00:40-00:59 missing but held; 01:00-01:19 missing: outage
+            *(bucket(minutes, 26.0 + minutes / 100, 62.0) for minutes in range(80, 160, 10))]
+            # 02:40-02:59 missing: outage up to the end
+
+
+def test_gaps_are_index_pairs_and_held_values_fill_quiet_intervals():
+    first_dt, temps, humids, gaps = chart_series(sample_buckets(), ANCHOR, START, END, 10)
+    assert first_dt == START and len(temps) == len(humids) == 18
+    assert temps[0] == 24.12 # Averages rounded to 2 decimals
+    assert temps[1:3] == [None, None]
+    assert temps[3:6] == [25.0, 25.0, 25.0] and humids[4:6] == [61.0, 61.0] # Carried forward from the 00:35 reading
+    assert temps[6:8] == [None, None] # 00:35 + 1500 s = 01:00: the hold has expired
+    assert gaps == [[1, 2], [6, 7], [16, 17]]
+
+
+def test_reading_before_the_range_holds_into_it():
+    before = bucket(-10, 22.0, 55.0, hold_seconds=1800, last_minutes=-5) # 23:55, holds until 00:25
+    _, temps, _, gaps = chart_series([before, bucket(40, 23.0, 56.0)], ANCHOR, START, START + timedelta(hours=1), 10)
+    assert temps == [22.0, 22.0, 22.0, None, 23.0, None]
+    assert gaps == [[3, 3], [5, 5]]
+
+
+def test_range_start_is_floored_to_its_interval():
+    first_dt, temps, _, gaps = chart_series([], ANCHOR, START + timedelta(minutes=37), START + timedelta(hours=1), 10)
+    assert first_dt == START + timedelta(minutes=30)
+    assert temps == [None] * 3 and gaps == [[0, 2]]
+
+
+def decode_compact(data):
+    """What index.html's decodeChartData() makes of a compact response."""
+    labels = [(CHART_WALL_EPOCH + timedelta(seconds=data['start'] + i * data['step'])).strftime('%Y-%m-%d %H:%M') for i in range(data['count'])]
+    unscale = lambda values: [None if v is None else v / data['scale'] for v in values]
+    return {'labels': labels, 'temperatures': unscale(data['temperatures']), 'humidities': unscale(data['humidities']),
+            'gaps': [{'start': labels[first], 'end': labels[last]} for first, last in data['gaps']]}
+
+
+@pytest.mark.parametrize('interval_minutes', [10, 60, 1440])
+def test_compact_format_decodes_to_the_default_format(interval_minutes):
+    buckets = [bucket(minutes, 20 + minutes / 7, 50 + minutes / 13, hold_seconds=900 if minutes % 3 else None, interval_minutes=interval_minutes)
+               for minutes in range(0, 3 * 1440, interval_minutes) if (minutes // interval_minutes) % 5 != 2]
+    end = START + timedelta(days=3)
+    default = chart_payload(buckets, ANCHOR, START, end, interval_minutes)
+    compact = chart_payload(buckets, ANCHOR, START, end, interval_minutes, compact=True)
+    assert compact['format'] == 'compact' and all(isinstance(v, int) for v in compact['temperatures'] if v is not None)
+    decoded = decode_compact(compact)
+    assert decoded['labels'] == default['labels']
+    assert decoded['gaps'] == default['gaps']
+    for key in ('temperatures', 'humidities'):
+        assert [v is None for v in decoded[key]] == [v is None for v in default[key]]
+        assert [v for v in decoded[key] if v is not None] == pytest.approx([v for v in default[key] if v is not None], abs=0.005)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# test_policy_replay.py - policy_replay.py: gaps, report-by-exception holds and the control cadence between readings.
+#   python3 -m pytest -q test_policy_replay.py
+# Skipped where mysql.connector (imported by policy_replay.py for its database access) is missing.
+
+from datetime import datetime, timedelta
+import pytest
+
+pytest.importorskip('mysql.connector')
+
+import policy_replay
+
+START = datetime(2026, 3, 1, 12, 0)
+SETTINGS = {'dev': {'min_temp': 24.0, 'max_temp': 28.0, 'off_start': None, 'off_end': None}}
+
+
+def rows(temperature, every_seconds, count, hold_seconds=None):
+    return [('dev', START + timedelta(seconds=i * every_seconds), temperature, hold_seconds) for i in range(count)]
+
+
+def test_held_readings_are_covered_and_unheld_silence_is_a_gap():
+    held = policy_replay.replay_readings(rows(26.0, 660, 11, hold_seconds=660), SETTINGS)['dev']
+    assert held['covered_hours'] == round(6600 / 3600, 1) and held['gap_hours'] == 0
+    unheld = policy_replay.replay_readings(rows(26.0, 660, 11), SETTINGS)['dev']
+    assert unheld['covered_hours'] == 0 and unheld['gap_hours'] == round(6600 / 3600, 1)
+    assert unheld['duty_cycle_pct'] is None
+
+
+def test_max_on_limit_is_applied_between_held_readings():
+    # Always below min: on 0-960 s (limit after > 900 s at the next 60 s step), cooldown 600 s, on again ... up to 6600 s
+    summary = policy_replay.replay_readings(rows(20.0, 660, 11, hold_seconds=660), SETTINGS)['dev']
+    assert summary['limit_trips'] == 4 and summary['relay_cycles'] == 5
+    assert summary['duty_cycle_pct'] == round(100 * (4 * 960 + 360) / 6600, 1)
+    assert summary['below_band_hours'] == round(6600 / 3600, 1) and summary['out_of_band_pct'] == 100.0
+    assert summary['readings'] == 11 and sum(summary['decisions'].values()) == 6600 // 60 + 1
+
+
+def test_readings_at_the_control_cadence_add_no_steps():
+    summary = policy_replay.replay_readings(rows(20.0, 60, 31), SETTINGS)['dev']
+    assert sum(summary['decisions'].values()) == summary['readings'] == 31
+    assert summary['limit_trips'] == 1 and summary['covered_hours'] == 0.5
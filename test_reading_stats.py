@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# test_reading_stats.py - reading_stats.py: sketch percentiles against exact ones, and time in range
+#                         including gaps and report-by-exception holds.
+#   python3 -m pytest -q test_reading_stats.py
+
+import math
+import random
+from datetime import datetime, timedelta
+import pytest
+from reading_stats import ValueSketch, reading_statistics
+
+START = datetime(2026, 3, 1)
+
+
+def nearest_rank(values, p):
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(p / 100 * len(ordered))) - 1]
+
+
+def test_percentiles_of_sensor_values_are_exact():
+    rng = random.Random(7)
+    readings = [(START + timedelta(minutes=i), round(rng.gauss(26, 3), 1), round(rng.uniform(40, 90), 1), None) for i in range(5000)]
+    percentiles = (1, 5, 25, 50, 75, 95, 99.5)
+    period = reading_statistics(readings, 22, 30, percentiles)['period']
+    for metric, column in (('temperature', 1), ('humidity', 2)):
+        values = [reading[column] for reading in readings]
+        summary = period[metric]
+        assert summary['count'] == len(values) and summary['min'] == min(values) and summary['max'] == max(values)
+        assert summary['mean'] == round(sum(values) / len(values), 2)
+        for p in percentiles: assert summary[f"p{p:g}"] == pytest.approx(nearest_rank(values, p)), (metric, p)
+
+
+def test_percentiles_are_within_half_a_bin():
+    rng = random.Random(8); values = [rng.uniform(15, 35) for _ in range(2000)]
+    sketch = ValueSketch(0.1)
+    for value in values: sketch.add(value)
+    qs = [0.0, 0.1, 0.5, 0.9, 1.0]
+    for q, estimate in zip(qs, sketch.quantiles(qs)):
+        assert abs(estimate - nearest_rank(values, q * 100)) <= 0.05 + 1e-9, q
+
+
+def test_merged_sketches_match_one_sketch():
+    rng = random.Random(9); values = [round(rng.uniform(15, 35), 1) for _ in range(1000)]
+    whole = ValueSketch(); first = ValueSketch(); second = ValueSketch()
+    for i, value in enumerate(values): whole.add(value); (first if i % 2 else second).add(value)
+    first.merge(second)
+    assert first.count == whole.count and first.quantiles([0.05, 0.5, 0.95]) == whole.quantiles([0.05, 0.5, 0.95])
+    assert ValueSketch().quantiles([0.5]) == [None]
+
+
+def at(minutes, temperature, hold_seconds=None):
+    return (START + timedelta(minutes=minutes), temperature, 60.0, hold_seconds)
+
+
+def test_time_in_range_and_gaps():
+    readings = [at(0, 25.0), at(5, 25.0), at(10, 20.0), at(15, 31.0), at(20, 25.0), # 10 min within, 5 below, 5 above
+                at(60, 25.0), # 40 min without a reading: gap
+                at(65, 20.0, hold_seconds=3600), at(125, 25.0), # Held below for an hour: no gap
+                at(130, 25.0)]
+    in_range = reading_statistics(readings, 22, 30)['period']['time_in_range']
+    # within: 0-10, 20-60 is a gap, 60-65, 125-130 = 20 min; below: 10-15, 65-125 = 65 min; above: 15-20 = 5 min
+    assert in_range == {'within_pct': round(100 * 20 / 90, 1), 'below_pct': round(100 * 65 / 90, 1), 'above_pct': round(100 * 5 / 90, 1),
+                        'covered_hours': 1.5, 'gap_hours': round(40 / 60, 2)}
+
+
+def test_hold_only_extends_the_allowed_gap_of_its_own_reading():
+    readings = [at(0, 25.0, hold_seconds=600), at(10, 25.0), at(20, 25.0), at(21, 25.0)] # 10 min held, then 10 min unheld
+    in_range = reading_statistics(readings, 22, 30, max_gap_seconds=300)['period']['time_in_range']
+    assert in_range['covered_hours'] == round(11 / 60, 2) and in_range['gap_hours'] == round(10 / 60, 2)
+    assert in_range['within_pct'] == 100.0
+
+
+def test_unset_thresholds_count_as_within():
+    in_range = reading_statistics([at(0, 10.0), at(5, 40.0), at(10, 40.0)], None, None)['period']['time_in_range']
+    assert in_range['within_pct'] == 100.0 and in_range['below_pct'] == 0.0
+
+
+def test_days_add_up_to_the_period():
+    readings = [at(minutes, 20.0 + (minutes % 97) / 10) for minutes in range(0, 3 * 1440, 5)]
+    result = reading_statistics(readings, 22, 28)
+    assert [day['date'] for day in result['days']] == ['2026-03-01', '2026-03-02', '2026-03-03']
+    assert sum(day['temperature']['count'] for day in result['days']) == result['period']['temperature']['count'] == len(readings)
+    assert sum(day['time_in_range']['covered_hours'] for day in result['days']) == pytest.approx(result['period']['time_in_range']['covered_hours'], abs=0.02)
+    assert reading_statistics([], 22, 28) == {'period': reading_statistics([], 22, 28)['period'], 'days': []}
+    assert reading_statistics([], 22, 28)['period']['time_in_range']['within_pct'] is None
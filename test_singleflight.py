@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# test_singleflight.py - terrarium_singleflight.py: overlapping identical calls share one computation,
+#                        in threads, on the event loop and across workers; errors reach every waiter.
+#   python3 -m pytest -q test_singleflight.py
+
+import asyncio
+import fcntl
+import os
+import threading
+import time
+import pytest
+import terrarium_singleflight as sf
+
+
+@pytest.fixture
+def outcomes(tmp_path, monkeypatch):
+    """Lock/result files under tmp_path; returns the (name, outcome) list outcome_observer fills."""
+    seen = []
+    monkeypatch.setattr(sf, 'SINGLEFLIGHT_DIR', str(tmp_path))
+    monkeypatch.setattr(sf, 'outcome_observer', lambda name, outcome: seen.append((name, outcome)))
+    return seen
+
+
+def run_threads(count, target):
+    results = [None] * count; errors = [None] * count
+    def call(i):
+        try: results[i] = target()
+        except Exception as e: errors[i] = e
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join(5)
+    return results, errors
+
+
+def slow(release, calls, value):
+    def compute():
+        calls.append(1); release.wait(5)
+        if isinstance(value, Exception): raise value
+        return value
+    return compute
+
+
+def test_threads_share_one_computation(outcomes):
+    release = threading.Event(); calls = []
+    threading.Timer(0.2, release.set).start()
+    results, errors = run_threads(5, lambda: sf.run('chart', ('chart', 1, '24h'), slow(release, calls, {'labels': [1, 2]})))
+    assert calls == [1]
+    assert results == [{'labels': [1, 2]}] * 5 and errors == [None] * 5
+    assert sorted(outcomes) == [('chart', 'computed')] + [('chart', 'merged_process')] * 4
+    assert sf._flights == {}
+
+
+def test_error_reaches_every_waiter(outcomes):
+    release = threading.Event(); calls = []
+    threading.Timer(0.2, release.set).start()
+    results, errors = run_threads(4, lambda: sf.run('stats', ('stats', 1), slow(release, calls, ValueError('query failed'))))
+    assert calls == [1]
+    assert all(isinstance(e, ValueError) and str(e) == 'query failed' for e in errors)
+    assert outcomes == [('stats', 'merged_process')] * 3 # The computing call raised before reporting
+    assert sf.run('stats', ('stats', 1), lambda: 'recovered') == 'recovered' # Nothing of the failure is kept
+
+
+def test_different_keys_do_not_merge(outcomes):
+    release = threading.Event(); calls = []
+    threading.Timer(0.2, release.set).start()
+    keys = iter([('chart', 1), ('chart', 2)]); key_lock = threading.Lock()
+    def call():
+        with key_lock: key = next(keys)
+        return sf.run('chart', key, slow(release, calls, key[1]))
+    results, _ = run_threads(2, call)
+    assert calls == [1, 1] and sorted(results) == [1, 2]
+
+
+def hold_worker_lock(key):
+    """Takes the key's lock through a separate open file, as another gunicorn worker would."""
+    lock_path, result_path = sf._paths(key)
+    os.makedirs(sf.SINGLEFLIGHT_DIR, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600); fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd, result_path
+
+
+def test_result_of_another_worker_is_taken(outcomes):
+    key = ('heatmap', 3); fd, result_path = hold_worker_lock(key)
+    results = [None]
+    thread = threading.Thread(target=lambda: results.__setitem__(0, sf.run('heatmap', key, lambda: 'own')))
+    thread.start(); time.sleep(0.1)
+    sf._publish(result_path, 'from other worker'); os.close(fd)
+    thread.join(5)
+    assert results == ['from other worker'] and outcomes == [('heatmap', 'merged_worker')]
+
+
+def test_result_finished_before_arrival_is_not_taken(outcomes):
+    key = ('heatmap', 4); fd, result_path = hold_worker_lock(key)
+    sf._publish(result_path, 'stale'); time.sleep(0.02) # Finished before the call arrived
+    results = [None]
+    thread = threading.Thread(target=lambda: results.__setitem__(0, sf.run('heatmap', key, lambda: 'own')))
+    thread.start(); time.sleep(0.1); os.close(fd)
+    thread.join(5)
+    assert results == ['own'] and outcomes == [('heatmap', 'computed')]
+
+
+def test_waiting_for_another_worker_is_bounded(outcomes, monkeypatch):
+    monkeypatch.setattr(sf, 'SINGLEFLIGHT_WAIT_SEC', 0.1)
+    fd, _ = hold_worker_lock(('chart', 5))
+    try: assert sf.run('chart', ('chart', 5), lambda: 'own') == 'own'
+    finally: os.close(fd)
+    assert outcomes == [('chart', 'wait_timeout')]
+
+
+def test_async_calls_share_one_computation(outcomes):
+    calls = []
+    async def compute():
+        calls.append(1); await asyncio.sleep(0.1); return [1, 2, 3]
+    async def main():
+        return await asyncio.gather(*(sf.run_async('chart', ('chart', 6), compute) for _ in range(5)))
+    assert asyncio.run(main()) == [[1, 2, 3]] * 5
+    assert calls == [1]
+    assert sorted(outcomes) == [('chart', 'computed')] + [('chart', 'merged_process')] * 4
+    assert sf._async_flights == {}
+
+
+def test_async_error_reaches_every_waiter(outcomes):
+    calls = []
+    async def compute():
+        calls.append(1); await asyncio.sleep(0.1); raise ValueError('query failed')
+    async def main():
+        return await asyncio.gather(*(sf.run_async('stats', ('stats', 7), compute) for _ in range(3)), return_exceptions=True)
+    errors = asyncio.run(main())
+    assert calls == [1] and all(isinstance(e, ValueError) for e in errors)
+    assert sf._async_flights == {}
+
+
+def test_async_result_of_another_worker_is_taken(outcomes):
+    key = ('chart', 8); fd, result_path = hold_worker_lock(key)
+    async def compute(): return 'own'
+    async def main():
+        task = asyncio.ensure_future(sf.run_async('chart', key, compute))
+        await asyncio.sleep(0.1); sf._publish(result_path, 'from other worker'); os.close(fd)
+        return await task
+    assert asyncio.run(main()) == 'from other worker'
+    assert outcomes == [('chart', 'merged_worker')]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# test_storage.py - The in-memory and SQLite backends of terrarium_storage.py must answer alike (MariaDB
+#                   is what they stand in for). Both are loaded with the same readings and compared.
+#   python3 -m pytest -q test_storage.py
+
+import random
+from datetime import datetime, timedelta
+import pytest
+import terrarium_storage
+
+START = datetime(2026, 3, 1)
+TIE_AT_END = START + timedelta(days=1, hours=23, minutes=59, seconds=30)
+
+
+def reading_set(seed=42):
+    """
+    (device_uid, reading_time, temperature, humidity, hold_seconds) for two devices over three days: a reading
+    every 7 minutes with a 5-hour outage, some report-by-exception readings, and runs of readings that share a timestamp.
+    Readings sharing a timestamp are ordered by arrival: the last one counts as the newest.
+    """
+    rng = random.Random(seed); readings = []
+    for uid in ('dev-a', 'dev-b'):
+        t = START
+        while t < START + timedelta(days=3):
+            if not START + timedelta(hours=30) <= t < START + timedelta(hours=35): # Outage
+                hold_seconds = rng.choice((None, None, 900))
+                readings.append((uid, t, round(rng.uniform(18, 32), 1), round(rng.uniform(40, 80), 1), hold_seconds))
+            t += timedelta(minutes=7)
+        for minute in (125, 610, 2200): # Same timestamp, several readings (batched gateway uploads)
+            t = START + timedelta(minutes=minute, seconds=30)
+            readings.extend((uid, t, round(rng.uniform(18, 32), 1), round(rng.uniform(40, 80), 1), None) for _ in range(4))
+        # Same timestamp as the newest reading of its interval (any interval up to a day); only the last one holds
+        t = TIE_AT_END
+        readings.extend((uid, t, round(rng.uniform(18, 32), 1), round(rng.uniform(40, 80), 1), hold) for hold in (None, None, 900))
+    return readings
+
+
+def loaded(storage, readings):
+    """Storage with one user, two devices and the readings. Returns (storage, user_id, {uid: device dict})."""
+    user_id = storage.create_user('Tester', 'tester@example.com', 'hash', 'question', 'answer-hash')
+    devices = {uid: storage.create_device(user_id, uid, uid.upper()) for uid in ('dev-a', 'dev-b')}
+    storage.add_readings([(devices[uid]['id'], uid, t, temp, humid, hold) for uid, t, temp, humid, hold in readings])
+    return storage, user_id, devices
+
+
+@pytest.fixture
+def backends(tmp_path):
+    readings = reading_set()
+    return {'memory': loaded(terrarium_storage.MemoryStorage(), readings),
+            'sqlite': loaded(terrarium_storage.SQLiteStorage(str(tmp_path / 'terrarium.sqlite3')), readings)}
+
+
+def assert_same_rows(memory_rows, sqlite_rows):
+    assert len(memory_rows) == len(sqlite_rows)
+    for memory_row, sqlite_row in zip(memory_rows, sqlite_rows):
+        assert memory_row.keys() == sqlite_row.keys()
+        for key in memory_row:
+            if isinstance(memory_row[key], float): assert sqlite_row[key] == pytest.approx(memory_row[key]), key
+            else: assert sqlite_row[key] == memory_row[key], key
+
+
+def all_pages(storage, device, since, until, page_size):
+    """Every reading via reading_page() keyset paging, as the app's iter_device_readings() walks it."""
+    rows = []; after_id = None
+    while True:
+        page = storage.reading_page(device, since, after_id, until, page_size)
+        rows.extend(page)
+        if len(page) < page_size: return rows
+        since, after_id = page[-1]['reading_time'], page[-1]['id']
+
+
+@pytest.mark.parametrize('interval_minutes', [10, 60, 1440])
+def test_reading_buckets_match(backends, interval_minutes):
+    since = START + timedelta(hours=5); until = START + timedelta(days=2, hours=7)
+    anchor = datetime.combine(since.date(), datetime.min.time())
+    results = {}
+    for name, (storage, _, devices) in backends.items():
+        results[name] = storage.reading_buckets(devices['dev-a'], since, until, anchor, interval_minutes)
+    assert_same_rows(results['memory'], results['sqlite'])
+    assert [row['bucket'] for row in results['memory']] == sorted(row['bucket'] for row in results['memory'])
+    tie = next(row for row in results['sqlite'] if row['last_time'] == TIE_AT_END)
+    expected = [reading for reading in reading_set() if reading[0] == 'dev-a' and reading[1] == TIE_AT_END][-1]
+    assert (tie['last_temperature'], tie['last_humidity'], tie['last_hold_seconds']) == expected[2:]
+
+
+@pytest.mark.parametrize('page_size', [1, 3, 4, 7, 1000])
+def test_reading_page_keyset_paging(backends, page_size):
+    """Page sizes that split the runs of equal timestamps must neither skip nor repeat a reading."""
+    since = START + timedelta(minutes=100); until = START + timedelta(hours=36)
+    expected = sorted((t, temp, humid, hold) for uid, t, temp, humid, hold in reading_set() if uid == 'dev-b' and since <= t < until)
+    for name, (storage, _, devices) in backends.items():
+        rows = all_pages(storage, devices['dev-b'], since, until, page_size)
+        assert len({row['id'] for row in rows}) == len(rows), name # No reading twice
+        assert [row['reading_time'] for row in rows] == sorted(row['reading_time'] for row in rows), name
+        assert sorted((row['reading_time'], row['temperature'], row['humidity'], row['hold_seconds']) for row in rows) == expected, name
+        assert set(rows[0]) == set(terrarium_storage.READING_PAGE_FIELDS), name
+
+
+def test_hourly_averages_match(backends):
+    since = START + timedelta(days=1); until = START + timedelta(days=3)
+    results = {name: storage.hourly_averages(devices['dev-a'], since, until) for name, (storage, _, devices) in backends.items()}
+    assert_same_rows(results['memory'], results['sqlite'])
+    hours = {row['bucket'] for row in results['memory']}
+    assert not hours & set(range(6, 11)) # 30-35 h after START: the outage
+    assert max(hours) == 47
+    assert sum(row['readings'] for row in results['memory']) == sum(1 for uid, t, *_ in reading_set() if uid == 'dev-a' and since <= t < until)
+
+
+def test_overview_latest_match(backends):
+    results = {}
+    for name, (storage, user_id, devices) in backends.items():
+        rows = storage.overview_latest(user_id)
+        ids = {device['id']: uid for uid, device in devices.items()}
+        results[name] = [dict(row, id=ids[row['id']]) for row in rows] # Memory and SQLite number devices differently
+    assert_same_rows(results['memory'], results['sqlite'])
+    assert [row['device_unique_id'] for row in results['memory']] == ['dev-a', 'dev-b']
+
+
+def test_overview_buckets_match(backends):
+    since = START + timedelta(days=2)
+    results = {}
+    for name, (storage, user_id, devices) in backends.items():
+        ids = {device['id']: uid for uid, device in devices.items()}
+        rows = [dict(row, device_db_id=ids[row['device_db_id']]) for row in storage.overview_buckets(user_id, since, 30)]
+        results[name] = sorted(rows, key=lambda row: (row['device_db_id'], row['bucket']))
+    assert_same_rows(results['memory'], results['sqlite'])
+    assert len(results['memory']) == 2 * 48
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# test_switch_watcher_dbus.py - switch_watcher.py's systemd D-Bus backend against systemd_dbus_standin.py
+#                               (private dbus-daemon, nothing is really started). Run on the Pi with:
+#   python3 -m pytest -q test_switch_watcher_dbus.py
+# Skipped where the watcher's hardware/DB libraries, jeepney or dbus-daemon are missing.
+
+import shutil
+import subprocess
+import time
+import pytest
+
+pytest.importorskip('board'); pytest.importorskip('digitalio'); pytest.importorskip('mysql.connector'); pytest.importorskip('jeepney')
+if shutil.which('dbus-daemon') is None: pytest.skip("dbus-daemon not installed", allow_module_level=True)
+
+import switch_watcher as sw
+from systemd_dbus_standin import SystemdStandin
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    """A stand-in systemd with the watcher's D-Bus backend connected to it; systemctl must not be run."""
+    standin = SystemdStandin(unit_name=sw.SERVICE_NAME).start()
+    monkeypatch.setenv('DBUS_SYSTEM_BUS_ADDRESS', standin.address)
+    monkeypatch.setattr(sw, 'DBUS_CALL_TIMEOUT_SEC', 1)
+    monkeypatch.setattr(sw, 'shutting_down', False)
+    systemctl_calls = []
+    monkeypatch.setattr(subprocess, 'run', lambda command, **kwargs: systemctl_calls.append(command) or subprocess.CompletedProcess(command, 0, '', ''))
+    standin.systemctl_calls = systemctl_calls
+    assert sw.initialize_dbus_backend()
+    yield standin
+    sw.shutting_down = True
+    sw.dbus_call_conn.close(); sw.dbus_call_conn = None
+    standin.stop()
+    sw.dbus_monitor_thread.join(2)
+    sw.set_service_state(None)
+
+
+def wait_for(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline: time.sleep(0.01)
+    return predicate()
+
+
+def test_start_and_stop_are_confirmed_by_signals(standin):
+    assert wait_for(lambda: 'Subscribe' in standin.calls) # Listener subscribed
+    assert sw.is_service_active() is False
+    assert sw.run_systemctl('start') is True
+    assert standin.state == 'active' and sw.is_service_active() is True
+    assert sw.run_systemctl('stop') is True
+    assert standin.state == 'inactive' and sw.is_service_active() is False
+    assert standin.systemctl_calls == []
+
+
+def test_state_is_polled_while_the_listener_reconnects(standin):
+    assert wait_for(lambda: 'Subscribe' in standin.calls)
+    standin.send_signals = False; sw.set_service_state(None) # As after a listener error: no signals, state unknown
+    assert sw.dbus_control_unit('start') is True # Read over the call connection instead of reporting a failure
+    assert standin.state == 'active'
+    assert standin.systemctl_calls == []
+
+
+def test_unit_that_does_not_reach_the_state_is_reported(standin):
+    assert wait_for(lambda: 'Subscribe' in standin.calls)
+    standin.transition_sec = 5 # Stuck in 'activating' past DBUS_CALL_TIMEOUT_SEC
+    assert sw.dbus_control_unit('start') is False
+
+
+def test_failed_call_falls_back_to_systemctl(standin):
+    sw.dbus_call_conn.close() # Calls over D-Bus now fail
+    assert sw.run_systemctl('start') is True
+    assert standin.systemctl_calls == [['/bin/systemctl', 'start', sw.SERVICE_NAME]]
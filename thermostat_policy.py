@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# --- thermostat_policy.py ---
+# Heater decision logic shared by terrarium_control.py (live) and policy_replay.py (offline).
+# Pure functions only: no GPIO, no clock, no logging. Callers pass in the time and apply the result.
+
+from datetime import datetime, time as time_obj
+
+# --- Safety Limits (defaults used by the device) ---
+MAX_HEATER_ON_DURATION = 15 * 60 # Seconds (15 minutes)
+MIN_HEATER_OFF_COOLDOWN = 10 * 60  # Seconds (10 minutes)
+
+
+def new_heater_state(relay_on=False):
+    """Returns a fresh heater state dict: relay state, when it was turned on, and forced cooldown end."""
+    return {'relay_on': relay_on, 'on_since': None, 'cooldown_until': None}
+
+
+def parse_off_time(value):
+    """Parses 'HH:MM:SS' or 'HH:MM' into a time object. Passes time objects and None through."""
+    if value is None or isinstance(value, time_obj):
+        return value
+    value = str(value).strip()
+    if not value:
+        return None
+    fmt = '%H:%M:%S' if value.count(':') == 2 else '%H:%M'
+    return datetime.strptime(value, fmt).time()
+
+
+def is_in_off_period(now_time, off_start, off_end):
+    """True if time-of-day now_time is inside the scheduled OFF period. Both ends must be set."""
+    if not isinstance(off_start, time_obj) or not isinstance(off_end, time_obj):
+        return False
+    if off_start > off_end:
+        # Overnight period (e.g. 22:00 - 06:00)
+        return now_time >= off_start or now_time < off_end
+    # Same-day period (e.g. 10:00 - 17:00)
+    return off_start <= now_time < off_end
+
+
+def decide_heater(state, temp_c, now_time, now_ts, min_temp, max_temp, off_start=None, off_end=None,
+                  max_on_duration=MAX_HEATER_ON_DURATION, cooldown=MIN_HEATER_OFF_COOLDOWN):
+    """
+    Decides the relay state for one control step.
+
+    state      -- dict from new_heater_state() (or a previous decision)
+    temp_c     -- current temperature, or None if the sensor reading is invalid
+    now_time   -- time of day (for the scheduled OFF period)
+    now_ts     -- seconds on any monotonic clock (for max-on and cooldown timers)
+    min_temp / max_temp -- hysteresis thresholds, None = not set
+    off_start / off_end -- scheduled OFF period as time objects, None = not set
+
+    Returns a new dict with the state keys plus:
+      'status'    -- LCD relay status string, e.g. "Relay: ON (Heat)"
+      'reason'    -- short machine-readable reason: heat, idle, reached_max, safe, cooldown, sched, limit, cfg_err
+      'error_msg' -- LCD error message or None
+    """
+    relay_on = state['relay_on']
+    on_since = state['on_since']
+    cooldown_until = state['cooldown_until']
+
+    def result(new_relay_on, status, reason, error_msg=None):
+        new_on_since = on_since
+        if new_relay_on and not relay_on:
+            new_on_since = now_ts # Start ON timer
+        elif not new_relay_on and relay_on:
+            new_on_since = None # Stop ON timer
+        return {'relay_on': new_relay_on, 'on_since': new_on_since, 'cooldown_until': cooldown_until,
+                'status': status, 'reason': reason, 'error_msg': error_msg}
+
+    # Invalid reading: turn OFF for safety
+    if temp_c is None:
+        return result(False, "Relay: OFF (Safe)", 'safe', "Sensor Error")
+
+    # Forced cooldown after exceeding the max ON time
+    if cooldown_until is not None:
+        if now_ts < cooldown_until:
+            return result(False, "Relay: OFF (Cool)", 'cooldown')
+        cooldown_until = None # Cooldown finished
+
+    # Scheduled OFF period
+    if is_in_off_period(now_time, off_start, off_end):
+        return result(False, "Relay: OFF (Sched)", 'sched')
+
+    # Max ON time limit
+    if relay_on and on_since is not None and now_ts - on_since > max_on_duration:
+        cooldown_until = now_ts + cooldown
+        return result(False, "Relay: OFF (Limit)", 'limit')
+
+    # Thresholds
+    try:
+        min_temp_float = float(min_temp) if min_temp is not None else None
+        max_temp_float = float(max_temp) if max_temp is not None else None
+    except (ValueError, TypeError):
+        return result(False, "Relay: OFF (Cfg Err)", 'cfg_err', "Settings Error")
+
+    temp_float = float(temp_c)
+    if relay_on:
+        # If ON, turn OFF once temp >= max (and max is set)
+        if max_temp_float is not None and temp_float >= max_temp_float:
+            return result(False, "Relay: OFF", 'reached_max')
+        return result(True, "Relay: ON (Heat)", 'heat')
+    # If OFF, turn ON when temp < min (and min is set)
+    if min_temp_float is not None and temp_float < min_temp_float:
+        return result(True, "Relay: ON (Heat)", 'heat')
+    return result(False, "Relay: OFF", 'idle')